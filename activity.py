@@ -0,0 +1,327 @@
+from datetime import datetime, time as dt_time
+import logging
+import os
+import re
+import threading
+import weakref
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+from jobs import JobContext, job_queue
+from models import UserActivity
+from partitions import (
+    ensure_partition,
+    list_partitions,
+    next_partition_start,
+    partition_name,
+    partition_start,
+)
+from tenancy import DEFAULT_TENANT, open_session, tenant_router
+
+# Months kept in Postgres, the current one included; older partitions are
+# moved to Parquet files
+ACTIVITY_HOT_MONTHS = max(1, int(os.getenv("ACTIVITY_HOT_MONTHS", "3")))
+ACTIVITY_PARTITIONS_AHEAD = int(os.getenv("ACTIVITY_PARTITIONS_AHEAD", "2"))
+ACTIVITY_ARCHIVE_DIR = os.getenv("ACTIVITY_ARCHIVE_DIR", "activity_archive")
+# Archived months kept, 0 keeps them all
+ACTIVITY_ARCHIVE_MONTHS = int(os.getenv("ACTIVITY_ARCHIVE_MONTHS", "0"))
+ACTIVITY_ARCHIVE_SECONDS = float(os.getenv("ACTIVITY_ARCHIVE_SECONDS", "3600"))
+# Rows per Parquet row group; also the fetch size while archiving. Files are
+# sorted by user, so a user filter skips most row groups of a month.
+ARCHIVE_ROW_GROUP = 65536
+
+TABLE = UserActivity.__tablename__
+COLUMNS = ("activity_id", "user_id", "action_type", "action_details", "timestamp")
+ARCHIVE_FILE_NAME = re.compile(rf"^{TABLE}_(\d{{6}})\.parquet$")
+
+
+def add_months(month, months: int):
+    ordinal = month.year * 12 + month.month - 1 + months
+    return month.replace(year=ordinal // 12, month=ordinal % 12 + 1, day=1)
+
+
+def _as_datetime(month) -> datetime:
+    return datetime.combine(month, dt_time())
+
+
+def ensure_activity_partitions(conn, now: datetime = None):
+    month = partition_start(now or datetime.utcnow(), "month")
+    for _ in range(ACTIVITY_PARTITIONS_AHEAD + 1):
+        ensure_partition(conn, TABLE, month, "month")
+        month = next_partition_start(month, "month")
+
+
+# Months known to have a committed partition, per engine (one per tenant).
+# The archive job creates partitions ahead of time; this covers a process
+# running past them, or a row for a month that has already been archived.
+_known_months = weakref.WeakKeyDictionary()
+_known_lock = threading.Lock()
+# Connection.info key of the months a transaction created a partition for
+_CREATED = "activity_partitions_created"
+
+
+@event.listens_for(UserActivity, "before_insert")
+def _ensure_activity_partition(mapper, connection, target):
+    if target.timestamp is None:
+        target.timestamp = datetime.utcnow()
+    month = partition_start(target.timestamp, "month")
+    with _known_lock:
+        known = _known_months.setdefault(connection.engine, set())
+        if month in known:
+            return
+    created = connection.info.setdefault(_CREATED, set())
+    if month in created:
+        return
+    name = partition_name(TABLE, month, "month")
+    exists = connection.execute(
+        text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}
+    ).scalar()
+    if exists:
+        with _known_lock:
+            known.add(month)
+    else:
+        ensure_partition(connection, TABLE, month, "month")
+        created.add(month)
+
+
+# A partition created by a transaction is only known once it commits
+@event.listens_for(Engine, "commit")
+def _partitions_committed(connection):
+    created = connection.info.pop(_CREATED, None)
+    if created:
+        with _known_lock:
+            _known_months.setdefault(connection.engine, set()).update(created)
+
+
+@event.listens_for(Engine, "rollback")
+def _partitions_rolled_back(connection):
+    connection.info.pop(_CREATED, None)
+
+
+def _forget_month(month):
+    with _known_lock:
+        for known in _known_months.values():
+            known.discard(month)
+
+
+def _activity_dict(activity):
+    return {column: getattr(activity, column) for column in COLUMNS}
+
+
+def _arrow_schema():
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("activity_id", pa.int64()),
+            ("user_id", pa.int64()),
+            ("action_type", pa.string()),
+            ("action_details", pa.string()),
+            ("timestamp", pa.timestamp("us")),
+        ]
+    )
+
+
+# Month files of user activity compacted out of Postgres, one directory per
+# tenant: <dir>/<tenant>/user_activity_YYYYMM.parquet (zstd compressed)
+class ActivityArchive:
+    def __init__(self, directory: str = ACTIVITY_ARCHIVE_DIR):
+        self.directory = directory
+        self.archived_partitions = 0
+        self.archived_rows = 0
+        self.files_read = 0
+        self.files_skipped = 0
+
+    def tenant_dir(self, tenant) -> str:
+        return os.path.join(self.directory, tenant or DEFAULT_TENANT)
+
+    def path(self, tenant, month) -> str:
+        return os.path.join(self.tenant_dir(tenant), f"{TABLE}_{month:%Y%m}.parquet")
+
+    def months(self, tenant):
+        months = {}
+        try:
+            names = os.listdir(self.tenant_dir(tenant))
+        except FileNotFoundError:
+            return months
+        for name in names:
+            match = ARCHIVE_FILE_NAME.match(name)
+            if match:
+                month = datetime.strptime(match.group(1), "%Y%m").date()
+                months[month] = os.path.join(self.tenant_dir(tenant), name)
+        return months
+
+    # Writes the partition to the month's file, then drops the partition in
+    # the caller's transaction. A month archived before (rows that arrived
+    # late) keeps its rows: they are copied into the new file first. Rows
+    # already in it are not written again: the file is swapped in before the
+    # drop commits, so a failed drop leaves the partition to be archived again.
+    def archive_partition(self, db, tenant, month, partition: str) -> int:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path = self.path(tenant, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        schema = _arrow_schema()
+        rows = 0
+        archived = set()
+        writer = pq.ParquetWriter(tmp_path, schema, compression="zstd")
+        try:
+            if os.path.exists(path):
+                previous = pq.ParquetFile(path)
+                for group in range(previous.num_row_groups):
+                    table = previous.read_row_group(group)
+                    archived.update(table.column("activity_id").to_pylist())
+                    writer.write_table(table)
+            result = db.execute(
+                text(
+                    f"SELECT {', '.join(COLUMNS)} FROM \"{partition}\" "
+                    "ORDER BY user_id, timestamp"
+                ).execution_options(stream_results=True)
+            )
+            for chunk in result.partitions(ARCHIVE_ROW_GROUP):
+                if archived:
+                    chunk = [row for row in chunk if row[0] not in archived]
+                    if not chunk:
+                        continue
+                columns = list(zip(*chunk))
+                arrays = [
+                    pa.array(values, type=field.type)
+                    for values, field in zip(columns, schema)
+                ]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                rows += len(chunk)
+        except Exception:
+            writer.close()
+            os.remove(tmp_path)
+            raise
+        writer.close()
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        db.execute(text(f'DROP TABLE "{partition}"'))
+        _forget_month(month)
+        self.archived_partitions += 1
+        self.archived_rows += rows
+        logging.info(f"Archived {rows} rows of {partition} to {path}")
+        return rows
+
+    def read_month(self, path, filters, limit: int):
+        import pyarrow.parquet as pq
+
+        # Row groups whose statistics rule out the filters are not read
+        table = pq.read_table(path, filters=filters or None)
+        self.files_read += 1
+        table = table.sort_by(
+            [("timestamp", "descending"), ("activity_id", "descending")]
+        ).slice(0, limit)
+        return table.to_pylist()
+
+    def prune(self, tenant, now: datetime = None) -> list:
+        if ACTIVITY_ARCHIVE_MONTHS <= 0:
+            return []
+        current = partition_start(now or datetime.utcnow(), "month")
+        cutoff = add_months(current, -(ACTIVITY_HOT_MONTHS + ACTIVITY_ARCHIVE_MONTHS))
+        removed = []
+        for month, path in sorted(self.months(tenant).items()):
+            if month < cutoff:
+                os.remove(path)
+                removed.append(os.path.basename(path))
+        return removed
+
+    def stats(self):
+        return {
+            "archived_partitions": self.archived_partitions,
+            "archived_rows": self.archived_rows,
+            "files_read": self.files_read,
+            "files_skipped": self.files_skipped,
+        }
+
+
+activity_archive = ActivityArchive()
+
+
+# Newest first across the hot partitions and the archive. Postgres prunes
+# partitions on the time range and uses the (user_id, timestamp) and
+# (action_type, timestamp) indexes; archive files are skipped by month and
+# once they can only hold rows older than the limit-th row found so far.
+def query_activity(
+    db,
+    tenant,
+    user_id: int = None,
+    action_type: str = None,
+    start: datetime = None,
+    end: datetime = None,
+    limit: int = 100,
+):
+    query = db.query(UserActivity)
+    filters = []
+    if user_id is not None:
+        query = query.filter(UserActivity.user_id == user_id)
+        filters.append(("user_id", "=", user_id))
+    if action_type is not None:
+        query = query.filter(UserActivity.action_type == action_type)
+        filters.append(("action_type", "=", action_type))
+    if start is not None:
+        query = query.filter(UserActivity.timestamp >= start)
+        filters.append(("timestamp", ">=", start))
+    if end is not None:
+        query = query.filter(UserActivity.timestamp < end)
+        filters.append(("timestamp", "<", end))
+    rows = [
+        _activity_dict(activity)
+        for activity in query.order_by(
+            UserActivity.timestamp.desc(), UserActivity.activity_id.desc()
+        ).limit(limit)
+    ]
+    for month, path in sorted(activity_archive.months(tenant).items(), reverse=True):
+        month_start = _as_datetime(month)
+        month_end = _as_datetime(next_partition_start(month, "month"))
+        outside = (end is not None and month_start >= end) or (
+            start is not None and month_end <= start
+        )
+        if outside or (len(rows) >= limit and month_end <= rows[-1]["timestamp"]):
+            activity_archive.files_skipped += 1
+            continue
+        archived = activity_archive.read_month(path, filters, limit)
+        # A row is in both places only if archiving was interrupted between
+        # writing the file and dropping the partition
+        seen = {row["activity_id"] for row in rows}
+        rows.extend(row for row in archived if row["activity_id"] not in seen)
+        rows.sort(key=lambda row: (row["timestamp"], row["activity_id"]), reverse=True)
+        del rows[limit:]
+    return rows
+
+
+@job_queue.register("activity_archive", heavy=True)
+def run_activity_archive(ctx: JobContext):
+    now = datetime.utcnow()
+    cutoff = add_months(partition_start(now, "month"), 1 - ACTIVITY_HOT_MONTHS)
+    archived = {}
+    with open_session(ctx.tenant) as db:
+        ensure_activity_partitions(db.connection(), now)
+        db.commit()
+        partitions = [
+            (month, name)
+            for month, name in sorted(
+                list_partitions(db.connection(), TABLE, "month").items()
+            )
+            if next_partition_start(month, "month") <= cutoff
+        ]
+        for i, (month, name) in enumerate(partitions):
+            ctx.progress(i / len(partitions), f"Archiving {name}")
+            archived[name] = activity_archive.archive_partition(
+                db, ctx.tenant, month, name
+            )
+            db.commit()
+    removed = activity_archive.prune(ctx.tenant, now)
+    return {"archived": archived, "removed_archives": removed}
+
+
+# Also runs once when the job workers start, which creates the partitions for
+# the coming months
+job_queue.schedule(
+    "activity_archive", ACTIVITY_ARCHIVE_SECONDS, tenant_router.active_tenants
+)
@@ -0,0 +1,274 @@
+import asyncio
+from collections import deque
+import json
+import math
+import os
+import time
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+# Per-route overrides as JSON, e.g.
+# {"POST /login": {"user_per_minute": 5}, "GET /reports": {"concurrency": 2}};
+# a route mapped to null is not limited
+ADMISSION_LIMITS = os.getenv("ADMISSION_LIMITS", "")
+# Buckets of users idle for longer than this are forgotten
+ADMISSION_IDLE_SECONDS = 600
+
+# Defaults for the endpoints that are far more expensive than plain CRUD. Rates
+# are tokens per minute, with bursts of up to *_burst requests. Limits are per
+# API process.
+DEFAULT_LIMITS = {
+    # Password hashing is deliberately slow; also slows down password guessing
+    "POST /login": {
+        "user_per_minute": 10,
+        "user_burst": 5,
+        "route_per_minute": 600,
+        "route_burst": 50,
+        "concurrency": 4,
+        "queue": 32,
+        "queue_timeout": 2.0,
+    },
+    # Loads and rewrites every vehicle and driver
+    "GET /simulated-updates": {
+        "user_per_minute": 30,
+        "user_burst": 5,
+        "route_per_minute": 300,
+        "route_burst": 20,
+        "concurrency": 2,
+        "queue": 8,
+        "queue_timeout": 5.0,
+    },
+    "POST /optimize-route": {
+        "user_per_minute": 60,
+        "user_burst": 10,
+        "route_per_minute": 600,
+        "route_burst": 50,
+        "concurrency": 4,
+        "queue": 16,
+        "queue_timeout": 3.0,
+    },
+    # Each accepted request queues a full database dump
+    "POST /backup": {
+        "user_per_minute": 2,
+        "user_burst": 2,
+        "route_per_minute": 10,
+        "route_burst": 5,
+        "concurrency": 1,
+        "queue": 4,
+        "queue_timeout": 2.0,
+    },
+}
+
+LIMIT_FIELDS = (
+    "user_per_minute",
+    "user_burst",
+    "route_per_minute",
+    "route_burst",
+    "concurrency",
+    "queue",
+    "queue_timeout",
+)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, per_minute: float, burst: float, now: float):
+        self.rate = per_minute / 60.0
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        # Returns 0 when a token was taken, else the seconds until one is free
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        if self.rate <= 0:
+            return math.inf
+        return (1 - self.tokens) / self.rate
+
+    def idle(self, now: float) -> bool:
+        return now - self.updated > ADMISSION_IDLE_SECONDS
+
+
+# Caps the requests of a route running at once. Requests over the cap wait in
+# FIFO order for up to queue_timeout seconds; when the queue is full or the
+# deadline passes they are shed.
+class ConcurrencyGate:
+    def __init__(self, limit: int, max_queue: int, queue_timeout: float):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiters = deque()
+
+    async def acquire(self) -> bool:
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            return True
+        if len(self.waiters) >= self.max_queue or self.queue_timeout <= 0:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            return False
+        except asyncio.CancelledError:
+            # Client went away while queued
+            self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter):
+        if waiter.done() and not waiter.cancelled():
+            # The slot was handed over just as the wait ended
+            self.release()
+        elif waiter in self.waiters:
+            self.waiters.remove(waiter)
+
+    def release(self):
+        # The slot passes straight to the next waiter, so in_flight only drops
+        # when nobody is waiting
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = max(1, math.ceil(min(retry_after, 3600)))
+
+
+class RouteLimiter:
+    def __init__(self, route: str, limits: dict):
+        self.route = route
+        self.limits = limits
+        now = time.monotonic()
+        self.route_bucket = TokenBucket(
+            limits["route_per_minute"], limits["route_burst"], now
+        )
+        self.user_buckets = {}
+        self.gate = ConcurrencyGate(
+            limits["concurrency"], limits["queue"], limits["queue_timeout"]
+        )
+        self._last_prune = now
+        self.admitted = 0
+        self.limited_user = 0
+        self.limited_route = 0
+        self.shed_queue_full = 0
+        self.shed_deadline = 0
+        self.queued = 0
+        self.max_wait = 0.0
+
+    def _user_bucket(self, user, now):
+        bucket = self.user_buckets.get(user)
+        if bucket is None:
+            if now - self._last_prune > ADMISSION_IDLE_SECONDS:
+                self._last_prune = now
+                for key in [k for k, b in self.user_buckets.items() if b.idle(now)]:
+                    del self.user_buckets[key]
+            bucket = self.user_buckets[user] = TokenBucket(
+                self.limits["user_per_minute"], self.limits["user_burst"], now
+            )
+        return bucket
+
+    async def enter(self, user):
+        now = time.monotonic()
+        wait = self._user_bucket(user, now).take(now)
+        if wait:
+            self.limited_user += 1
+            raise Rejected(429, "Too many requests, slow down", wait)
+        wait = self.route_bucket.take(now)
+        if wait:
+            self.limited_route += 1
+            raise Rejected(429, "Endpoint is busy, try again later", wait)
+        queued = self.gate.in_flight >= self.gate.limit or self.gate.waiters
+        if queued and len(self.gate.waiters) >= self.gate.max_queue:
+            self.shed_queue_full += 1
+            raise Rejected(503, "Server is busy, try again later", 1)
+        if queued:
+            self.queued += 1
+        if not await self.gate.acquire():
+            self.shed_deadline += 1
+            raise Rejected(
+                503, "Server is busy, try again later", self.gate.queue_timeout
+            )
+        self.max_wait = max(self.max_wait, time.monotonic() - now)
+        self.admitted += 1
+
+    def leave(self):
+        self.gate.release()
+
+    def stats(self):
+        return {
+            "limits": dict(self.limits),
+            "admitted": self.admitted,
+            "limited_user": self.limited_user,
+            "limited_route": self.limited_route,
+            "shed_queue_full": self.shed_queue_full,
+            "shed_deadline": self.shed_deadline,
+            "queued": self.queued,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "in_flight": self.gate.in_flight,
+            "waiting": len(self.gate.waiters),
+            "tracked_users": len(self.user_buckets),
+        }
+
+
+def load_limits(spec: str = ADMISSION_LIMITS):
+    limits = {route: dict(values) for route, values in DEFAULT_LIMITS.items()}
+    if not spec.strip():
+        return limits
+    try:
+        overrides = json.loads(spec)
+    except ValueError as e:
+        raise ValueError(f"ADMISSION_LIMITS is not valid JSON: {e}")
+    for route, values in overrides.items():
+        if values is None:
+            limits.pop(route, None)
+            continue
+        unknown = set(values) - set(LIMIT_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown admission limits for {route}: {unknown}")
+        base = limits.get(route) or DEFAULT_LIMITS["POST /optimize-route"]
+        limits[route] = {**base, **values}
+    return limits
+
+
+# Admission control for the expensive endpoints, applied before routing.
+# Runs on the event loop, so its state needs no locking.
+class AdmissionController:
+    def __init__(self, limits: dict = None, enabled: bool = ADMISSION_ENABLED):
+        self.enabled = enabled
+        self.routes = {
+            route: RouteLimiter(route, values)
+            for route, values in (limits or load_limits()).items()
+        }
+
+    def limiter(self, method: str, path: str):
+        if not self.enabled:
+            return None
+        return self.routes.get(f"{method} {path.rstrip('/') or '/'}")
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "routes": {route: r.stats() for route, r in self.routes.items()},
+        }
+
+
+admission = AdmissionController()
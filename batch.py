@@ -0,0 +1,404 @@
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+
+from pydantic import ValidationError
+from psycopg2.extras import execute_values
+from sqlalchemy import insert
+
+from fuel_monitor import is_fuel_cost, resolve_refuel_alerts
+from hos import status_change_event
+from models import (
+    Cost,
+    Driver,
+    DriverDocument,
+    DutyEvent,
+    MaintenanceRecord,
+    UserActivity,
+    Vehicle,
+    VehicleDocument,
+)
+from schemas import (
+    CostCreate,
+    DriverCreate,
+    MaintenanceRecordCreate,
+    VehicleCreate,
+)
+from search import driver_entry, vehicle_entry
+
+BATCH_MAX_OPERATIONS = 1000
+# Rows per multi-row INSERT or UPDATE statement
+BATCH_CHUNK = 500
+
+
+# dependents are the (model, column) pairs referencing the entity that the ORM
+# sets to NULL when one is deleted through a relationship; a batch delete
+# clears them the same way, set-wise
+class BatchEntity:
+    __slots__ = ("model", "schema", "pk", "unique", "refs", "dependents")
+
+    def __init__(self, model, schema, pk, unique=None, refs=None, dependents=()):
+        self.model = model
+        self.schema = schema
+        self.pk = pk
+        self.unique = unique
+        self.refs = refs or {}
+        self.dependents = dependents
+
+
+ENTITIES = {
+    "vehicle": BatchEntity(
+        Vehicle,
+        VehicleCreate,
+        "id",
+        "registration_number",
+        {"driver_id": "driver"},
+        (
+            (VehicleDocument, "vehicle_id"),
+            (Cost, "vehicle_id"),
+            (MaintenanceRecord, "vehicle_id"),
+        ),
+    ),
+    "driver": BatchEntity(
+        Driver,
+        DriverCreate,
+        "id",
+        "license_number",
+        dependents=(
+            (Vehicle, "driver_id"),
+            (DriverDocument, "driver_id"),
+            (Cost, "driver_id"),
+        ),
+    ),
+    "cost": BatchEntity(
+        Cost,
+        CostCreate,
+        "cost_id",
+        refs={"vehicle_id": "vehicle", "driver_id": "driver"},
+    ),
+    "maintenance_record": BatchEntity(
+        MaintenanceRecord,
+        MaintenanceRecordCreate,
+        "record_id",
+        refs={"vehicle_id": "vehicle"},
+    ),
+}
+OPS = ("create", "update", "delete")
+
+
+class BatchFailed(Exception):
+    def __init__(self, status_code: int, results: list):
+        super().__init__(f"Batch rejected ({status_code})")
+        self.status_code = status_code
+        self.results = results
+
+
+class _Op:
+    __slots__ = ("index", "op", "entity", "id", "data", "values", "error")
+
+    def __init__(self, index, operation):
+        self.index = index
+        self.op = operation.op
+        self.entity = operation.entity
+        self.id = operation.id
+        self.data = operation.data or {}
+        self.values = None
+        self.error = None
+
+    def result(self, status: str):
+        result = {
+            "index": self.index,
+            "op": self.op,
+            "entity": self.entity,
+            "id": self.id,
+            "status": status,
+        }
+        if self.error:
+            result["error"] = self.error
+        return result
+
+
+def _row_dict(row, schema):
+    return {field: row._mapping[field] for field in schema.model_fields}
+
+
+def _validate(ops, existing):
+    targets = Counter((op.entity, op.id) for op in ops if op.id is not None)
+    for op in ops:
+        if op.entity not in ENTITIES:
+            op.error = f"Unknown entity {op.entity!r}"
+        elif op.op not in OPS:
+            op.error = f"Unknown op {op.op!r}"
+        elif op.op == "create":
+            if op.id is not None:
+                op.error = "id is assigned by the server"
+        elif op.id is None:
+            op.error = "id is required"
+        elif op.id not in existing[op.entity]:
+            op.error = f"{op.entity} {op.id} not found"
+        elif targets[(op.entity, op.id)] > 1:
+            op.error = f"{op.entity} {op.id} appears more than once in the batch"
+        if op.error or op.op == "delete":
+            continue
+        schema = ENTITIES[op.entity].schema
+        if op.op == "update":
+            # Partial updates: unspecified fields keep their current value
+            values = {**_row_dict(existing[op.entity][op.id], schema), **op.data}
+        else:
+            values = op.data
+        try:
+            op.values = schema(**values).dict()
+        except ValidationError as e:
+            op.error = "; ".join(
+                f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()
+            )
+
+
+def _check_unique(ops, existing, db):
+    # One query per unique column for the whole batch. A value is taken when
+    # another operation in the batch sets it too, or a row that keeps its value
+    # (not deleted or given a new one in this batch) already has it.
+    for name, entity in ENTITIES.items():
+        if entity.unique is None:
+            continue
+        setting = [
+            op
+            for op in ops
+            if op.entity == name
+            and op.values
+            and not op.error
+            and (
+                op.op == "create"
+                or getattr(existing[name][op.id], entity.unique)
+                != op.values[entity.unique]
+            )
+        ]
+        if not setting:
+            continue
+        claimed = Counter(op.values[entity.unique] for op in setting)
+        column = getattr(entity.model, entity.unique)
+        pk = getattr(entity.model, entity.pk)
+        holders = dict(db.query(column, pk).filter(column.in_(list(claimed))).all())
+        released = {op.id for op in ops if op.entity == name and op.op == "delete"}
+        released.update(op.id for op in setting if op.op == "update")
+        for op in setting:
+            value = op.values[entity.unique]
+            holder = holders.get(value)
+            if claimed[value] > 1:
+                op.error = f"{entity.unique} {value} is used twice in the batch"
+            elif holder is not None and holder not in released:
+                op.error = f"{entity.unique} {value} already exists"
+
+
+def _check_references(ops, db):
+    # Referenced vehicles and drivers must exist and survive the batch
+    wanted = {"vehicle": set(), "driver": set()}
+    for op in ops:
+        if op.values and not op.error:
+            for field, target in ENTITIES[op.entity].refs.items():
+                if op.values.get(field) is not None:
+                    wanted[target].add(op.values[field])
+    for target, ids in wanted.items():
+        if not ids:
+            continue
+        model = ENTITIES[target].model
+        found = {row[0] for row in db.query(model.id).filter(model.id.in_(ids))}
+        found -= {op.id for op in ops if op.entity == target and op.op == "delete"}
+        for op in ops:
+            if not op.values or op.error:
+                continue
+            for field, ref_target in ENTITIES[op.entity].refs.items():
+                value = op.values.get(field)
+                if ref_target == target and value is not None and value not in found:
+                    op.error = f"{target} {value} not found"
+
+
+def _load_existing(ops, db):
+    existing = {name: {} for name in ENTITIES}
+    for name, entity in ENTITIES.items():
+        ids = {
+            op.id
+            for op in ops
+            if op.entity == name and op.op in ("update", "delete") and op.id is not None
+        }
+        if ids:
+            # Plain rows of the writable columns, not ORM objects
+            pk = getattr(entity.model, entity.pk)
+            columns = [getattr(entity.model, f) for f in entity.schema.model_fields]
+            for row in db.query(pk, *columns).filter(pk.in_(ids)):
+                existing[name][row[0]] = row
+    return existing
+
+
+# Duty events for drivers whose status update changes their duty status, as
+# the ORM listener in hos.py writes them for single updates; the driver's
+# last_duty_end and rest_hours move along unless the operation sets them
+def _duty_events(ops, existing):
+    now = datetime.utcnow()
+    events = []
+    for op in ops:
+        if op.entity != "driver" or op.op != "update":
+            continue
+        driver = SimpleNamespace(**op.values)
+        event = status_change_event(
+            op.id,
+            driver,
+            existing["driver"][op.id].status,
+            now,
+            keep_duty_end="last_duty_end" in op.data,
+        )
+        if event is None:
+            continue
+        events.append(event)
+        op.values = vars(driver)
+        op.data = {
+            **op.data,
+            "last_duty_end": driver.last_duty_end,
+            "rest_hours": driver.rest_hours,
+        }
+    return events
+
+
+def _insert(db, entity, ops):
+    model = entity.model
+    pk = getattr(model, entity.pk)
+    for start in range(0, len(ops), BATCH_CHUNK):
+        chunk = ops[start:start + BATCH_CHUNK]
+        rows = [dict(op.values) for op in chunk]
+        if model is Cost:
+            now = datetime.utcnow()
+            for row in rows:
+                row["created_at"] = now
+        # Postgres returns the rows of a multi-row VALUES insert in order
+        ids = db.execute(insert(model).values(rows).returning(pk)).scalars().all()
+        for op, new_id in zip(chunk, ids):
+            op.id = new_id
+
+
+class BatchOutcome:
+    def __init__(self, ops, fuel_costs):
+        self.results = [op.result(f"{op.op}d") for op in ops]
+        self.fuel_costs = fuel_costs
+        # Changes for the search index, as plain values
+        self.search_upserts = []
+        self.search_removals = []
+        for op in ops:
+            if op.entity == "vehicle" and op.values:
+                self.search_upserts.append(
+                    vehicle_entry(SimpleNamespace(id=op.id, **op.values))
+                )
+            elif op.entity == "driver" and op.values:
+                self.search_upserts.append(
+                    driver_entry(SimpleNamespace(id=op.id, **op.values))
+                )
+            elif op.entity in ("vehicle", "driver") and op.op == "delete":
+                self.search_removals.append((op.entity, op.id))
+
+
+def _update(db, entity, ops):
+    # UPDATE ... FROM (VALUES ...) through psycopg2's execute_values: one
+    # statement per page of rows, where an executemany sends one per row and
+    # a Core values() construct spends longer compiling than executing
+    table = entity.model.__table__
+    # Only the columns some operation sets; the rest already hold their values
+    # and leaving them out of SET keeps column triggers from firing
+    given = set().union(*(op.data for op in ops))
+    fields = [field for field in entity.schema.model_fields if field in given]
+    if not fields:
+        return
+    dialect = db.get_bind().dialect
+    assignments = ", ".join(
+        # A column of NULLs in VALUES is typed text
+        f"{field} = v.{field}::{table.c[field].type.compile(dialect=dialect)}"
+        for field in fields
+    )
+    sql = (
+        f"UPDATE {table.name} AS t SET {assignments} "
+        f"FROM (VALUES %s) AS v(_id, {', '.join(fields)}) "
+        f"WHERE t.{entity.pk} = v._id"
+    )
+    rows = [(op.id, *[op.values[field] for field in fields]) for op in ops]
+    cursor = db.connection().connection.cursor()
+    try:
+        execute_values(cursor, sql, rows, page_size=BATCH_CHUNK)
+    finally:
+        cursor.close()
+
+
+def apply_batch(db, operations, user_id: int):
+    ops = [_Op(i, operation) for i, operation in enumerate(operations)]
+    existing = _load_existing(ops, db)
+    _validate(ops, existing)
+    _check_unique(ops, existing, db)
+    _check_references(ops, db)
+    if any(op.error for op in ops):
+        db.rollback()
+        raise BatchFailed(
+            422, [op.result("error" if op.error else "skipped") for op in ops]
+        )
+
+    duty_events = _duty_events(ops, existing)
+    for name, entity in ENTITIES.items():
+        creates = [op for op in ops if op.entity == name and op.op == "create"]
+        if creates:
+            _insert(db, entity, creates)
+        updates = [op for op in ops if op.entity == name and op.op == "update"]
+        if updates:
+            _update(db, entity, updates)
+    if duty_events:
+        db.execute(insert(DutyEvent), duty_events)
+    # Deletes after inserts and updates, dependents before what they reference
+    for name in ("maintenance_record", "cost", "vehicle", "driver"):
+        entity = ENTITIES[name]
+        ids = [op.id for op in ops if op.entity == name and op.op == "delete"]
+        if ids:
+            for model, column in entity.dependents:
+                db.query(model).filter(getattr(model, column).in_(ids)).update(
+                    {column: None}, synchronize_session=False
+                )
+            pk = getattr(entity.model, entity.pk)
+            db.query(entity.model).filter(pk.in_(ids)).delete(
+                synchronize_session=False
+            )
+
+    completed = {}
+    fuel_costs = []
+    for op in ops:
+        if not op.values:
+            continue
+        if op.entity == "maintenance_record" and op.values.get("status") == "Completed":
+            vehicle_id = op.values["vehicle_id"]
+            completed[vehicle_id] = max(
+                completed.get(vehicle_id, op.values["date"]), op.values["date"]
+            )
+        elif (
+            op.entity == "cost"
+            and op.op == "create"
+            and is_fuel_cost(op.values["category"])
+            and op.values.get("vehicle_id") is not None
+        ):
+            fuel_costs.append((op.values["vehicle_id"], op.values["date"]))
+    if completed:
+        db.bulk_update_mappings(
+            Vehicle,
+            [
+                {"id": vehicle_id, "last_maintenance": day, "maintenance_score": 100}
+                for vehicle_id, day in completed.items()
+            ],
+        )
+    for vehicle_id, day in fuel_costs:
+        resolve_refuel_alerts(db, vehicle_id, day)
+
+    counts = Counter(f"{op.op} {op.entity}" for op in ops)
+    db.add(
+        UserActivity(
+            user_id=user_id,
+            action_type="batch",
+            action_details=", ".join(
+                f"{n} x {key}" for key, n in sorted(counts.items())
+            ),
+        )
+    )
+    # Committed by the caller; flushing here raises constraint violations now
+    db.flush()
+    return BatchOutcome(ops, fuel_costs)
@@ -0,0 +1,99 @@
+# Individual PUT /vehicles/{id} calls against one POST /batch.
+#
+# Creates --count throwaway vehicles through /batch, updates each of them once
+# per mode and deletes them again. Needs a migrated database with the seeded
+# admin user (POST /seed-data):
+#
+#     python benchmarks/bench_batch.py --count 1000
+import argparse
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+
+
+def vehicle(tag, i):
+    return {
+        "registration_number": f"BENCH-{tag}-{i}",
+        "vehicle_type": "Van",
+        "capacity": 1000.0,
+        "status": "Active",
+    }
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin123")
+    args = parser.parse_args()
+
+    tag = uuid.uuid4().hex[:8]
+    with TestClient(main.app) as client:
+        token = client.post(
+            "/login", data={"username": args.username, "password": args.password}
+        ).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        created = client.post(
+            "/batch",
+            headers=headers,
+            json={
+                "operations": [
+                    {"op": "create", "entity": "vehicle", "data": vehicle(tag, i)}
+                    for i in range(args.count)
+                ]
+            },
+        ).json()["results"]
+        ids = [result["id"] for result in created]
+        try:
+            start = time.perf_counter()
+            for i, vehicle_id in enumerate(ids):
+                body = {**vehicle(tag, i), "capacity": 2000.0}
+                response = client.put(
+                    f"/vehicles/{vehicle_id}", headers=headers, json=body
+                )
+                response.raise_for_status()
+            single = time.perf_counter() - start
+
+            start = time.perf_counter()
+            response = client.post(
+                "/batch",
+                headers=headers,
+                json={
+                    "operations": [
+                        {
+                            "op": "update",
+                            "entity": "vehicle",
+                            "id": vehicle_id,
+                            "data": {"capacity": 3000.0},
+                        }
+                        for vehicle_id in ids
+                    ]
+                },
+            )
+            response.raise_for_status()
+            batched = time.perf_counter() - start
+        finally:
+            client.post(
+                "/batch",
+                headers=headers,
+                json={
+                    "operations": [
+                        {"op": "delete", "entity": "vehicle", "id": vehicle_id}
+                        for vehicle_id in ids
+                    ]
+                },
+            )
+    print(f"{args.count} individual PUTs  {single * 1000:9.1f}ms")
+    print(f"one /batch request    {batched * 1000:9.1f}ms")
+    print(f"speedup               {single / batched:9.1f}x")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,181 @@
+# Time to serving of a new worker's fleet state: a cold load from Postgres
+# against mapping the last snapshot and replaying the rows changed since it was
+# written. Without --db the rows are synthetic and only the in-process part is
+# timed (building the columns from rows, mapping, applying the changes). With
+# --db the fleet in DB_URI is padded with bench vehicles up to --vehicles,
+# --changes of them are updated after the snapshot, and the bench rows are
+# deleted again at the end.
+#
+#     python benchmarks/bench_fleet_snapshot.py --vehicles 100000 --changes 2000
+#     DB_URI=postgresql://... python benchmarks/bench_fleet_snapshot.py --db
+import argparse
+from datetime import date, timedelta
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fleet_state import FLEET_TABLES, FleetState, FleetTable  # noqa: E402
+
+BENCH_PREFIX = "BENCH-SNAP-"
+STATUSES = ["Active", "Idle", "In Maintenance", "Out of Service"]
+TYPES = ["Truck", "Van", "Pickup"]
+
+
+def synthetic_vehicles(n, rng, start_id=1, version=1):
+    lat = rng.uniform(-4.5, 4.5, n).tolist()
+    lon = rng.uniform(33.5, 41.5, n).tolist()
+    status = rng.integers(0, len(STATUSES), n).tolist()
+    kind = rng.integers(0, len(TYPES), n).tolist()
+    serviced = rng.integers(0, 365, n).tolist()
+    return [
+        (
+            start_id + i,
+            lat[i],
+            lon[i],
+            float(i % 90),
+            float(i % 100),
+            float(i % 100),
+            3000.0,
+            None if i % 3 else i % 500 + 1,
+            STATUSES[status[i]],
+            TYPES[kind[i]],
+            "Diesel",
+            date(2026, 1, 1) + timedelta(days=serviced[i]),
+            version,
+        )
+        for i in range(n)
+    ]
+
+
+def synthetic_drivers(n):
+    return [
+        (i + 1, "Available", 8.0, 4.5, i, date(2027, 1, 1), None, 1)
+        for i in range(n)
+    ]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def in_process(args, path):
+    rng = np.random.default_rng(47)
+    vehicles = synthetic_vehicles(args.vehicles, rng)
+    drivers = synthetic_drivers(args.vehicles // 20)
+
+    def cold():
+        tables = {}
+        for spec, rows in zip(FLEET_TABLES, (vehicles, drivers)):
+            tables[spec.name] = FleetTable.empty(spec)
+            tables[spec.name].upsert(rows)
+        return FleetState(tables, 1, "database")
+
+    state, cold_time = timed(cold)
+    size, write_time = timed(state.write, path)
+    changed = synthetic_vehicles(args.changes, rng, version=2)
+    changed += synthetic_vehicles(args.changes // 10, rng, args.vehicles + 1, 2)
+
+    def warm():
+        mapped = FleetState.open(path)
+        mapped.vehicles.upsert(changed)
+        return mapped
+
+    mapped, warm_time = timed(warm)
+    assert mapped.vehicles.rows == args.vehicles + args.changes // 10
+    print(f"{args.vehicles} vehicles, snapshot {size / 1e6:.1f} MB in {write_time:.2f}s")
+    print(f"cold (columns from rows)      {cold_time:6.3f}s")
+    print(f"map + {len(changed):6d} changed rows    {warm_time:6.3f}s")
+
+
+def with_database(args, path):
+    from psycopg2.extras import execute_values
+    from sqlalchemy import text
+
+    from tenancy import open_session
+
+    with open_session(None) as db:
+        existing = db.execute(text("SELECT count(*) FROM vehicles")).scalar()
+        pad = max(args.vehicles - existing, 0)
+        rng = np.random.default_rng(47)
+        rows = [
+            (f"{BENCH_PREFIX}{i}", row[9], row[6], row[10], row[8], *row[1:6])
+            for i, row in enumerate(synthetic_vehicles(pad, rng))
+        ]
+        cursor = db.connection().connection.cursor()
+        execute_values(
+            cursor,
+            "INSERT INTO vehicles (registration_number, vehicle_type, capacity, "
+            "fuel_type, status, latitude, longitude, speed, fuel_level, "
+            "maintenance_score) VALUES %s",
+            rows,
+            page_size=5000,
+        )
+        db.commit()
+        try:
+            state, cold_time = timed(FleetState.load, db)
+            db.commit()
+            size, write_time = timed(state.write, path)
+            db.execute(
+                text(
+                    "UPDATE vehicles SET speed = speed + 1 WHERE id IN (SELECT id "
+                    "FROM vehicles WHERE registration_number LIKE :p LIMIT :n)"
+                ),
+                {"p": BENCH_PREFIX + "%", "n": args.changes},
+            )
+            db.commit()
+
+            def warm():
+                mapped = FleetState.open(path)
+                mapped.replay(db)
+                return mapped
+
+            mapped, warm_time = timed(warm)
+            db.commit()
+            assert mapped.vehicles.rows == state.vehicles.rows
+            print(
+                f"{state.vehicles.rows} vehicles, {state.drivers.rows} drivers, "
+                f"snapshot {size / 1e6:.1f} MB in {write_time:.2f}s"
+            )
+            print(f"cold load from Postgres       {cold_time:6.3f}s")
+            print(f"map + replay {mapped.replayed_rows:6d} rows      {warm_time:6.3f}s")
+        finally:
+            db.rollback()
+            ids = db.execute(
+                text("SELECT id FROM vehicles WHERE registration_number LIKE :p"),
+                {"p": BENCH_PREFIX + "%"},
+            ).scalars().all()
+            db.execute(text("DELETE FROM vehicles WHERE id = ANY(:ids)"), {"ids": ids})
+            # The delete trigger left a tombstone for every bench vehicle
+            db.execute(
+                text(
+                    "DELETE FROM tombstones "
+                    "WHERE table_name = 'vehicles' AND row_id = ANY(:ids)"
+                ),
+                {"ids": ids},
+            )
+            db.commit()
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vehicles", type=int, default=100000)
+    parser.add_argument("--changes", type=int, default=2000)
+    parser.add_argument("--db", action="store_true", help="use the fleet in DB_URI")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "fleet.snap")
+        if args.db:
+            with_database(args, path)
+        else:
+            in_process(args, path)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,101 @@
+# Fleet cost model fitting, in the job's thread and across worker processes,
+# and the latency of forecasts answered from the fitted models.
+#
+# Uses synthetic monthly cost series (no database needed):
+#
+#     python benchmarks/bench_forecast.py --vehicles 1000 --workers 4
+import argparse
+from datetime import date, datetime
+import json
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import forecasting  # noqa: E402
+from forecasting import ForecastModels, fit_all, month_ordinal  # noqa: E402
+
+CATEGORIES = ["Fuel", "Repair", "Insurance", "Toll"]
+
+
+def synthetic_series(vehicles, categories, months, rng):
+    season = np.sin(np.arange(months) / 12 * 2 * np.pi)
+    series = []
+    for vehicle_id in range(1, vehicles + 1):
+        for category in CATEGORIES[:categories]:
+            base = rng.uniform(50, 500)
+            values = base + base * 0.2 * season + rng.normal(0, base * 0.1, months)
+            # Younger vehicles have shorter histories
+            start = rng.integers(0, months - 3)
+            series.append(((vehicle_id, category), np.maximum(values[start:], 0)))
+    return series
+
+
+def timed_fit(series, workers):
+    forecasting.FORECAST_WORKERS = workers
+    start = time.perf_counter()
+    fitted = fit_all(series)
+    return fitted, time.perf_counter() - start
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vehicles", type=int, default=1000)
+    parser.add_argument("--categories", type=int, default=3)
+    parser.add_argument("--months", type=int, default=36)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    series = synthetic_series(args.vehicles, args.categories, args.months, rng)
+    print(f"{len(series)} series, up to {args.months} months each")
+
+    fitted, serial = timed_fit(series, 1)
+    print(f"fit in the job thread      {serial:8.1f}s")
+    if args.workers > 1:
+        _, parallel = timed_fit(series, args.workers)
+        print(f"fit with {args.workers} processes       {parallel:8.1f}s")
+        print(f"speedup                    {serial / parallel:8.1f}x")
+
+    last_period = date.today().replace(day=1)
+    rows = [
+        SimpleNamespace(
+            vehicle_id=vehicle_id,
+            category=category,
+            method=method,
+            params=json.dumps(params),
+            last_period=last_period,
+            fitted_at=datetime.utcnow(),
+        )
+        for (vehicle_id, category), method, params in fitted
+    ]
+    start = time.perf_counter()
+    models = ForecastModels(rows)
+    print(f"load models into the cache {(time.perf_counter() - start) * 1000:8.1f}ms")
+
+    first_period = month_ordinal(date.today()) + 1
+    for label, vehicle_ids in (
+        ("one vehicle, 12 months", rng.integers(1, args.vehicles + 1, args.queries)),
+        ("whole fleet, 12 months", [None] * args.queries),
+    ):
+        latencies = []
+        for vehicle_id in vehicle_ids:
+            vehicle_id = None if vehicle_id is None else int(vehicle_id)
+            start = time.perf_counter()
+            models.forecast(first_period, 12, vehicle_id)
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+        print(
+            f"{label:26} p50 {statistics.median(latencies):7.3f}ms  "
+            f"p99 {latencies[int(len(latencies) * 0.99) - 1]:7.3f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main_()
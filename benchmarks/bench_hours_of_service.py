@@ -0,0 +1,117 @@
+# Hours-of-service engine on a synthetic week of duty events, without a
+# database: the cost per event, listing the non-compliant drivers (first call,
+# which evaluates every clock, then calls that only evaluate the clocks due),
+# and the same listing recomputed from each driver's log as a baseline.
+#
+#     python benchmarks/bench_hours_of_service.py --drivers 10000 --days 8
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hos import DRIVING, OFF_DUTY, ON_DUTY, DriverClock, HosEngine  # noqa: E402
+
+
+# Each day: a rest of 11 to 13 hours (two days off every five or six), then
+# blocks of driving with breaks and some loading in between; a few drivers
+# drive too long and rest too little
+def synthetic_log(drivers, days, end, rng):
+    events = []
+    for driver_id in range(1, drivers + 1):
+        t = end - days * 86400 + rng.uniform(0, 86400)
+        reckless = rng.random() < 0.05
+        day = int(rng.integers(0, 5))
+        while t < end:
+            events.append((t, driver_id, OFF_DUTY))
+            day += 1
+            if day % 6 == 0:
+                t += rng.uniform(45, 50) * 3600
+            else:
+                t += rng.uniform(9 if reckless else 11, 13) * 3600
+            for _ in range(3 if reckless else 2):
+                if t >= end:
+                    break
+                events.append((t, driver_id, DRIVING))
+                t += rng.uniform(2.0, 5.0 if reckless else 4.0) * 3600
+                events.append((t, driver_id, ON_DUTY))
+                t += rng.uniform(0.75, 1.0) * 3600
+    events.sort()
+    return [(t, d, s, event_id) for event_id, (t, d, s) in enumerate(events, 1)]
+
+
+def recompute(log_by_driver, now):
+    flagged = 0
+    for events in log_by_driver.values():
+        t, status, event_id = events[0]
+        clock = DriverClock(status, t, (t, event_id))
+        for t, status, event_id in events[1:]:
+            clock.apply(status, t, (t, event_id))
+        state = clock.evaluate(now)
+        flagged += bool(state["violations"] or state["predicted"])
+    return flagged
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--drivers", type=int, default=10000)
+    parser.add_argument("--days", type=int, default=8)
+    args = parser.parse_args()
+    rng = np.random.default_rng(49)
+    now = time.time()
+    events = synthetic_log(args.drivers, args.days, now, rng)
+    history = [e for e in events if e[0] < now - 3600]
+    recent = [e for e in events if e[0] >= now - 3600]
+
+    engine = HosEngine()
+    start = time.perf_counter()
+    for t, driver_id, status, event_id in history:
+        engine.apply(driver_id, status, t, event_id)
+    per_event = (time.perf_counter() - start) / len(history)
+    print(
+        f"{args.drivers} drivers, {len(events)} events over {args.days} days; "
+        f"{per_event * 1e6:.1f} us per event"
+    )
+
+    start = time.perf_counter()
+    first = engine.non_compliant(now - 3600)
+    first_time = time.perf_counter() - start
+    start = time.perf_counter()
+    again = engine.non_compliant(now - 3590)
+    again_time = time.perf_counter() - start
+    for t, driver_id, status, event_id in recent:
+        engine.apply(driver_id, status, t, event_id)
+    evaluated = engine.evaluated
+    start = time.perf_counter()
+    latest = engine.non_compliant(now)
+    latest_time = time.perf_counter() - start
+    print(
+        f"list, every clock evaluated  {first_time * 1000:7.1f} ms"
+        f"  {len(first)} drivers"
+    )
+    print(
+        f"list again 10 s later        {again_time * 1000:7.1f} ms"
+        f"  {len(again)} drivers"
+    )
+    print(
+        f"list after {len(recent):5d} new events  {latest_time * 1000:7.1f} ms"
+        f"  {len(latest)} drivers, {engine.evaluated - evaluated} clocks evaluated"
+    )
+
+    log_by_driver = {}
+    for t, driver_id, status, event_id in events:
+        log_by_driver.setdefault(driver_id, []).append((t, status, event_id))
+    start = time.perf_counter()
+    flagged = recompute(log_by_driver, now)
+    print(
+        f"recomputed from the log      {(time.perf_counter() - start) * 1000:7.1f} ms"
+        f"  {flagged} drivers"
+    )
+    assert flagged == len(latest)
+
+
+if __name__ == "__main__":
+    main_()
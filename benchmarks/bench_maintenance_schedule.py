@@ -0,0 +1,93 @@
+# Full planning and single-vehicle rescheduling of the maintenance scheduler on
+# a synthetic fleet, without a database: greedy placement alone, then with the
+# local search, and the cost of re-planning one vehicle whose due date moved.
+#
+#     python benchmarks/bench_maintenance_schedule.py --vehicles 10000 \
+#         --workshops 40 --capacity 4 --days 90
+import argparse
+from datetime import date
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from maintenance_schedule import SchedulingProblem, travel_hours  # noqa: E402
+
+
+def synthetic_problem(args, rng):
+    n = args.vehicles
+    # A quarter of the fleet overdue, the rest due over the horizon and beyond
+    due = rng.integers(-60, args.days, n)
+    score = rng.uniform(0, 100, n)
+    urgency = 1 + np.maximum(50 - score, 0) / 10
+    blocked = np.zeros((n, args.days), dtype=bool)
+    for v in rng.choice(n, n // 10, replace=False):
+        start = rng.integers(0, args.days)
+        blocked[v, start:start + rng.integers(1, 15)] = True
+    travel = travel_hours(
+        rng.uniform(-4.5, 4.5, n),
+        rng.uniform(33.5, 41.5, n),
+        rng.uniform(-4.5, 4.5, args.workshops),
+        rng.uniform(33.5, 41.5, args.workshops),
+    )
+    return SchedulingProblem(
+        date.today(),
+        args.days,
+        np.arange(1, n + 1),
+        due,
+        urgency,
+        blocked,
+        np.arange(1, args.workshops + 1),
+        np.full(args.workshops, args.capacity),
+        travel,
+    )
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vehicles", type=int, default=10000)
+    parser.add_argument("--workshops", type=int, default=40)
+    parser.add_argument("--capacity", type=int, default=4, help="vehicles per day")
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--search-seconds", type=float, default=2.0)
+    parser.add_argument("--reschedules", type=int, default=200)
+    args = parser.parse_args()
+    rng = np.random.default_rng(5)
+
+    start = time.perf_counter()
+    greedy = synthetic_problem(args, rng)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    greedy.greedy()
+    greedy_time = time.perf_counter() - start
+    print(
+        f"{args.vehicles} vehicles, {args.workshops} workshops x {args.capacity}"
+        f"/day, {args.days} days; problem built in {build:.2f}s"
+    )
+    print(f"greedy          {greedy_time:6.2f}s  {greedy.summary()}")
+
+    searched = synthetic_problem(args, np.random.default_rng(5))
+    result = searched.solve(args.search_seconds)
+    print(f"greedy+search   {result['seconds']:6.2f}s  {searched.summary()}")
+    print(f"search moves    {result['search_moves']}")
+
+    # One vehicle's due date moves; it is taken out and placed again with a
+    # swap or ejection if that is cheaper
+    vehicles = rng.choice(args.vehicles, args.reschedules, replace=False)
+    start = time.perf_counter()
+    for v in vehicles:
+        searched.unassign(v)
+        searched.time_cost[v] = np.roll(searched.time_cost[v], -7)
+        free = searched.best_free(v)
+        if free is not None:
+            searched.assign(v, free[0], free[1])
+        searched.improve_vehicle(v)
+    per_vehicle = (time.perf_counter() - start) / args.reschedules
+    print(f"reschedule one  {per_vehicle * 1000:6.2f}ms per vehicle (in memory)")
+
+
+if __name__ == "__main__":
+    main_()
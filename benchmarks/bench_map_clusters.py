@@ -0,0 +1,79 @@
+# Map clustering on synthetic fleets of growing size, without a database: the
+# response size for a city-sized viewport at a few zoom levels (against one
+# marker per vehicle), the time to bin the tiles on a cache miss and to serve
+# them from the cache, and the cost of invalidating the tiles of a batch of
+# moved vehicles.
+#
+#     python benchmarks/bench_map_clusters.py --fleets 10000 100000 1000000 \
+#         --moves 2000
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_fleet_snapshot import synthetic_vehicles  # noqa: E402
+from fleet_state import FLEET_TABLES, FleetState, FleetTable  # noqa: E402
+from map_clusters import TileCache  # noqa: E402
+
+VIEWPORT = (-1.45, 36.65, -1.15, 37.05)  # Nairobi
+MARKER_BYTES = 60  # one vehicle as id, position and status in JSON
+
+
+def fleet(n, rng):
+    tables = {spec.name: FleetTable.empty(spec) for spec in FLEET_TABLES}
+    tables["vehicles"].upsert(synthetic_vehicles(n, rng))
+    return FleetState(tables, 1, "database")
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fleets", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--zooms", type=int, nargs="+", default=[8, 10, 12])
+    parser.add_argument("--moves", type=int, default=2000)
+    args = parser.parse_args()
+    rng = np.random.default_rng(48)
+
+    print(
+        "vehicles  zoom  in view  clusters  payload KB  markers KB"
+        "  miss ms  hit ms  invalidate ms"
+    )
+    for n in args.fleets:
+        state = fleet(n, rng)
+        cache = TileCache(state)
+        vehicles = state.vehicles
+        for zoom in args.zooms:
+            start = time.perf_counter()
+            clusters = cache.clusters(*VIEWPORT, zoom)
+            miss = time.perf_counter() - start
+            start = time.perf_counter()
+            cache.clusters(*VIEWPORT, zoom)
+            hit = time.perf_counter() - start
+            in_view = sum(cluster["count"] for cluster in clusters)
+            payload = len(json.dumps(clusters))
+
+            # A replay moving random vehicles by up to a kilometre
+            moved = rng.choice(vehicles.column("id"), args.moves, replace=False)
+            columns = ("latitude", "longitude")
+            before = vehicles.take(moved.tolist(), columns)
+            rows = [vehicles.index[i] for i in moved.tolist()]
+            for column in columns:
+                vehicles.columns[column][rows] += rng.uniform(-0.01, 0.01, len(rows))
+            start = time.perf_counter()
+            cache._moved(before, vehicles.take(moved.tolist(), columns))
+            invalidate = time.perf_counter() - start
+            print(
+                f"{n:8d}  {zoom:4d}  {in_view:7d}  {len(clusters):8d}"
+                f"  {payload / 1024:10.1f}  {in_view * MARKER_BYTES / 1024:10.1f}"
+                f"  {miss * 1000:7.1f}  {hit * 1000:6.2f}  {invalidate * 1000:13.1f}"
+            )
+        print(f"          cache {cache.stats()}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,432 @@
+# Database round trips per request of every write endpoint. Runs the app in
+# process (without starting the job workers) against DB_URI, on a vehicle,
+# driver and fuel alert it creates and removes again; queued jobs are cancelled
+# and deleted. Needs a migrated database with the seeded admin user.
+#
+#     python benchmarks/bench_request_round_trips.py --save before.json
+#     python benchmarks/bench_request_round_trips.py --compare before.json
+#
+# --sql prints the statements of each request. tests/test_round_trips.py keeps
+# every endpoint within its budget.
+import argparse
+from datetime import date, datetime, timedelta
+import json
+import os
+import sys
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+from database import SessionLocal  # noqa: E402
+from models import (  # noqa: E402
+    Cost,
+    Driver,
+    DriverDocument,
+    FuelAlert,
+    Job,
+    MaintenanceRecord,
+    MaintenanceSlot,
+    User,
+    UserActivity,
+    Vehicle,
+    VehicleDocument,
+    VehicleUnavailability,
+    Workshop,
+)
+
+
+# Round trips on every engine (primary, tenant pools and replicas): each
+# statement, plus the BEGIN psycopg2 sends before the first statement of a
+# transaction and the COMMIT or ROLLBACK that ends it
+class RoundTrips:
+    def __init__(self):
+        self.statements = []
+        self.transactions = 0
+        event.listen(Engine, "before_cursor_execute", self._statement)
+        event.listen(Engine, "begin", self._begin)
+        event.listen(Engine, "commit", self._end)
+        event.listen(Engine, "rollback", self._end)
+
+    def _statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(" ".join(statement.split()))
+
+    def _begin(self, conn):
+        self.transactions += 1
+
+    def _end(self, conn):
+        self.transactions += 1
+
+    def reset(self):
+        self.statements = []
+        self.transactions = 0
+
+    def close(self):
+        event.remove(Engine, "before_cursor_execute", self._statement)
+        event.remove(Engine, "begin", self._begin)
+        event.remove(Engine, "commit", self._end)
+        event.remove(Engine, "rollback", self._end)
+
+    @property
+    def total(self):
+        return len(self.statements) + self.transactions
+
+
+def scenario(tag, vehicle_id, driver_id, alert_id):
+    today = date.today()
+    user = {
+        "username": f"bench-{tag}",
+        "email": f"bench-{tag}@example.com",
+        "password": "secret",
+        "role": "viewer",
+    }
+    vehicle = {"registration_number": f"RT-{tag}", "vehicle_type": "Van"}
+    driver = {"name": f"Driver {tag}", "license_number": f"RT-{tag}"}
+    # Also sent through /batch: POST /costs takes the cost as a JSON body next to
+    # a file upload, which no request can satisfy
+    cost = {
+        "date": today.isoformat(),
+        "category": "Fuel",
+        "amount": 50.0,
+        "vehicle_id": vehicle_id,
+    }
+    document = {"file": ("scan.pdf", b"%PDF-1.4", "application/pdf")}
+    orders = [
+        {"order_id": i, "latitude": -1.29 + i / 100, "longitude": 36.82}
+        for i in range(5)
+    ]
+    # (name, method, path or a function of the earlier responses, keywords)
+    return [
+        ("register", "post", "/register", {"json": user}),
+        (
+            "create user",
+            "post",
+            "/admin/users",
+            {"json": {**user, "username": f"bench2-{tag}", "email": f"2{tag}@x.io"}},
+        ),
+        (
+            "update user",
+            "put",
+            lambda r: f"/admin/users/{r['create user']['id']}",
+            {"json": {**user, "username": f"bench2-{tag}", "email": f"2{tag}@x.io"}},
+        ),
+        (
+            "delete user",
+            "delete",
+            lambda r: f"/admin/users/{r['create user']['id']}",
+            {},
+        ),
+        ("create vehicle", "post", "/vehicles", {"json": vehicle}),
+        (
+            "update vehicle",
+            "put",
+            lambda r: f"/vehicles/{r['create vehicle']['id']}",
+            {"json": {**vehicle, "capacity": 900.0}},
+        ),
+        (
+            "delete vehicle",
+            "delete",
+            lambda r: f"/vehicles/{r['create vehicle']['id']}",
+            {},
+        ),
+        ("create driver", "post", "/drivers", {"json": driver}),
+        (
+            "update driver",
+            "put",
+            lambda r: f"/drivers/{r['create driver']['id']}",
+            {"json": {**driver, "phone": "0700000000"}},
+        ),
+        (
+            "delete driver",
+            "delete",
+            lambda r: f"/drivers/{r['create driver']['id']}",
+            {},
+        ),
+        (
+            "driver document",
+            "post",
+            f"/driver-documents?driver_id={driver_id}&doc_type=licence",
+            {"files": document},
+        ),
+        (
+            "vehicle document",
+            "post",
+            f"/vehicle-documents?vehicle_id={vehicle_id}&doc_type=insurance",
+            {"files": document},
+        ),
+        (
+            "maintenance record",
+            "post",
+            "/maintenance-records",
+            {
+                "json": {
+                    "vehicle_id": vehicle_id,
+                    "maintenance_type": "Service",
+                    "date": today.isoformat(),
+                    "status": "Completed",
+                    "next_maintenance_date": (today + timedelta(30)).isoformat(),
+                }
+            },
+        ),
+        (
+            "workshop",
+            "post",
+            "/workshops",
+            {"json": {"name": f"Workshop {tag}", "daily_capacity": 2}},
+        ),
+        (
+            "unavailability",
+            "post",
+            f"/vehicles/{vehicle_id}/unavailability",
+            {
+                "json": {
+                    "start_date": (today + timedelta(3)).isoformat(),
+                    "end_date": (today + timedelta(5)).isoformat(),
+                }
+            },
+        ),
+        (
+            "batch",
+            "post",
+            "/batch",
+            {
+                "json": {
+                    "operations": [
+                        {
+                            "op": "create",
+                            "entity": "vehicle",
+                            "data": {**vehicle, "registration_number": f"RTB-{tag}"},
+                        },
+                        {"op": "create", "entity": "cost", "data": cost},
+                        {
+                            "op": "update",
+                            "entity": "driver",
+                            "id": driver_id,
+                            "data": {"phone": "0711111111"},
+                        },
+                    ]
+                }
+            },
+        ),
+        (
+            "create geofence",
+            "post",
+            "/geofences",
+            {"json": {"name": f"Zone {tag}", "polygon": [[0, 0], [0, 1], [1, 1]]}},
+        ),
+        (
+            "delete geofence",
+            "delete",
+            lambda r: f"/geofences/{r['create geofence']['geofence_id']}",
+            {},
+        ),
+        ("resolve fuel alert", "post", f"/fuel-alerts/{alert_id}/resolve", {}),
+        ("optimize route", "post", f"/optimize-route?vehicle_id={vehicle_id}", {}),
+        (
+            "report",
+            "post",
+            f"/reports/fleet_costs?month={today:%Y-%m}&format=csv",
+            {},
+        ),
+        ("plan maintenance", "post", "/maintenance/schedule/plan", {}),
+        ("refit forecasts", "post", "/forecasts/refit", {}),
+        (
+            "backfill trips",
+            "post",
+            f"/trips/backfill?start={today}T00:00:00&end={today}T01:00:00",
+            {},
+        ),
+        (
+            "plan routes",
+            "post",
+            "/routes/plan",
+            {
+                "json": {
+                    "depot_latitude": -1.29,
+                    "depot_longitude": 36.82,
+                    "vehicle_ids": [vehicle_id],
+                    "orders": orders,
+                }
+            },
+        ),
+        ("backup", "post", "/backup", {}),
+        (
+            "restore",
+            "post",
+            "/restore",
+            {"files": {"file": ("dump.sql", b"-- empty\n", "text/plain")}},
+        ),
+        ("seed data", "post", "/seed-data", {}),
+    ]
+
+
+def make_fixtures(tag):
+    db = SessionLocal()
+    try:
+        vehicle = Vehicle(registration_number=f"RTF-{tag}", vehicle_type="Van")
+        driver = Driver(name=f"Fixture {tag}", license_number=f"RTF-{tag}")
+        db.add_all([vehicle, driver])
+        db.flush()
+        alert = FuelAlert(
+            vehicle_id=vehicle.id,
+            alert_type="fuel_drop",
+            occurred_at=datetime.utcnow(),
+            resolved=False,
+        )
+        db.add(alert)
+        db.commit()
+        return vehicle.id, driver.id, alert.alert_id
+    finally:
+        db.close()
+
+
+def remove_fixtures(tag, driver_id, job_ids, paths):
+    db = SessionLocal()
+    try:
+        vehicle_ids = [
+            row.id
+            for row in db.query(Vehicle.id).filter(
+                Vehicle.registration_number.in_([f"RTF-{tag}", f"RTB-{tag}"])
+            )
+        ]
+        for model, column in (
+            (Cost, Cost.vehicle_id),
+            (MaintenanceRecord, MaintenanceRecord.vehicle_id),
+            (MaintenanceSlot, MaintenanceSlot.vehicle_id),
+            (VehicleUnavailability, VehicleUnavailability.vehicle_id),
+            (VehicleDocument, VehicleDocument.vehicle_id),
+            (FuelAlert, FuelAlert.vehicle_id),
+        ):
+            db.query(model).filter(column.in_(vehicle_ids)).delete(
+                synchronize_session=False
+            )
+        db.query(DriverDocument).filter(DriverDocument.driver_id == driver_id).delete(
+            synchronize_session=False
+        )
+        db.query(Workshop).filter(Workshop.name == f"Workshop {tag}").delete(
+            synchronize_session=False
+        )
+        db.query(Vehicle).filter(Vehicle.id.in_(vehicle_ids)).delete(
+            synchronize_session=False
+        )
+        db.query(Driver).filter(Driver.id == driver_id).delete(
+            synchronize_session=False
+        )
+        jobs = db.query(Job).filter(Job.job_id.in_(job_ids))
+        paths += [json.loads(job.payload).get("backup_path") for job in jobs]
+        jobs.delete(synchronize_session=False)
+        user_ids = [
+            row.id for row in db.query(User.id).filter(User.username == f"bench-{tag}")
+        ]
+        db.query(UserActivity).filter(UserActivity.user_id.in_(user_ids)).delete(
+            synchronize_session=False
+        )
+        db.query(User).filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+# Round trips of each request of the scenario, by name
+def measure(username="admin", password="admin123", sql=False) -> dict:
+    tag = uuid.uuid4().hex[:8]
+    client = TestClient(main.app)
+    # Loaded at startup by the server (start_background_workers), not per request
+    main.pipelines.get(None)
+    trips = RoundTrips()
+    vehicle_id, driver_id, alert_id = make_fixtures(tag)
+    responses, counts, job_ids, paths = {}, {}, [], []
+
+    def call(name, method, path, **kwargs):
+        trips.reset()
+        response = getattr(client, method)(path, **kwargs)
+        counts[name] = {
+            "status": response.status_code,
+            "statements": len(trips.statements),
+            "begin/end": trips.transactions,
+            "total": trips.total,
+        }
+        if sql:
+            print(f"--- {name} ({response.status_code})")
+            for statement in trips.statements:
+                print(f"    {statement[:160]}")
+        return response
+
+    try:
+        # The first activity row of a process checks that its month's partition
+        # exists, once
+        credentials = {"username": username, "password": password}
+        client.post("/login", data=credentials)
+        login = call("login", "post", "/login", data=credentials)
+        headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+        for name, method, path, kwargs in scenario(
+            tag, vehicle_id, driver_id, alert_id
+        ):
+            if callable(path):
+                path = path(responses)
+            response = call(name, method, path, headers=headers, **kwargs)
+            body = response.json() if response.content else None
+            responses[name] = body
+            if isinstance(body, dict):
+                paths.append(body.get("file_path"))
+                job = body.get("job") if "job" in body else body
+                if job and "job_id" in job:
+                    job_ids.append(job["job_id"])
+                    if job["status"] == "queued":
+                        call(
+                            "cancel job",
+                            "post",
+                            f"/jobs/{job['job_id']}/cancel",
+                            headers=headers,
+                        )
+    finally:
+        trips.close()
+        remove_fixtures(tag, driver_id, job_ids, paths)
+    return counts
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin123")
+    parser.add_argument("--save", help="write the counts to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier --save")
+    parser.add_argument("--sql", action="store_true", help="print the statements")
+    args = parser.parse_args()
+
+    counts = measure(args.username, args.password, args.sql)
+
+    before = {}
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+    print("endpoint              status  statements  begin/end  round trips")
+    for name, count in counts.items():
+        line = (
+            f"{name:20s}  {count['status']:6d}  {count['statements']:10d}"
+            f"  {count['begin/end']:9d}  {count['total']:11d}"
+        )
+        if name in before:
+            line += f"  (was {before[name]['total']}, "
+            line += f"{count['total'] / before[name]['total'] - 1:+.0%})"
+        print(line)
+    if before:
+        common = [name for name in counts if name in before]
+        now = sum(counts[name]["total"] for name in common)
+        was = sum(before[name]["total"] for name in common)
+        print(f"all endpoints: {now} round trips, was {was} ({now / was - 1:+.0%})")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(counts, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_()
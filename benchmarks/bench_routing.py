@@ -0,0 +1,139 @@
+# Solution quality and runtime of the fleet routing solver on synthetic days of
+# 1k to 10k orders around one depot, without a database. Every order needs
+# some capacity and a third have a two hour delivery window. Reports the
+# distance of a plain sweep (vehicles filled in bearing order, windows
+# ignored), of the savings construction and after the local search, and checks
+# every route.
+#
+#     python benchmarks/bench_routing.py --orders 1000 2000 5000 10000 \
+#         --budget 30 --workers 4
+import argparse
+from datetime import date, time as dt_time
+import math
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from routing import SectorSearch, make_sectors, plan_routes  # noqa: E402
+from trips import EARTH_RADIUS_KM  # noqa: E402
+
+DEPOT = (-1.2921, 36.8219)
+SHIFT = (dt_time(7), dt_time(19))
+
+
+def synthetic_day(n, rng):
+    # Clustered around a few towns within ~60 km of the depot
+    centres = rng.normal(0, 0.3, (12, 2))
+    town = rng.integers(0, len(centres), n)
+    points = centres[town] + rng.normal(0, 0.05, (n, 2))
+    orders = []
+    for i in range(n):
+        order = {
+            "order_id": i + 1,
+            "latitude": DEPOT[0] + points[i, 0],
+            "longitude": DEPOT[1] + points[i, 1],
+            "demand": float(rng.integers(1, 20)),
+            "service_minutes": 5.0,
+        }
+        if rng.random() < 1 / 3:
+            start = int(rng.integers(8, 16))
+            order["window_start"] = f"{start:02d}:00:00"
+            order["window_end"] = f"{start + 2:02d}:00:00"
+        orders.append(order)
+    # Enough capacity for the demand, plus a quarter
+    total = sum(o["demand"] for o in orders)
+    capacities = rng.choice([150.0, 250.0, 400.0], size=int(total / 250 * 1.25) + 1)
+    return orders, [(vehicle_id + 1, c) for vehicle_id, c in enumerate(capacities)]
+
+
+def sweep_km(orders, vehicles):
+    lat0, lon0 = map(math.radians, DEPOT)
+    lat = np.radians([o["latitude"] for o in orders])
+    lon = np.radians([o["longitude"] for o in orders])
+    x = EARTH_RADIUS_KM * (lon - lon0) * math.cos(lat0)
+    y = EARTH_RADIUS_KM * (lat - lat0)
+    demand = np.array([o["demand"] for o in orders])
+    total = 0.0
+    for members, sector_vehicles in make_sectors(x, y, demand, vehicles, len(orders)):
+        search = SectorSearch(
+            {
+                "x": x[members].tolist(),
+                "y": y[members].tolist(),
+                "demand": demand[members].tolist(),
+                "service": [5.0] * len(members),
+                "early": [420.0] * len(members),
+                "late": [1140.0] * len(members),
+                "vehicles": sector_vehicles,
+                "shift": (420.0, 1140.0),
+                "speed_kmh": 40.0,
+            }
+        )
+        route, r = [], 0
+        for o in range(1, search.n + 1):
+            if r >= len(search.routes):
+                break
+            if sum(search.demand[s] for s in route) + search.demand[o] > search.cap[r]:
+                search._set_route(r, route)
+                route, r = [], r + 1
+            route.append(o)
+        if r < len(search.routes):
+            search._set_route(r, route)
+        total += search.total_km()
+    return total
+
+
+def check(result, orders, vehicles):
+    capacity = dict(vehicles)
+    served = [stop["order_id"] for route in result["routes"] for stop in route["stops"]]
+    assert len(served) == len(set(served)), "order served twice"
+    assert set(served) | set(result["unassigned"]) == {o["order_id"] for o in orders}
+    by_id = {o["order_id"]: o for o in orders}
+    for route in result["routes"]:
+        load = sum(by_id[stop["order_id"]]["demand"] for stop in route["stops"])
+        assert load <= capacity[route["vehicle_id"]] + 1e-9, "over capacity"
+        for stop in route["stops"]:
+            window = by_id[stop["order_id"]].get("window_end")
+            if window:
+                assert stop["arrival"].time() <= dt_time.fromisoformat(window)
+        assert route["returns_at"].time() <= SHIFT[1], "back after the shift"
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, nargs="+", default=[1000, 2000, 5000])
+    parser.add_argument("--budget", type=float, default=30.0, help="seconds")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    print(
+        f"budget {args.budget:.0f}s, {args.workers} workers; distances in km\n"
+        "orders  vehicles  sectors   sweep  savings   final  vs sweep"
+        "  used  unassigned  seconds"
+    )
+    for n in args.orders:
+        orders, vehicles = synthetic_day(n, np.random.default_rng(n))
+        result = plan_routes(
+            orders,
+            vehicles,
+            DEPOT,
+            date.today(),
+            SHIFT,
+            args.budget,
+            workers=args.workers,
+        )
+        check(result, orders, vehicles)
+        baseline = sweep_km(orders, vehicles)
+        print(
+            f"{n:6d}  {len(vehicles):8d}  {result['sectors']:7d}"
+            f"  {baseline:6.0f}  {result['construction_km']:7.0f}"
+            f"  {result['km']:6.0f}  {result['km'] / baseline - 1:+8.1%}"
+            f"  {result['vehicles_used']:4d}  {len(result['unassigned']):10d}"
+            f"  {result['seconds']:7.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,113 @@
+# Query latency of the in-process fuzzy search index.
+#
+# Builds an index of synthetic vehicles, drivers and documents (no database
+# needed) and times exact, prefix, partial and misspelled queries:
+#
+#     python benchmarks/bench_search.py --entities 1000000
+import argparse
+import os
+import random
+import statistics
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import SearchIndex  # noqa: E402
+
+FIRST_NAMES = [
+    "john", "jane", "peter", "mary", "james", "grace", "david", "faith", "joseph",
+    "esther", "daniel", "ruth", "samuel", "mercy", "brian", "joy", "kevin", "ann",
+    "dennis", "lucy", "moses", "agnes", "paul", "alice", "victor", "rose",
+]
+LAST_NAMES = [
+    "otieno", "wanjiru", "kamau", "achieng", "mwangi", "njeri", "odhiambo",
+    "wambui", "kiprop", "chebet", "mutua", "akinyi", "kariuki", "nyambura",
+    "omondi", "jeptoo", "kimani", "atieno", "ndungu", "wairimu", "smith", "doe",
+]
+
+
+def registration(rng):
+    letters = "".join(rng.choices(string.ascii_uppercase, k=3))
+    return f"{letters} {rng.randint(100, 999)}{rng.choice(string.ascii_uppercase)}"
+
+
+def build(entities, rng):
+    index = SearchIndex()
+    vehicles = entities // 2
+    drivers = entities * 2 // 5
+    documents = entities - vehicles - drivers
+    samples = {"vehicle": [], "driver": [], "license": [], "document": []}
+    for i in range(vehicles):
+        reg = registration(rng)
+        index.upsert("vehicle", i, reg, {"registration_number": reg})
+        if i % 5000 == 0:
+            samples["vehicle"].append(reg)
+    for i in range(drivers):
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}".title()
+        license_number = f"DL{rng.randint(0, 99999999):08d}"
+        phone = f"07{rng.randint(0, 99999999):08d}"
+        index.upsert(
+            "driver",
+            i,
+            name,
+            {"name": name, "license_number": license_number, "phone": phone},
+        )
+        if i % 5000 == 0:
+            samples["driver"].append(name)
+            samples["license"].append(license_number)
+    for i in range(documents):
+        number = f"INS-{rng.randint(0, 9999999):07d}"
+        index.upsert("vehicle_document", i, number, {"doc_number": number})
+        if i % 5000 == 0:
+            samples["document"].append(number)
+    return index, samples
+
+
+def misspell(value, rng):
+    i = rng.randrange(len(value))
+    return value[:i] + rng.choice(string.ascii_lowercase) + value[i + 1:]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    start = time.perf_counter()
+    index, samples = build(args.entities, rng)
+    print(f"built {args.entities} entities in {time.perf_counter() - start:.1f}s")
+    print(index.stats())
+
+    workloads = {
+        "registration exact": lambda: rng.choice(samples["vehicle"]),
+        "registration prefix": lambda: rng.choice(samples["vehicle"])[:5],
+        "registration typo": lambda: misspell(rng.choice(samples["vehicle"]), rng),
+        "driver name": lambda: rng.choice(samples["driver"]),
+        "driver name typo": lambda: misspell(rng.choice(samples["driver"]), rng),
+        "license partial": lambda: rng.choice(samples["license"])[3:9],
+        "document number": lambda: rng.choice(samples["document"]),
+    }
+    for label, make_query in workloads.items():
+        samples_ms = []
+        found = 0
+        for _ in range(args.queries // len(workloads)):
+            query = make_query()
+            t0 = time.perf_counter()
+            results = index.search(query, limit=10)
+            samples_ms.append((time.perf_counter() - t0) * 1000)
+            found += bool(results)
+        samples_ms.sort()
+        print(
+            f"{label:<22} mean {statistics.fmean(samples_ms):6.2f}ms"
+            f"  p50 {samples_ms[len(samples_ms) // 2]:6.2f}ms"
+            f"  p99 {samples_ms[int(len(samples_ms) * 0.99)]:6.2f}ms"
+            f"  with results {found}/{len(samples_ms)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Cold start time of the API process.
+#
+# Measures, each in a fresh interpreter:
+#   import    - "import main" (what every worker pays before serving)
+#   lifespan  - import plus running the startup and shutdown hooks
+#   ready     - time until /health/live answers
+#   dashboard - time until the first /dashboard/summary answers (--dashboard;
+#               needs the database and the seeded admin user)
+#
+# Point DB_URI at an unreachable host to check that startup does not block on
+# the database:
+#
+#     python benchmarks/bench_startup.py --runs 10
+#     DB_URI=postgresql://postgres@10.255.255.1/x python benchmarks/bench_startup.py
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPTS = {
+    "import": """
+import time
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+""",
+    "lifespan": """
+import time
+start = time.perf_counter()
+import main
+from fastapi.testclient import TestClient
+with TestClient(main.app):
+    pass
+print(time.perf_counter() - start)
+""",
+    "ready": """
+import time
+start = time.perf_counter()
+import main
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:
+    assert client.get("/health/live").status_code == 200
+    print(time.perf_counter() - start)
+""",
+}
+DASHBOARD_SCRIPT = """
+import time
+start = time.perf_counter()
+import main
+from fastapi.testclient import TestClient
+from utils import create_access_token
+token = create_access_token({"sub": "admin", "role": "admin"})
+with TestClient(main.app) as client:
+    response = client.get(
+        "/dashboard/summary", headers={"Authorization": f"Bearer {token}"}
+    )
+    assert response.status_code == 200, response.text
+    print(time.perf_counter() - start)
+"""
+
+
+def run(script: str) -> float:
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--dashboard", action="store_true")
+    args = parser.parse_args()
+
+    scripts = dict(SCRIPTS)
+    if args.dashboard:
+        scripts["dashboard"] = DASHBOARD_SCRIPT
+    for label, script in scripts.items():
+        samples = sorted(run(script) * 1000 for _ in range(args.runs))
+        print(
+            f"{label:<10} mean {statistics.fmean(samples):8.1f}ms"
+            f"  min {samples[0]:8.1f}ms  max {samples[-1]:8.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Per-request overhead of tenant routing with many tenants.
+#
+# Uses the "database" tenant mode with one SQLite file per tenant so it runs
+# without a Postgres server:
+#
+#     python benchmarks/bench_tenancy.py --tenants 1000 --requests 20000
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jose import jwt  # noqa: E402
+from sqlalchemy import create_engine, text  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from tenancy import TenantRouter, validate_tenant  # noqa: E402
+from utils import SECRET_KEY, ALGORITHM  # noqa: E402
+
+
+def simulate_request(open_session):
+    db = open_session()
+    try:
+        db.execute(text("SELECT 1"))
+    finally:
+        db.close()
+
+
+def timed(requests, fn):
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        "mean_us": statistics.fmean(samples),
+        "p50_us": samples[len(samples) // 2],
+        "p99_us": samples[int(len(samples) * 0.99)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tenants", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--max-pools", type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="tenancy-bench-")
+    template = f"sqlite:///{workdir}/{{tenant}}.db"
+    tenants = [f"fleet{i:04d}" for i in range(args.tenants)]
+    tokens = {
+        t: jwt.encode({"sub": "admin", "tenant": t}, SECRET_KEY, algorithm=ALGORITHM)
+        for t in tenants
+    }
+
+    single = create_engine(template.format(tenant="single"))
+    single_session = sessionmaker(bind=single)
+    results = {
+        "single engine": timed(args.requests, lambda: simulate_request(single_session))
+    }
+
+    def resolve():
+        tenant = random.choice(tenants)
+        claims = jwt.decode(tokens[tenant], SECRET_KEY, algorithms=[ALGORITHM])
+        return validate_tenant(claims["tenant"])
+
+    results["tenant resolution only"] = timed(args.requests, resolve)
+
+    for label, max_pools in (
+        (f"routed, all {args.tenants} pools cached", args.tenants),
+        (f"routed, LRU capped at {args.max_pools} pools", args.max_pools),
+    ):
+        router = TenantRouter(
+            mode="database", url_template=template, max_pools=max_pools
+        )
+        for tenant in tenants:
+            simulate_request(lambda: router.session_for(tenant))
+
+        def routed():
+            tenant = resolve()
+            simulate_request(lambda: router.session_for(tenant))
+
+        results[label] = timed(args.requests, routed)
+        results[label].update(router.stats())
+
+    baseline = results["single engine"]["mean_us"]
+    for label, stats in results.items():
+        print(
+            f"{label:<40} mean {stats['mean_us']:8.1f}us  p50 {stats['p50_us']:8.1f}us"
+            f"  p99 {stats['p99_us']:8.1f}us"
+        )
+        if "pools" in stats:
+            overhead = stats["mean_us"] - baseline
+            print(
+                f"{'':<40} overhead vs single engine {overhead:+.1f}us per request"
+            )
+            print(
+                f"{'':<40} pools {stats['pools']}  created {stats['created']}"
+                f"  evicted {stats['evicted']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
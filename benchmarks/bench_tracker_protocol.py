@@ -0,0 +1,115 @@
+# Bytes per update and decode throughput of the binary tracker framing against
+# one JSON message per update, as trackers send them to /ws/updates.
+#
+# Decoding only, no database needed: the JSON side parses each message and
+# reads its fields as the JSON handler does, the binary side decodes frames
+# into the Python values handed to the telemetry pipeline.
+#
+#     python benchmarks/bench_tracker_protocol.py --updates 200000 --frame 64
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telemetry import parse_timestamp  # noqa: E402
+from tracker_protocol import (  # noqa: E402
+    POSITION_FIELDS,
+    decode_frame,
+    encode_frame,
+    pack_records,
+    record_values,
+)
+
+
+# A client to server WebSocket frame adds 2 to 10 bytes of header and a 4 byte mask
+def ws_overhead(payload: int) -> int:
+    if payload < 126:
+        return 6
+    return 8 if payload < 65536 else 14
+
+
+def synthetic_updates(n, rng):
+    start = int(time.time())
+    return [
+        (
+            rng.randint(1, 5000),
+            start + i // 100,
+            round(rng.uniform(-4.5, 4.5), 6),
+            round(rng.uniform(33.5, 41.5), 6),
+            round(rng.uniform(0, 110), 1),
+            round(rng.uniform(0, 100), 2),
+        )
+        for i in range(n)
+    ]
+
+
+def decode_json(messages):
+    for message in messages:
+        data = json.loads(message)
+        data.get("vehicle_id")
+        parse_timestamp(data.get("timestamp"))
+        for field in POSITION_FIELDS:
+            data.get(field)
+
+
+def decode_binary(frames):
+    for frame in frames:
+        _, records = decode_frame(frame)
+        values = record_values(records)
+        records["vehicle_id"].tolist()
+        records["timestamp"].tolist()
+        for field in POSITION_FIELDS:
+            values[field].tolist()
+
+
+def timed(fn, payload, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=200000)
+    parser.add_argument("--frame", type=int, default=64, help="records per frame")
+    args = parser.parse_args()
+
+    updates = synthetic_updates(args.updates, random.Random(3))
+    fields = ("vehicle_id", "timestamp", *POSITION_FIELDS)
+    messages = [json.dumps(dict(zip(fields, update))) for update in updates]
+    frames = [
+        encode_frame(seq, pack_records(updates[start:start + args.frame]))
+        for seq, start in enumerate(range(0, len(updates), args.frame))
+    ]
+
+    json_bytes = sum(len(m) + ws_overhead(len(m)) for m in messages)
+    binary_bytes = sum(len(f) + ws_overhead(len(f)) for f in frames)
+    json_time = timed(decode_json, messages)
+    binary_time = timed(decode_binary, frames)
+
+    print(f"{args.updates} updates, {args.frame} records per binary frame")
+    print("                 bytes/update   updates/s")
+    print(
+        f"JSON messages    {json_bytes / args.updates:12.1f}"
+        f"{args.updates / json_time:12,.0f}"
+    )
+    print(
+        f"binary frames    {binary_bytes / args.updates:12.1f}"
+        f"{args.updates / binary_time:12,.0f}"
+    )
+    print(
+        f"ratio            {json_bytes / binary_bytes:11.1f}x"
+        f"{json_time / binary_time:11.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,129 @@
+# Trip engine on synthetic position updates, without a database: vehicles
+# that drive and stop around a city with depots as geofences, fed one update
+# at a time (as the tracker listener does) and in batches (as the ingestion
+# buffer does); the target is 10k updates per second.
+#
+#     python benchmarks/bench_trips.py --vehicles 2000 --minutes 120
+import argparse
+from datetime import datetime, timedelta
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trips import GeofenceIndex, TripEngine  # noqa: E402
+
+TARGET_UPDATES_PER_SECOND = 10000
+CITY = (-1.45, 36.65, -1.15, 37.05)
+
+
+def depots(count, rng):
+    fences = {}
+    for geofence_id in range(1, count + 1):
+        lat = rng.uniform(CITY[0], CITY[2])
+        lon = rng.uniform(CITY[1], CITY[3])
+        half = rng.uniform(0.002, 0.01)
+        fences[geofence_id] = [
+            (lat - half, lon - half),
+            (lat - half, lon + half),
+            (lat + half, lon + half),
+            (lat + half, lon - half),
+        ]
+    return fences
+
+
+# One update every 10 seconds per vehicle; each vehicle alternates between
+# driving on a heading and stopping, some with no speed reported
+def synthetic_positions(vehicles, minutes, start, rng):
+    lat = rng.uniform(CITY[0], CITY[2], vehicles)
+    lon = rng.uniform(CITY[1], CITY[3], vehicles)
+    heading = rng.uniform(0, 2 * np.pi, vehicles)
+    speed = np.zeros(vehicles)
+    switch = rng.integers(1, 30, vehicles)
+    reports_speed = rng.random(vehicles) < 0.8
+    points = []
+    for tick in range(minutes * 6):
+        at = start + timedelta(seconds=tick * 10)
+        switch -= 1
+        flip = switch <= 0
+        moving = speed > 0
+        speed[flip & moving] = 0.0
+        speed[flip & ~moving] = rng.uniform(20, 80, int((flip & ~moving).sum()))
+        heading[flip] = rng.uniform(0, 2 * np.pi, int(flip.sum()))
+        # Drives of 2 to 20 minutes, stops of 1 to 25 (the long ones end trips)
+        switch[flip & moving] = rng.integers(6, 150, int((flip & moving).sum()))
+        switch[flip & ~moving] = rng.integers(12, 120, int((flip & ~moving).sum()))
+        step = speed / 3600.0 * 10 / 111.0
+        lat += step * np.cos(heading)
+        lon += step * np.sin(heading)
+        for vehicle_id in range(vehicles):
+            points.append(
+                (
+                    vehicle_id + 1,
+                    at,
+                    float(lat[vehicle_id]),
+                    float(lon[vehicle_id]),
+                    float(speed[vehicle_id]) if reports_speed[vehicle_id] else None,
+                )
+            )
+    return points
+
+
+def engine_with(fences):
+    engine = TripEngine(GeofenceIndex())
+    for geofence_id, polygon in fences.items():
+        engine.add_geofence(geofence_id, polygon)
+    return engine
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vehicles", type=int, default=2000)
+    parser.add_argument("--minutes", type=int, default=120)
+    parser.add_argument("--geofences", type=int, default=500)
+    parser.add_argument("--batch", type=int, default=500)
+    args = parser.parse_args()
+    rng = np.random.default_rng(28)
+    fences = depots(args.geofences, rng)
+    points = synthetic_positions(
+        args.vehicles, args.minutes, datetime(2026, 10, 19), rng
+    )
+    print(
+        f"{args.vehicles} vehicles, {len(points)} updates over {args.minutes} "
+        f"minutes, {args.geofences} geofences"
+    )
+
+    end = points[-1][1] + timedelta(hours=1)
+    results = {}
+    engine = engine_with(fences)
+    start = time.perf_counter()
+    for vehicle_id, at, lat, lon, speed in points:
+        engine.process(vehicle_id, at, lat, lon, speed)
+    elapsed = time.perf_counter() - start
+    engine.close_stale(end)
+    results["one at a time"] = (elapsed, engine.drain())
+
+    engine = engine_with(fences)
+    start = time.perf_counter()
+    for i in range(0, len(points), args.batch):
+        engine.process_many(points[i : i + args.batch])
+    elapsed = time.perf_counter() - start
+    engine.close_stale(end)
+    results[f"batches of {args.batch}"] = (elapsed, engine.drain())
+
+    for label, (elapsed, (trips, events)) in results.items():
+        rate = len(points) / elapsed
+        print(
+            f"{label:16s} {rate:10.0f} updates/s  {len(trips)} trips, "
+            f"{len(events)} geofence events"
+            + ("" if rate >= TARGET_UPDATES_PER_SECOND else "  BELOW TARGET")
+        )
+    counts = {(len(t), len(e)) for _, (t, e) in results.values()}
+    assert len(counts) == 1
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,396 @@
+# Replays traces captured by traffic_capture.py (TRAFFIC_CAPTURE_PATH) against a
+# running instance, at the recorded pace or --speed times faster, and reports
+# latency percentiles and error rates per route next to the captured latencies.
+#
+# Requests are sent open loop at their recorded offsets, so a slow server gets
+# the same arrival rate rather than fewer requests. Writes are replayed too:
+# point it at a scratch copy of the database (--read-only sends only the safe
+# methods). Requests use the token of --username; captured logins are sent
+# with the same credentials, and the unique fields of captured bodies get fresh
+# values. What cannot be rebuilt from the trace is skipped and counted:
+# redacted path or query values, writes whose body was not captured
+# (TRAFFIC_CAPTURE_BODIES) or is not JSON or form data, and bodies with other
+# redacted values.
+#
+# WebSocket connections are held open for their recorded duration (divided by
+# --speed). Trackers on /ws/updates send as many messages as were captured,
+# spread evenly over the same span, with made-up positions of the target's
+# vehicles; other WebSocket routes only receive. Needs websockets for those.
+#
+#     TRAFFIC_CAPTURE_PATH=traces/trace-{pid}.jsonl.gz uvicorn main:app --workers 4
+#     uvicorn main:app --port 8000  # against a scratch database
+#     python benchmarks/replay_traffic.py traces/*.jsonl.gz --speed 4 \
+#         --save after.json
+import argparse
+import asyncio
+from collections import defaultdict
+import gzip
+import json
+import os
+import re
+import sys
+import time
+from urllib.parse import urlencode
+import uuid
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracker_protocol import MAX_RECORDS, encode_frame, pack_records  # noqa: E402
+from traffic_capture import REDACTED  # noqa: E402
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+UNIQUE_FIELDS = ("registration_number", "license_number", "username", "email")
+PATH_PARAM = re.compile(r"{(\w+)(?::\w+)?}")
+FRAME_HEADER_BYTES = 8
+RECORD_BYTES = 20
+
+
+class Skip(Exception):
+    pass
+
+
+def read_traces(paths):
+    entries = []
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    entry = json.loads(line)
+                    if "trace" not in entry:
+                        entries.append(entry)
+            except (EOFError, zlib.error, json.JSONDecodeError):
+                # A trace still being written ends in the middle of a line
+                pass
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+
+def route_key(entry):
+    name = entry["route"] or f"{entry['path']} (unmatched)"
+    if entry["kind"] == "websocket":
+        return f"WS {name}"
+    return f"{entry['method']} {name}"
+
+
+class Replay:
+    def __init__(self, args, client, token, vehicle_ids):
+        self.args = args
+        self.client = client
+        self.token = token
+        self.vehicle_ids = vehicle_ids or [1]
+        self.rng = np.random.default_rng(50)
+        self.run = uuid.uuid4().hex[:8]
+        self.unique = 0
+        self.results = defaultdict(list)  # route -> [(status, seconds)]
+        self.captured = defaultdict(list)  # route -> captured seconds
+        self.skipped = defaultdict(int)  # reason -> entries
+        self.messages = 0
+        self.lag = 0.0
+        self.headers = {"X-Tenant-ID": args.tenant} if args.tenant else {}
+
+    def field(self, key, value):
+        if key in UNIQUE_FIELDS:
+            return self.unique_value(key)
+        if key == "password":
+            return f"replay-{self.run}"
+        return self.substitute(value)
+
+    def unique_value(self, field):
+        self.unique += 1
+        if field == "email":
+            return f"replay-{self.run}-{self.unique}@example.com"
+        return f"REPLAY-{self.run}-{self.unique}"
+
+    # Fresh unique values and passwords (of registered users, say); any other
+    # redacted value cannot be made up
+    def substitute(self, value):
+        if isinstance(value, dict):
+            return {k: self.field(k, v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.substitute(v) for v in value]
+        if value == REDACTED:
+            raise Skip("redacted body value")
+        return value
+
+    def target(self, entry):
+        if entry["route"] is None:
+            return entry["path"], entry["query"]
+        params = entry["params"]
+        if REDACTED in params.values():
+            raise Skip("redacted path parameter")
+        path = PATH_PARAM.sub(lambda m: params[m.group(1)], entry["route"])
+        query = []
+        for key, value in entry["query"]:
+            if value == REDACTED:
+                if key != "token":
+                    raise Skip("redacted query value")
+                value = self.token
+            query.append((key, value))
+        return path, query
+
+    def body(self, entry):
+        if entry["route"] == "/login":
+            credentials = {"username": self.args.username}
+            return {"data": {**credentials, "password": self.args.password}}
+        body = entry.get("body")
+        if body is None:
+            if entry["request_bytes"] and entry["method"] not in SAFE_METHODS:
+                raise Skip("body not captured")
+            return {}
+        if "json" in body:
+            return {"json": self.substitute(body["json"])}
+        return {"data": self.substitute(dict(body["form"]))}
+
+    async def send(self, entry):
+        try:
+            if entry["kind"] == "websocket":
+                await self.websocket(entry)
+            else:
+                await self.http(entry)
+        except Skip as e:
+            self.skipped[str(e)] += 1
+
+    async def http(self, entry):
+        import httpx
+
+        if self.args.read_only and entry["method"] not in SAFE_METHODS:
+            raise Skip("write (--read-only)")
+        path, query = self.target(entry)
+        kwargs = self.body(entry)
+        headers = dict(self.headers)
+        if entry["auth"]:
+            headers["Authorization"] = f"Bearer {self.token}"
+        key = route_key(entry)
+        self.captured[key].append(entry["duration"])
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(
+                entry["method"], path, params=query, headers=headers, **kwargs
+            )
+            status = response.status_code
+        except httpx.HTTPError:
+            status = None
+        self.results[key].append((status, time.perf_counter() - start))
+
+    async def websocket(self, entry):
+        try:
+            import websockets
+        except ImportError:
+            raise Skip("WebSocket (websockets is not installed)")
+
+        path, query = self.target(entry)
+        url = re.sub(r"^http", "ws", self.args.url.rstrip("/")) + path
+        if query:
+            url += "?" + urlencode(query)
+        headers = dict(self.headers)
+        if entry["auth"] and not any(key == "token" for key, _ in query):
+            headers["Authorization"] = f"Bearer {self.token}"
+        key = route_key(entry)
+        status = handshake = None
+        start = time.perf_counter()
+        try:
+            async with websockets.connect(
+                url, extra_headers=headers, max_size=None
+            ) as ws:
+                # Timed to the handshake; the connection then lives as long as
+                # the captured one
+                status, handshake = 101, time.perf_counter() - start
+                drain = asyncio.ensure_future(self.drain(ws))
+                try:
+                    if entry["route"] == "/ws/updates":
+                        await self.track(ws, entry, start)
+                    left = entry["duration"] / self.args.speed
+                    await asyncio.sleep(max(0.0, left - (time.perf_counter() - start)))
+                finally:
+                    drain.cancel()
+        except websockets.InvalidStatusCode as e:
+            status = e.status_code
+        except websockets.ConnectionClosedOK:
+            pass
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+            # Also a close with an error code after the handshake
+            status = None
+        if handshake is None:
+            handshake = time.perf_counter() - start
+        self.results[key].append((status, handshake))
+
+    @staticmethod
+    async def drain(ws):
+        async for _ in ws:
+            pass
+
+    async def track(self, ws, entry, start):
+        received = entry["received"]
+        count = received["text"] + received["binary"]
+        if not count:
+            return
+        kinds = ["binary"] * received["binary"] + ["text"] * received["text"]
+        self.rng.shuffle(kinds)
+        span = (received["last"] - received["first"]) / self.args.speed
+        first = received["first"] / self.args.speed
+        # Frames as large as the captured ones on average
+        size = received["bytes"] / count
+        records = int(max(1, (size - FRAME_HEADER_BYTES) // RECORD_BYTES))
+        records = min(records, MAX_RECORDS)
+        for i, kind in enumerate(kinds):
+            due = first + (span * i / (count - 1) if count > 1 else 0.0)
+            await asyncio.sleep(max(0.0, due - (time.perf_counter() - start)))
+            if kind == "text":
+                await ws.send(json.dumps(self.position()))
+            else:
+                points = [tuple(self.position().values()) for _ in range(records)]
+                await ws.send(encode_frame(i + 1, pack_records(points)))
+            self.messages += 1
+
+    def position(self):
+        rng = self.rng
+        return {
+            "vehicle_id": int(rng.choice(self.vehicle_ids)),
+            "timestamp": None,
+            "latitude": float(rng.uniform(-4.5, 4.5)),
+            "longitude": float(rng.uniform(33.5, 41.5)),
+            "speed": float(rng.uniform(0, 90)),
+            "fuel_level": float(rng.uniform(5, 100)),
+        }
+
+
+async def login(client, args):
+    headers = {"X-Tenant-ID": args.tenant} if args.tenant else {}
+    response = await client.post(
+        "/login",
+        data={"username": args.username, "password": args.password},
+        headers=headers,
+    )
+    response.raise_for_status()
+    token = response.json()["access_token"]
+    response = await client.get(
+        "/vehicles",
+        params={"limit": 1000},
+        headers={**headers, "Authorization": f"Bearer {token}"},
+    )
+    response.raise_for_status()
+    return token, [vehicle["id"] for vehicle in response.json()]
+
+
+async def replay(args, entries):
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=args.connections, max_keepalive_connections=args.connections
+    )
+    async with httpx.AsyncClient(
+        base_url=args.url, limits=limits, timeout=args.timeout
+    ) as client:
+        token, vehicle_ids = await login(client, args)
+        state = Replay(args, client, token, vehicle_ids)
+        pending = set()
+        first = entries[0]["t"]
+        start = time.perf_counter()
+        for entry in entries:
+            late = time.perf_counter() - start - (entry["t"] - first) / args.speed
+            if late < 0:
+                await asyncio.sleep(-late)
+            else:
+                state.lag = max(state.lag, late)
+            task = asyncio.ensure_future(state.send(entry))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+        return state, time.perf_counter() - start
+
+
+def percentiles(seconds):
+    return [float(v) * 1000 for v in np.percentile(seconds, [50, 95, 99, 100])]
+
+
+def summarize(state):
+    routes = {}
+    for key, results in state.results.items():
+        statuses = [status for status, _ in results]
+        latencies = [seconds for _, seconds in results]
+        p50, p95, p99, worst = percentiles(latencies)
+        captured = state.captured.get(key)
+        routes[key] = {
+            "count": len(results),
+            "ok": sum(1 for s in statuses if s is not None and s < 400),
+            "4xx": sum(1 for s in statuses if s is not None and 400 <= s < 500),
+            "5xx": sum(1 for s in statuses if s is not None and s >= 500),
+            "failed": statuses.count(None),
+            "p50_ms": p50,
+            "p95_ms": p95,
+            "p99_ms": p99,
+            "max_ms": worst,
+            "captured_p50_ms": percentiles(captured)[0] if captured else None,
+            "captured_p99_ms": percentiles(captured)[2] if captured else None,
+        }
+    return routes
+
+
+def report(routes, state, entries, elapsed, args):
+    span = entries[-1]["t"] - entries[0]["t"]
+    sent = sum(route["count"] for route in routes.values())
+    print(
+        f"{sent} of {len(entries)} captured entries replayed in {elapsed:.1f}s "
+        f"(captured over {span:.1f}s, speed {args.speed:g}x), "
+        f"{state.messages} WebSocket messages, "
+        f"schedule lag up to {state.lag * 1000:.0f} ms"
+    )
+    width = max([len(key) for key in routes] + [5])
+    print(
+        f"{'route':<{width}}  count     ok   4xx   5xx  fail"
+        "  p50 ms  p95 ms  p99 ms  max ms  captured p50/p99"
+    )
+    for key, r in sorted(routes.items(), key=lambda item: -item[1]["count"]):
+        captured = (
+            f"{r['captured_p50_ms']:.1f}/{r['captured_p99_ms']:.1f}"
+            if r["captured_p50_ms"] is not None
+            else "-"
+        )
+        print(
+            f"{key:<{width}}  {r['count']:5d}  {r['ok']:5d}  {r['4xx']:4d}"
+            f"  {r['5xx']:4d}  {r['failed']:4d}  {r['p50_ms']:6.1f}"
+            f"  {r['p95_ms']:6.1f}  {r['p99_ms']:6.1f}  {r['max_ms']:6.1f}"
+            f"  {captured}"
+        )
+    for reason, count in sorted(state.skipped.items()):
+        print(f"skipped {count:5d}  {reason}")
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("traces", nargs="+")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin123")
+    parser.add_argument("--tenant", help="X-Tenant-ID of the login")
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--limit", type=int, help="replay the first N entries")
+    parser.add_argument("--read-only", action="store_true")
+    parser.add_argument("--save", help="write the per-route results as JSON")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    entries = read_traces(args.traces)[: args.limit]
+    if not entries:
+        sys.exit("No captured requests in the traces")
+    state, elapsed = asyncio.run(replay(args, entries))
+    routes = summarize(state)
+    report(routes, state, entries, elapsed, args)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {"speed": args.speed, "routes": routes, "skipped": state.skipped},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,69 @@
+import threading
+import time
+
+
+class _Entry:
+    __slots__ = ("value", "expires_at")
+
+    def __init__(self, value, expires_at):
+        self.value = value
+        self.expires_at = expires_at
+
+
+# Small in-process TTL cache. Concurrent misses on the same key wait for a
+# single computation instead of each running it (single flight).
+class TTLCache:
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at > time.monotonic():
+            self.hits += 1
+            return entry.value, entry.expires_at
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > time.monotonic():
+                self.hits += 1
+                return entry.value, entry.expires_at
+            self.misses += 1
+            value = compute()
+            entry = _Entry(value, time.monotonic() + self.ttl)
+            with self._lock:
+                if len(self._entries) >= self.max_entries:
+                    self._evict_expired()
+                self._entries[key] = entry
+        return entry.value, entry.expires_at
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for key in [k for k, e in self._entries.items() if e.expires_at <= now]:
+            del self._entries[key]
+            self._key_locks.pop(key, None)
+        while len(self._entries) >= self.max_entries:
+            key = next(iter(self._entries))
+            del self._entries[key]
+            self._key_locks.pop(key, None)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "ttl_seconds": self.ttl,
+        }
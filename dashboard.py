@@ -0,0 +1,184 @@
+from datetime import date, datetime, timedelta
+import os
+
+import numpy as np
+from sqlalchemy import and_, func, or_
+
+from cache import TTLCache
+from models import Cost, Driver, FuelAlert, MaintenanceRecord, Vehicle
+
+DASHBOARD_CACHE_SECONDS = float(os.getenv("DASHBOARD_CACHE_SECONDS", "15"))
+DASHBOARD_TOP_CATEGORIES = 10
+MAINTENANCE_DUE_DAYS = 30
+# kg CO2 per unit of fuel level, as estimated by the dashboard
+CARBON_FACTOR = 2.68
+
+summary_cache = TTLCache(DASHBOARD_CACHE_SECONDS)
+
+
+def _count(condition):
+    return func.count().filter(condition)
+
+
+def vehicle_summary(db, today: date):
+    # Same thresholds as the dashboard's maintenance status
+    overdue = or_(
+        Vehicle.last_maintenance.is_(None),
+        Vehicle.last_maintenance < today - timedelta(days=180),
+    )
+    soon = Vehicle.last_maintenance < today - timedelta(days=120)
+    needs_service = or_(Vehicle.maintenance_score < 30, overdue)
+    schedule_soon = and_(~needs_service, or_(Vehicle.maintenance_score < 50, soon))
+    row = db.query(
+        func.count(Vehicle.id),
+        _count(Vehicle.status == "Active"),
+        _count(Vehicle.status == "Maintenance"),
+        func.avg(Vehicle.fuel_level),
+        func.avg(Vehicle.speed),
+        func.sum(Vehicle.fuel_level),
+        _count(needs_service),
+        _count(schedule_soon),
+        func.count(func.distinct(Vehicle.driver_id)).filter(
+            Vehicle.status == "Active"
+        ),
+    ).one()
+    total = row[0] or 0
+    return {
+        "total": total,
+        "active": row[1] or 0,
+        "in_maintenance": row[2] or 0,
+        "avg_fuel_level": round(float(row[3] or 0), 1),
+        "avg_speed": round(float(row[4] or 0), 1),
+        "carbon_kg": round(float(row[5] or 0) * CARBON_FACTOR, 2),
+        "maintenance_status": {
+            "needs_service": row[6] or 0,
+            "schedule_soon": row[7] or 0,
+            "good": total - (row[6] or 0) - (row[7] or 0),
+        },
+        "drivers_assigned_active": row[8] or 0,
+    }
+
+
+def driver_summary(db):
+    total, active, on_trip = db.query(
+        func.count(Driver.id),
+        _count(Driver.status.in_(("Active", "Available"))),
+        _count(Driver.status == "On Trip"),
+    ).one()
+    return {"total": total or 0, "active": active or 0, "on_trip": on_trip or 0}
+
+
+# Rows of the fleet state table whose code column holds one of the values
+def _matches(table, column: str, *values):
+    codes = [table.code(column, value) for value in values]
+    return np.isin(table.column(column), [code for code in codes if code >= 0])
+
+
+# Mean of the non-null values, like SQL's avg
+def _mean(values):
+    values = values[~np.isnan(values)]
+    return float(values.mean()) if len(values) else 0.0
+
+
+# vehicle_summary and driver_summary from the fleet state every worker keeps in
+# memory (fleet_state.py), which trails the database by a replay interval
+def fleet_vehicle_summary(state, today: date):
+    with state.lock:
+        vehicles = state.vehicles
+        active = _matches(vehicles, "status", "Active")
+        score = vehicles.column("maintenance_score")
+        last = vehicles.column("last_maintenance")
+        fuel = vehicles.column("fuel_level")
+        driver_ids = vehicles.column("driver_id")
+        overdue = np.isnat(last) | (last < np.datetime64(today - timedelta(days=180)))
+        soon = last < np.datetime64(today - timedelta(days=120))
+        needs_service = (score < 30) | overdue
+        schedule_soon = ~needs_service & ((score < 50) | soon)
+        total = vehicles.rows
+        needs, schedule = int(needs_service.sum()), int(schedule_soon.sum())
+        return {
+            "total": total,
+            "active": int(active.sum()),
+            "in_maintenance": int(_matches(vehicles, "status", "Maintenance").sum()),
+            "avg_fuel_level": round(_mean(fuel), 1),
+            "avg_speed": round(_mean(vehicles.column("speed")), 1),
+            "carbon_kg": round(float(np.nansum(fuel)) * CARBON_FACTOR, 2),
+            "maintenance_status": {
+                "needs_service": needs,
+                "schedule_soon": schedule,
+                "good": total - needs - schedule,
+            },
+            "drivers_assigned_active": len(
+                np.unique(driver_ids[active & (driver_ids >= 0)])
+            ),
+        }
+
+
+def fleet_driver_summary(state):
+    with state.lock:
+        drivers = state.drivers
+        return {
+            "total": drivers.rows,
+            "active": int(_matches(drivers, "status", "Active", "Available").sum()),
+            "on_trip": int(_matches(drivers, "status", "On Trip").sum()),
+        }
+
+
+def cost_summary(db, today: date):
+    month_start = today.replace(day=1)
+    rows = (
+        db.query(Cost.category, func.count(Cost.cost_id), func.sum(Cost.amount))
+        .filter(Cost.date >= month_start, Cost.date <= today)
+        .group_by(Cost.category)
+        .all()
+    )
+    rows.sort(key=lambda row: row[2] or 0, reverse=True)
+    return {
+        "month": month_start.strftime("%Y-%m"),
+        "total": round(sum(float(row[2] or 0) for row in rows), 2),
+        "entries": sum(row[1] for row in rows),
+        "by_category": [
+            {"category": category, "entries": count, "total": round(float(amount), 2)}
+            for category, count, amount in rows[:DASHBOARD_TOP_CATEGORIES]
+        ],
+    }
+
+
+def alert_summary(db, today: date):
+    maintenance_due = (
+        db.query(func.count(MaintenanceRecord.record_id))
+        .filter(
+            MaintenanceRecord.next_maintenance_date >= today,
+            MaintenanceRecord.next_maintenance_date
+            <= today + timedelta(days=MAINTENANCE_DUE_DAYS),
+        )
+        .scalar_subquery()
+    )
+    open_fuel_alerts = (
+        db.query(func.count(FuelAlert.alert_id))
+        .filter(FuelAlert.resolved.is_(False))
+        .scalar_subquery()
+    )
+    due, alerts = db.query(maintenance_due, open_fuel_alerts).one()
+    return {"maintenance_due": due or 0, "open_fuel_alerts": alerts or 0}
+
+
+# Every figure is an aggregate, so the response has the same size for a fleet
+# of ten vehicles or ten thousand. Vehicle and driver figures come from the
+# fleet state when there is one, leaving only costs and alerts to Postgres.
+def compute_summary(db, pipeline, fleet=None):
+    today = datetime.utcnow().date()
+    if fleet is not None:
+        vehicles = fleet_vehicle_summary(fleet, today)
+        drivers = fleet_driver_summary(fleet)
+    else:
+        vehicles = vehicle_summary(db, today)
+        drivers = driver_summary(db)
+    return {
+        "generated_at": datetime.utcnow(),
+        "vehicles": vehicles,
+        "vehicles_on_trip": len(pipeline.trips.open_trip_vehicle_ids()),
+        "drivers": drivers,
+        "costs_this_month": cost_summary(db, today),
+        "alerts": alert_summary(db, today),
+    }
@@ -1,8 +1,73 @@
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+import logging
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+SQLALCHEMY_DATABASE_URL = os.getenv(
+    "DB_URI", "postgresql://postgres@localhost/logistics_saas"
+)
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+
+
 
-SQLALCHEMY_DATABASE_URL = "postgresql://postgres@localhost/logistics_saas"
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Driver arguments for a new engine; only libpq knows connect_timeout (SQLite,
+# used by the tenancy benchmark, rejects it)
+def connect_args(url) -> dict:
+    if make_url(url).get_backend_name() == "postgresql":
+        return {"connect_timeout": DB_CONNECT_TIMEOUT}
+    return {}
+
+
+# Creating the engine does not connect; the first checkout does
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL, connect_args=connect_args(SQLALCHEMY_DATABASE_URL)
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+AFTER_COMMIT = "after_commit"
+
+
+# One transaction per request or job step: the session is committed once when
+# the block ends and rolled back if it raises. Code inside flushes when it
+# needs generated ids (INSERT ... RETURNING) instead of committing, so the
+# objects are not expired and nothing has to be reloaded.
+@contextmanager
+def unit_of_work(session: Session):
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# Runs callback(*args) once the session's current transaction has committed,
+# for work outside the database (search indexes, in-memory state, waking
+# workers) that must not see changes that are later rolled back
+def after_commit(session: Session, callback, *args):
+    session.info.setdefault(AFTER_COMMIT, []).append((callback, args))
+
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(session):
+    if session.in_nested_transaction():
+        # A savepoint was released; the transaction is still open
+        return
+    for callback, args in session.info.pop(AFTER_COMMIT, []):
+        try:
+            callback(*args)
+        except Exception as e:
+            logging.error(f"After-commit callback {callback.__name__} failed: {e}")
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_after_commit(session, previous_transaction):
+    if not session.in_transaction():
+        session.info.pop(AFTER_COMMIT, None)
@@ -0,0 +1,282 @@
+from collections import deque
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+# "memory": events stay in this process. "redis": batches are also published
+# on a Redis channel, so WebSocket clients of every API process and node see
+# every update.
+EVENT_BUS = os.getenv("EVENT_BUS", "memory")
+EVENT_BUS_URL = os.getenv("EVENT_BUS_URL", "redis://localhost:6379/0")
+EVENT_BUS_CHANNEL = os.getenv("EVENT_BUS_CHANNEL", "logistics:events")
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "500"))
+EVENT_BATCH_SECONDS = float(os.getenv("EVENT_BATCH_SECONDS", "0.05"))
+# Events buffered per subscriber; a client that falls further behind loses the
+# oldest ones rather than holding up the others
+EVENT_SUBSCRIBER_QUEUE = int(os.getenv("EVENT_SUBSCRIBER_QUEUE", "5000"))
+EVENT_MAX_PENDING = int(os.getenv("EVENT_MAX_PENDING", "100000"))
+RECONNECT_SECONDS = 2.0
+LATENCY_SAMPLES = 2048
+
+
+# Publish to delivery times of recent events, in milliseconds. Events from
+# other nodes include their clock offset.
+class LatencyStats:
+    def __init__(self):
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.count = 0
+        self.max_ms = 0.0
+
+    def add(self, now: float, events):
+        for event in events:
+            ms = (now - event["ts"]) * 1000
+            self.samples.append(ms)
+            self.count += 1
+            self.max_ms = max(self.max_ms, ms)
+
+    def stats(self):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {"events": 0}
+        return {
+            "events": self.count,
+            "p50_ms": round(ordered[len(ordered) // 2], 3),
+            "p99_ms": round(ordered[int(len(ordered) * 0.99) - 1], 3),
+            "max_ms": round(self.max_ms, 3),
+        }
+
+
+# An asyncio queue of one WebSocket client, filled from the bus's threads
+class Subscription:
+    def __init__(self, topics, tenant, loop, maxsize: int = EVENT_SUBSCRIBER_QUEUE):
+        self.topics = set(topics)
+        self.tenant = tenant
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def wants(self, event) -> bool:
+        return event["tenant"] == self.tenant and event["topic"] in self.topics
+
+    # Runs on the subscriber's event loop
+    def _put(self, events):
+        for event in events:
+            if self.queue.full():
+                self.queue.get_nowait()
+                self.dropped += 1
+            self.queue.put_nowait(event)
+
+    # Waits for at least one event, then takes what else is queued
+    async def next_batch(self, limit: int = EVENT_BATCH_SIZE):
+        events = [await self.queue.get()]
+        while len(events) < limit and not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return events
+
+
+class MemoryTransport:
+    name = "memory"
+
+    def start(self, receive):
+        pass
+
+    def send(self, message: str):
+        pass
+
+    def stop(self):
+        pass
+
+
+# One PUBLISH per batch on a shared channel; a listener thread hands batches
+# from other processes to the bus. Messages published while a listener is
+# reconnecting are lost, as with any Redis pub/sub.
+class RedisTransport:
+    name = "redis"
+
+    def __init__(self, url: str = EVENT_BUS_URL, channel: str = EVENT_BUS_CHANNEL):
+        import redis
+
+        self.channel = channel
+        self.client = redis.Redis.from_url(url)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pubsub = None
+
+    def start(self, receive):
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._listen, args=(receive,), name="event-bus-listener", daemon=True
+        )
+        self._thread.start()
+
+    def _listen(self, receive):
+        while not self._stopping.is_set():
+            try:
+                self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                self._pubsub.subscribe(self.channel)
+                while not self._stopping.is_set():
+                    message = self._pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        receive(message["data"])
+            except Exception as e:
+                if self._stopping.is_set():
+                    break
+                logging.error(f"Event bus listener disconnected: {e}")
+                self._stopping.wait(RECONNECT_SECONDS)
+            finally:
+                if self._pubsub is not None:
+                    self._pubsub.close()
+
+    def send(self, message: str):
+        self.client.publish(self.channel, message)
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+def make_transport(kind: str = EVENT_BUS):
+    if kind == "memory":
+        return MemoryTransport()
+    if kind == "redis":
+        return RedisTransport()
+    raise ValueError(f"Unknown EVENT_BUS {kind!r}, expected 'memory' or 'redis'")
+
+
+# Publishing only appends to a buffer; a flusher thread sends it in batches
+# (every EVENT_BATCH_SECONDS or EVENT_BATCH_SIZE events), delivers it to this
+# process's subscribers and hands it to the transport for the other processes.
+class EventBus:
+    def __init__(self, transport=None, batch_size: int = EVENT_BATCH_SIZE):
+        self.transport = transport or MemoryTransport()
+        self.batch_size = batch_size
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._pending = []
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.published = 0
+        self.dropped = 0
+        self.batches_sent = 0
+        self.batches_received = 0
+        self.send_errors = 0
+        self.local_latency = LatencyStats()
+        self.remote_latency = LatencyStats()
+
+    def publish(self, topic: str, data: dict, tenant: str = None):
+        event = {"topic": topic, "tenant": tenant, "data": data, "ts": time.time()}
+        with self._lock:
+            if len(self._pending) >= EVENT_MAX_PENDING:
+                self.dropped += 1
+                return
+            self._pending.append(event)
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    def subscribe(self, topics, tenant: str = None) -> Subscription:
+        subscription = Subscription(topics, tenant, asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            self.dropped += subscription.dropped
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self.transport.start(self._receive)
+        self._thread = threading.Thread(
+            target=self._run, name="event-bus-flusher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.transport.stop()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(EVENT_BATCH_SECONDS)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Event bus flush failed: {e}")
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            self._deliver(batch, self.local_latency)
+            message = json.dumps({"origin": self.origin, "events": batch}, default=str)
+            try:
+                self.transport.send(message)
+                self.batches_sent += 1
+            except Exception as e:
+                self.send_errors += 1
+                logging.error(
+                    f"Event bus publish failed, {len(batch)} events lost: {e}"
+                )
+        self.published += len(pending)
+
+    # Batches from the other processes, on the transport's thread
+    def _receive(self, message):
+        batch = json.loads(message)
+        if batch["origin"] == self.origin:
+            return
+        self.batches_received += 1
+        self._deliver(batch["events"], self.remote_latency)
+
+    def _deliver(self, events, latency: LatencyStats):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            wanted = [event for event in events if subscription.wants(event)]
+            if not wanted:
+                continue
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._put, wanted)
+            except RuntimeError:
+                # Its event loop has closed
+                self.unsubscribe(subscription)
+        latency.add(time.time(), events)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+            subscribers = len(self._subscriptions)
+        return {
+            "backend": self.transport.name,
+            "subscribers": subscribers,
+            "pending": pending,
+            "published": self.published,
+            "dropped": self.dropped,
+            "batches_sent": self.batches_sent,
+            "batches_received": self.batches_received,
+            "send_errors": self.send_errors,
+            "latency": {
+                "local": self.local_latency.stats(),
+                "remote": self.remote_latency.stats(),
+            },
+        }
+
+
+event_bus = EventBus(make_transport())
@@ -0,0 +1,511 @@
+from datetime import datetime
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import select
+
+from jobs import JobContext, job_queue
+from models import Driver, Tombstone, Vehicle
+from sync import SYNC_TOKEN_MAX_AGE, snapshot_xmin
+from tenancy import DEFAULT_TENANT, open_session, tenant_router
+
+FLEET_SNAPSHOT_DIR = os.getenv("FLEET_SNAPSHOT_DIR", "snapshots")
+FLEET_SNAPSHOT_SECONDS = float(os.getenv("FLEET_SNAPSHOT_SECONDS", "300"))
+# How often every process replays the rows other processes changed
+FLEET_STATE_REFRESH_SECONDS = float(os.getenv("FLEET_STATE_REFRESH_SECONDS", "2"))
+
+SNAPSHOT_MAGIC = b"FLEETSNP"
+# Bumped whenever the file layout changes; older files are ignored
+SNAPSHOT_FORMAT = 1
+# Columns start on cache line boundaries
+SNAPSHOT_ALIGN = 64
+
+# Column kinds: NULL is NaN for floats, NaT for dates and times, and -1 for
+# references, counts and codes. Codes index the column's vocabulary.
+KIND_DTYPES = {
+    "id": np.dtype("<i8"),
+    "float": np.dtype("<f8"),
+    "ref": np.dtype("<i8"),
+    "count": np.dtype("<i8"),
+    "code": np.dtype("<i2"),
+    "date": np.dtype("<M8[D]"),
+    "time": np.dtype("<M8[us]"),
+}
+
+
+class TableSpec:
+    def __init__(self, name: str, model, columns: dict):
+        self.name = name
+        self.model = model
+        self.columns = columns  # column -> kind; "id" first, "row_version" last
+        self.dtypes = {column: KIND_DTYPES[kind] for column, kind in columns.items()}
+
+
+# The hot state of the fleet: what live views need for every vehicle and
+# driver at once. Free text (names, notes, documents) stays in Postgres.
+FLEET_TABLES = (
+    TableSpec(
+        "vehicles",
+        Vehicle,
+        {
+            "id": "id",
+            "latitude": "float",
+            "longitude": "float",
+            "speed": "float",
+            "fuel_level": "float",
+            "maintenance_score": "float",
+            "capacity": "float",
+            "driver_id": "ref",
+            "status": "code",
+            "vehicle_type": "code",
+            "fuel_type": "code",
+            "last_maintenance": "date",
+            "row_version": "id",
+        },
+    ),
+    TableSpec(
+        "drivers",
+        Driver,
+        {
+            "id": "id",
+            "status": "code",
+            "rest_hours": "float",
+            "rating": "float",
+            "total_trips": "count",
+            "license_expiry": "date",
+            "last_duty_end": "time",
+            "row_version": "id",
+        },
+    ),
+)
+
+
+def _align(offset: int) -> int:
+    return -(-offset // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+
+# One table as parallel column arrays. Rows have no order; a delete moves the
+# last row into the gap so every column stays dense for vectorized readers.
+class FleetTable:
+    def __init__(self, spec: TableSpec, columns: dict, vocab: dict, rows: int):
+        self.spec = spec
+        self.columns = columns
+        self.vocab = vocab  # code column -> list of values
+        self._codes = {
+            column: {value: code for code, value in enumerate(values)}
+            for column, values in vocab.items()
+        }
+        self.rows = rows
+        self.index = dict(zip(columns["id"][:rows].tolist(), range(rows)))
+
+    @classmethod
+    def empty(cls, spec: TableSpec):
+        columns = {column: np.empty(0, dtype) for column, dtype in spec.dtypes.items()}
+        vocab = {c: [] for c, kind in spec.columns.items() if kind == "code"}
+        return cls(spec, columns, vocab, 0)
+
+    def column(self, name: str) -> np.ndarray:
+        return self.columns[name][:self.rows]
+
+    def decode(self, column: str, values):
+        vocab = self.vocab[column]
+        return [vocab[code] if code >= 0 else None for code in values]
+
+    def code(self, column: str, value) -> int:
+        return self._codes[column].get(value, -1)
+
+    # Copies of the given columns for the ids present, in the order given
+    def take(self, row_ids, columns):
+        rows = [row for row in map(self.index.get, row_ids) if row is not None]
+        return {column: self.columns[column][rows] for column in columns}
+
+    def row(self, row_id: int):
+        row = self.index.get(row_id)
+        if row is None:
+            return None
+        record = {}
+        for column, kind in self.spec.columns.items():
+            value = self.columns[column][row]
+            if kind == "code":
+                value = self.vocab[column][value] if value >= 0 else None
+            elif kind in ("date", "time"):
+                value = None if np.isnat(value) else value.item()
+            elif kind == "float":
+                value = None if value != value else float(value)
+            else:
+                value = None if kind != "id" and value < 0 else int(value)
+            record[column] = value
+        return record
+
+    # Database rows (tuples in spec column order) to column arrays
+    def _arrays(self, records):
+        values = list(zip(*records))
+        arrays = {}
+        for (column, kind), column_values in zip(self.spec.columns.items(), values):
+            dtype = self.spec.dtypes[column]
+            if kind == "code":
+                codes = self._codes[column]
+                vocab = self.vocab[column]
+                encoded = []
+                for value in column_values:
+                    if value is None:
+                        encoded.append(-1)
+                        continue
+                    code = codes.get(value)
+                    if code is None:
+                        code = codes[value] = len(vocab)
+                        vocab.append(value)
+                    encoded.append(code)
+                column_values = encoded
+            elif kind in ("ref", "count"):
+                column_values = [-1 if v is None else v for v in column_values]
+            arrays[column] = np.array(column_values, dtype=dtype)
+        return arrays
+
+    def _reserve(self, rows: int):
+        capacity = len(self.columns["id"])
+        if rows <= capacity:
+            return
+        capacity = max(rows, capacity * 2, 1024)
+        for column, data in self.columns.items():
+            grown = np.empty(capacity, data.dtype)
+            grown[:self.rows] = data[:self.rows]
+            self.columns[column] = grown
+
+    def upsert(self, records):
+        if not records:
+            return
+        arrays = self._arrays(records)
+        ids = arrays["id"].tolist()
+        rows = np.array([self.index.get(row_id, -1) for row_id in ids], dtype=np.int64)
+        known = rows >= 0
+        new = np.flatnonzero(~known)
+        if len(new):
+            start = self.rows
+            self._reserve(start + len(new))
+            rows[new] = np.arange(start, start + len(new))
+            self.rows += len(new)
+            for i, row in zip(new.tolist(), rows[new].tolist()):
+                self.index[ids[i]] = row
+        for column, values in arrays.items():
+            self.columns[column][rows] = values
+
+    def delete(self, row_ids):
+        for row_id in row_ids:
+            row = self.index.pop(row_id, None)
+            if row is None:
+                continue
+            last = self.rows - 1
+            if row != last:
+                for data in self.columns.values():
+                    data[row] = data[last]
+                self.index[int(self.columns["id"][row])] = row
+            self.rows = last
+
+
+def _select(db, spec: TableSpec, since: int = None):
+    model = spec.model
+    query = select(*[getattr(model, column) for column in spec.columns])
+    if since is not None:
+        query = query.where(model.row_version >= since)
+    return db.execute(query).fetchall()
+
+
+# The fleet's hot state for one tenant as of a row version (see sync.py): every
+# change made by transactions before `version` is included. Loads from
+# Postgres, or maps a snapshot file and replays the rows changed since the
+# version it was written at.
+class FleetState:
+    def __init__(self, tables: dict, version: int, source: str):
+        self.tables = tables
+        self.version = version
+        self.source = source  # "database" or "snapshot"
+        self.lock = threading.RLock()
+        self.replays = 0
+        self.replayed_rows = 0
+        self.replayed_at = None
+        # (table, columns, callback): callback(before, after) gets the columns
+        # of the changed rows as they were and are after each replay
+        self.watchers = []
+
+    def watch(self, table: str, columns, callback):
+        with self.lock:
+            self.watchers.append((table, tuple(columns), callback))
+
+    @property
+    def vehicles(self) -> FleetTable:
+        return self.tables["vehicles"]
+
+    @property
+    def drivers(self) -> FleetTable:
+        return self.tables["drivers"]
+
+    @classmethod
+    def load(cls, db):
+        version = snapshot_xmin(db)
+        tables = {}
+        for spec in FLEET_TABLES:
+            table = tables[spec.name] = FleetTable.empty(spec)
+            table.upsert(_select(db, spec))
+        return cls(tables, version, "database")
+
+    # Maps the file copy-on-write: columns are read from the page cache as
+    # they are touched, and updates stay private to this process
+    @classmethod
+    def open(cls, path: str):
+        with open(path, "rb") as f:
+            prefix = f.read(len(SNAPSHOT_MAGIC) + 4)
+            if prefix[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError("not a fleet snapshot")
+            length = int.from_bytes(prefix[len(SNAPSHOT_MAGIC):], "little")
+            header = json.loads(f.read(length))
+            if header.get("format") != SNAPSHOT_FORMAT:
+                raise ValueError(f"snapshot format {header.get('format')}")
+            if time.time() - header["written_at"] > SYNC_TOKEN_MAX_AGE.total_seconds():
+                # Deletes older than that may have lost their tombstones
+                raise ValueError("snapshot older than the tombstone retention")
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        data_start = _align(len(prefix) + length)
+        tables = {}
+        for spec in FLEET_TABLES:
+            meta = header["tables"].get(spec.name)
+            layout = {column: dtype.str for column, dtype in spec.dtypes.items()}
+            if meta is None or meta["dtypes"] != layout:
+                raise ValueError(f"snapshot columns of {spec.name} changed")
+            rows = meta["rows"]
+            columns = {
+                column: np.frombuffer(
+                    buffer,
+                    dtype,
+                    count=rows,
+                    offset=data_start + meta["offsets"][column],
+                )
+                for column, dtype in spec.dtypes.items()
+            }
+            tables[spec.name] = FleetTable(spec, columns, meta["vocab"], rows)
+        return cls(tables, header["version"], "snapshot")
+
+    # Applies the rows written and deleted since the state's version. Deletes go
+    # first, so a row deleted and created again under the same id survives.
+    def replay(self, db) -> int:
+        version = snapshot_xmin(db)
+        changes = {spec.name: _select(db, spec, self.version) for spec in FLEET_TABLES}
+        deleted = {}
+        for table_name, row_id in db.query(
+            Tombstone.table_name, Tombstone.row_id
+        ).filter(
+            Tombstone.table_name.in_(list(self.tables)),
+            Tombstone.row_version >= self.version,
+        ):
+            deleted.setdefault(table_name, []).append(row_id)
+        with self.lock:
+            for name, table in self.tables.items():
+                row_ids = deleted.get(name, []) + [row[0] for row in changes[name]]
+                watchers = [w for w in self.watchers if w[0] == name and row_ids]
+                before = [table.take(row_ids, columns) for _, columns, _ in watchers]
+                table.delete(deleted.get(name, ()))
+                table.upsert(changes[name])
+                for (_, columns, callback), old in zip(watchers, before):
+                    try:
+                        callback(old, table.take(row_ids, columns))
+                    except Exception as e:
+                        logging.error(f"Fleet state watcher failed: {e}")
+            self.version = version
+            self.replays += 1
+            self.replayed_rows += sum(map(len, changes.values()))
+            self.replayed_at = datetime.utcnow()
+        return sum(map(len, changes.values())) + sum(map(len, deleted.values()))
+
+    # Writes the state to a new file and renames it over `path`, so processes
+    # that mapped the previous file keep reading a consistent copy
+    def write(self, path: str) -> int:
+        with self.lock:
+            version = self.version
+            tables = {
+                name: (
+                    table.rows,
+                    {c: list(v) for c, v in table.vocab.items()},
+                    {c: table.column(c).copy() for c in table.spec.columns},
+                )
+                for name, table in self.tables.items()
+            }
+        header = {
+            "format": SNAPSHOT_FORMAT,
+            "version": version,
+            "written_at": time.time(),
+            "tables": {},
+        }
+        offset = 0
+        for name, (rows, vocab, columns) in tables.items():
+            offsets = {}
+            for column, data in columns.items():
+                offsets[column] = offset
+                offset = _align(offset + data.nbytes)
+            header["tables"][name] = {
+                "rows": rows,
+                "vocab": vocab,
+                "dtypes": {column: data.dtype.str for column, data in columns.items()},
+                "offsets": offsets,
+            }
+        encoded = json.dumps(header).encode()
+        prefix = SNAPSHOT_MAGIC + len(encoded).to_bytes(4, "little")
+        data_start = _align(len(prefix) + len(encoded))
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(prefix + encoded)
+                for name, (rows, vocab, columns) in tables.items():
+                    offsets = header["tables"][name]["offsets"]
+                    for column, data in columns.items():
+                        f.seek(data_start + offsets[column])
+                        f.write(data.tobytes())
+                f.truncate(data_start + offset)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return data_start + offset
+
+    def stats(self):
+        return {
+            "source": self.source,
+            "version": self.version,
+            "vehicles": self.vehicles.rows,
+            "drivers": self.drivers.rows,
+            "replays": self.replays,
+            "replayed_rows": self.replayed_rows,
+            "replayed_at": self.replayed_at.isoformat() if self.replayed_at else None,
+        }
+
+
+# One fleet state per tenant, loaded on first use from the tenant's snapshot
+# (or Postgres when there is none). A single thread replays the changes of
+# every loaded tenant so writes from other processes show up within
+# FLEET_STATE_REFRESH_SECONDS.
+class FleetStateRegistry:
+    def __init__(
+        self,
+        directory: str = FLEET_SNAPSHOT_DIR,
+        refresh_seconds: float = FLEET_STATE_REFRESH_SECONDS,
+    ):
+        self.directory = directory
+        self.refresh_seconds = refresh_seconds
+        self.states = {}
+        self.load_seconds = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def path(self, tenant: str = None) -> str:
+        return os.path.join(self.directory, f"fleet-{tenant or DEFAULT_TENANT}.snap")
+
+    def get(self, tenant: str = None) -> FleetState:
+        state = self.states.get(tenant)
+        if state is not None:
+            return state
+        with self._lock:
+            state = self.states.get(tenant)
+            if state is None:
+                state = self.states[tenant] = self._load(tenant)
+        return state
+
+    # Loads the tenant's state in the background
+    def warm(self, tenant: str = None):
+        threading.Thread(
+            target=self._warm, args=(tenant,), name="fleet-state-warmup", daemon=True
+        ).start()
+
+    def _warm(self, tenant):
+        try:
+            self.get(tenant)
+        except Exception as e:
+            logging.error(f"Fleet state warm-up failed for tenant {tenant}: {e}")
+
+    def _load(self, tenant):
+        started = time.monotonic()
+        state = None
+        path = self.path(tenant)
+        if os.path.exists(path):
+            try:
+                state = FleetState.open(path)
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Ignoring fleet snapshot {path}: {e}")
+        with open_session(tenant) as db:
+            if state is None:
+                state = FleetState.load(db)
+            else:
+                state.replay(db)
+        self.load_seconds[tenant] = time.monotonic() - started
+        logging.info(
+            f"Loaded fleet state for tenant {tenant} from {state.source}: "
+            f"{state.vehicles.rows} vehicles, {state.drivers.rows} drivers "
+            f"in {self.load_seconds[tenant]:.2f}s"
+        )
+        return state
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="fleet-state-refresh", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping.wait(self.refresh_seconds):
+            self.refresh_all()
+
+    def refresh_all(self):
+        for tenant, state in list(self.states.items()):
+            try:
+                with open_session(tenant) as db:
+                    state.replay(db)
+            except Exception as e:
+                logging.error(f"Fleet state refresh failed for tenant {tenant}: {e}")
+
+    def stats(self):
+        return {
+            str(tenant): {
+                **state.stats(),
+                "load_seconds": round(self.load_seconds.get(tenant, 0.0), 3),
+            }
+            for tenant, state in list(self.states.items())
+        }
+
+
+fleet_states = FleetStateRegistry()
+
+
+@job_queue.register("fleet_snapshot")
+def run_fleet_snapshot(ctx: JobContext):
+    state = fleet_states.get(ctx.tenant)
+    with open_session(ctx.tenant) as db:
+        state.replay(db)
+    size = state.write(fleet_states.path(ctx.tenant))
+    return {
+        "version": state.version,
+        "vehicles": state.vehicles.rows,
+        "drivers": state.drivers.rows,
+        "bytes": size,
+    }
+
+
+job_queue.schedule(
+    "fleet_snapshot", FLEET_SNAPSHOT_SECONDS, tenant_router.active_tenants
+)
@@ -0,0 +1,348 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime
+import json
+import multiprocessing
+import os
+import warnings
+
+import numpy as np
+from sqlalchemy import insert, text
+
+from cache import TTLCache
+from jobs import JobContext, job_queue
+from models import CostForecast
+from tenancy import open_session
+
+FORECAST_WORKERS = int(os.getenv("FORECAST_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Below this many series the fit runs in the job's thread: starting worker
+# processes and importing statsmodels in each costs more than it saves
+FORECAST_PARALLEL_MIN_SERIES = int(os.getenv("FORECAST_PARALLEL_MIN_SERIES", "200"))
+FORECAST_HISTORY_MONTHS = int(os.getenv("FORECAST_HISTORY_MONTHS", "60"))
+FORECAST_CACHE_SECONDS = float(os.getenv("FORECAST_CACHE_SECONDS", "300"))
+FORECAST_MAX_MONTHS = 24
+# Series per task sent to a worker process
+FORECAST_CHUNK = 100
+# Rows per multi-row INSERT, vehicle ids per DELETE
+STORE_CHUNK = 500
+
+SEASON = 12
+# Months of history needed for a damped trend, and for a yearly season on top
+TREND_MIN_OBSERVATIONS = 6
+SEASONAL_MIN_OBSERVATIONS = 2 * SEASON
+Z_95 = 1.96
+
+
+def month_ordinal(day: date) -> int:
+    return day.year * 12 + day.month - 1
+
+
+def ordinal_month(ordinal: int) -> date:
+    return date(ordinal // 12, ordinal % 12 + 1, 1)
+
+
+def _mean_model(y):
+    sigma = float(np.std(y, ddof=1)) if len(y) > 1 else abs(float(y[0]))
+    params = {"level": float(np.mean(y)), "trend": 0.0, "phi": 0.0, "sigma": sigma}
+    return "mean", params
+
+
+# Additive Holt-Winters with a damped trend when there are two years of
+# history, Holt's damped trend with less, the mean for very short series.
+# Only the final state is kept: it is all a forecast needs. The brute force
+# grid search for starting values halves the fit rate for no better fit here.
+def fit_series(y):
+    from statsmodels.tsa.holtwinters import ExponentialSmoothing
+
+    if len(y) < TREND_MIN_OBSERVATIONS or not y.any():
+        return _mean_model(y)
+    seasonal = len(y) >= SEASONAL_MIN_OBSERVATIONS
+    try:
+        fit = ExponentialSmoothing(
+            y,
+            trend="add",
+            damped_trend=True,
+            seasonal="add" if seasonal else None,
+            seasonal_periods=SEASON if seasonal else None,
+            initialization_method="estimated",
+        ).fit(use_brute=False)
+        params = {
+            "level": float(fit.level[-1]),
+            "trend": float(fit.trend[-1]),
+            "phi": float(fit.params["damping_trend"]),
+            "sigma": float(np.std(fit.resid)),
+        }
+        if seasonal:
+            params["season"] = [float(v) for v in fit.season[-SEASON:]]
+    except Exception:
+        # One degenerate series must not fail the fleet's refit
+        return _mean_model(y)
+    if not np.isfinite([params[k] for k in ("level", "trend", "phi", "sigma")]).all():
+        return _mean_model(y)
+    return ("holt_winters" if seasonal else "damped_trend"), params
+
+
+# Runs in the worker processes: (key, monthly amounts) pairs in,
+# (key, method, params) out
+def fit_chunk(series):
+    with warnings.catch_warnings():
+        # Convergence warnings on short or flat series
+        warnings.simplefilter("ignore")
+        return [(key, *fit_series(values)) for key, values in series]
+
+
+def fit_all(series, progress=None):
+    chunks = [
+        series[start:start + FORECAST_CHUNK]
+        for start in range(0, len(series), FORECAST_CHUNK)
+    ]
+    results = []
+    if FORECAST_WORKERS <= 1 or len(series) < FORECAST_PARALLEL_MIN_SERIES:
+        for chunk in chunks:
+            results.extend(fit_chunk(chunk))
+            if progress:
+                progress(len(results))
+        return results
+    # Spawned, not forked: the API process runs threads and holds connections
+    executor = ProcessPoolExecutor(
+        FORECAST_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+    try:
+        futures = [executor.submit(fit_chunk, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            results.extend(future.result())
+            if progress:
+                progress(len(results))
+    finally:
+        executor.shutdown(cancel_futures=True)
+    return results
+
+
+# Per vehicle: cost rows, newest row version and the last complete month. Any
+# insert, update or delete of a vehicle's costs changes it, and so does the
+# turn of a month, which adds a month to every series.
+def cost_signatures(db, month_start: date):
+    rows = db.execute(
+        text(
+            "SELECT vehicle_id, count(*), max(row_version) FROM costs "
+            "WHERE vehicle_id IS NOT NULL AND date < :month_start "
+            "GROUP BY vehicle_id"
+        ),
+        {"month_start": month_start},
+    )
+    last = month_ordinal(month_start) - 1
+    return {vehicle_id: f"{n}:{version}:{last}" for vehicle_id, n, version in rows}
+
+
+# Monthly totals per (vehicle, category), from the month of the first cost to
+# the last complete month, months without costs as zero
+def monthly_series(db, vehicle_ids, month_start: date):
+    import pandas as pd
+
+    rows = db.execute(
+        text(
+            "SELECT vehicle_id, category, "
+            "extract(year FROM date)::int * 12 + extract(month FROM date)::int - 1, "
+            "sum(amount) FROM costs "
+            "WHERE vehicle_id = ANY(:vehicle_ids) AND date < :month_start "
+            "GROUP BY 1, 2, 3"
+        ),
+        {"vehicle_ids": list(vehicle_ids), "month_start": month_start},
+    ).fetchall()
+    if not rows:
+        return []
+    frame = pd.DataFrame(rows, columns=["vehicle_id", "category", "period", "amount"])
+    wide = frame.pivot_table(
+        index="period", columns=["vehicle_id", "category"], values="amount"
+    )
+    last = month_ordinal(month_start) - 1
+    first_period = max(frame["period"].min(), last - FORECAST_HISTORY_MONTHS + 1)
+    wide = wide.reindex(range(first_period, last + 1))
+    observed = wide.notna().to_numpy()
+    # Series start at their first month with costs
+    first = np.where(observed.any(axis=0), observed.argmax(axis=0), len(wide))
+    values = wide.fillna(0.0).to_numpy().T.copy()
+    return [
+        ((int(vehicle_id), category), values[i, first[i]:])
+        for i, (vehicle_id, category) in enumerate(wide.columns)
+        if first[i] < len(wide)
+    ]
+
+
+def store_models(db, fitted, signatures, replaced, last_period: date):
+    for start in range(0, len(replaced), STORE_CHUNK):
+        db.query(CostForecast).filter(
+            CostForecast.vehicle_id.in_(replaced[start:start + STORE_CHUNK])
+        ).delete(synchronize_session=False)
+    now = datetime.utcnow()
+    rows = [
+        {
+            "vehicle_id": vehicle_id,
+            "category": category,
+            "method": method,
+            "params": json.dumps(params),
+            "last_period": last_period,
+            "observations": observations,
+            "source_version": signatures[vehicle_id],
+            "fitted_at": now,
+        }
+        for (vehicle_id, category), method, params, observations in fitted
+    ]
+    for start in range(0, len(rows), STORE_CHUNK):
+        db.execute(insert(CostForecast).values(rows[start:start + STORE_CHUNK]))
+    db.commit()
+
+
+# Fitted models of a tenant as arrays, so a forecast for one vehicle or the
+# whole fleet is a few vectorised operations
+class ForecastModels:
+    def __init__(self, rows):
+        self.categories = sorted({row.category for row in rows})
+        codes = {category: i for i, category in enumerate(self.categories)}
+        n = len(rows)
+        self.vehicle_ids = np.array([row.vehicle_id for row in rows], dtype=np.int64)
+        self.category_codes = np.array([codes[row.category] for row in rows], dtype=int)
+        self.methods = [row.method for row in rows]
+        self.last_period = np.array(
+            [month_ordinal(row.last_period) for row in rows], dtype=int
+        )
+        self.level = np.zeros(n)
+        self.trend = np.zeros(n)
+        self.phi = np.zeros(n)
+        self.sigma = np.zeros(n)
+        self.season = np.zeros((n, SEASON))
+        for i, row in enumerate(rows):
+            params = json.loads(row.params)
+            self.level[i] = params["level"]
+            self.trend[i] = params["trend"]
+            self.phi[i] = params["phi"]
+            self.sigma[i] = params["sigma"]
+            if "season" in params:
+                self.season[i] = params["season"]
+        self.fitted_at = max((row.fitted_at for row in rows), default=None)
+        self.by_vehicle = {}
+        for i, vehicle_id in enumerate(self.vehicle_ids.tolist()):
+            self.by_vehicle.setdefault(vehicle_id, []).append(i)
+
+    def _predict(self, rows, first_period: int, months: int):
+        # Months ahead of each series' last fitted month
+        steps = first_period + np.arange(months)[None, :] - self.last_period[rows, None]
+        steps = np.maximum(steps, 1)
+        phi = self.phi[rows, None]
+        # phi + phi^2 + ... + phi^h
+        with np.errstate(divide="ignore", invalid="ignore"):
+            damping = np.where(
+                phi < 1, phi * (1 - phi**steps) / (1 - phi), steps.astype(float)
+            )
+        season = np.take_along_axis(self.season[rows], (steps - 1) % SEASON, axis=1)
+        mean = self.level[rows, None] + damping * self.trend[rows, None] + season
+        variance = self.sigma[rows, None] ** 2 * steps
+        return np.maximum(mean, 0.0), variance
+
+    def forecast(self, first_period: int, months: int, vehicle_id: int = None):
+        periods = [ordinal_month(first_period + k) for k in range(months)]
+        if vehicle_id is not None:
+            rows = np.array(self.by_vehicle.get(vehicle_id, []), dtype=int)
+        else:
+            rows = np.arange(len(self.vehicle_ids))
+        mean, variance = self._predict(rows, first_period, months)
+        # Fleet figures sum the vehicles' series, assumed independent
+        codes = self.category_codes[rows]
+        totals = np.zeros((len(self.categories), months))
+        variances = np.zeros((len(self.categories), months))
+        np.add.at(totals, codes, mean)
+        np.add.at(variances, codes, variance)
+        counts = np.bincount(codes, minlength=len(self.categories))
+        categories = []
+        for code in np.flatnonzero(counts):
+            method = None
+            if vehicle_id is not None:
+                method = self.methods[rows[codes == code][0]]
+            categories.append(
+                {
+                    "category": self.categories[code],
+                    "method": method,
+                    "series": int(counts[code]),
+                    "points": _points(periods, totals[code], variances[code]),
+                }
+            )
+        return {
+            "vehicle_id": vehicle_id,
+            "fitted_at": self.fitted_at,
+            "categories": categories,
+            "total": _points(periods, totals.sum(axis=0), variances.sum(axis=0)),
+        }
+
+
+def _points(periods, amounts, variances):
+    spread = Z_95 * np.sqrt(variances)
+    return [
+        {
+            "period": period,
+            "amount": round(float(amount), 2),
+            "lower": round(float(max(amount - width, 0.0)), 2),
+            "upper": round(float(amount + width), 2),
+        }
+        for period, amount, width in zip(periods, amounts, spread)
+    ]
+
+
+def load_models(db) -> ForecastModels:
+    return ForecastModels(db.query(CostForecast).all())
+
+
+# Tenant -> ForecastModels; the refit job invalidates its tenant's entry here,
+# other API processes pick the new models up when theirs expires
+forecast_cache = TTLCache(FORECAST_CACHE_SECONDS)
+
+
+def cost_forecast(db, tenant, months: int, vehicle_id: int = None, today=None):
+    models, _ = forecast_cache.get_or_compute(tenant, lambda: load_models(db))
+    first_period = month_ordinal(today or date.today())
+    return models.forecast(first_period, months, vehicle_id)
+
+
+# Refits the vehicles whose costs changed since their models were fitted, or
+# every vehicle with "full". The database session is not held during the fit.
+@job_queue.register("cost_forecast", heavy=True)
+def run_cost_forecast(ctx: JobContext):
+    full = bool(ctx.payload.get("full"))
+    month_start = date.today().replace(day=1)
+    with open_session(ctx.tenant) as db:
+        signatures = cost_signatures(db, month_start)
+        fitted_versions = dict(
+            db.query(CostForecast.vehicle_id, CostForecast.source_version).distinct()
+        )
+        stale = sorted(
+            vehicle_id
+            for vehicle_id, signature in signatures.items()
+            if full or fitted_versions.get(vehicle_id) != signature
+        )
+        removed = [v for v in fitted_versions if v not in signatures]
+        series = monthly_series(db, stale, month_start) if stale else []
+    ctx.progress(0.1, f"Fitting {len(series)} series for {len(stale)} vehicles")
+    fitted = fit_all(
+        series,
+        lambda done: ctx.progress(
+            0.1 + 0.8 * done / len(series), f"Fitted {done} of {len(series)} series"
+        ),
+    )
+    observations = {key: len(values) for key, values in series}
+    fitted = [
+        (key, method, params, observations[key]) for key, method, params in fitted
+    ]
+    if stale or removed:
+        with open_session(ctx.tenant) as db:
+            store_models(
+                db,
+                fitted,
+                signatures,
+                stale + removed,
+                ordinal_month(month_ordinal(month_start) - 1),
+            )
+    forecast_cache.invalidate(ctx.tenant)
+    return {
+        "vehicles": len(signatures),
+        "refitted": len(stale),
+        "removed": len(removed),
+        "series": len(series),
+    }
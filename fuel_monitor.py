@@ -0,0 +1,268 @@
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+import math
+import os
+import threading
+
+from sqlalchemy import func
+
+from models import Cost, FuelAlert
+from trips import haversine_km
+
+# Fuel levels are percentages of tank capacity, as stored on Vehicle.fuel_level
+FUEL_DROP_THRESHOLD = float(os.getenv("FUEL_DROP_THRESHOLD", "8"))
+FUEL_REFUEL_THRESHOLD = float(os.getenv("FUEL_REFUEL_THRESHOLD", "10"))
+FUEL_MAX_GAP = float(os.getenv("FUEL_MAX_GAP", "3600"))  # seconds
+FUEL_COST_MATCH_DAYS = int(os.getenv("FUEL_COST_MATCH_DAYS", "1"))
+FUEL_MIN_SEGMENT_KM = float(os.getenv("FUEL_MIN_SEGMENT_KM", "50"))
+FUEL_OUTLIER_Z = float(os.getenv("FUEL_OUTLIER_Z", "3"))
+FUEL_EWMA_ALPHA = float(os.getenv("FUEL_EWMA_ALPHA", "0.2"))
+FUEL_MIN_SEGMENTS = 3
+# Consumption (% of tank per km) assumed until a vehicle has its own history
+DEFAULT_CONSUMPTION_RATE = float(os.getenv("FUEL_DEFAULT_RATE", "0.25"))
+
+FUEL_CATEGORY = "fuel"
+
+
+def is_fuel_cost(category) -> bool:
+    return bool(category) and category.strip().lower() == FUEL_CATEGORY
+
+
+# Per-vehicle rolling state lives in parallel typed arrays indexed by a slot
+# number, so the detector keeps a few dozen bytes per vehicle and never
+# touches the database while processing a message.
+class FuelMonitor:
+    def __init__(self):
+        self.slots = {}
+        self.last_ts = array("d")
+        self.last_fuel = array("d")
+        self.last_lat = array("d")
+        self.last_lon = array("d")
+        self.segment_km = array("d")
+        self.segment_used = array("d")
+        self.rate_mean = array("d")
+        self.rate_var = array("d")
+        self.rate_count = array("l")
+        self.fuel_costs = {}
+        self.pending = []
+        self._lock = threading.Lock()
+
+    def load_fuel_costs(self, db, days: int = 90):
+        since = datetime.utcnow().date() - timedelta(days=days)
+        rows = (
+            db.query(Cost.vehicle_id, Cost.date)
+            .filter(
+                func.lower(Cost.category) == FUEL_CATEGORY,
+                Cost.vehicle_id.isnot(None),
+                Cost.date >= since,
+            )
+            .all()
+        )
+        with self._lock:
+            self.fuel_costs = {}
+            for vehicle_id, day in rows:
+                self.fuel_costs.setdefault(vehicle_id, []).append(day.toordinal())
+            for ordinals in self.fuel_costs.values():
+                ordinals.sort()
+
+    def note_fuel_cost(self, vehicle_id: int, day):
+        with self._lock:
+            ordinals = self.fuel_costs.setdefault(vehicle_id, [])
+            ordinals.insert(bisect_left(ordinals, day.toordinal()), day.toordinal())
+
+    def _has_fuel_cost(self, vehicle_id, at: datetime):
+        ordinals = self.fuel_costs.get(vehicle_id)
+        if not ordinals:
+            return False
+        day = at.toordinal()
+        i = bisect_left(ordinals, day - FUEL_COST_MATCH_DAYS)
+        return i < len(ordinals) and ordinals[i] <= day + FUEL_COST_MATCH_DAYS
+
+    def _slot(self, vehicle_id):
+        slot = self.slots.get(vehicle_id)
+        if slot is None:
+            slot = self.slots[vehicle_id] = len(self.last_ts)
+            for column in (
+                self.last_ts,
+                self.last_fuel,
+                self.last_lat,
+                self.last_lon,
+                self.segment_km,
+                self.segment_used,
+                self.rate_mean,
+                self.rate_var,
+            ):
+                column.append(math.nan)
+            self.rate_count.append(0)
+            self.segment_km[slot] = 0.0
+            self.segment_used[slot] = 0.0
+            self.rate_mean[slot] = DEFAULT_CONSUMPTION_RATE
+            self.rate_var[slot] = 0.0
+        return slot
+
+    def _alert(
+        self, vehicle_id, alert_type, at, lat, lon, fuel_before, fuel_after, details
+    ):
+        alert = {
+            "vehicle_id": vehicle_id,
+            "alert_type": alert_type,
+            "occurred_at": at,
+            "latitude": lat,
+            "longitude": lon,
+            "fuel_before": fuel_before,
+            "fuel_after": fuel_after,
+            "details": details,
+            "resolved": False,
+        }
+        self.pending.append(alert)
+
+    def process(self, vehicle_id: int, at: datetime, lat, lon, fuel):
+        if fuel is None:
+            return
+        with self._lock:
+            self._process(vehicle_id, at, lat, lon, fuel)
+
+    def _process(self, vehicle_id, at, lat, lon, fuel):
+        slot = self._slot(vehicle_id)
+        ts = at.timestamp()
+        last_ts = self.last_ts[slot]
+        last_fuel = self.last_fuel[slot]
+        last_lat = self.last_lat[slot]
+        last_lon = self.last_lon[slot]
+        self.last_ts[slot] = ts
+        self.last_fuel[slot] = fuel
+        if lat is not None and lon is not None:
+            self.last_lat[slot] = lat
+            self.last_lon[slot] = lon
+        if math.isnan(last_ts) or ts <= last_ts:
+            return
+        if ts - last_ts > FUEL_MAX_GAP:
+            # Too long without data to attribute the change to a single event
+            self.segment_km[slot] = 0.0
+            self.segment_used[slot] = 0.0
+            return
+
+        step_km = 0.0
+        if lat is not None and lon is not None and not math.isnan(last_lat):
+            step_km = haversine_km(last_lat, last_lon, lat, lon)
+        delta = fuel - last_fuel
+
+        if delta >= FUEL_REFUEL_THRESHOLD:
+            if not self._has_fuel_cost(vehicle_id, at):
+                self._alert(
+                    vehicle_id,
+                    "unmatched_refuel",
+                    at,
+                    lat,
+                    lon,
+                    last_fuel,
+                    fuel,
+                    f"Refuel of {delta:.1f}% with no fuel cost recorded "
+                    f"within {FUEL_COST_MATCH_DAYS} day(s)",
+                )
+            self._close_segment(vehicle_id, slot, at, lat, lon)
+            return
+
+        used = max(0.0, -delta)
+        expected = step_km * self.rate_mean[slot]
+        if used - expected >= FUEL_DROP_THRESHOLD:
+            self._alert(
+                vehicle_id,
+                "fuel_drop",
+                at,
+                lat,
+                lon,
+                last_fuel,
+                fuel,
+                f"Fuel dropped {used:.1f}% over {step_km:.2f} km in "
+                f"{ts - last_ts:.0f}s (expected {expected:.1f}%)",
+            )
+            # Stolen or leaked fuel must not skew the consumption baseline
+            return
+        self.segment_km[slot] += step_km
+        self.segment_used[slot] += used
+
+    def _close_segment(self, vehicle_id, slot, at, lat, lon):
+        distance = self.segment_km[slot]
+        used = self.segment_used[slot]
+        self.segment_km[slot] = 0.0
+        self.segment_used[slot] = 0.0
+        if distance < FUEL_MIN_SEGMENT_KM:
+            return
+        rate = used / distance
+        mean = self.rate_mean[slot]
+        var = self.rate_var[slot]
+        count = self.rate_count[slot]
+        if count >= FUEL_MIN_SEGMENTS and var > 0:
+            z = (rate - mean) / math.sqrt(var)
+            if z >= FUEL_OUTLIER_Z:
+                self._alert(
+                    vehicle_id,
+                    "consumption_outlier",
+                    at,
+                    lat,
+                    lon,
+                    None,
+                    None,
+                    f"Used {rate:.3f}%/km over {distance:.0f} km, "
+                    f"usual {mean:.3f}%/km (z={z:.1f})",
+                )
+        # Exponentially weighted mean and variance of consumption per km
+        if count == 0:
+            mean, var = rate, 0.0
+        else:
+            diff = rate - mean
+            incr = FUEL_EWMA_ALPHA * diff
+            mean += incr
+            var = (1 - FUEL_EWMA_ALPHA) * (var + diff * incr)
+        self.rate_mean[slot] = mean
+        self.rate_var[slot] = var
+        self.rate_count[slot] = count + 1
+
+    def has_pending(self) -> bool:
+        return bool(self.pending)
+
+    def flush(self, db):
+        with self._lock:
+            alerts, self.pending = self.pending, []
+        if alerts:
+            db.bulk_insert_mappings(FuelAlert, alerts)
+
+    def stats(self):
+        return {
+            "vehicles": len(self.slots),
+            "state_bytes": sum(
+                column.itemsize * len(column)
+                for column in (
+                    self.last_ts,
+                    self.last_fuel,
+                    self.last_lat,
+                    self.last_lon,
+                    self.segment_km,
+                    self.segment_used,
+                    self.rate_mean,
+                    self.rate_var,
+                    self.rate_count,
+                )
+            ),
+            "pending_alerts": len(self.pending),
+        }
+
+
+def resolve_refuel_alerts(db, vehicle_id: int, day):
+    # A fuel cost entered after the refuel was seen explains it
+    window = timedelta(days=FUEL_COST_MATCH_DAYS)
+    start = datetime.combine(day - window, datetime.min.time())
+    end = datetime.combine(day + window + timedelta(days=1), datetime.min.time())
+    return (
+        db.query(FuelAlert)
+        .filter(
+            FuelAlert.vehicle_id == vehicle_id,
+            FuelAlert.alert_type == "unmatched_refuel",
+            FuelAlert.resolved.is_(False),
+            FuelAlert.occurred_at >= start,
+            FuelAlert.occurred_at < end,
+        )
+        .update({"resolved": True}, synchronize_session=False)
+    )
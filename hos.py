@@ -0,0 +1,537 @@
+from collections import deque
+from datetime import datetime, timedelta
+import logging
+import math
+import os
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models import Driver, DutyEvent, Tombstone
+from sync import snapshot_xmin
+from telemetry import parse_timestamp
+from tenancy import open_session
+
+# Hours-of-service rules, EU 561/2006 style by default. Daily limits apply to
+# the duty period since the last daily rest; weekly ones to the last 7 days.
+HOS_DAILY_DRIVING_HOURS = float(os.getenv("HOS_DAILY_DRIVING_HOURS", "9"))
+HOS_WEEKLY_DRIVING_HOURS = float(os.getenv("HOS_WEEKLY_DRIVING_HOURS", "56"))
+HOS_CONTINUOUS_DRIVING_HOURS = float(os.getenv("HOS_CONTINUOUS_DRIVING_HOURS", "4.5"))
+# Any time not driving this long resets the continuous driving clock
+HOS_BREAK_MINUTES = float(os.getenv("HOS_BREAK_MINUTES", "45"))
+# Every duty period ends with this much rest within 24 hours of the last one
+HOS_DAILY_REST_HOURS = float(os.getenv("HOS_DAILY_REST_HOURS", "11"))
+HOS_WEEKLY_REST_HOURS = float(os.getenv("HOS_WEEKLY_REST_HOURS", "45"))
+# A weekly rest starts at most this long after the previous one ended
+HOS_WEEKLY_REST_DUE_HOURS = float(os.getenv("HOS_WEEKLY_REST_DUE_HOURS", "144"))
+# Limits reached within this time at the current duty status are predicted
+HOS_WARNING_MINUTES = float(os.getenv("HOS_WARNING_MINUTES", "60"))
+HOS_REFRESH_SECONDS = float(os.getenv("HOS_REFRESH_SECONDS", "2"))
+# Accepted clock skew for events recorded by devices
+HOS_MAX_FUTURE_SECONDS = 60
+
+DAY = 24 * 3600.0
+WEEK = 7 * DAY
+# History loaded on start: the weekly windows, or back to the start of the last
+# weekly rest a compliant driver can have had, and a day to spare
+HOS_LOOKBACK_SECONDS = (
+    max(WEEK, (HOS_WEEKLY_REST_DUE_HOURS + HOS_WEEKLY_REST_HOURS) * 3600) + DAY
+)
+
+DRIVING = "driving"
+ON_DUTY = "on_duty"
+OFF_DUTY = "off_duty"
+DUTY_STATUSES = (DRIVING, ON_DUTY, OFF_DUTY)
+# Driver.status <-> duty status; other driver statuses leave the duty log alone
+DRIVER_STATUS_DUTY = {"On Trip": DRIVING, "Available": ON_DUTY, "Off Duty": OFF_DUTY}
+DUTY_DRIVER_STATUS = {duty: status for status, duty in DRIVER_STATUS_DUTY.items()}
+
+# Rule -> (limit in seconds, duty statuses during which its clock runs)
+RULES = {
+    "daily_driving": (HOS_DAILY_DRIVING_HOURS * 3600, (DRIVING,)),
+    "weekly_driving": (HOS_WEEKLY_DRIVING_HOURS * 3600, (DRIVING,)),
+    "continuous_driving": (HOS_CONTINUOUS_DRIVING_HOURS * 3600, (DRIVING,)),
+    "daily_rest": (DAY - HOS_DAILY_REST_HOURS * 3600, (DRIVING, ON_DUTY)),
+    "weekly_rest": (HOS_WEEKLY_REST_DUE_HOURS * 3600, (DRIVING, ON_DUTY)),
+}
+WARNING = HOS_WARNING_MINUTES * 60
+EPOCH = datetime(1970, 1, 1)
+
+
+class HosError(ValueError):
+    pass
+
+
+def _seconds(moment: datetime) -> float:
+    return (moment - EPOCH).total_seconds()
+
+
+def _datetime(seconds: float) -> datetime:
+    return EPOCH + timedelta(seconds=seconds)
+
+
+# Sum of the closed periods overlapping the last `window` seconds. Periods come
+# in time order and leave from the front once they fall out of the window, so
+# each one is touched twice whatever the query rate.
+class RollingTotal:
+    __slots__ = ("window", "periods", "total")
+
+    def __init__(self, window: float):
+        self.window = window
+        self.periods = deque()
+        self.total = 0.0
+
+    def add(self, start: float, end: float):
+        if end > start:
+            self.periods.append((start, end))
+            self.total += end - start
+
+    def value(self, now: float) -> float:
+        cutoff = now - self.window
+        periods = self.periods
+        while periods and periods[0][1] <= cutoff:
+            start, end = periods.popleft()
+            self.total -= end - start
+        if not periods:
+            self.total = 0.0
+            return 0.0
+        if periods[0][0] < cutoff:
+            return self.total - (cutoff - periods[0][0])
+        return self.total
+
+
+# Running totals of one driver, advanced by each duty event in O(1). Time
+# before the driver's first known event counts as rest.
+class DriverClock:
+    __slots__ = (
+        "status",
+        "since",
+        "event_key",
+        "vehicle_id",
+        "day_driving",
+        "week_driving",
+        "day_rest",
+        "week_rest",
+        "continuous",
+        "period_driving",
+        "rest_end",
+        "weekly_rest_end",
+    )
+
+    def __init__(self, status: str, since: float, event_key, vehicle_id=None):
+        self.status = status
+        self.since = since
+        self.event_key = event_key
+        self.vehicle_id = vehicle_id
+        self.day_driving = RollingTotal(DAY)
+        self.week_driving = RollingTotal(WEEK)
+        self.day_rest = RollingTotal(DAY)
+        self.week_rest = RollingTotal(WEEK)
+        # Closed periods only: driving since the last break and the last rest
+        self.continuous = 0.0
+        self.period_driving = 0.0
+        self.rest_end = since
+        self.weekly_rest_end = since
+
+    # Closes the current period and starts one at `status`; an event repeating
+    # the current status continues the period
+    def apply(self, status: str, at: float, event_key, vehicle_id=None):
+        self.event_key = event_key
+        self.vehicle_id = vehicle_id
+        if status == self.status:
+            return
+        start, length = self.since, at - self.since
+        if self.status == DRIVING:
+            self.day_driving.add(start, at)
+            self.week_driving.add(start, at)
+            self.continuous += length
+            self.period_driving += length
+        else:
+            if length >= HOS_BREAK_MINUTES * 60:
+                self.continuous = 0.0
+            if self.status == OFF_DUTY:
+                self.day_rest.add(start, at)
+                self.week_rest.add(start, at)
+                if length >= HOS_DAILY_REST_HOURS * 3600:
+                    self.rest_end = at
+                    self.period_driving = 0.0
+                if length >= HOS_WEEKLY_REST_HOURS * 3600:
+                    self.weekly_rest_end = at
+        self.status = status
+        self.since = at
+
+    def evaluate(self, now: float) -> dict:
+        current = max(now - self.since, 0.0)
+        driving = current if self.status == DRIVING else 0.0
+        resting = current if self.status == OFF_DUTY else 0.0
+        continuous = self.continuous + driving
+        if self.status != DRIVING and current >= HOS_BREAK_MINUTES * 60:
+            continuous = 0.0
+        rest_end, weekly_rest_end = self.rest_end, self.weekly_rest_end
+        period_driving = self.period_driving + driving
+        if resting >= HOS_DAILY_REST_HOURS * 3600:
+            rest_end = now
+            period_driving = 0.0
+        if resting >= HOS_WEEKLY_REST_HOURS * 3600:
+            weekly_rest_end = now
+        # A rest in progress holds the rest clocks where it started
+        clock = self.since if self.status == OFF_DUTY else now
+        used = {
+            "daily_driving": period_driving,
+            "weekly_driving": self.week_driving.value(now) + min(driving, WEEK),
+            "continuous_driving": continuous,
+            "daily_rest": max(clock - rest_end, 0.0),
+            "weekly_rest": max(clock - weekly_rest_end, 0.0),
+        }
+        violations, predicted = [], []
+        next_review = math.inf
+        remaining_driving = math.inf
+        for rule, (limit, running) in RULES.items():
+            left = limit - used[rule]
+            if left < 0:
+                violations.append(rule)
+            elif self.status in running:
+                if left <= WARNING:
+                    predicted.append(rule)
+                next_review = min(next_review, now + left - WARNING)
+            if DRIVING in running:
+                remaining_driving = min(remaining_driving, max(left, 0.0))
+        if violations or predicted:
+            next_review = now
+        return {
+            "duty_status": self.status,
+            "duty_since": _datetime(self.since),
+            "vehicle_id": self.vehicle_id,
+            "driving_hours_24h": (self.day_driving.value(now) + min(driving, DAY))
+            / 3600,
+            "driving_hours_7d": used["weekly_driving"] / 3600,
+            "rest_hours_24h": (self.day_rest.value(now) + min(resting, DAY)) / 3600,
+            "rest_hours_7d": (self.week_rest.value(now) + min(resting, WEEK)) / 3600,
+            "continuous_driving_hours": continuous / 3600,
+            "duty_period_hours": used["daily_rest"] / 3600,
+            "duty_period_driving_hours": period_driving / 3600,
+            "hours_since_weekly_rest": used["weekly_rest"] / 3600,
+            # A lower bound: driving that leaves the rolling windows frees more
+            "remaining_driving_hours": remaining_driving / 3600,
+            "violations": violations,
+            "predicted": predicted,
+            "next_review": next_review,
+        }
+
+
+# The clocks of one tenant's drivers. Next to each clock is the earliest time
+# its verdict can get worse without another event; listing the non-compliant
+# drivers only evaluates the clocks that are due, which a numpy comparison
+# over all of them finds.
+class HosEngine:
+    def __init__(self, version: int = 0):
+        self.version = version
+        self.clocks = {}
+        self.slots = {}  # driver id -> position in driver_ids and review_at
+        self.driver_ids = []
+        self.review_at = np.empty(0)
+        self.events = 0
+        self.evaluated = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, db, now: datetime = None):
+        now = now or datetime.utcnow()
+        engine = cls(snapshot_xmin(db))
+        start = now - timedelta(seconds=HOS_LOOKBACK_SECONDS)
+        # The status each driver was in when the loaded history starts
+        earlier = (
+            db.query(DutyEvent)
+            .filter(DutyEvent.started_at < start)
+            .distinct(DutyEvent.driver_id)
+            .order_by(
+                DutyEvent.driver_id,
+                DutyEvent.started_at.desc(),
+                DutyEvent.event_id.desc(),
+            )
+        )
+        for e in earlier:
+            engine.apply(e.driver_id, e.duty_status, start, e.event_id, e.vehicle_id)
+        engine.apply_all(
+            db.query(DutyEvent)
+            .filter(DutyEvent.started_at >= start)
+            .order_by(DutyEvent.started_at, DutyEvent.event_id)
+        )
+        return engine
+
+    def apply_all(self, events):
+        for e in events:
+            self.apply(
+                e.driver_id, e.duty_status, e.started_at, e.event_id, e.vehicle_id
+            )
+
+    def apply(self, driver_id, status, at, event_id, vehicle_id=None) -> bool:
+        if isinstance(at, datetime):
+            at = _seconds(at)
+        key = (at, event_id)
+        with self._lock:
+            clock = self.clocks.get(driver_id)
+            if clock is None:
+                self.clocks[driver_id] = DriverClock(status, at, key, vehicle_id)
+                self._slot(driver_id)
+            elif key <= clock.event_key:
+                # Already applied; the clock only moves forward
+                return False
+            else:
+                clock.apply(status, at, key, vehicle_id)
+                self.review_at[self.slots[driver_id]] = -math.inf
+            self.events += 1
+        return True
+
+    def _slot(self, driver_id):
+        slot = self.slots.get(driver_id)
+        if slot is None:
+            slot = self.slots[driver_id] = len(self.driver_ids)
+            self.driver_ids.append(driver_id)
+            if slot >= len(self.review_at):
+                grown = np.full(max(2 * len(self.review_at), 1024), math.inf)
+                grown[:slot] = self.review_at[:slot]
+                self.review_at = grown
+        self.review_at[slot] = -math.inf
+
+    def remove(self, driver_id):
+        with self._lock:
+            if self.clocks.pop(driver_id, None) is not None:
+                self.review_at[self.slots[driver_id]] = math.inf
+
+    # Applies the events written since the engine's version, from any process
+    def replay(self, db) -> int:
+        version = snapshot_xmin(db)
+        events = (
+            db.query(DutyEvent)
+            .filter(DutyEvent.row_version >= self.version)
+            .order_by(DutyEvent.started_at, DutyEvent.event_id)
+            .all()
+        )
+        deleted = (
+            db.query(Tombstone.row_id)
+            .filter(
+                Tombstone.table_name == "drivers",
+                Tombstone.row_version >= self.version,
+            )
+            .all()
+        )
+        for (driver_id,) in deleted:
+            self.remove(driver_id)
+        before = self.events
+        self.apply_all(events)
+        self.version = version
+        return self.events - before
+
+    def state(self, driver_id, now: float = None):
+        now = time.time() if now is None else now
+        with self._lock:
+            clock = self.clocks.get(driver_id)
+            if clock is None:
+                return None
+            state = clock.evaluate(now)
+        state.pop("next_review")
+        return {"driver_id": driver_id, **state}
+
+    # Drivers in violation now, and with predicted=True also those about to be
+    def non_compliant(self, now: float = None, predicted: bool = True):
+        now = time.time() if now is None else now
+        results = []
+        with self._lock:
+            due = np.flatnonzero(self.review_at[:len(self.driver_ids)] <= now)
+            for slot in due.tolist():
+                driver_id = self.driver_ids[slot]
+                clock = self.clocks.get(driver_id)
+                if clock is None:
+                    self.review_at[slot] = math.inf
+                    continue
+                state = clock.evaluate(now)
+                self.review_at[slot] = state.pop("next_review")
+                if state["violations"] or (predicted and state["predicted"]):
+                    results.append({"driver_id": driver_id, **state})
+            self.evaluated += len(due)
+        results.sort(key=lambda s: (not s["violations"], s["remaining_driving_hours"]))
+        return results
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "drivers": len(self.clocks),
+            "events": self.events,
+            "evaluated": self.evaluated,
+        }
+
+
+# Mirrors a duty status onto the driver's own columns: when the driver last
+# went off duty, and how long the rest before the current duty period was
+def _update_driver(driver: Driver, duty_status: str, at: datetime, previous):
+    driver.status = DUTY_DRIVER_STATUS[duty_status]
+    if duty_status == OFF_DUTY:
+        driver.last_duty_end = at
+    elif previous == OFF_DUTY and driver.last_duty_end is not None:
+        driver.rest_hours = round((at - driver.last_duty_end).total_seconds() / 3600, 2)
+
+
+# Appends a duty event for a driver locked by the caller (SELECT ... FOR
+# UPDATE), so concurrent events of one driver are serialized and in order
+def record_duty_event(
+    db, driver: Driver, duty_status: str, at: datetime = None, vehicle_id=None
+) -> DutyEvent:
+    if duty_status not in DUTY_STATUSES:
+        raise HosError(f"Duty status must be one of {', '.join(DUTY_STATUSES)}")
+    now = datetime.utcnow()
+    # Offsets are converted to the naive UTC the log is kept in
+    at = now if at is None else parse_timestamp(at)
+    if at > now + timedelta(seconds=HOS_MAX_FUTURE_SECONDS):
+        raise HosError("Duty events cannot start in the future")
+    last = (
+        db.query(DutyEvent.started_at, DutyEvent.duty_status)
+        .filter(DutyEvent.driver_id == driver.id)
+        .order_by(DutyEvent.started_at.desc(), DutyEvent.event_id.desc())
+        .first()
+    )
+    if last is not None and at < last.started_at:
+        raise HosError(
+            f"Duty events must be recorded in order; the last one started at "
+            f"{last.started_at.isoformat()}"
+        )
+    duty_event = DutyEvent(
+        driver_id=driver.id,
+        duty_status=duty_status,
+        started_at=at,
+        vehicle_id=vehicle_id,
+        source="api",
+        recorded_at=now,
+    )
+    db.add(duty_event)
+    _update_driver(driver, duty_status, at, last.duty_status if last else None)
+    db.flush()
+    return duty_event
+
+
+# Status changes made anywhere else through the ORM (driver updates) are
+# logged too, unless they come with their own duty event
+@event.listens_for(Session, "before_flush")
+def _log_status_changes(session, flush_context, instances):
+    explicit = {obj.driver_id for obj in session.new if isinstance(obj, DutyEvent)}
+    now = None
+    for obj in list(session.dirty):
+        if not isinstance(obj, Driver) or obj.id in explicit:
+            continue
+        history = inspect(obj).attrs.status.history
+        if not history.added or not history.deleted:
+            continue
+        duty_status = DRIVER_STATUS_DUTY.get(history.added[0])
+        previous = DRIVER_STATUS_DUTY.get(history.deleted[0])
+        if duty_status is None or duty_status == previous:
+            continue
+        now = now or datetime.utcnow()
+        session.add(
+            DutyEvent(
+                driver_id=obj.id,
+                duty_status=duty_status,
+                started_at=now,
+                source="driver_status",
+                recorded_at=now,
+            )
+        )
+        if not inspect(obj).attrs.last_duty_end.history.added:
+            _update_driver(obj, duty_status, now, previous)
+
+
+# The duty event of a status change written without the ORM (the set-wise
+# updates of /batch never reach before_flush), or None when the duty status
+# stays the same. `driver` holds the new column values and is moved along like
+# the listener moves the ORM object.
+def status_change_event(
+    driver_id: int, driver, previous_status, at: datetime, keep_duty_end=False
+):
+    duty_status = DRIVER_STATUS_DUTY.get(driver.status)
+    previous = DRIVER_STATUS_DUTY.get(previous_status)
+    if duty_status is None or duty_status == previous:
+        return None
+    if not keep_duty_end:
+        _update_driver(driver, duty_status, at, previous)
+    return {
+        "driver_id": driver_id,
+        "duty_status": duty_status,
+        "started_at": at,
+        "source": "driver_status",
+        "recorded_at": at,
+    }
+
+
+# One engine per tenant, loaded on first use. A single thread replays the
+# events other processes wrote for every loaded tenant.
+class HosRegistry:
+    def __init__(self, refresh_seconds: float = HOS_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.engines = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def get(self, tenant: str = None) -> HosEngine:
+        engine = self.engines.get(tenant)
+        if engine is not None:
+            return engine
+        with self._lock:
+            engine = self.engines.get(tenant)
+            if engine is None:
+                started = time.monotonic()
+                with open_session(tenant) as db:
+                    engine = HosEngine.load(db)
+                # Sets every clock's next review, so the first listing is as
+                # cheap as the following ones
+                engine.non_compliant()
+                self.engines[tenant] = engine
+                logging.info(
+                    f"Loaded hours of service for tenant {tenant}: "
+                    f"{len(engine.clocks)} drivers, {engine.events} events in "
+                    f"{time.monotonic() - started:.2f}s"
+                )
+        return engine
+
+    # Applies an event this process committed without waiting for the replay
+    def record(self, tenant, driver_id, duty_status, at, event_id, vehicle_id):
+        engine = self.engines.get(tenant)
+        if engine is not None:
+            engine.apply(driver_id, duty_status, at, event_id, vehicle_id)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="hos-refresh", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping.wait(self.refresh_seconds):
+            self.refresh_all()
+
+    def refresh_all(self):
+        for tenant, engine in list(self.engines.items()):
+            try:
+                with open_session(tenant) as db:
+                    engine.replay(db)
+            except Exception as e:
+                logging.error(f"Hours of service refresh failed for {tenant}: {e}")
+
+    def stats(self):
+        return {
+            str(tenant): engine.stats() for tenant, engine in list(self.engines.items())
+        }
+
+
+hos_engines = HosRegistry()
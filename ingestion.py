@@ -0,0 +1,197 @@
+from datetime import datetime
+import logging
+import os
+import threading
+import time
+
+from events import event_bus
+from fuel_monitor import FuelMonitor
+from telemetry import TelemetryBuffer, TELEMETRY_FLUSH_SECONDS
+from trips import TRIP_MAX_GAP, GeofenceIndex, TripEngine, load_geofences
+
+# A tenant's pipeline is dropped after this long without positions or requests,
+# once its last trip has closed and everything is written. Longer than
+# TRIP_MAX_GAP, so the trips of a silent fleet have timed out by then.
+TELEMETRY_PIPELINE_IDLE_SECONDS = max(
+    float(os.getenv("TELEMETRY_PIPELINE_IDLE_SECONDS", "3600")), TRIP_MAX_GAP
+)
+PIPELINE_SWEEP_SECONDS = 60
+
+
+# Everything that consumes position updates for one fleet: the history
+# writer, trip/geofence engine and fuel detector. Each tenant gets its own
+# pipeline because vehicle ids are only unique within a tenant. Positions are
+# also published on the event bus for the /ws/fleet dashboards.
+class TelemetryPipeline:
+    def __init__(
+        self, session_factory, wakeup: threading.Event = None, tenant: str = None
+    ):
+        self.session_factory = session_factory
+        self.tenant = tenant
+        self.buffer = TelemetryBuffer(session_factory, wakeup=wakeup)
+        self.geofences = GeofenceIndex()
+        self.trips = TripEngine(self.geofences)
+        self.fuel = FuelMonitor()
+        self.buffer.flushers.append(self.trips)
+        self.buffer.flushers.append(self.fuel)
+        self.last_used = time.monotonic()
+
+    def load(self):
+        db = self.session_factory()
+        try:
+            load_geofences(db, self.geofences)
+            self.fuel.load_fuel_costs(db)
+        finally:
+            db.close()
+
+    def record(
+        self,
+        vehicle_id: int,
+        recorded_at: datetime,
+        latitude,
+        longitude,
+        speed,
+        fuel_level,
+    ):
+        self.last_used = time.monotonic()
+        if not self.buffer.accepts(recorded_at):
+            return False
+        self.buffer.add(
+            vehicle_id, recorded_at, latitude, longitude, speed, fuel_level
+        )
+        self.trips.process(vehicle_id, recorded_at, latitude, longitude, speed)
+        self.fuel.process(vehicle_id, recorded_at, latitude, longitude, fuel_level)
+        event_bus.publish(
+            "vehicle.position",
+            {
+                "vehicle_id": vehicle_id,
+                "recorded_at": recorded_at.isoformat(),
+                "latitude": latitude,
+                "longitude": longitude,
+                "speed": speed,
+                "fuel_level": fuel_level,
+            },
+            self.tenant,
+        )
+        return True
+
+    # Nothing left in memory that is not in the database
+    def idle(self) -> bool:
+        return (
+            not self.buffer.stats()["buffered"]
+            and not self.trips.open_trip_vehicle_ids()
+            and not any(f.has_pending() for f in self.buffer.flushers)
+        )
+
+    def stats(self):
+        return {"buffer": self.buffer.stats(), "fuel": self.fuel.stats()}
+
+
+# Lazily builds one pipeline per tenant; a single writer thread flushes all of
+# them so idle tenants cost neither threads nor database connections, and
+# drops the pipelines of tenants that stopped sending.
+class PipelineRegistry:
+    def __init__(
+        self,
+        session_factory_for,
+        flush_seconds=TELEMETRY_FLUSH_SECONDS,
+        idle_seconds=TELEMETRY_PIPELINE_IDLE_SECONDS,
+    ):
+        self.session_factory_for = session_factory_for
+        self.flush_seconds = flush_seconds
+        self.idle_seconds = idle_seconds
+        self.pipelines = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._last_sweep = time.monotonic()
+        self.evicted = 0
+
+    # Callers look the pipeline up for each use (a WebSocket for each message)
+    # rather than keeping it, so they never write into an evicted one
+    def get(self, tenant: str = None) -> TelemetryPipeline:
+        with self._lock:
+            pipeline = self.pipelines.get(tenant)
+            if pipeline is not None:
+                pipeline.last_used = time.monotonic()
+                return pipeline
+        # Loaded outside the lock so other tenants are not held up; when two
+        # requests race, the first one stored wins
+        pipeline = TelemetryPipeline(
+            self.session_factory_for(tenant), wakeup=self._wakeup, tenant=tenant
+        )
+        pipeline.load()
+        with self._lock:
+            pipeline = self.pipelines.setdefault(tenant, pipeline)
+            pipeline.last_used = time.monotonic()
+        return pipeline
+
+    # The tenant-less pipeline is never evicted
+    def evict_idle(self):
+        now = time.monotonic()
+        self._last_sweep = now
+        with self._lock:
+            candidates = [
+                (tenant, pipeline)
+                for tenant, pipeline in self.pipelines.items()
+                if tenant is not None and now - pipeline.last_used >= self.idle_seconds
+            ]
+        evicted = 0
+        for tenant, pipeline in candidates:
+            try:
+                # Closes trips that timed out and writes them
+                pipeline.buffer.flush()
+            except Exception as e:
+                logging.error(f"Telemetry flush failed for tenant {tenant}: {e}")
+                continue
+            with self._lock:
+                # Used again since it was picked, or still holding state
+                if self.pipelines.get(tenant) is not pipeline:
+                    continue
+                if time.monotonic() - pipeline.last_used < self.idle_seconds:
+                    continue
+                if not pipeline.idle():
+                    continue
+                del self.pipelines[tenant]
+            evicted += 1
+        self.evicted += evicted
+        return evicted
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="telemetry-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush_all()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush_all()
+            if time.monotonic() - self._last_sweep >= PIPELINE_SWEEP_SECONDS:
+                self.evict_idle()
+
+    def flush_all(self):
+        for tenant, pipeline in list(self.pipelines.items()):
+            try:
+                pipeline.buffer.flush()
+            except Exception as e:
+                logging.error(f"Telemetry flush failed for tenant {tenant}: {e}")
+
+    def stats(self):
+        return {
+            str(tenant): pipeline.stats()
+            for tenant, pipeline in list(self.pipelines.items())
+        }
@@ -0,0 +1,473 @@
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+
+from sqlalchemy import func, or_, text
+
+from database import SessionLocal, after_commit
+from models import Job
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Heavy jobs (dumps, restores, bulk rebuilds) allowed to run at once across all
+# API processes, so they cannot take every worker and database connection
+JOB_HEAVY_CONCURRENCY = int(os.getenv("JOB_HEAVY_CONCURRENCY", "1"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", "10"))  # seconds
+# A running job whose worker has not reported for this long is requeued
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "600"))
+# Running jobs are marked alive this often, whether or not they report progress
+JOB_HEARTBEAT_SECONDS = float(
+    os.getenv("JOB_HEARTBEAT_SECONDS", str(JOB_STALE_SECONDS / 10))
+)
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "30"))
+
+# Serialises claims so the heavy job limit holds across processes
+CLAIM_LOCK_ID = 73310001
+
+FINISHED = ("succeeded", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class UnknownJobType(ValueError):
+    pass
+
+
+class _Handler:
+    __slots__ = ("fn", "heavy", "max_attempts")
+
+    def __init__(self, fn, heavy, max_attempts):
+        self.fn = fn
+        self.heavy = heavy
+        self.max_attempts = max_attempts
+
+
+class _Schedule:
+    __slots__ = ("job_type", "every_seconds", "tenants", "last_submitted")
+
+    def __init__(self, job_type, every_seconds, tenants):
+        self.job_type = job_type
+        self.every_seconds = every_seconds
+        self.tenants = tenants
+        self.last_submitted = None
+
+
+# Passed to handlers; reports progress and is the point where a cancellation
+# request is noticed.
+class JobContext:
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job_id = job.job_id
+        self.job_type = job.job_type
+        self.tenant = job.tenant
+        self.user_id = job.created_by
+        self.attempt = job.attempts
+        self.payload = json.loads(job.payload) if job.payload else {}
+
+    def progress(self, fraction: float, message: str = None):
+        if self.queue.update_progress(self.job_id, fraction, message):
+            raise JobCancelled()
+
+    def check_cancelled(self):
+        if self.queue.cancel_requested(self.job_id):
+            raise JobCancelled()
+
+    def run_process(self, args, env=None, poll_seconds: float = 1.0):
+        # Runs an external command, terminating it if the job is cancelled
+        process = subprocess.Popen(
+            args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        last_check = time.monotonic()
+        while True:
+            try:
+                _, stderr = process.communicate(timeout=poll_seconds)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if time.monotonic() - last_check >= JOB_POLL_SECONDS:
+                last_check = time.monotonic()
+                try:
+                    self.progress(None)
+                except JobCancelled:
+                    process.terminate()
+                    process.wait()
+                    raise
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(
+                process.returncode, args, stderr=stderr
+            )
+
+
+# A persistent job queue backed by the jobs table. Jobs survive restarts, any
+# API process can run them and a small thread pool per process works through
+# them in priority order.
+class JobQueue:
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        workers: int = JOB_WORKERS,
+        heavy_concurrency: int = JOB_HEAVY_CONCURRENCY,
+        poll_seconds: float = JOB_POLL_SECONDS,
+        heartbeat_seconds: float = JOB_HEARTBEAT_SECONDS,
+    ):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.heavy_concurrency = heavy_concurrency
+        self.poll_seconds = poll_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.handlers = {}
+        self.worker_name = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._running = {}
+        self._lock = threading.Lock()
+        self._last_maintenance = 0.0
+        self._schedules = []
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+
+    def register(self, job_type: str, heavy: bool = False, max_attempts: int = 3):
+        def decorator(fn):
+            self.handlers[job_type] = _Handler(fn, heavy, max_attempts)
+            return fn
+
+        return decorator
+
+    # Submits job_type every every_seconds (first when the workers start) for
+    # each tenant tenants() returns. Each API process keeps its own timer and a
+    # job already queued or running is not submitted again, so handlers of
+    # scheduled jobs must be idempotent.
+    def schedule(self, job_type: str, every_seconds: float, tenants=lambda: [None]):
+        self._schedules.append(_Schedule(job_type, every_seconds, tenants))
+
+    def submit(
+        self,
+        db,
+        job_type: str,
+        payload: dict = None,
+        priority: int = 0,
+        tenant: str = None,
+        created_by: int = None,
+        dedupe_key: str = None,
+    ) -> Job:
+        handler = self.handlers.get(job_type)
+        if handler is None:
+            raise UnknownJobType(f"Unknown job type: {job_type}")
+        if dedupe_key is not None:
+            existing = (
+                db.query(Job)
+                .filter(
+                    Job.dedupe_key == dedupe_key,
+                    Job.status.in_(("queued", "running")),
+                )
+                .first()
+            )
+            if existing is not None:
+                return existing
+        job = Job(
+            job_type=job_type,
+            tenant=tenant,
+            payload=json.dumps(payload or {}, default=str),
+            priority=priority,
+            heavy=handler.heavy,
+            max_attempts=handler.max_attempts,
+            status="queued",
+            progress=0.0,
+            attempts=0,
+            cancel_requested=False,
+            created_by=created_by,
+            created_at=datetime.utcnow(),
+            run_after=datetime.utcnow(),
+            dedupe_key=dedupe_key,
+        )
+        # Flushed for its id and committed by the caller
+        db.add(job)
+        db.flush()
+        after_commit(db, self._wakeup.set)
+        return job
+
+    def cancel(self, db, job: Job) -> Job:
+        if job.status == "queued":
+            job.status = "cancelled"
+            job.finished_at = datetime.utcnow()
+        elif job.status == "running":
+            # The worker stops at the handler's next progress report
+            job.cancel_requested = True
+        return job
+
+    def update_progress(self, job_id: int, fraction, message) -> bool:
+        values = {"heartbeat_at": datetime.utcnow()}
+        if fraction is not None:
+            values["progress"] = max(0.0, min(1.0, float(fraction)))
+        if message is not None:
+            values["message"] = message
+        db = self.session_factory()
+        try:
+            db.query(Job).filter(Job.job_id == job_id).update(
+                values, synchronize_session=False
+            )
+            cancel = (
+                db.query(Job.cancel_requested).filter(Job.job_id == job_id).scalar()
+            )
+            db.commit()
+            return bool(cancel)
+        finally:
+            db.close()
+
+    # Keeps the job's heartbeat fresh until `done` is set, so a handler that
+    # runs for long without reporting progress is not taken for a dead worker
+    # and run a second time elsewhere
+    def _keep_alive(self, job_id: int, done: threading.Event):
+        while not done.wait(self.heartbeat_seconds):
+            db = self.session_factory()
+            try:
+                db.query(Job).filter(
+                    Job.job_id == job_id,
+                    Job.status == "running",
+                    Job.worker == self.worker_name,
+                ).update({"heartbeat_at": datetime.utcnow()}, synchronize_session=False)
+                db.commit()
+            except Exception as e:
+                logging.error(f"Heartbeat of job {job_id} failed: {e}")
+            finally:
+                db.close()
+
+    def cancel_requested(self, job_id: int) -> bool:
+        db = self.session_factory()
+        try:
+            return bool(
+                db.query(Job.cancel_requested).filter(Job.job_id == job_id).scalar()
+            )
+        finally:
+            db.close()
+
+    def start(self):
+        if self._threads or self.workers <= 0:
+            return
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"job-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 30):
+        self._stopping.set()
+        self._wakeup.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        # Jobs still running are picked up again once their heartbeat goes stale
+        self._threads = []
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self._maintain()
+                job = self._claim()
+            except Exception as e:
+                logging.error(f"Job queue unavailable: {e}")
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_seconds)
+                self._wakeup.clear()
+                continue
+            self._execute(job)
+
+    def _claim(self):
+        db = self.session_factory()
+        try:
+            db.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": CLAIM_LOCK_ID})
+            now = datetime.utcnow()
+            query = db.query(Job).filter(
+                Job.status == "queued",
+                Job.run_after <= now,
+                Job.job_type.in_(list(self.handlers)),
+            )
+            heavy_running = (
+                db.query(func.count(Job.job_id))
+                .filter(Job.status == "running", Job.heavy.is_(True))
+                .scalar()
+            )
+            if heavy_running >= self.heavy_concurrency:
+                query = query.filter(Job.heavy.is_(False))
+            job = (
+                query.order_by(Job.priority.desc(), Job.job_id)
+                .with_for_update(skip_locked=True)
+                .first()
+            )
+            if job is None:
+                db.rollback()
+                return None
+            job.status = "running"
+            job.attempts += 1
+            job.started_at = now
+            job.heartbeat_at = now
+            job.worker = self.worker_name
+            db.commit()
+            db.refresh(job)
+            db.expunge(job)
+            return job
+        finally:
+            db.close()
+
+    def _execute(self, job):
+        handler = self.handlers[job.job_type]
+        context = JobContext(self, job)
+        with self._lock:
+            self._running[job.job_id] = job.job_type
+        done = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._keep_alive,
+            args=(job.job_id, done),
+            name=f"job-heartbeat-{job.job_id}",
+            daemon=True,
+        )
+        heartbeat.start()
+        started = time.monotonic()
+        try:
+            result = handler.fn(context)
+        except JobCancelled:
+            self._finish(job.job_id, "cancelled", message="Cancelled")
+            logging.info(f"Job {job.job_id} ({job.job_type}) cancelled")
+        except Exception as e:
+            logging.error(f"Job {job.job_id} ({job.job_type}) failed: {e}")
+            self._fail(job, e)
+        else:
+            self._finish(
+                job.job_id,
+                "succeeded",
+                result=json.dumps(result, default=str),
+                progress=1.0,
+            )
+            self.completed += 1
+            logging.info(
+                f"Job {job.job_id} ({job.job_type}) finished in "
+                f"{time.monotonic() - started:.1f}s"
+            )
+        finally:
+            done.set()
+            heartbeat.join()
+            with self._lock:
+                self._running.pop(job.job_id, None)
+
+    def _finish(self, job_id, status, **values):
+        db = self.session_factory()
+        try:
+            db.query(Job).filter(Job.job_id == job_id).update(
+                {"status": status, "finished_at": datetime.utcnow(), **values},
+                synchronize_session=False,
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def _fail(self, job, error):
+        message = str(error) or error.__class__.__name__
+        if job.attempts < job.max_attempts and not self.cancel_requested(job.job_id):
+            delay = JOB_RETRY_BACKOFF * 2 ** (job.attempts - 1)
+            db = self.session_factory()
+            try:
+                db.query(Job).filter(Job.job_id == job.job_id).update(
+                    {
+                        "status": "queued",
+                        "error": message,
+                        "run_after": datetime.utcnow() + timedelta(seconds=delay),
+                    },
+                    synchronize_session=False,
+                )
+                db.commit()
+            finally:
+                db.close()
+            self.retried += 1
+            return
+        self._finish(job.job_id, "failed", error=message)
+        self.failed += 1
+
+    def _maintain(self):
+        now = time.monotonic()
+        if now - self._last_maintenance < 60:
+            return
+        self._last_maintenance = now
+        db = self.session_factory()
+        try:
+            stale = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+            stale_jobs = db.query(Job).filter(
+                Job.status == "running",
+                or_(Job.heartbeat_at.is_(None), Job.heartbeat_at < stale),
+            )
+            # A stale job being cancelled ends there; one whose worker died on
+            # its last attempt (it may be what keeps killing workers) fails
+            # instead of running again. The others are requeued.
+            cancelled = stale_jobs.filter(Job.cancel_requested.is_(True)).update(
+                {"status": "cancelled", "finished_at": datetime.utcnow()},
+                synchronize_session=False,
+            )
+            exhausted = stale_jobs.filter(Job.attempts >= Job.max_attempts).update(
+                {
+                    "status": "failed",
+                    "error": "Worker stopped responding on the last attempt",
+                    "finished_at": datetime.utcnow(),
+                },
+                synchronize_session=False,
+            )
+            requeued = stale_jobs.update(
+                {"status": "queued", "run_after": datetime.utcnow()},
+                synchronize_session=False,
+            )
+            cutoff = datetime.utcnow() - timedelta(days=JOB_RETENTION_DAYS)
+            db.query(Job).filter(
+                Job.status.in_(FINISHED), Job.finished_at < cutoff
+            ).delete(synchronize_session=False)
+            db.commit()
+            if requeued:
+                logging.warning(f"Requeued {requeued} stale job(s)")
+            if exhausted:
+                self.failed += exhausted
+                logging.warning(f"Failed {exhausted} stale job(s) out of attempts")
+            if cancelled:
+                logging.info(f"Cancelled {cancelled} stale job(s)")
+            self._submit_scheduled(db)
+        finally:
+            db.close()
+
+    def _submit_scheduled(self, db):
+        now = time.monotonic()
+        for schedule in self._schedules:
+            last = schedule.last_submitted
+            if last is not None and now - last < schedule.every_seconds:
+                continue
+            schedule.last_submitted = now
+            for tenant in schedule.tenants():
+                self.submit(
+                    db,
+                    schedule.job_type,
+                    tenant=tenant,
+                    dedupe_key=f"{tenant}:{schedule.job_type}",
+                )
+        db.commit()
+
+    def stats(self):
+        with self._lock:
+            running = dict(self._running)
+        return {
+            "workers": len(self._threads),
+            "heavy_concurrency": self.heavy_concurrency,
+            "running": running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+
+job_queue = JobQueue()
@@ -1,18 +1,39 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, WebSocket
+from fastapi import (
+    FastAPI,
+    Depends,
+    HTTPException,
+    status,
+    UploadFile,
+    File,
+    WebSocket,
+    WebSocketException,
+    Request,
+    Query,
+    Response,
+)
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.requests import HTTPConnection
+from fastapi.responses import FileResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from jose import JWTError, jwt
 from datetime import timedelta, datetime, date
-from passlib.context import CryptContext
+from contextlib import asynccontextmanager
 from typing import Optional, List  # Added Optional import
+import asyncio
 import random
 import os
 from pathlib import Path
 import logging
-import subprocess
+import time
+import uuid
+import json
 
-from database import SessionLocal, engine, Base
+from database import after_commit, engine, unit_of_work
 from models import (
     User,
     UserActivity,
@@ -22,6 +43,15 @@ from models import (
     VehicleDocument,
     Cost,
     MaintenanceRecord,
+    Trip,
+    Geofence,
+    GeofenceEvent,
+    FuelAlert,
+    Job,
+    MaintenanceSlot,
+    VehicleUnavailability,
+    Workshop,
+    DutyEvent,
 )
 from schemas import (
     UserCreate,
@@ -40,13 +70,102 @@ from schemas import (
     MaintenanceRecordCreate,
     MaintenanceRecordOut,
     RouteOptimizationOut,
+    TelemetryHistoryOut,
+    TripOut,
+    GeofenceCreate,
+    GeofenceOut,
+    GeofenceEventOut,
+    FuelAlertOut,
+    JobOut,
+    ReportOut,
+    DashboardSummaryOut,
+    SearchResultOut,
+    MapClustersOut,
+    BatchRequest,
+    BatchOut,
+    SyncOut,
+    CostForecastOut,
+    WorkshopCreate,
+    WorkshopOut,
+    VehicleUnavailabilityCreate,
+    VehicleUnavailabilityOut,
+    MaintenanceSlotOut,
+    RoutePlanRequest,
+    DutyEventCreate,
+    DutyEventOut,
+    HoursOfServiceOut,
+    HosComplianceOut,
 )
 from utils import (
+    hash_password,
     verify_password,
     create_access_token,
     SECRET_KEY,
     ALGORITHM,
     ACCESS_TOKEN_EXPIRE_MINUTES,
+    DEVICE_TOKEN_EXPIRE_DAYS,
+)
+from log_config import setup_logging, request_id_var
+from telemetry import TELEMETRY_MAX_POINTS, parse_timestamp, query_history
+from trips import backfill
+from tracker_protocol import AckWindow, FrameError, binary_telemetry, decode_frame
+from fuel_monitor import is_fuel_cost, resolve_refuel_alerts
+from ingestion import PipelineRegistry, TelemetryPipeline
+from jobs import FINISHED, JobContext, job_queue
+from activity import activity_archive, query_activity
+from admission import Rejected, admission
+from batch import BATCH_MAX_OPERATIONS, BatchFailed, apply_batch
+from dashboard import compute_summary, summary_cache
+from events import event_bus
+from fleet_state import fleet_states
+from hos import HosError, hos_engines, record_duty_event
+from map_clusters import MAP_MAX_ZOOM, ViewportTooLarge, map_clusters
+from traffic_capture import TrafficCapture, traffic_recorder
+from forecasting import FORECAST_MAX_MONTHS, cost_forecast, forecast_cache
+from maintenance_schedule import reschedule_vehicle
+from routing import ROUTING_MAX_ORDERS, ROUTING_MAX_TIME_BUDGET_SECONDS
+from sync import (
+    SYNC_PAGE_SIZE,
+    SYNC_TABLES,
+    SyncError,
+    SyncTokenExpired,
+    sync_changes,
+)
+from search import (
+    KINDS,
+    SearchRegistry,
+    database_search,
+    document_entry,
+    driver_entry,
+    vehicle_entry,
+)
+from reports import (
+    REPORT_FORMATS,
+    ReportError,
+    ReportRequest,
+    artifact_path,
+    cached_artifact,
+)
+from replicas import (
+    READ_AFTER_COOKIE,
+    READ_AFTER_HEADER,
+    READ_YOUR_WRITES_SECONDS,
+    replica_router,
+)
+from schema_migrations import (
+    RUN_MIGRATIONS_ON_STARTUP,
+    current_revision,
+    head_revision,
+    upgrade_database,
+)
+from tenancy import (
+    DEFAULT_TENANT,
+    InvalidTenant,
+    database_location,
+    open_session,
+    session_factory_for,
+    tenant_router,
+    validate_tenant,
 )
 
 from dotenv import load_dotenv
@@ -56,48 +175,276 @@ import os
 
 DB_URI = os.getenv("DB_URI")
 
-# Configure logging
-logging.basicConfig(
-    filename="app.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
-logging.info("Application started.")
-app = FastAPI()
+telemetry_logger = logging.getLogger("telemetry")
+
+
+# Everything that touches the database or starts threads runs here rather than
+# at import time, so workers start fast and survive a briefly unavailable DB.
+# The schema is managed by Alembic ("alembic upgrade head").
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Configure logging (queued, written by a background thread)
+    setup_logging()
+    logging.info("Application started.")
+    if RUN_MIGRATIONS_ON_STARTUP:
+        await run_in_threadpool(upgrade_database)
+    await run_in_threadpool(start_background_workers)
+    yield
+    await run_in_threadpool(stop_background_workers)
+    logging.info("Application stopped.")
+
+
+app = FastAPI(lifespan=lifespan)
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+# Rate limits and concurrency caps for the expensive endpoints. Registered
+# before the request id middleware so shed requests still get an id.
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    limiter = admission.limiter(request.method, request.url.path)
+    if limiter is None:
+        return await call_next(request)
+    payload = get_token_payload(request)
+    if payload is not None and payload.get("sub"):
+        user = (payload.get("tenant"), payload["sub"])
+    else:
+        user = request.client.host if request.client else None
+    try:
+        await limiter.enter(user)
+    except Rejected as e:
+        logging.warning(f"Shed {request.method} {request.url.path} for {user}: {e}")
+        return JSONResponse(
+            status_code=e.status_code,
+            content={"detail": e.detail},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    try:
+        return await call_next(request)
+    finally:
+        limiter.leave()
+
 
-# CORS configuration
+# Tag every log record emitted while serving a request with its request id
+@app.middleware("http")
+async def request_id_middleware(request: Request, call_next):
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    if (
+        request.method not in SAFE_METHODS
+        and response.status_code < 400
+        and replica_router.enabled
+    ):
+        # The write has committed; whichever worker serves the client's next
+        # reads keeps them off replicas that have not replayed it yet
+        position = await run_in_threadpool(replica_router.write_position)
+        if position:
+            response.set_cookie(
+                READ_AFTER_COOKIE,
+                position,
+                max_age=int(READ_YOUR_WRITES_SECONDS),
+                httponly=True,
+                samesite="lax",
+            )
+            response.headers[READ_AFTER_HEADER] = position
+    return response
+
+
+# CORS configuration. Added after the middleware above so it wraps them: shed
+# 429/503 responses carry the CORS headers too, and the browser can read their
+# status and Retry-After.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After", "X-Request-ID", READ_AFTER_HEADER],
 )
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+
+# Request shapes and timings for benchmarks/replay_traffic.py, only when
+# TRAFFIC_CAPTURE_PATH is set. Added last, so it wraps the other middleware.
+if traffic_recorder.enabled:
+    app.add_middleware(TrafficCapture)
+
 
 # Security setup
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login", auto_error=False)
+
+
+# Telemetry consumers (history writer, trips, fuel alerts), one pipeline per tenant
+pipelines = PipelineRegistry(session_factory_for)
+# Fuzzy search over vehicles, drivers and documents, one index per tenant
+search_indexes = SearchRegistry(session_factory_for)
+
+
+def start_background_workers():
+    event_bus.start()
+    pipelines.start()
+    replica_router.start()
+    job_queue.start()
+    fleet_states.start()
+    hos_engines.start()
+    search_indexes.start()
+    traffic_recorder.start()
+    if not tenant_router.enabled:
+        try:
+            pipelines.get(None)
+        except Exception as e:
+            # Retried on the first telemetry request; readiness reports the DB state
+            logging.error(f"Telemetry pipeline warm-up failed: {e}")
+        # Maps the last snapshot and replays what changed since, off the startup
+        # path; the first reader waits for it
+        fleet_states.warm(None)
+        try:
+            hos_engines.get(None)
+        except Exception as e:
+            logging.error(f"Hours of service warm-up failed: {e}")
+        # Built in the background; /search answers from the database meanwhile
+        search_indexes.ready(None)
+
+
+def stop_background_workers():
+    job_queue.stop()
+    fleet_states.stop()
+    hos_engines.stop()
+    search_indexes.stop()
+    pipelines.stop()
+    replica_router.stop()
+    event_bus.stop()
+    traffic_recorder.stop()
+
+
+# Decoded bearer token claims, cached for the rest of the request; None when
+# there is no valid token (get_current_user still rejects those requests)
+def get_token_payload(conn: HTTPConnection) -> Optional[dict]:
+    if "token_payload" in conn.scope.get("state", {}):
+        return conn.state.token_payload
+    scheme, _, token = conn.headers.get("Authorization", "").partition(" ")
+    if not token and conn.scope["type"] == "websocket":
+        # Browsers cannot set headers on a WebSocket handshake
+        scheme, token = "bearer", conn.query_params.get("token", "")
+    payload = None
+    if scheme.lower() == "bearer" and token:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            payload = None
+    conn.state.token_payload = payload
+    return payload
+
+
+# Tenant resolution: the signed "tenant" claim of the bearer token wins (user
+# tokens, and device tokens for trackers). Only signing in and registering,
+# which have no token yet, may name the tenant in X-Tenant-ID or ?tenant=; other
+# requests without a token are refused rather than let the caller pick a tenant.
+TENANT_SELECTION_PATHS = ("/login", "/register")
+
+
+def get_tenant(conn: HTTPConnection) -> Optional[str]:
+    if not tenant_router.enabled:
+        return None
+    tenant = getattr(conn.state, "tenant", None)
+    if tenant is not None:
+        return tenant
+    payload = get_token_payload(conn)
+    if payload is not None:
+        tenant = payload.get("tenant") or DEFAULT_TENANT
+    elif conn.url.path in TENANT_SELECTION_PATHS:
+        tenant = (
+            conn.headers.get("X-Tenant-ID")
+            or conn.query_params.get("tenant")
+            or DEFAULT_TENANT
+        )
+    elif conn.scope["type"] == "websocket":
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION)
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    try:
+        tenant = validate_tenant(tenant)
+    except InvalidTenant:
+        raise HTTPException(status_code=400, detail="Invalid tenant")
+    conn.state.tenant = tenant
+    return tenant
+
+
+# WAL position of the client's last write, from the header for API clients that
+# echo it and from the cookie for browsers
+def read_after(conn: HTTPConnection) -> Optional[str]:
+    return conn.headers.get(READ_AFTER_HEADER) or conn.cookies.get(READ_AFTER_COOKIE)
+
+
+# Database dependency: GET/HEAD requests read from a replica when one is healthy
+# and has replayed the client's last write; everything else uses the primary
+def get_db(conn: HTTPConnection, tenant: Optional[str] = Depends(get_tenant)):
+    db = None
+    if conn.scope["type"] == "http" and conn.scope["method"] in SAFE_METHODS:
+        db = replica_router.open_read_session(tenant, read_after(conn))
+    if db is None:
+        db = open_session(tenant)
+    # Committed after the response is serialized and before it is sent, so a
+    # failed commit still fails the request
+    with unit_of_work(db):
+        yield db
 
 
-# Database dependency
-def get_db():
-    db = SessionLocal()
-    try:
+# For GET endpoints that write
+def get_primary_db(tenant: Optional[str] = Depends(get_tenant)):
+    with unit_of_work(open_session(tenant)) as db:
         yield db
-    finally:
-        db.close()
 
 
-# Log user activity
+# Jobs live in the main database. Without tenants that is the request's own
+# session, so the job is written in the request's transaction.
+def get_jobs_db(
+    db: Session = Depends(get_db), tenant: Optional[str] = Depends(get_tenant)
+):
+    if tenant is None or not tenant_router.enabled:
+        yield db
+        return
+    with unit_of_work(open_session(None)) as jobs_db:
+        yield jobs_db
+
+
+def get_pipeline(tenant: Optional[str] = Depends(get_tenant)) -> TelemetryPipeline:
+    return pipelines.get(tenant)
+
+
+# SQLSTATE of a duplicate key
+UNIQUE_VIOLATION = "23505"
+
+
+# Flushes the pending inserts and updates, answering a write that breaks a
+# unique constraint (a taken username, registration or licence number) with a
+# 400 instead of looking the value up before writing
+def flush_unique(db: Session, detail: str, message: str):
+    try:
+        db.flush()
+    except IntegrityError as e:
+        if getattr(e.orig, "pgcode", None) != UNIQUE_VIOLATION:
+            raise
+        logging.error(message)
+        raise HTTPException(status_code=400, detail=detail)
+
+
+# Log user activity, committed with the rest of the request's changes
 def log_activity(db: Session, user_id: int, action_type: str, details: str):
     activity = UserActivity(
         user_id=user_id, action_type=action_type, action_details=details
     )
     db.add(activity)
-    db.commit()
     logging.info(f"User activity: {action_type} - {details}")
 
 
@@ -113,7 +460,8 @@ def get_current_user(
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        if username is None:
+        # Device tokens only open the tracker WebSocket
+        if username is None or "device" in payload:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
@@ -123,6 +471,17 @@ def get_current_user(
     return user
 
 
+# The caller on endpoints that also serve anonymous requests; a token that is
+# sent must still be valid
+def get_optional_user(
+    token: Optional[str] = Depends(optional_oauth2_scheme),
+    db: Session = Depends(get_db),
+):
+    if token is None:
+        return None
+    return get_current_user(token, db)
+
+
 # Admin-only dependency
 def get_admin_user(current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
@@ -140,19 +499,7 @@ def get_manager_or_admin_user(current_user: User = Depends(get_current_user)):
 # --- User Endpoints ---
 @app.post("/register", response_model=UserOut)
 def register_user(user: UserCreate, db: Session = Depends(get_db)):
-    existing_user = (
-        db.query(User)
-        .filter((User.username == user.username) | (User.email == user.email))
-        .first()
-    )
-    if existing_user:
-        logging.error(
-            f"Registration failed: Username {user.username} or email {user.email} already exists"
-        )
-        raise HTTPException(
-            status_code=400, detail="Username or email already registered"
-        )
-    hashed_password = pwd_context.hash(user.password)
+    hashed_password = hash_password(user.password)
     new_user = User(
         username=user.username,
         email=user.email,
@@ -164,15 +511,21 @@ def register_user(user: UserCreate, db: Session = Depends(get_db)):
         status=user.status,
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    flush_unique(
+        db,
+        "Username or email already registered",
+        f"Registration failed: Username {user.username} or email {user.email} "
+        "already exists",
+    )
     log_activity(db, new_user.id, "register", f"User {user.username} registered")
     return new_user
 
 
 @app.post("/login")
 def login(
-    form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
 ):
     user = db.query(User).filter(User.username == form_data.username).first()
     if not user or not verify_password(form_data.password, user.password_hash):
@@ -183,12 +536,14 @@ def login(
             headers={"WWW-Authenticate": "Bearer"},
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    claims = {"sub": user.username, "role": user.role}
+    if tenant is not None:
+        claims["tenant"] = tenant
     access_token = create_access_token(
-        data={"sub": user.username, "role": user.role},
+        data=claims,
         expires_delta=access_token_expires,
     )
     user.last_login = datetime.utcnow()
-    db.commit()
     log_activity(db, user.id, "login", "User logged in")
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -211,19 +566,7 @@ def admin_create_user(
     db: Session = Depends(get_db),
     admin_user: User = Depends(get_admin_user),
 ):
-    existing_user = (
-        db.query(User)
-        .filter((User.username == user.username) | (User.email == user.email))
-        .first()
-    )
-    if existing_user:
-        logging.error(
-            f"User creation failed: Username {user.username} or email {user.email} already exists"
-        )
-        raise HTTPException(
-            status_code=400, detail="Username or email already registered"
-        )
-    hashed_password = pwd_context.hash(user.password)
+    hashed_password = hash_password(user.password)
     new_user = User(
         username=user.username,
         email=user.email,
@@ -235,8 +578,12 @@ def admin_create_user(
         status=user.status,
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    flush_unique(
+        db,
+        "Username or email already registered",
+        f"User creation failed: Username {user.username} or email {user.email} "
+        "already exists",
+    )
     log_activity(db, admin_user.id, "add_user", f"Added user {user.username}")
     return new_user
 
@@ -252,21 +599,6 @@ def update_user(
     if not db_user:
         logging.error(f"User update failed: User ID {user_id} not found")
         raise HTTPException(status_code=404, detail="User not found")
-    existing_user = (
-        db.query(User)
-        .filter(
-            ((User.username == user.username) | (User.email == user.email))
-            & (User.id != user_id)
-        )
-        .first()
-    )
-    if existing_user:
-        logging.error(
-            f"User update failed: Username {user.username} or email {user.email} already exists"
-        )
-        raise HTTPException(
-            status_code=400, detail="Username or email already registered"
-        )
     db_user.username = user.username
     db_user.email = user.email
     db_user.role = user.role
@@ -275,9 +607,13 @@ def update_user(
     db_user.department = user.department
     db_user.status = user.status
     if user.password:
-        db_user.password_hash = pwd_context.hash(user.password)
-    db.commit()
-    db.refresh(db_user)
+        db_user.password_hash = hash_password(user.password)
+    flush_unique(
+        db,
+        "Username or email already registered",
+        f"User update failed: Username {user.username} or email {user.email} "
+        "already exists",
+    )
     log_activity(db, admin_user.id, "update_user", f"Updated user {user.username}")
     return db_user
 
@@ -296,16 +632,29 @@ def delete_user(
         logging.error(f"User deletion failed: Cannot delete self (User ID {user_id})")
         raise HTTPException(status_code=400, detail="Cannot delete yourself")
     db.delete(db_user)
-    db.commit()
     log_activity(db, admin_user.id, "delete_user", f"Deleted user {db_user.username}")
     return {"message": "User deleted"}
 
 
+# Newest first, from the recent months in the database and the archived ones in
+# Parquet files; page back by passing the oldest timestamp returned as end
 @app.get("/admin/user-activity", response_model=List[UserActivityOut])
 def get_user_activity(
-    db: Session = Depends(get_db), admin_user: User = Depends(get_admin_user)
+    user_id: Optional[int] = None,
+    action_type: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=10000),
+    db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    admin_user: User = Depends(get_admin_user),
 ):
-    return db.query(UserActivity).all()
+    # Archived timestamps are naive UTC like the table's
+    start = parse_timestamp(start) if start else None
+    end = parse_timestamp(end) if end else None
+    if start is not None and end is not None and start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    return query_activity(db, tenant, user_id, action_type, start, end, limit)
 
 
 # --- Vehicle Endpoints ---
@@ -313,24 +662,18 @@ def get_user_activity(
 def create_vehicle(
     vehicle: VehicleCreate,
     db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
     current_user: User = Depends(get_manager_or_admin_user),
 ):
-    existing_vehicle = (
-        db.query(Vehicle)
-        .filter(Vehicle.registration_number == vehicle.registration_number)
-        .first()
-    )
-    if existing_vehicle:
-        logging.error(
-            f"Vehicle creation failed: Registration number {vehicle.registration_number} already exists"
-        )
-        raise HTTPException(
-            status_code=400, detail="Vehicle registration number already exists"
-        )
     new_vehicle = Vehicle(**vehicle.dict())
     db.add(new_vehicle)
-    db.commit()
-    db.refresh(new_vehicle)
+    flush_unique(
+        db,
+        "Vehicle registration number already exists",
+        f"Vehicle creation failed: Registration number "
+        f"{vehicle.registration_number} already exists",
+    )
+    after_commit(db, search_indexes.upsert, tenant, vehicle_entry(new_vehicle))
     log_activity(
         db,
         current_user.id,
@@ -352,31 +695,22 @@ def update_vehicle(
     vehicle_id: int,
     vehicle: VehicleCreate,
     db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
     current_user: User = Depends(get_manager_or_admin_user),
 ):
     db_vehicle = db.query(Vehicle).filter(Vehicle.id == vehicle_id).first()
     if not db_vehicle:
         logging.error(f"Vehicle update failed: Vehicle ID {vehicle_id} not found")
         raise HTTPException(status_code=404, detail="Vehicle not found")
-    existing_vehicle = (
-        db.query(Vehicle)
-        .filter(
-            Vehicle.registration_number == vehicle.registration_number,
-            Vehicle.id != vehicle_id,
-        )
-        .first()
-    )
-    if existing_vehicle:
-        logging.error(
-            f"Vehicle update failed: Registration number {vehicle.registration_number} already exists"
-        )
-        raise HTTPException(
-            status_code=400, detail="Vehicle registration number already exists"
-        )
     for key, value in vehicle.dict().items():
         setattr(db_vehicle, key, value)
-    db.commit()
-    db.refresh(db_vehicle)
+    flush_unique(
+        db,
+        "Vehicle registration number already exists",
+        f"Vehicle update failed: Registration number "
+        f"{vehicle.registration_number} already exists",
+    )
+    after_commit(db, search_indexes.upsert, tenant, vehicle_entry(db_vehicle))
     log_activity(
         db,
         current_user.id,
@@ -390,14 +724,20 @@ def update_vehicle(
 def delete_vehicle(
     vehicle_id: int,
     db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
     current_user: User = Depends(get_manager_or_admin_user),
 ):
     db_vehicle = db.query(Vehicle).filter(Vehicle.id == vehicle_id).first()
     if not db_vehicle:
         logging.error(f"Vehicle deletion failed: Vehicle ID {vehicle_id} not found")
         raise HTTPException(status_code=404, detail="Vehicle not found")
+    # Deleting the vehicle unlinks its documents, which leave the index with it
+    for document in db_vehicle.documents:
+        after_commit(
+            db, search_indexes.remove, tenant, "vehicle_document", document.doc_id
+        )
     db.delete(db_vehicle)
-    db.commit()
+    after_commit(db, search_indexes.remove, tenant, "vehicle", vehicle_id)
     log_activity(
         db,
         current_user.id,
@@ -412,22 +752,18 @@ def delete_vehicle(
 def create_driver(
     driver: DriverCreate,
     db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
     current_user: User = Depends(get_manager_or_admin_user),
 ):
-    existing_driver = (
-        db.query(Driver).filter(Driver.license_number == driver.license_number).first()
-    )
-    if existing_driver:
-        logging.error(
-            f"Driver creation failed: License number {driver.license_number} already exists"
-        )
-        raise HTTPException(
-            status_code=400, detail="Driver license number already exists"
-        )
     new_driver = Driver(**driver.dict())
     db.add(new_driver)
-    db.commit()
-    db.refresh(new_driver)
+    flush_unique(
+        db,
+        "Driver license number already exists",
+        f"Driver creation failed: License number {driver.license_number} "
+        "already exists",
+    )
+    after_commit(db, search_indexes.upsert, tenant, driver_entry(new_driver))
     log_activity(db, current_user.id, "add_driver", f"Added driver {driver.name}")
     return new_driver
 
@@ -444,28 +780,22 @@ def update_driver(
     driver_id: int,
     driver: DriverCreate,
     db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
     current_user: User = Depends(get_manager_or_admin_user),
 ):
     db_driver = db.query(Driver).filter(Driver.id == driver_id).first()
     if not db_driver:
         logging.error(f"Driver update failed: Driver ID {driver_id} not found")
         raise HTTPException(status_code=404, detail="Driver not found")
-    existing_driver = (
-        db.query(Driver)
-        .filter(Driver.license_number == driver.license_number, Driver.id != driver_id)
-        .first()
-    )
-    if existing_driver:
-        logging.error(
-            f"Driver update failed: License number {driver.license_number} already exists"
-        )
-        raise HTTPException(
-            status_code=400, detail="Driver license number already exists"
-        )
     for key, value in driver.dict().items():
         setattr(db_driver, key, value)
-    db.commit()
-    db.refresh(db_driver)
+    flush_unique(
+        db,
+        "Driver license number already exists",
+        f"Driver update failed: License number {driver.license_number} "
+        "already exists",
+    )
+    after_commit(db, search_indexes.upsert, tenant, driver_entry(db_driver))
     log_activity(db, current_user.id, "update_driver", f"Updated driver {driver.name}")
     return db_driver
 
@@ -474,20 +804,117 @@ def update_driver(
 def delete_driver(
     driver_id: int,
     db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
     current_user: User = Depends(get_manager_or_admin_user),
 ):
     db_driver = db.query(Driver).filter(Driver.id == driver_id).first()
     if not db_driver:
         logging.error(f"Driver deletion failed: Driver ID {driver_id} not found")
         raise HTTPException(status_code=404, detail="Driver not found")
+    for document in db_driver.documents:
+        after_commit(
+            db, search_indexes.remove, tenant, "driver_document", document.doc_id
+        )
     db.delete(db_driver)
-    db.commit()
+    after_commit(db, search_indexes.remove, tenant, "driver", driver_id)
     log_activity(
         db, current_user.id, "delete_driver", f"Deleted driver {db_driver.name}"
     )
     return {"message": "Driver deleted"}
 
 
+# --- Hours of service ---
+# Appends to the driver's duty log and moves Driver.status along with it
+@app.post("/drivers/{driver_id}/duty-events", response_model=DutyEventOut)
+def create_duty_event(
+    driver_id: int,
+    duty_event: DutyEventCreate,
+    db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    db_driver = (
+        db.query(Driver).filter(Driver.id == driver_id).with_for_update().first()
+    )
+    if not db_driver:
+        raise HTTPException(status_code=404, detail="Driver not found")
+    try:
+        db_event = record_duty_event(
+            db,
+            db_driver,
+            duty_event.duty_status,
+            duty_event.started_at,
+            duty_event.vehicle_id,
+        )
+    except HosError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    after_commit(
+        db,
+        hos_engines.record,
+        tenant,
+        driver_id,
+        db_event.duty_status,
+        db_event.started_at,
+        db_event.event_id,
+        db_event.vehicle_id,
+    )
+    log_activity(
+        db,
+        current_user.id,
+        "duty_event",
+        f"Driver {db_driver.name} {duty_event.duty_status}",
+    )
+    return db_event
+
+
+@app.get("/drivers/{driver_id}/duty-events", response_model=List[DutyEventOut])
+def list_duty_events(
+    driver_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    query = db.query(DutyEvent).filter(DutyEvent.driver_id == driver_id)
+    if start:
+        query = query.filter(DutyEvent.started_at >= parse_timestamp(start))
+    if end:
+        query = query.filter(DutyEvent.started_at < parse_timestamp(end))
+    return (
+        query.order_by(DutyEvent.started_at.desc(), DutyEvent.event_id.desc())
+        .limit(limit)
+        .all()
+    )
+
+
+# Rolling driving and rest totals from the in-memory clocks
+@app.get("/drivers/{driver_id}/hours", response_model=HoursOfServiceOut)
+def driver_hours(
+    driver_id: int,
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_current_user),
+):
+    state = hos_engines.get(tenant).state(driver_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="No duty events for this driver")
+    return state
+
+
+# Drivers breaking a rule now and, unless predicted=false, those reaching a
+# limit within HOS_WARNING_MINUTES; violations first
+@app.get("/compliance/hours-of-service", response_model=HosComplianceOut)
+def hours_of_service_compliance(
+    predicted: bool = True,
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_current_user),
+):
+    return {
+        "checked_at": datetime.utcnow(),
+        "drivers": hos_engines.get(tenant).non_compliant(predicted=predicted),
+    }
+
+
 # --- Document Endpoints ---
 @app.post("/driver-documents", response_model=DriverDocumentOut)
 async def upload_driver_document(
@@ -499,6 +926,7 @@ async def upload_driver_document(
     status: Optional[str] = None,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
     current_user: User = Depends(get_manager_or_admin_user),
 ):
     driver = db.query(Driver).filter(Driver.id == driver_id).first()
@@ -523,8 +951,10 @@ async def upload_driver_document(
         file_path=str(save_path),
     )
     db.add(document)
-    db.commit()
-    db.refresh(document)
+    db.flush()
+    after_commit(
+        db, search_indexes.upsert, tenant, document_entry("driver_document", document)
+    )
     log_activity(
         db,
         current_user.id,
@@ -557,6 +987,7 @@ async def upload_vehicle_document(
     status: Optional[str] = None,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
     current_user: User = Depends(get_manager_or_admin_user),
 ):
     vehicle = db.query(Vehicle).filter(Vehicle.id == vehicle_id).first()
@@ -583,8 +1014,10 @@ async def upload_vehicle_document(
         file_path=str(save_path),
     )
     db.add(document)
-    db.commit()
-    db.refresh(document)
+    db.flush()
+    after_commit(
+        db, search_indexes.upsert, tenant, document_entry("vehicle_document", document)
+    )
     log_activity(
         db,
         current_user.id,
@@ -617,6 +1050,7 @@ async def create_cost(
     cost: CostCreate,
     receipt: Optional[UploadFile] = File(None),
     db: Session = Depends(get_db),
+    pipeline: TelemetryPipeline = Depends(get_pipeline),
     current_user: User = Depends(get_manager_or_admin_user),
 ):
     receipt_path = None
@@ -630,8 +1064,10 @@ async def create_cost(
         receipt_path = str(save_path)
     new_cost = Cost(**cost.dict(), receipt_path=receipt_path)
     db.add(new_cost)
-    db.commit()
-    db.refresh(new_cost)
+    if is_fuel_cost(cost.category) and cost.vehicle_id is not None:
+        resolve_refuel_alerts(db, cost.vehicle_id, cost.date)
+        after_commit(db, pipeline.fuel.note_fuel_cost, cost.vehicle_id, cost.date)
+    db.flush()
     log_activity(
         db, current_user.id, "add_cost", f"Added {cost.category} cost of {cost.amount}"
     )
@@ -660,12 +1096,11 @@ def create_maintenance_record(
         raise HTTPException(status_code=404, detail="Vehicle not found")
     new_record = MaintenanceRecord(**record.dict())
     db.add(new_record)
-    db.commit()
-    db.refresh(new_record)
     if record.status == "Completed":
         vehicle.last_maintenance = record.date
         vehicle.maintenance_score = 100
-        db.commit()
+    db.flush()
+    replan_vehicle(db, record.vehicle_id)
     log_activity(
         db,
         current_user.id,
@@ -682,6 +1117,545 @@ def list_maintenance_records(
     return db.query(MaintenanceRecord).all()
 
 
+# --- Maintenance Schedule ---
+# Workshop visits planned against each workshop's daily capacity and the days
+# vehicles are unavailable (maintenance_schedule.py). The whole fleet is
+# re-planned daily or on request; a new maintenance record or unavailability
+# re-plans only its vehicle.
+def replan_vehicle(db: Session, vehicle_id: int):
+    try:
+        with db.begin_nested():
+            reschedule_vehicle(db, vehicle_id)
+    except Exception as e:
+        # The change itself is still saved; the next full planning picks it up
+        logging.error(f"Rescheduling vehicle {vehicle_id} failed: {e}")
+
+
+@app.post("/workshops", response_model=WorkshopOut)
+def create_workshop(
+    workshop: WorkshopCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    new_workshop = Workshop(**workshop.dict())
+    db.add(new_workshop)
+    db.flush()
+    log_activity(db, current_user.id, "add_workshop", f"Added workshop {workshop.name}")
+    return new_workshop
+
+
+@app.get("/workshops", response_model=List[WorkshopOut])
+def list_workshops(
+    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+):
+    return db.query(Workshop).order_by(Workshop.id).all()
+
+
+@app.post(
+    "/vehicles/{vehicle_id}/unavailability", response_model=VehicleUnavailabilityOut
+)
+def create_vehicle_unavailability(
+    vehicle_id: int,
+    unavailability: VehicleUnavailabilityCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    if unavailability.end_date < unavailability.start_date:
+        raise HTTPException(status_code=400, detail="end_date is before start_date")
+    if db.query(Vehicle.id).filter(Vehicle.id == vehicle_id).first() is None:
+        raise HTTPException(status_code=404, detail="Vehicle not found")
+    new_unavailability = VehicleUnavailability(
+        vehicle_id=vehicle_id, **unavailability.dict()
+    )
+    db.add(new_unavailability)
+    db.flush()
+    replan_vehicle(db, vehicle_id)
+    return new_unavailability
+
+
+@app.get(
+    "/vehicles/{vehicle_id}/unavailability",
+    response_model=List[VehicleUnavailabilityOut],
+)
+def list_vehicle_unavailability(
+    vehicle_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    return (
+        db.query(VehicleUnavailability)
+        .filter(VehicleUnavailability.vehicle_id == vehicle_id)
+        .order_by(VehicleUnavailability.start_date)
+        .all()
+    )
+
+
+# Planned visits by date; unscheduled=true lists the vehicles due within the
+# horizon that no workshop had room for
+@app.get("/maintenance/schedule", response_model=List[MaintenanceSlotOut])
+def get_maintenance_schedule(
+    workshop_id: Optional[int] = None,
+    vehicle_id: Optional[int] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    unscheduled: bool = False,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    query = db.query(MaintenanceSlot)
+    if unscheduled:
+        query = query.filter(MaintenanceSlot.scheduled_date.is_(None))
+    if workshop_id is not None:
+        query = query.filter(MaintenanceSlot.workshop_id == workshop_id)
+    if vehicle_id is not None:
+        query = query.filter(MaintenanceSlot.vehicle_id == vehicle_id)
+    if start is not None:
+        query = query.filter(MaintenanceSlot.scheduled_date >= start)
+    if end is not None:
+        query = query.filter(MaintenanceSlot.scheduled_date <= end)
+    return query.order_by(
+        MaintenanceSlot.scheduled_date.nullsfirst(),
+        MaintenanceSlot.workshop_id,
+        MaintenanceSlot.vehicle_id,
+    ).all()
+
+
+@app.post("/maintenance/schedule/plan", status_code=202, response_model=JobOut)
+def plan_maintenance_schedule(
+    jobs_db: Session = Depends(get_jobs_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    job = job_queue.submit(
+        jobs_db,
+        "maintenance_schedule",
+        {},
+        tenant=tenant,
+        created_by=current_user.id,
+        dedupe_key=f"{tenant}:maintenance_schedule",
+    )
+    return job_out(job)
+
+
+# --- Batch ---
+# Many creates, updates and deletes of vehicles, drivers, costs and maintenance
+# records in one transaction: either every operation is applied or none is
+@app.post("/batch", response_model=BatchOut)
+def batch(
+    request: BatchRequest,
+    db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    pipeline: TelemetryPipeline = Depends(get_pipeline),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    if len(request.operations) > BATCH_MAX_OPERATIONS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {BATCH_MAX_OPERATIONS} operations per batch",
+        )
+    try:
+        outcome = apply_batch(db, request.operations, current_user.id)
+    except BatchFailed as e:
+        return JSONResponse(
+            status_code=e.status_code,
+            content={"committed": False, "results": e.results},
+        )
+    except IntegrityError as e:
+        db.rollback()
+        logging.error(f"Batch rejected by the database: {e.orig}")
+        raise HTTPException(
+            status_code=409,
+            detail="Batch conflicts with existing data (e.g. a deleted row "
+            "is still referenced)",
+        )
+    for vehicle_id, day in outcome.fuel_costs:
+        after_commit(db, pipeline.fuel.note_fuel_cost, vehicle_id, day)
+    for entry in outcome.search_upserts:
+        after_commit(db, search_indexes.upsert, tenant, entry)
+    for kind, entity_id in outcome.search_removals:
+        after_commit(db, search_indexes.remove, tenant, kind, entity_id)
+    logging.info(f"Batch of {len(outcome.results)} operations applied")
+    return {"committed": True, "results": outcome.results}
+
+
+# --- Sync ---
+# Rows of vehicles, drivers, costs and maintenance records changed or deleted
+# since the client's token. Without a token the first cycle returns every row.
+# Call again with the returned token while "more" is true, then keep the last
+# token for the next refresh.
+@app.get("/sync", response_model=SyncOut)
+def sync(
+    token: Optional[str] = None,
+    tables: Optional[str] = None,
+    limit: int = Query(SYNC_PAGE_SIZE, ge=1, le=5000),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    table_list = [table.strip() for table in tables.split(",")] if tables else None
+    if table_list and any(table not in SYNC_TABLES for table in table_list):
+        raise HTTPException(
+            status_code=400,
+            detail=f"tables must be among: {', '.join(SYNC_TABLES)}",
+        )
+    try:
+        return sync_changes(db, token, table_list, limit)
+    except SyncTokenExpired as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except SyncError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+# --- Dashboard ---
+# KPIs for the dashboard cards; shared by every dashboard of a tenant for a few
+# seconds so refreshes cost one set of aggregate queries per interval
+@app.get("/dashboard/summary", response_model=DashboardSummaryOut)
+def dashboard_summary(
+    response: Response,
+    db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    pipeline: TelemetryPipeline = Depends(get_pipeline),
+    current_user: User = Depends(get_current_user),
+):
+    summary, expires_at = summary_cache.get_or_compute(
+        tenant, lambda: compute_summary(db, pipeline, fleet_states.get(tenant))
+    )
+    max_age = max(0, int(expires_at - time.monotonic()))
+    response.headers["Cache-Control"] = f"private, max-age={max_age}"
+    return summary
+
+
+# --- Map ---
+# Vehicles of the viewport clustered on a grid within each web mercator tile, so
+# the payload grows with the viewport rather than the fleet. Served from the
+# in-memory fleet state; a tile is cached until a vehicle in it moves.
+@app.get("/map/clusters", response_model=MapClustersOut)
+def map_cluster_view(
+    min_lat: float = Query(..., ge=-90, le=90),
+    min_lon: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    max_lon: float = Query(..., ge=-180, le=180),
+    zoom: int = Query(..., ge=0, le=MAP_MAX_ZOOM),
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_current_user),
+):
+    if min_lat > max_lat or min_lon > max_lon:
+        raise HTTPException(status_code=400, detail="Invalid bounding box")
+    cache = map_clusters.get(tenant)
+    try:
+        clusters = cache.clusters(min_lat, min_lon, max_lat, max_lon, zoom)
+    except ViewportTooLarge as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "zoom": zoom,
+        "version": cache.state.version,
+        "vehicles": sum(cluster["count"] for cluster in clusters),
+        "clusters": clusters,
+    }
+
+
+# --- Forecasts ---
+# Monthly cost forecast per category for one vehicle, or summed over the fleet,
+# from the models the cost_forecast job fitted; starts with the current month
+@app.get("/forecasts/costs", response_model=CostForecastOut)
+def forecast_costs(
+    vehicle_id: Optional[int] = None,
+    months: int = Query(6, ge=1, le=FORECAST_MAX_MONTHS),
+    db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_current_user),
+):
+    if (
+        vehicle_id is not None
+        and db.query(Vehicle.id).filter(Vehicle.id == vehicle_id).first() is None
+    ):
+        raise HTTPException(status_code=404, detail="Vehicle not found")
+    return cost_forecast(db, tenant, months, vehicle_id)
+
+
+# Refits the models of vehicles with new, changed or deleted costs since their
+# last fit (all of them with full=true)
+@app.post("/forecasts/refit", status_code=202, response_model=JobOut)
+def refit_forecasts(
+    full: bool = False,
+    jobs_db: Session = Depends(get_jobs_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    job = job_queue.submit(
+        jobs_db,
+        "cost_forecast",
+        {"full": full},
+        tenant=tenant,
+        created_by=current_user.id,
+        dedupe_key=f"{tenant}:cost_forecast",
+    )
+    return job_out(job)
+
+
+# --- Search ---
+# Typo tolerant lookup of registrations, driver names, licence and phone numbers
+# and document numbers; served from memory. While the tenant's index is being
+# built, exact substrings are looked up in the database instead.
+@app.get("/search", response_model=List[SearchResultOut])
+def search(
+    q: str = Query(..., min_length=2, max_length=100),
+    limit: int = Query(20, ge=1, le=100),
+    kinds: Optional[str] = None,
+    db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_current_user),
+):
+    kind_list = [kind.strip() for kind in kinds.split(",")] if kinds else None
+    if kind_list and any(kind not in KINDS for kind in kind_list):
+        raise HTTPException(
+            status_code=400, detail=f"kinds must be among: {', '.join(KINDS)}"
+        )
+    index = search_indexes.ready(tenant)
+    if index is None:
+        return database_search(db, q, limit, kind_list)
+    return index.search(q, limit, kind_list)
+
+
+# --- Telemetry History ---
+def telemetry_window(start: Optional[datetime], end: Optional[datetime]):
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(hours=1)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    return start, end
+
+
+@app.get("/vehicles/{vehicle_id}/telemetry", response_model=TelemetryHistoryOut)
+def get_vehicle_telemetry(
+    vehicle_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    resolution: str = "auto",
+    limit: int = Query(TELEMETRY_MAX_POINTS, ge=1, le=TELEMETRY_MAX_POINTS),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    if resolution not in ("auto", "raw", "1m", "1h"):
+        raise HTTPException(status_code=400, detail="Invalid resolution")
+    start, end = telemetry_window(start, end)
+    resolution, points = query_history(db, start, end, vehicle_id, resolution, limit)
+    return {
+        "vehicle_id": vehicle_id,
+        "resolution": resolution,
+        "start": start,
+        "end": end,
+        "points": points,
+    }
+
+
+@app.get("/telemetry", response_model=TelemetryHistoryOut)
+def get_fleet_telemetry(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    resolution: str = "auto",
+    limit: int = Query(TELEMETRY_MAX_POINTS, ge=1, le=TELEMETRY_MAX_POINTS),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    if resolution not in ("auto", "raw", "1m", "1h"):
+        raise HTTPException(status_code=400, detail="Invalid resolution")
+    start, end = telemetry_window(start, end)
+    resolution, points = query_history(db, start, end, None, resolution, limit)
+    return {"resolution": resolution, "start": start, "end": end, "points": points}
+
+
+# --- Trips and Geofences ---
+@app.get("/vehicles/{vehicle_id}/trips", response_model=List[TripOut])
+def list_vehicle_trips(
+    vehicle_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+    pipeline: TelemetryPipeline = Depends(get_pipeline),
+    current_user: User = Depends(get_current_user),
+):
+    end = end or datetime.utcnow()
+    start = start or datetime.combine(end.date(), datetime.min.time())
+    trips = (
+        db.query(Trip)
+        .filter(
+            Trip.vehicle_id == vehicle_id,
+            Trip.started_at >= start,
+            Trip.started_at < end,
+        )
+        .order_by(Trip.started_at)
+        .all()
+    )
+    trips = [TripOut.from_orm(t) for t in trips]
+    open_trip = pipeline.trips.open_trip(vehicle_id)
+    if open_trip and start <= open_trip["started_at"] < end:
+        trips.append(TripOut(**open_trip))
+    return trips
+
+
+@job_queue.register("backfill_trips", heavy=True)
+def run_backfill_trips(ctx: JobContext):
+    start = datetime.fromisoformat(ctx.payload["start"])
+    end = datetime.fromisoformat(ctx.payload["end"])
+    pipeline = pipelines.get(ctx.tenant)
+    ctx.progress(0.0, f"Rebuilding trips from {start} to {end}")
+    with unit_of_work(open_session(ctx.tenant)) as db:
+        result = backfill(
+            db, pipeline.geofences, start, end, ctx.payload.get("vehicle_id")
+        )
+        log_activity(
+            db, ctx.user_id, "backfill_trips", f"Rebuilt trips from {start} to {end}"
+        )
+    return result
+
+
+@app.post("/trips/backfill", status_code=202, response_model=JobOut)
+def backfill_trips(
+    start: datetime,
+    end: datetime,
+    vehicle_id: Optional[int] = None,
+    jobs_db: Session = Depends(get_jobs_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    admin_user: User = Depends(get_admin_user),
+):
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    payload = {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "vehicle_id": vehicle_id,
+    }
+    job = job_queue.submit(
+        jobs_db, "backfill_trips", payload, tenant=tenant, created_by=admin_user.id
+    )
+    return job_out(job)
+
+
+def geofence_out(geofence: Geofence):
+    return {
+        "geofence_id": geofence.geofence_id,
+        "name": geofence.name,
+        "polygon": json.loads(geofence.polygon),
+        "created_at": geofence.created_at,
+    }
+
+
+@app.post("/geofences", response_model=GeofenceOut)
+def create_geofence(
+    geofence: GeofenceCreate,
+    db: Session = Depends(get_db),
+    pipeline: TelemetryPipeline = Depends(get_pipeline),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    if len(geofence.polygon) < 3 or any(len(p) != 2 for p in geofence.polygon):
+        raise HTTPException(
+            status_code=400,
+            detail="Polygon needs at least 3 [latitude, longitude] points",
+        )
+    new_geofence = Geofence(name=geofence.name, polygon=json.dumps(geofence.polygon))
+    db.add(new_geofence)
+    db.flush()
+    after_commit(
+        db, pipeline.trips.add_geofence, new_geofence.geofence_id, geofence.polygon
+    )
+    log_activity(
+        db, current_user.id, "add_geofence", f"Added geofence {geofence.name}"
+    )
+    return geofence_out(new_geofence)
+
+
+@app.get("/geofences", response_model=List[GeofenceOut])
+def list_geofences(
+    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+):
+    return [geofence_out(g) for g in db.query(Geofence).all()]
+
+
+@app.delete("/geofences/{geofence_id}")
+def delete_geofence(
+    geofence_id: int,
+    db: Session = Depends(get_db),
+    pipeline: TelemetryPipeline = Depends(get_pipeline),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    db_geofence = (
+        db.query(Geofence).filter(Geofence.geofence_id == geofence_id).first()
+    )
+    if not db_geofence:
+        logging.error(f"Geofence deletion failed: Geofence ID {geofence_id} not found")
+        raise HTTPException(status_code=404, detail="Geofence not found")
+    db.query(GeofenceEvent).filter(GeofenceEvent.geofence_id == geofence_id).delete(
+        synchronize_session=False
+    )
+    db.delete(db_geofence)
+    after_commit(db, pipeline.trips.remove_geofence, geofence_id)
+    log_activity(
+        db, current_user.id, "delete_geofence", f"Deleted geofence {db_geofence.name}"
+    )
+    return {"message": "Geofence deleted"}
+
+
+@app.get("/geofence-events", response_model=List[GeofenceEventOut])
+def list_geofence_events(
+    vehicle_id: Optional[int] = None,
+    geofence_id: Optional[int] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    query = db.query(GeofenceEvent)
+    if vehicle_id is not None:
+        query = query.filter(GeofenceEvent.vehicle_id == vehicle_id)
+    if geofence_id is not None:
+        query = query.filter(GeofenceEvent.geofence_id == geofence_id)
+    if start is not None:
+        query = query.filter(GeofenceEvent.occurred_at >= start)
+    if end is not None:
+        query = query.filter(GeofenceEvent.occurred_at < end)
+    return query.order_by(GeofenceEvent.occurred_at).all()
+
+
+# --- Fuel Alerts ---
+@app.get("/fuel-alerts", response_model=List[FuelAlertOut])
+def list_fuel_alerts(
+    vehicle_id: Optional[int] = None,
+    alert_type: Optional[str] = None,
+    since: Optional[datetime] = None,
+    include_resolved: bool = False,
+    limit: int = 500,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    query = db.query(FuelAlert)
+    if vehicle_id is not None:
+        query = query.filter(FuelAlert.vehicle_id == vehicle_id)
+    if alert_type is not None:
+        query = query.filter(FuelAlert.alert_type == alert_type)
+    if since is not None:
+        query = query.filter(FuelAlert.occurred_at >= since)
+    if not include_resolved:
+        query = query.filter(FuelAlert.resolved.is_(False))
+    return query.order_by(FuelAlert.occurred_at.desc()).limit(limit).all()
+
+
+@app.post("/fuel-alerts/{alert_id}/resolve", response_model=FuelAlertOut)
+def resolve_fuel_alert(
+    alert_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    alert = db.query(FuelAlert).filter(FuelAlert.alert_id == alert_id).first()
+    if not alert:
+        logging.error(f"Fuel alert resolve failed: Alert ID {alert_id} not found")
+        raise HTTPException(status_code=404, detail="Fuel alert not found")
+    alert.resolved = True
+    log_activity(
+        db, current_user.id, "resolve_fuel_alert", f"Resolved fuel alert {alert_id}"
+    )
+    return alert
+
+
 # --- Route Optimization ---
 @app.post("/optimize-route", response_model=RouteOptimizationOut)
 def optimize_route(
@@ -712,13 +1686,60 @@ def optimize_route(
     }
 
 
+# Routes for a day's orders across every available vehicle (routing.py),
+# respecting vehicle capacities, driver availability and delivery windows.
+# Runs as a job; its result holds the routes, in stop order, and the orders no
+# vehicle could take.
+@app.post("/routes/plan", status_code=202, response_model=JobOut)
+def plan_fleet_routes(
+    request: RoutePlanRequest,
+    jobs_db: Session = Depends(get_jobs_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    if len(request.orders) > ROUTING_MAX_ORDERS:
+        raise HTTPException(
+            status_code=413, detail=f"At most {ROUTING_MAX_ORDERS} orders per plan"
+        )
+    if request.shift_end <= request.shift_start:
+        raise HTTPException(
+            status_code=400, detail="shift_end must be after shift_start"
+        )
+    if (request.time_budget_seconds or 0) > ROUTING_MAX_TIME_BUDGET_SECONDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"time_budget_seconds is at most {ROUTING_MAX_TIME_BUDGET_SECONDS}",
+        )
+    for order in request.orders:
+        if (
+            order.window_start is not None
+            and order.window_end is not None
+            and order.window_end < order.window_start
+        ):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Order {order.order_id} has its window_end before window_start",
+            )
+    job = job_queue.submit(
+        jobs_db,
+        "route_plan",
+        request.dict(),
+        tenant=tenant,
+        created_by=current_user.id,
+    )
+    return job_out(job)
+
+
 # --- Simulated Updates ---
 @app.get("/simulated-updates")
 def get_simulated_updates(
-    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+    db: Session = Depends(get_primary_db),
+    pipeline: TelemetryPipeline = Depends(get_pipeline),
+    current_user: User = Depends(get_current_user),
 ):
     vehicles = db.query(Vehicle).all()
     drivers = db.query(Driver).all()
+    now = datetime.utcnow()
     for vehicle in vehicles:
         vehicle.latitude = (vehicle.latitude or -1.2921) + random.uniform(-0.01, 0.01)
         vehicle.longitude = (vehicle.longitude or 36.8219) + random.uniform(-0.01, 0.01)
@@ -728,12 +1749,19 @@ def get_simulated_updates(
         vehicle.maintenance_score = max(
             0, vehicle.maintenance_score - random.uniform(0, 0.2)
         )
+        pipeline.record(
+            vehicle.id,
+            now,
+            vehicle.latitude,
+            vehicle.longitude,
+            vehicle.speed,
+            vehicle.fuel_level,
+        )
     for driver in drivers:
         driver.status = random.choice(["Available", "On Trip", "Off Duty"])
         if driver.status == "On Trip":
             driver.total_trips += 1
             driver.rating = min(5.0, driver.rating + random.uniform(0, 0.1))
-    db.commit()
     log_activity(
         db,
         current_user.id,
@@ -746,13 +1774,75 @@ def get_simulated_updates(
     }
 
 
-# --- WebSocket Placeholder ---
+# --- Device credentials ---
+# A bearer token for a vehicle's tracker, accepted by /ws/updates (as ?token= or
+# an Authorization header). It carries the tenant, so trackers never name one
+# themselves, and it is not a user: every user endpoint rejects it.
+@app.post("/vehicles/{vehicle_id}/device-token")
+def create_device_token(
+    vehicle_id: int,
+    db: Session = Depends(get_primary_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    admin_user: User = Depends(get_admin_user),
+):
+    if db.query(Vehicle.id).filter(Vehicle.id == vehicle_id).first() is None:
+        raise HTTPException(status_code=404, detail="Vehicle not found")
+    expires = timedelta(days=DEVICE_TOKEN_EXPIRE_DAYS)
+    claims = {"sub": f"device:{vehicle_id}", "device": vehicle_id}
+    if tenant is not None:
+        claims["tenant"] = tenant
+    log_activity(
+        db, admin_user.id, "device_token", f"Issued a tracker token for {vehicle_id}"
+    )
+    return {
+        "access_token": create_access_token(claims, expires),
+        "token_type": "bearer",
+        "expires_at": datetime.utcnow() + expires,
+    }
+
+
+# --- Telemetry WebSocket ---
+# Trackers send one JSON update per text message, each acknowledged, or frames
+# of packed binary records (tracker_protocol.py) acknowledged cumulatively. With
+# tenants, the connection needs a device (or user) token naming the tenant.
 @app.websocket("/ws/updates")
-async def websocket_updates(websocket: WebSocket, db: Session = Depends(get_db)):
+async def websocket_updates(
+    websocket: WebSocket,
+    db: Session = Depends(get_db),
+    tenant: Optional[str] = Depends(get_tenant),
+):
     await websocket.accept()
+    window = AckWindow()
     try:
         while True:
-            data = await websocket.receive_json()
+            try:
+                message = await asyncio.wait_for(
+                    websocket.receive(), window.timeout()
+                )
+            except asyncio.TimeoutError:
+                await websocket.send_bytes(window.take_ack())
+                continue
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                frame = message["bytes"]
+                try:
+                    sequence, records = decode_frame(frame)
+                except FrameError as e:
+                    await websocket.close(code=1007, reason=str(e))
+                    break
+                accepted, rejected = await run_in_threadpool(
+                    binary_telemetry.apply,
+                    db,
+                    pipelines.get(tenant),
+                    len(frame),
+                    records,
+                )
+                window.add(sequence, accepted, rejected)
+                if window.timeout() == 0:
+                    await websocket.send_bytes(window.take_ack())
+                continue
+            data = json.loads(message["text"])
             vehicle_id = data.get("vehicle_id")
             vehicle = db.query(Vehicle).filter(Vehicle.id == vehicle_id).first()
             if vehicle:
@@ -761,6 +1851,19 @@ async def websocket_updates(websocket: WebSocket, db: Session = Depends(get_db))
                 vehicle.speed = data.get("speed", vehicle.speed)
                 vehicle.fuel_level = data.get("fuel_level", vehicle.fuel_level)
                 db.commit()
+                pipelines.get(tenant).record(
+                    vehicle.id,
+                    parse_timestamp(data.get("timestamp")),
+                    vehicle.latitude,
+                    vehicle.longitude,
+                    vehicle.speed,
+                    vehicle.fuel_level,
+                )
+                telemetry_logger.info(
+                    f"Telemetry update for vehicle {vehicle_id}: "
+                    f"lat={vehicle.latitude} lon={vehicle.longitude} "
+                    f"speed={vehicle.speed} fuel={vehicle.fuel_level}"
+                )
                 await websocket.send_json(
                     {"status": "updated", "vehicle_id": vehicle_id}
                 )
@@ -769,74 +1872,163 @@ async def websocket_updates(websocket: WebSocket, db: Session = Depends(get_db))
         logging.error(f"WebSocket error: {e}")
 
 
+# --- Fleet WebSocket ---
+# Dashboards get the position updates of their tenant's vehicles, whichever API
+# process the tracker is connected to, as {"events": [...]} messages holding
+# what was published since the previous message. The bearer token may be
+# passed as ?token=.
+FLEET_TOPICS = ("vehicle.position",)
+
+
+@app.websocket("/ws/fleet")
+async def websocket_fleet(websocket: WebSocket):
+    try:
+        if get_token_payload(websocket) is None:
+            raise HTTPException(status_code=401)
+        tenant = get_tenant(websocket)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    subscription = event_bus.subscribe(FLEET_TOPICS, tenant)
+
+    # Dashboards send nothing; this only notices the disconnect
+    async def wait_disconnect():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    disconnected = asyncio.ensure_future(wait_disconnect())
+    try:
+        while True:
+            batch = asyncio.ensure_future(subscription.next_batch())
+            await asyncio.wait(
+                {batch, disconnected}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if disconnected.done():
+                batch.cancel()
+                break
+            await websocket.send_json(
+                {
+                    "events": [
+                        {"topic": e["topic"], "data": e["data"], "ts": e["ts"]}
+                        for e in batch.result()
+                    ]
+                }
+            )
+    except Exception as e:
+        logging.error(f"Fleet WebSocket error: {e}")
+    finally:
+        disconnected.cancel()
+        event_bus.unsubscribe(subscription)
+
+
 # --- Backup/Restore ---
-@app.post("/backup")
+# Dumps and restores run as background jobs; the endpoints return 202 with the
+# job to poll at /jobs/{job_id}
+# pg_dump and psql arguments and environment reaching the tenant's data (the
+# main database without tenants). The password goes in the environment rather
+# than on the command line.
+def pg_client(tenant: Optional[str]):
+    url, schema = database_location(tenant)
+    url = make_url(url)
+    env = dict(os.environ)
+    if url.password is not None:
+        env["PGPASSWORD"] = str(url.password)
+    dbname = url.set(drivername="postgresql", password=None)
+    args = [f"--dbname={dbname.render_as_string(hide_password=False)}"]
+    if schema is not None:
+        env["PGOPTIONS"] = f"-csearch_path={schema}"
+    return args, schema, env
+
+
+@job_queue.register("backup", heavy=True, max_attempts=2)
+def run_backup(ctx: JobContext):
+    backup_file = ctx.payload["backup_file"]
+    os.makedirs("backup", exist_ok=True)
+    ctx.progress(0.0, "Dumping database")
+    args, schema, env = pg_client(ctx.tenant)
+    if schema is not None:
+        args.append(f"--schema={schema}")
+    ctx.run_process(["pg_dump", *args, "-f", backup_file], env=env)
+    with unit_of_work(open_session(ctx.tenant)) as db:
+        log_activity(db, ctx.user_id, "backup", f"Created backup: {backup_file}")
+    return {"message": f"Backup created: {backup_file}", "file": backup_file}
+
+
+# A restore is not idempotent, so it is never retried automatically
+@job_queue.register("restore", heavy=True, max_attempts=1)
+def run_restore(ctx: JobContext):
+    backup_path = ctx.payload["backup_path"]
+    ctx.progress(0.0, "Restoring database")
+    args, _, env = pg_client(ctx.tenant)
+    ctx.run_process(["psql", *args, "-f", backup_path], env=env)
+    with unit_of_work(open_session(ctx.tenant)) as db:
+        log_activity(
+            db, ctx.user_id, "restore", f"Restored database from: {backup_path}"
+        )
+    search_indexes.invalidate(ctx.tenant)
+    return {"message": "Database restored successfully"}
+
+
+@app.post("/backup", status_code=202, response_model=JobOut)
 def create_backup(
-    db: Session = Depends(get_db), admin_user: User = Depends(get_admin_user)
+    priority: int = 0,
+    jobs_db: Session = Depends(get_jobs_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    admin_user: User = Depends(get_admin_user),
 ):
     backup_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_file = f"backup/logistics_backup_{backup_time}.sql"
-    os.makedirs("backup", exist_ok=True)
-    try:
-        subprocess.run(
-            [
-                "pg_dump",
-                "-U",
-                "postgres",
-                "-h",
-                "localhost",
-                "-f",
-                backup_file,
-                "logistics_saas",
-            ],
-            check=True,
-            env={**os.environ, "PGPASSWORD": "password"},
-        )
-        log_activity(db, admin_user.id, "backup", f"Created backup: {backup_file}")
-        return {"message": f"Backup created: {backup_file}"}
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Backup failed: {e}")
-        raise HTTPException(status_code=500, detail=f"Backup failed: {e}")
+    name = f"logistics_backup_{tenant}" if tenant else "logistics_backup"
+    backup_file = f"backup/{name}_{backup_time}.sql"
+    job = job_queue.submit(
+        jobs_db,
+        "backup",
+        {"backup_file": backup_file},
+        priority=priority,
+        tenant=tenant,
+        created_by=admin_user.id,
+    )
+    return job_out(job)
 
 
-@app.post("/restore")
+@app.post("/restore", status_code=202, response_model=JobOut)
 async def restore_backup(
     file: UploadFile = File(...),
-    db: Session = Depends(get_db),
+    priority: int = 0,
+    jobs_db: Session = Depends(get_jobs_db),
+    tenant: Optional[str] = Depends(get_tenant),
     admin_user: User = Depends(get_admin_user),
 ):
     backup_path = f"backup/restore_{datetime.now().strftime('%Y%m%d_%H%M%S')}.sql"
     os.makedirs("backup", exist_ok=True)
     with open(backup_path, "wb") as f:
         f.write(await file.read())
-    try:
-        subprocess.run(
-            [
-                "psql",
-                "-U",
-                "postgres",
-                "-h",
-                "localhost",
-                "-d",
-                "logistics_saas",
-                "-f",
-                backup_path,
-            ],
-            check=True,
-            env={**os.environ, "PGPASSWORD": "password"},
-        )
-        log_activity(
-            db, admin_user.id, "restore", f"Restored database from: {backup_path}"
+
+    def submit():
+        job = job_queue.submit(
+            jobs_db,
+            "restore",
+            {"backup_path": backup_path},
+            priority=priority,
+            tenant=tenant,
+            created_by=admin_user.id,
         )
-        return {"message": "Database restored successfully"}
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Restore failed: {e}")
-        raise HTTPException(status_code=500, detail=f"Restore failed: {e}")
+        return job_out(job)
+
+    return await run_in_threadpool(submit)
 
 
 # --- Seed Data ---
-@app.post("/seed-data")
-def seed_data(db: Session = Depends(get_db)):
+@job_queue.register("seed_data")
+def run_seed_data(ctx: JobContext):
+    with unit_of_work(open_session(ctx.tenant)) as db:
+        seed_database(db)
+        log_activity(db, ctx.user_id, "seed_data", "Database seeded with sample data")
+    search_indexes.invalidate(ctx.tenant)
+    return {"message": "Database seeded"}
+
+
+def seed_database(db: Session):
     if db.query(Vehicle).count() == 0:
         vehicles = [
             Vehicle(
@@ -927,18 +2119,223 @@ def seed_data(db: Session = Depends(get_db)):
         admin = User(
             username="admin",
             email="admin@logistics.com",
-            password_hash=pwd_context.hash("admin123"),
+            password_hash=hash_password("admin123"),
             role="admin",
             full_name="System Administrator",
             department="IT",
             status="active",
         )
         db.add(admin)
-    db.commit()
-    log_activity(db, 0, "seed_data", "Database seeded with sample data")
-    return {"message": "Database seeded"}
+
+
+# Open without a token, since it creates the first admin of an empty database
+@app.post("/seed-data", status_code=202, response_model=JobOut)
+def seed_data(
+    jobs_db: Session = Depends(get_jobs_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: Optional[User] = Depends(get_optional_user),
+):
+    created_by = current_user.id if current_user is not None else None
+    return job_out(
+        job_queue.submit(jobs_db, "seed_data", tenant=tenant, created_by=created_by)
+    )
+
+
+# --- Reports ---
+# Reports are aggregated in SQL and rendered by a background job. Finished files
+# are keyed by their parameters and the data version of the tables they read,
+# so a repeated request is answered from disk until that data changes.
+@app.post("/reports/{report_type}", response_model=ReportOut)
+def request_report(
+    report_type: str,
+    response: Response,
+    month: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    format: str = "xlsx",
+    vehicle_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    jobs_db: Session = Depends(get_jobs_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    try:
+        request = ReportRequest.parse(report_type, month, start, end, format, vehicle_id)
+    except ReportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    version, filename, ready = cached_artifact(db, tenant, request)
+    report = ReportOut(
+        report_type=report_type,
+        format=format,
+        start=request.start,
+        end=request.end - timedelta(days=1),
+        vehicle_id=vehicle_id,
+        data_version=version,
+        status="ready" if ready else "pending",
+    )
+    if ready:
+        report.download_url = f"/reports/files/{filename}"
+        return report
+    job = job_queue.submit(
+        jobs_db,
+        "report",
+        request.payload(),
+        priority=1,
+        tenant=tenant,
+        created_by=current_user.id,
+        dedupe_key=f"{tenant}:{filename}",
+    )
+    report.job = job_out(job)
+    response.status_code = 202
+    return report
+
+
+@app.get("/reports/files/{filename}")
+def download_report(
+    filename: str,
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_manager_or_admin_user),
+):
+    try:
+        path = artifact_path(tenant, filename)
+    except ReportError:
+        raise HTTPException(status_code=404, detail="Report not found")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Report not found")
+    fmt = filename.rsplit(".", 1)[1]
+    return FileResponse(path, media_type=REPORT_FORMATS[fmt], filename=filename)
+
+
+# --- Jobs ---
+def job_out(job: Job):
+    return JobOut(
+        job_id=job.job_id,
+        job_type=job.job_type,
+        status=job.status,
+        priority=job.priority,
+        progress=job.progress,
+        message=job.message,
+        attempts=job.attempts,
+        max_attempts=job.max_attempts,
+        cancel_requested=job.cancel_requested,
+        error=job.error,
+        result=json.loads(job.result) if job.result else None,
+        created_by=job.created_by,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+    )
+
+
+# Jobs live in the main database; users only see their own tenant's jobs and,
+# unless they are admins, only the ones they started
+def visible_jobs(jobs_db: Session, tenant: Optional[str], user: User):
+    query = jobs_db.query(Job).filter(Job.tenant == tenant)
+    if user.role != "admin":
+        query = query.filter(Job.created_by == user.id)
+    return query
+
+
+def get_visible_job(jobs_db: Session, job_id: int, tenant, user: User) -> Job:
+    job = visible_jobs(jobs_db, tenant, user).filter(Job.job_id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/jobs", response_model=List[JobOut])
+def list_jobs(
+    job_status: Optional[str] = Query(None, alias="status"),
+    job_type: Optional[str] = None,
+    limit: int = 100,
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_current_user),
+):
+    with open_session(None) as jobs_db:
+        query = visible_jobs(jobs_db, tenant, current_user)
+        if job_status:
+            query = query.filter(Job.status == job_status)
+        if job_type:
+            query = query.filter(Job.job_type == job_type)
+        jobs = query.order_by(Job.job_id.desc()).limit(min(limit, 1000)).all()
+        return [job_out(job) for job in jobs]
+
+
+@app.get("/jobs/{job_id}", response_model=JobOut)
+def get_job(
+    job_id: int,
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_current_user),
+):
+    with open_session(None) as jobs_db:
+        return job_out(get_visible_job(jobs_db, job_id, tenant, current_user))
+
+
+@app.post("/jobs/{job_id}/cancel", response_model=JobOut)
+def cancel_job(
+    job_id: int,
+    jobs_db: Session = Depends(get_jobs_db),
+    tenant: Optional[str] = Depends(get_tenant),
+    current_user: User = Depends(get_current_user),
+):
+    job = get_visible_job(jobs_db, job_id, tenant, current_user)
+    if job.status in FINISHED:
+        raise HTTPException(status_code=409, detail=f"Job already {job.status}")
+    return job_out(job_queue.cancel(jobs_db, job))
 
 
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the HC Logistics SaaS!"}
+
+
+# --- Health ---
+@app.get("/health/live")
+def liveness():
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+def readiness():
+    checks = {}
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            checks["database"] = "ok"
+            if not tenant_router.enabled:
+                revision = current_revision(conn)
+                expected = head_revision()
+                checks["schema"] = (
+                    "ok"
+                    if revision == expected
+                    else f"at revision {revision}, expected {expected}"
+                )
+    except Exception as e:
+        checks["database"] = f"unavailable: {e.__class__.__name__}"
+    ready = all(value == "ok" for value in checks.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not ready", "checks": checks},
+    )
+
+
+# Per-process counters of the in-memory subsystems, for operators
+@app.get("/admin/metrics")
+def metrics(current_user: User = Depends(get_admin_user)):
+    return {
+        "admission": admission.stats(),
+        "jobs": job_queue.stats(),
+        "telemetry": pipelines.stats(),
+        "telemetry_binary": binary_telemetry.stats(),
+        "replicas": replica_router.stats(),
+        "tenants": tenant_router.stats(),
+        "events": event_bus.stats(),
+        "dashboard_cache": summary_cache.stats(),
+        "forecast_cache": forecast_cache.stats(),
+        "activity_archive": activity_archive.stats(),
+        "search": search_indexes.stats(),
+        "fleet_state": fleet_states.stats(),
+        "map_tiles": map_clusters.stats(),
+        "hours_of_service": hos_engines.stats(),
+        "traffic_capture": traffic_recorder.stats(),
+    }
@@ -0,0 +1,553 @@
+from datetime import date, datetime, timedelta
+import logging
+import os
+import time
+
+import numpy as np
+from sqlalchemy import func, insert, or_, tuple_
+
+from jobs import JobContext, job_queue
+from models import (
+    MaintenanceRecord,
+    MaintenanceSlot,
+    Vehicle,
+    VehicleUnavailability,
+    Workshop,
+)
+from tenancy import open_session, tenant_router
+from trips import EARTH_RADIUS_KM
+
+MAINTENANCE_HORIZON_DAYS = int(os.getenv("MAINTENANCE_HORIZON_DAYS", "90"))
+# Service interval when no maintenance record names the next date; the
+# dashboard's "overdue" threshold
+MAINTENANCE_INTERVAL_DAYS = int(os.getenv("MAINTENANCE_INTERVAL_DAYS", "180"))
+# Points of maintenance_score a vehicle is assumed to lose per day; it is due
+# when the score reaches the dashboard's "needs service" threshold
+SCORE_DECAY_PER_DAY = float(os.getenv("MAINTENANCE_SCORE_DECAY_PER_DAY", "0.5"))
+SCORE_NEEDS_SERVICE = 30.0
+# Below the dashboard's "schedule soon" threshold each overdue day costs more
+SCORE_SCHEDULE_SOON = 50.0
+# Costs of a day overdue (times the vehicle's urgency), of a day early, and of
+# an hour on the road to and from the workshop
+EARLY_DAY_COST = float(os.getenv("MAINTENANCE_EARLY_DAY_COST", "0.1"))
+TRAVEL_HOUR_COST = float(os.getenv("MAINTENANCE_TRAVEL_HOUR_COST", "0.5"))
+TRAVEL_SPEED_KMH = float(os.getenv("MAINTENANCE_TRAVEL_SPEED_KMH", "50"))
+# Nearest workshops tried first for each vehicle
+WORKSHOP_CANDIDATES = int(os.getenv("MAINTENANCE_WORKSHOP_CANDIDATES", "8"))
+MAINTENANCE_SEARCH_SECONDS = float(os.getenv("MAINTENANCE_SEARCH_SECONDS", "2"))
+MAINTENANCE_SCHEDULE_SECONDS = float(
+    os.getenv("MAINTENANCE_SCHEDULE_SECONDS", "86400")
+)
+# Booked days, cheaper for a vehicle than its own, whose occupants the local
+# search tries to swap with or move out
+SWAP_CELLS = 4
+STORE_CHUNK = 500
+EPSILON = 1e-9
+
+
+def travel_hours(vehicle_lat, vehicle_lon, workshop_lat, workshop_lon):
+    lat1 = np.radians(vehicle_lat)[:, None]
+    lon1 = np.radians(vehicle_lon)[:, None]
+    lat2 = np.radians(workshop_lat)[None, :]
+    lon2 = np.radians(workshop_lon)[None, :]
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    km = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    # An unknown position costs no travel
+    return np.nan_to_num(2 * km / TRAVEL_SPEED_KMH)
+
+
+# Vehicles due for service within the horizon, one booking of one day each, to
+# be placed in a workshop's daily capacity. Days are offsets from `today`;
+# vehicles and workshops are indexed by position. The cost of a booking is
+#
+#   urgency * days overdue  +  EARLY_DAY_COST * days early
+#                           +  TRAVEL_HOUR_COST * round trip hours
+#
+# and a vehicle left unbooked costs more than any booking it could have had.
+class SchedulingProblem:
+    def __init__(
+        self,
+        today: date,
+        horizon: int,
+        vehicle_ids,
+        due,
+        urgency,
+        blocked,
+        workshop_ids,
+        capacity,
+        travel,
+    ):
+        self.today = today
+        self.horizon = horizon
+        self.vehicle_ids = np.asarray(vehicle_ids, dtype=np.int64)
+        self.due = np.asarray(due, dtype=np.int64)
+        self.urgency = np.asarray(urgency, dtype=np.float64)
+        self.workshop_ids = np.asarray(workshop_ids, dtype=np.int64)
+        self.capacity = np.asarray(capacity, dtype=np.int64)
+        self.travel = np.asarray(travel, dtype=np.float64).reshape(
+            len(self.vehicle_ids), len(self.workshop_ids)
+        )
+        self.travel_cost = TRAVEL_HOUR_COST * self.travel
+        days = np.arange(horizon)[None, :]
+        late = days - self.due[:, None]
+        self.time_cost = np.where(
+            late > 0, self.urgency[:, None] * late, -EARLY_DAY_COST * late
+        )
+        self.time_cost[blocked] = np.inf
+        self.candidates = np.argsort(self.travel, axis=1, kind="stable")[
+            :, :WORKSHOP_CANDIDATES
+        ]
+        self.unscheduled_cost = (
+            self.urgency * np.maximum(horizon - self.due, 0)
+            + self.travel_cost.max(axis=1, initial=0)
+            + 1.0
+        )
+        with np.errstate(invalid="ignore"):
+            self.lower_bound = np.where(
+                np.isfinite(self.time_cost).any(axis=1),
+                self.travel_cost.min(axis=1, initial=0)
+                + self.time_cost.min(axis=1, initial=np.inf),
+                self.unscheduled_cost,
+            )
+        self.all_workshops = np.arange(len(self.workshop_ids))
+        self.remaining = np.repeat(self.capacity[:, None], horizon, axis=1)
+        self.assigned_workshop = np.full(len(self.vehicle_ids), -1)
+        self.assigned_day = np.full(len(self.vehicle_ids), -1)
+        self.occupants = {}
+
+    def __len__(self):
+        return len(self.vehicle_ids)
+
+    def cost(self, v: int, w: int, d: int) -> float:
+        return self.travel_cost[v, w] + self.time_cost[v, d]
+
+    def current_cost(self, v: int) -> float:
+        w = self.assigned_workshop[v]
+        if w < 0:
+            return self.unscheduled_cost[v]
+        return self.cost(v, w, self.assigned_day[v])
+
+    def current_costs(self):
+        booked = self.assigned_workshop >= 0
+        costs = self.unscheduled_cost.copy()
+        v = np.flatnonzero(booked)
+        costs[v] = (
+            self.travel_cost[v, self.assigned_workshop[v]]
+            + self.time_cost[v, self.assigned_day[v]]
+        )
+        return costs
+
+    # Takes the slot without touching the capacity left: for bookings that are
+    # already counted in it (incremental rescheduling)
+    def place(self, v: int, w: int, d: int):
+        self.assigned_workshop[v] = w
+        self.assigned_day[v] = d
+        self.occupants.setdefault((w, d), []).append(v)
+
+    def assign(self, v: int, w: int, d: int):
+        self.remaining[w, d] -= 1
+        self.place(v, w, d)
+
+    def unassign(self, v: int):
+        w, d = self.assigned_workshop[v], self.assigned_day[v]
+        if w < 0:
+            return
+        self.remaining[w, d] += 1
+        self.occupants[(w, d)].remove(v)
+        self.assigned_workshop[v] = self.assigned_day[v] = -1
+
+    def _costs(self, v: int, workshops):
+        return self.travel_cost[v, workshops][:, None] + self.time_cost[v][None, :]
+
+    # Cheapest (workshop, day, cost) with capacity left, None if there is none
+    def best_free(self, v: int):
+        for workshops in (self.candidates[v], self.all_workshops):
+            costs = self._costs(v, workshops)
+            costs[self.remaining[workshops] <= 0] = np.inf
+            i, d = np.unravel_index(np.argmin(costs), costs.shape)
+            if np.isfinite(costs[i, d]):
+                return int(workshops[i]), int(d), float(costs[i, d])
+        return None
+
+    # Fully booked (workshop, day) slots cheaper for v than `below`
+    def full_cells_below(self, v: int, below: float, limit: int = SWAP_CELLS):
+        workshops = self.candidates[v]
+        costs = self._costs(v, workshops)
+        costs[(self.remaining[workshops] > 0) | ~(costs < below)] = np.inf
+        flat = costs.ravel()
+        count = min(limit, flat.size)
+        if count == 0:
+            return []
+        best = np.argpartition(flat, count - 1)[:count]
+        best = best[np.argsort(flat[best])]
+        return [
+            (int(workshops[i // self.horizon]), int(i % self.horizon))
+            for i in best
+            if np.isfinite(flat[i])
+        ]
+
+    def greedy(self):
+        # Earliest due first, the more urgent first on the same day
+        for v in np.lexsort((-self.urgency, self.due)):
+            free = self.best_free(v)
+            if free is not None:
+                self.assign(v, free[0], free[1])
+
+    # The best of: moving v to a free slot, swapping it with the occupant of a
+    # cheaper booked slot, or taking that slot and moving its occupant to the
+    # occupant's best free one. Returns whether v's booking changed.
+    def improve_vehicle(self, v: int) -> bool:
+        current = self.current_cost(v)
+        free = self.best_free(v)
+        if free is not None and free[2] < current - EPSILON:
+            self.unassign(v)
+            self.assign(v, free[0], free[1])
+            return True
+        wv, dv = self.assigned_workshop[v], self.assigned_day[v]
+        best_delta, best_move = -EPSILON, None
+        for w, d in self.full_cells_below(v, current - EPSILON):
+            cost_v = self.cost(v, w, d)
+            for u in self.occupants.get((w, d), ()):
+                cost_u = self.cost(u, w, d)
+                if wv >= 0:
+                    delta = cost_v + self.cost(u, wv, dv) - current - cost_u
+                    if delta < best_delta:
+                        best_delta, best_move = delta, (w, d, u, (wv, dv))
+                # Moving u costs at least its lower bound
+                if cost_v + self.lower_bound[u] - current - cost_u >= best_delta:
+                    continue
+                moved = self.best_free(u)
+                if moved is not None:
+                    delta = cost_v + moved[2] - current - cost_u
+                    if delta < best_delta:
+                        best_delta, best_move = delta, (w, d, u, moved[:2])
+        if best_move is None:
+            return False
+        w, d, u, (wu, du) = best_move
+        self.unassign(u)
+        self.unassign(v)
+        self.assign(v, w, d)
+        self.assign(u, wu, du)
+        return True
+
+    # Passes over the vehicles furthest from their lower bound first, until a
+    # pass changes nothing or the time is up
+    def improve(self, deadline: float) -> int:
+        moves = 0
+        while time.monotonic() < deadline:
+            gaps = self.current_costs() - self.lower_bound
+            changed = 0
+            for n, v in enumerate(np.argsort(-gaps)):
+                if gaps[v] <= EPSILON:
+                    break
+                if n % 64 == 0 and time.monotonic() >= deadline:
+                    break
+                if self.improve_vehicle(v):
+                    changed += 1
+            moves += changed
+            if not changed:
+                break
+        return moves
+
+    def solve(self, search_seconds: float = MAINTENANCE_SEARCH_SECONDS) -> dict:
+        started = time.monotonic()
+        self.greedy()
+        greedy_cost = float(self.current_costs().sum())
+        greedy_seconds = time.monotonic() - started
+        moves = self.improve(time.monotonic() + search_seconds)
+        return {
+            **self.summary(),
+            "greedy_cost": round(greedy_cost, 2),
+            "greedy_seconds": round(greedy_seconds, 3),
+            "search_moves": moves,
+            "seconds": round(time.monotonic() - started, 3),
+        }
+
+    def summary(self) -> dict:
+        booked = np.flatnonzero(self.assigned_workshop >= 0)
+        overdue = np.maximum(self.assigned_day[booked] - self.due[booked], 0)
+        return {
+            "vehicles": len(self),
+            "scheduled": len(booked),
+            "unscheduled": len(self) - len(booked),
+            "overdue_vehicles": int((overdue > 0).sum()),
+            "overdue_days": int(overdue.sum()),
+            "travel_hours": round(
+                float(self.travel[booked, self.assigned_workshop[booked]].sum()), 1
+            ),
+            "cost": round(float(self.current_costs().sum()), 2),
+        }
+
+    def rows(self, vehicles, planned_at: datetime):
+        rows = []
+        for v in vehicles:
+            w, d = self.assigned_workshop[v], self.assigned_day[v]
+            booked = w >= 0
+            rows.append(
+                {
+                    "vehicle_id": int(self.vehicle_ids[v]),
+                    "workshop_id": int(self.workshop_ids[w]) if booked else None,
+                    "scheduled_date": (
+                        self.today + timedelta(days=int(d)) if booked else None
+                    ),
+                    "due_date": self.today + timedelta(days=int(self.due[v])),
+                    "overdue_days": max(0, int(d - self.due[v])) if booked else None,
+                    "travel_hours": (
+                        round(float(self.travel[v, w]), 2) if booked else None
+                    ),
+                    "planned_at": planned_at,
+                }
+            )
+        return rows
+
+
+# Due date per vehicle: the next date of its latest maintenance record that
+# names one, else its last service plus the interval, else today; brought
+# forward to when its score is projected to reach "needs service". Vehicles
+# already in the workshop are left out.
+def due_vehicles(db, today: date, vehicle_ids=None):
+    records = db.query(
+        MaintenanceRecord.vehicle_id, MaintenanceRecord.next_maintenance_date
+    ).filter(MaintenanceRecord.next_maintenance_date.isnot(None))
+    if vehicle_ids is not None:
+        records = records.filter(MaintenanceRecord.vehicle_id.in_(vehicle_ids))
+    latest = (
+        records.distinct(MaintenanceRecord.vehicle_id)
+        .order_by(
+            MaintenanceRecord.vehicle_id,
+            MaintenanceRecord.date.desc(),
+            MaintenanceRecord.record_id.desc(),
+        )
+        .subquery()
+    )
+    query = (
+        db.query(
+            Vehicle.id,
+            Vehicle.last_maintenance,
+            Vehicle.maintenance_score,
+            Vehicle.latitude,
+            Vehicle.longitude,
+            latest.c.next_maintenance_date,
+        )
+        .outerjoin(latest, latest.c.vehicle_id == Vehicle.id)
+        .filter(or_(Vehicle.status.is_(None), Vehicle.status != "Maintenance"))
+    )
+    if vehicle_ids is not None:
+        query = query.filter(Vehicle.id.in_(vehicle_ids))
+    rows = query.order_by(Vehicle.id).all()
+    if not rows:
+        return None
+    ids, last, score, lat, lon, next_date = zip(*rows)
+    interval = timedelta(days=MAINTENANCE_INTERVAL_DAYS)
+    due = np.array(
+        [
+            ((n or (l + interval if l else today)) - today).days
+            for l, n in zip(last, next_date)
+        ]
+    )
+    score = np.array([100.0 if s is None else s for s in score])
+    by_score = np.floor(
+        np.maximum(score - SCORE_NEEDS_SERVICE, 0) / SCORE_DECAY_PER_DAY
+    )
+    due = np.minimum(due, by_score).astype(np.int64)
+    urgency = 1 + np.maximum(SCORE_SCHEDULE_SOON - score, 0) / 10
+    return {
+        "ids": np.array(ids),
+        "due": due,
+        "urgency": urgency,
+        "lat": np.array(lat, dtype=np.float64),
+        "lon": np.array(lon, dtype=np.float64),
+    }
+
+
+def load_problem(db, today: date, vehicle_ids=None, horizon=MAINTENANCE_HORIZON_DAYS):
+    workshops = (
+        db.query(
+            Workshop.id, Workshop.daily_capacity, Workshop.latitude, Workshop.longitude
+        )
+        .order_by(Workshop.id)
+        .all()
+    )
+    if not workshops:
+        return None
+    vehicles = due_vehicles(db, today, vehicle_ids)
+    if vehicles is None:
+        return None
+    keep = vehicles["due"] < horizon
+    vehicles = {key: values[keep] for key, values in vehicles.items()}
+    if not keep.any():
+        return None
+    index = {vehicle_id: i for i, vehicle_id in enumerate(vehicles["ids"].tolist())}
+    blocked = np.zeros((len(index), horizon), dtype=bool)
+    end = today + timedelta(days=horizon)
+    unavailable = db.query(
+        VehicleUnavailability.vehicle_id,
+        VehicleUnavailability.start_date,
+        VehicleUnavailability.end_date,
+    ).filter(
+        VehicleUnavailability.start_date < end,
+        VehicleUnavailability.end_date >= today,
+    )
+    if vehicle_ids is not None:
+        unavailable = unavailable.filter(
+            VehicleUnavailability.vehicle_id.in_(vehicle_ids)
+        )
+    for vehicle_id, start, last in unavailable:
+        v = index.get(vehicle_id)
+        if v is not None:
+            blocked[v, max((start - today).days, 0):(last - today).days + 1] = True
+    workshop_ids, capacity, workshop_lat, workshop_lon = zip(*workshops)
+    travel = travel_hours(
+        vehicles["lat"],
+        vehicles["lon"],
+        np.array(workshop_lat, dtype=np.float64),
+        np.array(workshop_lon, dtype=np.float64),
+    )
+    return SchedulingProblem(
+        today,
+        horizon,
+        vehicles["ids"],
+        vehicles["due"],
+        vehicles["urgency"],
+        blocked,
+        workshop_ids,
+        [max(c or 0, 0) for c in capacity],
+        travel,
+    )
+
+
+def _insert_rows(db, rows):
+    for start in range(0, len(rows), STORE_CHUNK):
+        db.execute(insert(MaintenanceSlot).values(rows[start:start + STORE_CHUNK]))
+
+
+# Replaces the whole schedule in one transaction
+def plan_schedule(db, today: date = None, progress=None) -> dict:
+    today = today or date.today()
+    problem = load_problem(db, today)
+    db.query(MaintenanceSlot).delete(synchronize_session=False)
+    if problem is None:
+        db.commit()
+        return {"vehicles": 0, "scheduled": 0}
+    if progress:
+        progress(0.1, f"Scheduling {len(problem)} vehicles")
+    result = problem.solve()
+    if progress:
+        progress(0.9, "Saving schedule")
+    _insert_rows(db, problem.rows(range(len(problem)), datetime.utcnow()))
+    db.commit()
+    return result
+
+
+def _booked_counts(problem, db, today: date):
+    counts = (
+        db.query(
+            MaintenanceSlot.workshop_id,
+            MaintenanceSlot.scheduled_date,
+            func.count(),
+        )
+        .filter(
+            MaintenanceSlot.scheduled_date >= today,
+            MaintenanceSlot.scheduled_date < today + timedelta(days=problem.horizon),
+        )
+        .group_by(MaintenanceSlot.workshop_id, MaintenanceSlot.scheduled_date)
+    )
+    index = {w: i for i, w in enumerate(problem.workshop_ids.tolist())}
+    for workshop_id, day, count in counts:
+        w = index.get(workshop_id)
+        if w is not None:
+            problem.remaining[w, (day - today).days] -= count
+
+
+# Re-plans one vehicle after its records, score or availability changed,
+# keeping everyone else's booking except at most one vehicle it swaps with or
+# moves out of a slot. Returns the vehicle's new slot row, None when it is not
+# due within the horizon. The caller commits.
+def reschedule_vehicle(db, vehicle_id: int, today: date = None):
+    today = today or date.today()
+    db.query(MaintenanceSlot).filter(MaintenanceSlot.vehicle_id == vehicle_id).delete(
+        synchronize_session=False
+    )
+    problem = load_problem(db, today, [vehicle_id])
+    if problem is None:
+        return None
+    _booked_counts(problem, db, today)
+    free = problem.best_free(0)
+    below = problem.unscheduled_cost[0] if free is None else free[2]
+    cells = problem.full_cells_below(0, below - EPSILON)
+    if cells:
+        workshop_ids = problem.workshop_ids
+        occupants = (
+            db.query(
+                MaintenanceSlot.vehicle_id,
+                MaintenanceSlot.workshop_id,
+                MaintenanceSlot.scheduled_date,
+            )
+            .filter(
+                tuple_(MaintenanceSlot.workshop_id, MaintenanceSlot.scheduled_date).in_(
+                    [
+                        (int(workshop_ids[w]), today + timedelta(days=d))
+                        for w, d in cells
+                    ]
+                )
+            )
+            .all()
+        )
+        problem = load_problem(
+            db, today, [vehicle_id, *(row[0] for row in occupants)]
+        )
+        _booked_counts(problem, db, today)
+        index = {v: i for i, v in enumerate(problem.vehicle_ids.tolist())}
+        workshop_index = {w: i for i, w in enumerate(problem.workshop_ids.tolist())}
+        for occupant_id, workshop_id, day in occupants:
+            if occupant_id in index:
+                problem.place(
+                    index[occupant_id],
+                    workshop_index[workshop_id],
+                    (day - today).days,
+                )
+        v = index[vehicle_id]
+        free = problem.best_free(v)
+    else:
+        v = 0
+    if free is not None:
+        problem.assign(v, free[0], free[1])
+    before = problem.assigned_workshop.copy(), problem.assigned_day.copy()
+    problem.improve_vehicle(v)
+    changed = [
+        i
+        for i in range(len(problem))
+        if i != v
+        and (
+            problem.assigned_workshop[i] != before[0][i]
+            or problem.assigned_day[i] != before[1][i]
+        )
+    ]
+    if changed:
+        db.query(MaintenanceSlot).filter(
+            MaintenanceSlot.vehicle_id.in_(
+                [int(problem.vehicle_ids[i]) for i in changed]
+            )
+        ).delete(synchronize_session=False)
+    rows = problem.rows([v, *changed], datetime.utcnow())
+    _insert_rows(db, rows)
+    if changed:
+        logging.info(
+            f"Rescheduling vehicle {vehicle_id} moved vehicle "
+            f"{rows[1]['vehicle_id']} to {rows[1]['scheduled_date']}"
+        )
+    return rows[0]
+
+
+@job_queue.register("maintenance_schedule", heavy=True)
+def run_maintenance_schedule(ctx: JobContext):
+    with open_session(ctx.tenant) as db:
+        return plan_schedule(db, progress=ctx.progress)
+
+
+job_queue.schedule(
+    "maintenance_schedule", MAINTENANCE_SCHEDULE_SECONDS, tenant_router.active_tenants
+)
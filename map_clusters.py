@@ -0,0 +1,217 @@
+from collections import OrderedDict
+import math
+import os
+import threading
+
+import numpy as np
+
+from fleet_state import FleetState, fleet_states
+
+# Each web mercator tile is split into a GRID x GRID raster of cells; 8 gives
+# 32 pixel clusters on 256 pixel tiles
+MAP_CLUSTER_GRID = int(os.getenv("MAP_CLUSTER_GRID", "8"))
+# A viewport spanning more tiles than this has to zoom in
+MAP_MAX_TILES = int(os.getenv("MAP_MAX_TILES", "256"))
+MAP_TILE_CACHE_SIZE = int(os.getenv("MAP_TILE_CACHE_SIZE", "20000"))
+MAP_MAX_ZOOM = 20
+MAX_LATITUDE = 85.05112878  # web mercator cuts off the poles
+UNKNOWN_STATUS = "unknown"
+
+
+class ViewportTooLarge(ValueError):
+    pass
+
+
+# Fractional web mercator tile coordinates, y growing southwards
+def tile_coordinates(latitude, longitude, zoom: int):
+    n = 2.0 ** zoom
+    lat = np.radians(np.clip(latitude, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(longitude, dtype=float) + 180.0) / 360.0 * n
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * n
+    # Keeps longitude 180 and the clipped poles on the last tile
+    last = np.nextafter(n, 0)
+    return np.clip(x, 0, last), np.clip(y, 0, last)
+
+
+# Latitude and longitude of the north-west corner of tile (x, y)
+def tile_corner(x: int, y: int, zoom: int):
+    n = 2.0 ** zoom
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lat, x / n * 360.0 - 180.0
+
+
+# Clusters per tile for one tenant's fleet state. The state reports the old and
+# new positions of every vehicle a replay touched; the tiles containing either
+# are dropped, at every zoom level with cached tiles.
+class TileCache:
+    def __init__(
+        self,
+        state: FleetState,
+        grid: int = MAP_CLUSTER_GRID,
+        size: int = MAP_TILE_CACHE_SIZE,
+    ):
+        self.state = state
+        self.grid = grid
+        self.size = size
+        self.tiles = OrderedDict()  # (zoom, x, y) -> clusters, least recent first
+        self.zooms = {}  # zoom -> cached tiles
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self._lock = threading.Lock()
+        state.watch("vehicles", ("latitude", "longitude"), self._moved)
+
+    def _moved(self, before, after):
+        lat = np.concatenate([before["latitude"], after["latitude"]])
+        lon = np.concatenate([before["longitude"], after["longitude"]])
+        placed = ~(np.isnan(lat) | np.isnan(lon))
+        lat, lon = lat[placed], lon[placed]
+        with self._lock:
+            self.generation += 1
+            for zoom in list(self.zooms):
+                fx, fy = tile_coordinates(lat, lon, zoom)
+                tx, ty = fx.astype(np.int64).tolist(), fy.astype(np.int64).tolist()
+                for x, y in set(zip(tx, ty)):
+                    if self._drop((zoom, x, y)):
+                        self.invalidated += 1
+
+    def _drop(self, key) -> bool:
+        if self.tiles.pop(key, None) is None:
+            return False
+        self.zooms[key[0]] -= 1
+        if not self.zooms[key[0]]:
+            del self.zooms[key[0]]
+        return True
+
+    def clusters(self, min_lat, min_lon, max_lat, max_lon, zoom: int):
+        x0, y0 = tile_coordinates(max_lat, min_lon, zoom)
+        x1, y1 = tile_coordinates(min_lat, max_lon, zoom)
+        xs = range(int(x0), int(x1) + 1)
+        ys = range(int(y0), int(y1) + 1)
+        if len(xs) * len(ys) > MAP_MAX_TILES:
+            raise ViewportTooLarge(
+                f"The viewport covers {len(xs) * len(ys)} tiles at zoom {zoom}; "
+                f"at most {MAP_MAX_TILES} are allowed"
+            )
+        keys = [(zoom, x, y) for x in xs for y in ys]
+        found = {}
+        with self._lock:
+            for key in keys:
+                tile = self.tiles.get(key)
+                if tile is not None:
+                    self.tiles.move_to_end(key)
+                    found[key] = tile
+            generation = self.generation
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            computed = self._compute(zoom, missing)
+            with self._lock:
+                # Tiles computed from positions a replay has since changed
+                # are served once but not kept
+                if self.generation == generation:
+                    for key, tile in computed.items():
+                        if key not in self.tiles:
+                            self.zooms[zoom] = self.zooms.get(zoom, 0) + 1
+                        self.tiles[key] = tile
+                    while len(self.tiles) > self.size:
+                        self._drop(next(iter(self.tiles)))
+            found.update(computed)
+        return [cluster for key in keys for cluster in found[key]]
+
+    # Bins the vehicles of the missing tiles into grid cells in one pass:
+    # counts, position sums and per-status counts are bincounts over the cells
+    def _compute(self, zoom: int, keys):
+        with self.state.lock:
+            vehicles = self.state.vehicles
+            lat = vehicles.column("latitude").copy()
+            lon = vehicles.column("longitude").copy()
+            status = vehicles.column("status").copy()
+            ids = vehicles.column("id").copy()
+            labels = [UNKNOWN_STATUS] + [str(s) for s in vehicles.vocab["status"]]
+        tiles = {key: [] for key in keys}
+        # Projecting only the vehicles around the missing tiles; NaN positions
+        # fail the comparisons
+        xs = [x for _, x, _ in keys]
+        ys = [y for _, _, y in keys]
+        north, west = tile_corner(min(xs), min(ys), zoom)
+        south, east = tile_corner(max(xs) + 1, max(ys) + 1, zoom)
+        near = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+        lat, lon, status, ids = lat[near], lon[near], status[near], ids[near]
+        fx, fy = tile_coordinates(lat, lon, zoom)
+        tx, ty = fx.astype(np.int64), fy.astype(np.int64)
+        n = 1 << zoom
+        tile = tx * n + ty
+        wanted = np.isin(tile, [x * n + y for _, x, y in keys])
+        if not wanted.any():
+            return tiles
+        grid = self.grid
+        cx = ((fx[wanted] - tx[wanted]) * grid).astype(np.int64)
+        cy = ((fy[wanted] - ty[wanted]) * grid).astype(np.int64)
+        cell = (tile[wanted] * grid + cx) * grid + cy
+        lat, lon, status, ids = lat[wanted], lon[wanted], status[wanted], ids[wanted]
+        cells, inverse, counts = np.unique(
+            cell, return_inverse=True, return_counts=True
+        )
+        lat_mean = np.bincount(inverse, weights=lat) / counts
+        lon_mean = np.bincount(inverse, weights=lon) / counts
+        width = len(labels)
+        breakdown = np.bincount(
+            inverse * width + status.astype(np.int64) + 1, minlength=len(cells) * width
+        ).reshape(len(cells), width)
+        # The vehicle of each single-vehicle cell, so it can be drawn as a marker
+        first = np.argsort(inverse, kind="stable")[np.cumsum(counts) - counts]
+        cell_tiles = cells // (grid * grid)
+        for i, count in enumerate(counts.tolist()):
+            row = breakdown[i]
+            statuses = {labels[s]: int(row[s]) for s in np.flatnonzero(row)}
+            tile_id = int(cell_tiles[i])
+            tiles[(zoom, tile_id // n, tile_id % n)].append(
+                {
+                    "latitude": float(lat_mean[i]),
+                    "longitude": float(lon_mean[i]),
+                    "count": count,
+                    "statuses": statuses,
+                    "vehicle_id": int(ids[first[i]]) if count == 1 else None,
+                }
+            )
+        return tiles
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tiles": len(self.tiles),
+                "zooms": sorted(self.zooms),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidated": self.invalidated,
+            }
+
+
+# One tile cache per tenant, over the tenant's fleet state
+class MapClusters:
+    def __init__(self, states=fleet_states):
+        self.states = states
+        self.caches = {}
+        self._lock = threading.Lock()
+
+    def get(self, tenant: str = None) -> TileCache:
+        state = self.states.get(tenant)
+        cache = self.caches.get(tenant)
+        if cache is not None and cache.state is state:
+            return cache
+        with self._lock:
+            cache = self.caches.get(tenant)
+            if cache is None or cache.state is not state:
+                cache = self.caches[tenant] = TileCache(state)
+        return cache
+
+    def stats(self):
+        return {
+            str(tenant): cache.stats() for tenant, cache in list(self.caches.items())
+        }
+
+
+map_clusters = MapClusters()
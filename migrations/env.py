@@ -0,0 +1,80 @@
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine, pool, text
+
+from database import SQLALCHEMY_DATABASE_URL, Base
+import models  # noqa: F401  (registers every table on Base.metadata)
+from partitions import is_partition_name
+from tenancy import TenantRouter, tenant_router, validate_tenant
+
+config = context.config
+configure_logger = config.attributes.get("configure_logger", True)
+if config.config_file_name is not None and configure_logger:
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
+
+target_metadata = Base.metadata
+
+
+# Autogenerate and `alembic check` compare the models with the live database,
+# which also holds the partitions created at runtime (partitions.py) and tables
+# the models do not declare; those, and their indexes and constraints, are left
+# alone rather than proposed for dropping
+def include_object(object, name, type_, reflected, compare_to):
+    table = object if type_ == "table" else getattr(object, "table", None)
+    if table is None:
+        return True
+    if is_partition_name(table.name):
+        return False
+    return not (reflected and table.name not in target_metadata.tables)
+
+
+def migration_target():
+    # Returns (url, schema) for the main database or for one tenant
+    tenant = context.get_x_argument(as_dictionary=True).get("tenant")
+    tenant = config.attributes.get("tenant", tenant)
+    if not tenant:
+        return config.attributes.get("url", SQLALCHEMY_DATABASE_URL), None
+    tenant = validate_tenant(tenant)
+    router = tenant_router
+    if not router.enabled:
+        router = TenantRouter(mode="schema")
+    return router.location(tenant)
+
+
+def run_migrations_offline():
+    url, schema = migration_target()
+    context.configure(
+        url=url,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        version_table_schema=schema,
+        include_object=include_object,
+    )
+    with context.begin_transaction():
+        if schema:
+            context.execute(f'SET search_path TO "{schema}"')
+        context.run_migrations()
+
+
+def run_migrations_online():
+    url, schema = migration_target()
+    connectable = create_engine(url, poolclass=pool.NullPool)
+    with connectable.connect() as connection:
+        if schema:
+            connection.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+            connection.execute(text(f'SET search_path TO "{schema}"'))
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            version_table_schema=schema,
+            include_object=include_object,
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,241 @@
+"""Initial schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19 09:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("username", sa.String(), nullable=False),
+        sa.Column("email", sa.String(), nullable=False, unique=True),
+        sa.Column("password_hash", sa.String(), nullable=False),
+        sa.Column("role", sa.String(), nullable=False),
+        sa.Column("full_name", sa.String()),
+        sa.Column("phone", sa.String()),
+        sa.Column("department", sa.String()),
+        sa.Column("status", sa.String()),
+        sa.Column("last_login", sa.DateTime()),
+        sa.Column("created_at", sa.DateTime()),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+    op.create_index("ix_users_username", "users", ["username"], unique=True)
+
+    op.create_table(
+        "user_activity",
+        sa.Column("activity_id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("action_type", sa.String(), nullable=False),
+        sa.Column("action_details", sa.Text()),
+        sa.Column("timestamp", sa.DateTime()),
+    )
+    op.create_index("ix_user_activity_activity_id", "user_activity", ["activity_id"])
+
+    op.create_table(
+        "drivers",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("license_number", sa.String(), nullable=False, unique=True),
+        sa.Column("license_expiry", sa.Date()),
+        sa.Column("phone", sa.String()),
+        sa.Column("email", sa.String()),
+        sa.Column("status", sa.String()),
+        sa.Column("join_date", sa.Date()),
+        sa.Column("rest_hours", sa.Float()),
+        sa.Column("last_duty_end", sa.DateTime()),
+        sa.Column("total_trips", sa.Integer()),
+        sa.Column("rating", sa.Float()),
+        sa.Column("notes", sa.Text()),
+    )
+    op.create_index("ix_drivers_id", "drivers", ["id"])
+
+    op.create_table(
+        "vehicles",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("registration_number", sa.String(), nullable=False, unique=True),
+        sa.Column("vehicle_type", sa.String(), nullable=False),
+        sa.Column("capacity", sa.Float()),
+        sa.Column("fuel_type", sa.String()),
+        sa.Column("status", sa.String()),
+        sa.Column("last_maintenance", sa.Date()),
+        sa.Column("latitude", sa.Float()),
+        sa.Column("longitude", sa.Float()),
+        sa.Column("speed", sa.Float()),
+        sa.Column("fuel_level", sa.Float()),
+        sa.Column("maintenance_score", sa.Float()),
+        sa.Column("driver_id", sa.Integer(), sa.ForeignKey("drivers.id")),
+    )
+    op.create_index("ix_vehicles_id", "vehicles", ["id"])
+
+    for table, owner in (("driver_documents", "driver"), ("vehicle_documents", "vehicle")):
+        op.create_table(
+            table,
+            sa.Column("doc_id", sa.Integer(), primary_key=True),
+            sa.Column(f"{owner}_id", sa.Integer(), sa.ForeignKey(f"{owner}s.id")),
+            sa.Column("doc_type", sa.String(), nullable=False),
+            sa.Column("doc_number", sa.String()),
+            sa.Column("issue_date", sa.Date()),
+            sa.Column("expiry_date", sa.Date()),
+            sa.Column("status", sa.String()),
+            sa.Column("file_path", sa.String()),
+        )
+        op.create_index(f"ix_{table}_doc_id", table, ["doc_id"])
+
+    op.create_table(
+        "costs",
+        sa.Column("cost_id", sa.Integer(), primary_key=True),
+        sa.Column("date", sa.Date(), nullable=False),
+        sa.Column("category", sa.String(), nullable=False),
+        sa.Column("amount", sa.Float(), nullable=False),
+        sa.Column("description", sa.Text()),
+        sa.Column("vehicle_id", sa.Integer(), sa.ForeignKey("vehicles.id")),
+        sa.Column("driver_id", sa.Integer(), sa.ForeignKey("drivers.id")),
+        sa.Column("receipt_path", sa.String()),
+        sa.Column("status", sa.String()),
+        sa.Column("created_at", sa.DateTime()),
+    )
+    op.create_index("ix_costs_cost_id", "costs", ["cost_id"])
+
+    op.create_table(
+        "maintenance_records",
+        sa.Column("record_id", sa.Integer(), primary_key=True),
+        sa.Column("vehicle_id", sa.Integer(), sa.ForeignKey("vehicles.id")),
+        sa.Column("maintenance_type", sa.String(), nullable=False),
+        sa.Column("date", sa.Date(), nullable=False),
+        sa.Column("cost", sa.Float()),
+        sa.Column("notes", sa.Text()),
+        sa.Column("next_maintenance_date", sa.Date()),
+        sa.Column("status", sa.String()),
+    )
+    op.create_index(
+        "ix_maintenance_records_record_id", "maintenance_records", ["record_id"]
+    )
+
+    # Partitions are created on demand by partitions.ensure_partition
+    op.create_table(
+        "vehicle_telemetry",
+        sa.Column("vehicle_id", sa.Integer(), primary_key=True),
+        sa.Column("recorded_at", sa.DateTime(), primary_key=True),
+        sa.Column("latitude", sa.Float()),
+        sa.Column("longitude", sa.Float()),
+        sa.Column("speed", sa.Float()),
+        sa.Column("fuel_level", sa.Float()),
+        postgresql_partition_by="RANGE (recorded_at)",
+    )
+
+    op.create_table(
+        "vehicle_telemetry_rollups",
+        sa.Column("vehicle_id", sa.Integer(), primary_key=True),
+        sa.Column("resolution", sa.String(), primary_key=True),
+        sa.Column("bucket_start", sa.DateTime(), primary_key=True),
+        sa.Column("samples", sa.Integer(), nullable=False),
+        sa.Column("sum_latitude", sa.Float()),
+        sa.Column("sum_longitude", sa.Float()),
+        sa.Column("sum_speed", sa.Float()),
+        sa.Column("sum_fuel_level", sa.Float()),
+        sa.Column("max_speed", sa.Float()),
+        sa.Column("min_fuel_level", sa.Float()),
+        sa.Column("max_fuel_level", sa.Float()),
+    )
+    op.create_index(
+        "ix_telemetry_rollups_resolution_bucket",
+        "vehicle_telemetry_rollups",
+        ["resolution", "bucket_start"],
+    )
+
+    op.create_table(
+        "trips",
+        sa.Column("trip_id", sa.Integer(), primary_key=True),
+        sa.Column("vehicle_id", sa.Integer(), nullable=False),
+        sa.Column("started_at", sa.DateTime(), nullable=False),
+        sa.Column("ended_at", sa.DateTime(), nullable=False),
+        sa.Column("start_latitude", sa.Float()),
+        sa.Column("start_longitude", sa.Float()),
+        sa.Column("end_latitude", sa.Float()),
+        sa.Column("end_longitude", sa.Float()),
+        sa.Column("distance_km", sa.Float()),
+        sa.Column("duration_seconds", sa.Float()),
+        sa.Column("idle_seconds", sa.Float()),
+        sa.Column("avg_speed", sa.Float()),
+    )
+    op.create_index("ix_trips_trip_id", "trips", ["trip_id"])
+    op.create_index("ix_trips_vehicle_started", "trips", ["vehicle_id", "started_at"])
+
+    op.create_table(
+        "geofences",
+        sa.Column("geofence_id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("polygon", sa.Text(), nullable=False),
+        sa.Column("created_at", sa.DateTime()),
+    )
+    op.create_index("ix_geofences_geofence_id", "geofences", ["geofence_id"])
+
+    op.create_table(
+        "geofence_events",
+        sa.Column("event_id", sa.Integer(), primary_key=True),
+        sa.Column(
+            "geofence_id",
+            sa.Integer(),
+            sa.ForeignKey("geofences.geofence_id", ondelete="CASCADE"),
+        ),
+        sa.Column("vehicle_id", sa.Integer(), nullable=False),
+        sa.Column("event_type", sa.String(), nullable=False),
+        sa.Column("occurred_at", sa.DateTime(), nullable=False),
+        sa.Column("latitude", sa.Float()),
+        sa.Column("longitude", sa.Float()),
+    )
+    op.create_index("ix_geofence_events_event_id", "geofence_events", ["event_id"])
+    op.create_index(
+        "ix_geofence_events_vehicle_occurred",
+        "geofence_events",
+        ["vehicle_id", "occurred_at"],
+    )
+
+    op.create_table(
+        "fuel_alerts",
+        sa.Column("alert_id", sa.Integer(), primary_key=True),
+        sa.Column("vehicle_id", sa.Integer(), nullable=False),
+        sa.Column("alert_type", sa.String(), nullable=False),
+        sa.Column("occurred_at", sa.DateTime(), nullable=False),
+        sa.Column("latitude", sa.Float()),
+        sa.Column("longitude", sa.Float()),
+        sa.Column("fuel_before", sa.Float()),
+        sa.Column("fuel_after", sa.Float()),
+        sa.Column("details", sa.Text()),
+        sa.Column("resolved", sa.Boolean()),
+    )
+    op.create_index("ix_fuel_alerts_alert_id", "fuel_alerts", ["alert_id"])
+    op.create_index(
+        "ix_fuel_alerts_vehicle_occurred", "fuel_alerts", ["vehicle_id", "occurred_at"]
+    )
+
+
+def downgrade():
+    for table in (
+        "fuel_alerts",
+        "geofence_events",
+        "geofences",
+        "trips",
+        "vehicle_telemetry_rollups",
+        "vehicle_telemetry",
+        "maintenance_records",
+        "costs",
+        "vehicle_documents",
+        "driver_documents",
+        "vehicles",
+        "drivers",
+        "user_activity",
+        "users",
+    ):
+        op.drop_table(table)
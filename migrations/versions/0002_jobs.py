@@ -0,0 +1,47 @@
+"""Background jobs
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19 10:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "jobs",
+        sa.Column("job_id", sa.Integer(), primary_key=True),
+        sa.Column("job_type", sa.String(), nullable=False),
+        sa.Column("tenant", sa.String()),
+        sa.Column("payload", sa.Text()),
+        sa.Column("result", sa.Text()),
+        sa.Column("error", sa.Text()),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("priority", sa.Integer(), nullable=False),
+        sa.Column("heavy", sa.Boolean()),
+        sa.Column("progress", sa.Float()),
+        sa.Column("message", sa.String()),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("max_attempts", sa.Integer(), nullable=False),
+        sa.Column("cancel_requested", sa.Boolean()),
+        sa.Column("worker", sa.String()),
+        sa.Column("created_by", sa.Integer()),
+        sa.Column("created_at", sa.DateTime()),
+        sa.Column("run_after", sa.DateTime()),
+        sa.Column("started_at", sa.DateTime()),
+        sa.Column("heartbeat_at", sa.DateTime()),
+        sa.Column("finished_at", sa.DateTime()),
+    )
+    op.create_index("ix_jobs_job_id", "jobs", ["job_id"])
+    op.create_index("ix_jobs_status_priority", "jobs", ["status", "priority"])
+
+
+def downgrade():
+    op.drop_table("jobs")
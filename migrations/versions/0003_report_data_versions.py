@@ -0,0 +1,103 @@
+"""Data versions for report caching
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19 11:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+# Table -> column whose month a change is recorded under (None: whole table)
+VERSIONED_TABLES = {
+    "costs": "date",
+    "maintenance_records": "date",
+    "trips": "started_at",
+    "vehicles": None,
+    "drivers": None,
+}
+
+
+def upgrade():
+    op.create_table(
+        "data_versions",
+        sa.Column("table_name", sa.String(), primary_key=True),
+        sa.Column("period", sa.Date(), primary_key=True),
+        sa.Column("version", sa.BigInteger(), nullable=False),
+    )
+    # Counts changes per table and month so cached reports for untouched months
+    # stay valid. Runs inside the writing transaction, so a committed change is
+    # always visible in the version.
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION note_data_change(tbl text, changed text)
+        RETURNS void AS $$
+        BEGIN
+            INSERT INTO data_versions (table_name, period, version)
+            VALUES (
+                tbl,
+                COALESCE(date_trunc('month', changed::timestamp)::date, '1970-01-01'),
+                1
+            )
+            ON CONFLICT (table_name, period)
+            DO UPDATE SET version = data_versions.version + 1;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                PERFORM note_data_change(
+                    TG_TABLE_NAME,
+                    CASE WHEN TG_NARGS > 0 THEN to_jsonb(OLD) ->> TG_ARGV[0] END
+                );
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                PERFORM note_data_change(
+                    TG_TABLE_NAME,
+                    CASE WHEN TG_NARGS > 0 THEN to_jsonb(NEW) ->> TG_ARGV[0] END
+                );
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    for table, column in VERSIONED_TABLES.items():
+        events = "INSERT OR UPDATE OR DELETE"
+        argument = f"'{column}'" if column else ""
+        if table == "vehicles":
+            # Position updates arrive constantly; only labels matter to reports
+            events = "INSERT OR DELETE OR UPDATE OF registration_number, vehicle_type"
+        op.execute(
+            f"CREATE TRIGGER {table}_data_version AFTER {events} ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION bump_data_version({argument})"
+        )
+
+    op.create_index("ix_costs_date", "costs", ["date"])
+    op.create_index("ix_maintenance_records_date", "maintenance_records", ["date"])
+    op.create_index("ix_trips_started_at", "trips", ["started_at"])
+
+    op.add_column("jobs", sa.Column("dedupe_key", sa.String()))
+    op.create_index("ix_jobs_dedupe_key", "jobs", ["dedupe_key"])
+
+
+def downgrade():
+    op.drop_index("ix_jobs_dedupe_key", table_name="jobs")
+    op.drop_column("jobs", "dedupe_key")
+    op.drop_index("ix_trips_started_at", table_name="trips")
+    op.drop_index("ix_maintenance_records_date", table_name="maintenance_records")
+    op.drop_index("ix_costs_date", table_name="costs")
+    for table in VERSIONED_TABLES:
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_data_version ON {table}")
+    op.execute("DROP FUNCTION IF EXISTS bump_data_version()")
+    op.execute("DROP FUNCTION IF EXISTS note_data_change(text, text)")
+    op.drop_table("data_versions")
@@ -0,0 +1,93 @@
+"""Row versions and tombstones for incremental sync
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19 14:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+# Table -> primary key column
+SYNCED_TABLES = {
+    "vehicles": "id",
+    "drivers": "id",
+    "costs": "cost_id",
+    "maintenance_records": "record_id",
+}
+
+
+def upgrade():
+    op.create_table(
+        "tombstones",
+        sa.Column("table_name", sa.String(), primary_key=True),
+        sa.Column("row_id", sa.BigInteger(), primary_key=True),
+        sa.Column("row_version", sa.BigInteger(), nullable=False),
+        sa.Column("deleted_at", sa.DateTime(), nullable=False),
+    )
+    op.create_index(
+        "ix_tombstones_table_version", "tombstones", ["table_name", "row_version"]
+    )
+    # A row's version is the id of the last transaction that wrote it. Set by
+    # trigger, so every writer (ORM, bulk statements, telemetry, psql) keeps it.
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION set_row_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.row_version := pg_current_xact_id()::text::bigint;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION record_tombstone() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO tombstones (table_name, row_id, row_version, deleted_at)
+            VALUES (
+                TG_TABLE_NAME,
+                (to_jsonb(OLD) ->> TG_ARGV[0])::bigint,
+                pg_current_xact_id()::text::bigint,
+                now() AT TIME ZONE 'utc'
+            )
+            ON CONFLICT (table_name, row_id) DO UPDATE
+            SET row_version = EXCLUDED.row_version,
+                deleted_at = EXCLUDED.deleted_at;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    for table, pk in SYNCED_TABLES.items():
+        op.add_column(table, sa.Column("row_version", sa.BigInteger()))
+        op.execute(
+            f"UPDATE {table} SET row_version = pg_current_xact_id()::text::bigint"
+        )
+        op.alter_column(table, "row_version", nullable=False)
+        op.create_index(f"ix_{table}_row_version", table, ["row_version", pk])
+        op.execute(
+            f"CREATE TRIGGER {table}_row_version BEFORE INSERT OR UPDATE ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION set_row_version()"
+        )
+        op.execute(
+            f"CREATE TRIGGER {table}_tombstone AFTER DELETE ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION record_tombstone('{pk}')"
+        )
+
+
+def downgrade():
+    for table in SYNCED_TABLES:
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_tombstone ON {table}")
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_row_version ON {table}")
+        op.drop_index(f"ix_{table}_row_version", table_name=table)
+        op.drop_column(table, "row_version")
+    op.execute("DROP FUNCTION IF EXISTS record_tombstone()")
+    op.execute("DROP FUNCTION IF EXISTS set_row_version()")
+    op.drop_index("ix_tombstones_table_version", table_name="tombstones")
+    op.drop_table("tombstones")
@@ -0,0 +1,37 @@
+"""Fitted per-vehicle cost forecast models
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19 15:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "cost_forecasts",
+        sa.Column(
+            "vehicle_id",
+            sa.Integer(),
+            sa.ForeignKey("vehicles.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("category", sa.String(), primary_key=True),
+        sa.Column("method", sa.String(), nullable=False),
+        sa.Column("params", sa.Text(), nullable=False),
+        sa.Column("last_period", sa.Date(), nullable=False),
+        sa.Column("observations", sa.Integer(), nullable=False),
+        sa.Column("source_version", sa.String(), nullable=False),
+        sa.Column("fitted_at", sa.DateTime(), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("cost_forecasts")
@@ -0,0 +1,129 @@
+"""Partition user_activity by month
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-19 16:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+# Months after the current one given a partition up front; later ones are
+# created by activity.py as rows arrive
+PARTITIONS_AHEAD = 2
+
+
+def upgrade():
+    op.execute("ALTER TABLE user_activity RENAME TO user_activity_old")
+    op.execute(
+        "ALTER TABLE user_activity_old "
+        "RENAME CONSTRAINT user_activity_pkey TO user_activity_old_pkey"
+    )
+    op.drop_index("ix_user_activity_activity_id", table_name="user_activity_old")
+    op.execute(
+        "UPDATE user_activity_old SET timestamp = now() AT TIME ZONE 'utc' "
+        "WHERE timestamp IS NULL"
+    )
+    # The partition key has to be part of the primary key
+    op.create_table(
+        "user_activity",
+        sa.Column(
+            "activity_id",
+            sa.Integer(),
+            server_default=sa.text("nextval('user_activity_activity_id_seq')"),
+            nullable=False,
+        ),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("action_type", sa.String(), nullable=False),
+        sa.Column("action_details", sa.Text()),
+        sa.Column("timestamp", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("activity_id", "timestamp"),
+        postgresql_partition_by="RANGE (timestamp)",
+    )
+    op.create_index("ix_user_activity_timestamp", "user_activity", ["timestamp"])
+    op.create_index(
+        "ix_user_activity_user_timestamp", "user_activity", ["user_id", "timestamp"]
+    )
+    op.create_index(
+        "ix_user_activity_action_timestamp",
+        "user_activity",
+        ["action_type", "timestamp"],
+    )
+    op.execute(
+        f"""
+        DO $$
+        DECLARE
+            month date;
+        BEGIN
+            FOR month IN
+                SELECT DISTINCT date_trunc('month', timestamp)::date
+                FROM user_activity_old
+                UNION
+                SELECT (
+                    date_trunc('month', now() AT TIME ZONE 'utc')
+                    + make_interval(months => ahead)
+                )::date
+                FROM generate_series(0, {PARTITIONS_AHEAD}) AS ahead
+            LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF user_activity '
+                    'FOR VALUES FROM (%L) TO (%L)',
+                    'user_activity_p' || to_char(month, 'YYYYMM'),
+                    month,
+                    (month + interval '1 month')::date
+                );
+            END LOOP;
+        END
+        $$
+        """
+    )
+    op.execute(
+        "INSERT INTO user_activity "
+        "(activity_id, user_id, action_type, action_details, timestamp) "
+        "SELECT activity_id, user_id, action_type, action_details, timestamp "
+        "FROM user_activity_old"
+    )
+    op.execute(
+        "ALTER SEQUENCE user_activity_activity_id_seq "
+        "OWNED BY user_activity.activity_id"
+    )
+    op.drop_table("user_activity_old")
+
+
+def downgrade():
+    # Rows already moved to Parquet archives stay there
+    op.execute("ALTER TABLE user_activity RENAME TO user_activity_partitioned")
+    op.execute(
+        "ALTER TABLE user_activity_partitioned "
+        "RENAME CONSTRAINT user_activity_pkey TO user_activity_partitioned_pkey"
+    )
+    op.create_table(
+        "user_activity",
+        sa.Column(
+            "activity_id",
+            sa.Integer(),
+            server_default=sa.text("nextval('user_activity_activity_id_seq')"),
+            primary_key=True,
+        ),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+        sa.Column("action_type", sa.String(), nullable=False),
+        sa.Column("action_details", sa.Text()),
+        sa.Column("timestamp", sa.DateTime()),
+    )
+    op.create_index("ix_user_activity_activity_id", "user_activity", ["activity_id"])
+    op.execute(
+        "INSERT INTO user_activity "
+        "(activity_id, user_id, action_type, action_details, timestamp) "
+        "SELECT activity_id, user_id, action_type, action_details, timestamp "
+        "FROM user_activity_partitioned"
+    )
+    op.execute(
+        "ALTER SEQUENCE user_activity_activity_id_seq "
+        "OWNED BY user_activity.activity_id"
+    )
+    op.execute("DROP TABLE user_activity_partitioned CASCADE")
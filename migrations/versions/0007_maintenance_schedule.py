@@ -0,0 +1,75 @@
+"""Workshops, vehicle unavailability and the maintenance schedule
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-19 18:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "workshops",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("latitude", sa.Float()),
+        sa.Column("longitude", sa.Float()),
+        sa.Column("daily_capacity", sa.Integer(), nullable=False),
+    )
+    op.create_index("ix_workshops_id", "workshops", ["id"])
+    op.create_table(
+        "vehicle_unavailability",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column(
+            "vehicle_id",
+            sa.Integer(),
+            sa.ForeignKey("vehicles.id", ondelete="CASCADE"),
+            nullable=False,
+        ),
+        sa.Column("start_date", sa.Date(), nullable=False),
+        sa.Column("end_date", sa.Date(), nullable=False),
+        sa.Column("reason", sa.String()),
+    )
+    op.create_index("ix_vehicle_unavailability_id", "vehicle_unavailability", ["id"])
+    op.create_index(
+        "ix_vehicle_unavailability_vehicle",
+        "vehicle_unavailability",
+        ["vehicle_id", "end_date"],
+    )
+    op.create_table(
+        "maintenance_schedule",
+        sa.Column(
+            "vehicle_id",
+            sa.Integer(),
+            sa.ForeignKey("vehicles.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column(
+            "workshop_id",
+            sa.Integer(),
+            sa.ForeignKey("workshops.id", ondelete="CASCADE"),
+        ),
+        sa.Column("scheduled_date", sa.Date()),
+        sa.Column("due_date", sa.Date(), nullable=False),
+        sa.Column("overdue_days", sa.Integer()),
+        sa.Column("travel_hours", sa.Float()),
+        sa.Column("planned_at", sa.DateTime(), nullable=False),
+    )
+    op.create_index(
+        "ix_maintenance_schedule_workshop_date",
+        "maintenance_schedule",
+        ["workshop_id", "scheduled_date"],
+    )
+
+
+def downgrade():
+    op.drop_table("maintenance_schedule")
+    op.drop_table("vehicle_unavailability")
+    op.drop_table("workshops")
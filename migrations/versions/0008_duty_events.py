@@ -0,0 +1,55 @@
+"""Driver duty-event log
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-19 20:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "duty_events",
+        sa.Column("event_id", sa.BigInteger(), primary_key=True),
+        sa.Column(
+            "driver_id",
+            sa.Integer(),
+            sa.ForeignKey("drivers.id", ondelete="CASCADE"),
+            nullable=False,
+        ),
+        sa.Column("duty_status", sa.String(), nullable=False),
+        sa.Column("started_at", sa.DateTime(), nullable=False),
+        sa.Column(
+            "vehicle_id",
+            sa.Integer(),
+            sa.ForeignKey("vehicles.id", ondelete="SET NULL"),
+        ),
+        sa.Column("source", sa.String(), nullable=False),
+        sa.Column("recorded_at", sa.DateTime(), nullable=False),
+        sa.Column("row_version", sa.BigInteger(), nullable=False),
+    )
+    op.create_index(
+        "ix_duty_events_driver_started", "duty_events", ["driver_id", "started_at"]
+    )
+    op.create_index("ix_duty_events_started_at", "duty_events", ["started_at"])
+    # Versioned like the synced tables (0004) so every process can replay the
+    # events written since it last looked
+    op.create_index(
+        "ix_duty_events_row_version", "duty_events", ["row_version", "event_id"]
+    )
+    op.execute(
+        "CREATE TRIGGER duty_events_row_version "
+        "BEFORE INSERT OR UPDATE ON duty_events "
+        "FOR EACH ROW EXECUTE FUNCTION set_row_version()"
+    )
+
+
+def downgrade():
+    op.drop_table("duty_events")
@@ -0,0 +1,137 @@
+"""Bump data versions once per statement
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-19 21:00:00
+"""
+from alembic import op
+
+
+revision = "0009"
+down_revision = "0008"
+branch_labels = None
+depends_on = None
+
+# Same tables and period columns as 0003
+VERSIONED_TABLES = {
+    "costs": "date",
+    "maintenance_records": "date",
+    "trips": "started_at",
+    "vehicles": None,
+    "drivers": None,
+}
+# Only label changes of vehicles matter to reports
+VEHICLE_LABEL_COLUMNS = "registration_number, vehicle_type"
+
+
+def upgrade():
+    # The row triggers of 0003 updated the same data_versions row once per
+    # changed row, so a bulk write queued on that row as many times as it had
+    # rows. Statement triggers read the changed rows from transition tables and
+    # bump each (table, month) they touch once.
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION bump_data_versions() RETURNS trigger AS $$
+        DECLARE
+            period text := '''1970-01-01''::date';
+            changed text;
+        BEGIN
+            IF TG_NARGS > 0 THEN
+                period := format(
+                    'date_trunc(''month'', (%I)::timestamp)::date', TG_ARGV[0]
+                );
+            END IF;
+            changed := CASE TG_OP
+                WHEN 'INSERT' THEN format('SELECT %s AS p FROM new_rows', period)
+                WHEN 'DELETE' THEN format('SELECT %s AS p FROM old_rows', period)
+                ELSE format(
+                    'SELECT %s AS p FROM old_rows UNION SELECT %s FROM new_rows',
+                    period,
+                    period
+                )
+            END;
+            EXECUTE format(
+                'INSERT INTO data_versions (table_name, period, version) '
+                'SELECT DISTINCT %L, COALESCE(p, ''1970-01-01''), 1 FROM (%s) c '
+                'ON CONFLICT (table_name, period) '
+                'DO UPDATE SET version = data_versions.version + 1',
+                TG_TABLE_NAME,
+                changed
+            );
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    # Transition tables cannot go with a column list, so label updates of
+    # vehicles bump the whole-table row once per statement without reading them
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION bump_table_data_version() RETURNS trigger AS $$
+        BEGIN
+            PERFORM note_data_change(TG_TABLE_NAME, NULL);
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    for table, column in VERSIONED_TABLES.items():
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_data_version ON {table}")
+        argument = f"'{column}'" if column else ""
+        for event, referencing in (
+            ("INSERT", "NEW TABLE AS new_rows"),
+            ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+            ("DELETE", "OLD TABLE AS old_rows"),
+        ):
+            if table == "vehicles" and event == "UPDATE":
+                op.execute(
+                    f"CREATE TRIGGER {table}_data_version_update AFTER UPDATE OF "
+                    f"{VEHICLE_LABEL_COLUMNS} ON {table} "
+                    "FOR EACH STATEMENT EXECUTE FUNCTION bump_table_data_version()"
+                )
+                continue
+            op.execute(
+                f"CREATE TRIGGER {table}_data_version_{event.lower()} "
+                f"AFTER {event} ON {table} REFERENCING {referencing} "
+                f"FOR EACH STATEMENT EXECUTE FUNCTION bump_data_versions({argument})"
+            )
+    op.execute("DROP FUNCTION IF EXISTS bump_data_version()")
+
+
+def downgrade():
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                PERFORM note_data_change(
+                    TG_TABLE_NAME,
+                    CASE WHEN TG_NARGS > 0 THEN to_jsonb(OLD) ->> TG_ARGV[0] END
+                );
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                PERFORM note_data_change(
+                    TG_TABLE_NAME,
+                    CASE WHEN TG_NARGS > 0 THEN to_jsonb(NEW) ->> TG_ARGV[0] END
+                );
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    for table, column in VERSIONED_TABLES.items():
+        for event in ("insert", "update", "delete"):
+            op.execute(
+                f"DROP TRIGGER IF EXISTS {table}_data_version_{event} ON {table}"
+            )
+        events = "INSERT OR UPDATE OR DELETE"
+        argument = f"'{column}'" if column else ""
+        if table == "vehicles":
+            events = f"INSERT OR DELETE OR UPDATE OF {VEHICLE_LABEL_COLUMNS}"
+        op.execute(
+            f"CREATE TRIGGER {table}_data_version AFTER {events} ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION bump_data_version({argument})"
+        )
+    op.execute("DROP FUNCTION IF EXISTS bump_table_data_version()")
+    op.execute("DROP FUNCTION IF EXISTS bump_data_versions()")
@@ -0,0 +1,36 @@
+"""Per-field sample counts of telemetry rollups
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-19 22:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0010"
+down_revision = "0009"
+branch_labels = None
+depends_on = None
+
+COUNTS = ("position_samples", "speed_samples", "fuel_samples")
+
+
+def upgrade():
+    for column in COUNTS:
+        op.add_column(
+            "vehicle_telemetry_rollups",
+            sa.Column(column, sa.Integer(), nullable=False, server_default="0"),
+        )
+    # Older buckets only know their total; points without fuel readings left
+    # min_fuel_level empty
+    op.execute(
+        "UPDATE vehicle_telemetry_rollups SET position_samples = samples, "
+        "speed_samples = samples, fuel_samples = CASE WHEN min_fuel_level IS NULL "
+        "THEN 0 ELSE samples END"
+    )
+
+
+def downgrade():
+    for column in reversed(COUNTS):
+        op.drop_column("vehicle_telemetry_rollups", column)
@@ -0,0 +1,45 @@
+"""Row versions and tombstones of documents
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-19 23:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0011"
+down_revision = "0010"
+branch_labels = None
+depends_on = None
+
+# Versioned like the synced tables (0004) so every process's search index can
+# replay the documents written and deleted since it last looked
+DOCUMENT_TABLES = {"driver_documents": "doc_id", "vehicle_documents": "doc_id"}
+
+
+def upgrade():
+    for table, pk in DOCUMENT_TABLES.items():
+        op.add_column(table, sa.Column("row_version", sa.BigInteger()))
+        op.execute(
+            f"UPDATE {table} SET row_version = pg_current_xact_id()::text::bigint"
+        )
+        op.alter_column(table, "row_version", nullable=False)
+        op.create_index(f"ix_{table}_row_version", table, ["row_version", pk])
+        op.execute(
+            f"CREATE TRIGGER {table}_row_version BEFORE INSERT OR UPDATE ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION set_row_version()"
+        )
+        op.execute(
+            f"CREATE TRIGGER {table}_tombstone AFTER DELETE ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION record_tombstone('{pk}')"
+        )
+
+
+def downgrade():
+    for table in DOCUMENT_TABLES:
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_tombstone ON {table}")
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_row_version ON {table}")
+        op.drop_index(f"ix_{table}_row_version", table_name=table)
+        op.drop_column(table, "row_version")
+        op.execute(f"DELETE FROM tombstones WHERE table_name = '{table}'")
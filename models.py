@@ -1,9 +1,33 @@
-from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Text
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    Float,
+    Date,
+    DateTime,
+    ForeignKey,
+    Text,
+    Index,
+    Boolean,
+    BigInteger,
+    FetchedValue,
+)
 from sqlalchemy.orm import relationship
 from database import Base
 from datetime import datetime
 
 
+# Id of the last transaction that wrote the row, kept by a trigger on every
+# insert and update (see /sync)
+def row_version_column():
+    return Column(
+        BigInteger,
+        nullable=False,
+        server_default=FetchedValue(),
+        server_onupdate=FetchedValue(),
+    )
+
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
@@ -20,18 +44,27 @@ class User(Base):
     activities = relationship("UserActivity", back_populates="user")
 
 
+# Partitioned by month on timestamp (migration 0006); activity.py creates
+# partitions and moves old ones to Parquet archives
 class UserActivity(Base):
     __tablename__ = "user_activity"
-    activity_id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (
+        Index("ix_user_activity_timestamp", "timestamp"),
+        Index("ix_user_activity_user_timestamp", "user_id", "timestamp"),
+        Index("ix_user_activity_action_timestamp", "action_type", "timestamp"),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+    activity_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     action_type = Column(String, nullable=False)
     action_details = Column(Text)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow)
     user = relationship("User", back_populates="activities")
 
 
 class Vehicle(Base):
     __tablename__ = "vehicles"
+    __table_args__ = (Index("ix_vehicles_row_version", "row_version", "id"),)
     id = Column(Integer, primary_key=True, index=True)
     registration_number = Column(String, unique=True, nullable=False)
     vehicle_type = Column(String, nullable=False)  # Truck, Van, etc.
@@ -45,6 +78,7 @@ class Vehicle(Base):
     fuel_level = Column(Float, default=100)
     maintenance_score = Column(Float, default=100)
     driver_id = Column(Integer, ForeignKey("drivers.id"))
+    row_version = row_version_column()
     driver = relationship("Driver", back_populates="vehicles")
     documents = relationship("VehicleDocument", back_populates="vehicle")
     costs = relationship("Cost", back_populates="vehicle")
@@ -53,6 +87,7 @@ class Vehicle(Base):
 
 class Driver(Base):
     __tablename__ = "drivers"
+    __table_args__ = (Index("ix_drivers_row_version", "row_version", "id"),)
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
     license_number = Column(String, unique=True, nullable=False)
@@ -66,6 +101,7 @@ class Driver(Base):
     total_trips = Column(Integer, default=0)
     rating = Column(Float, default=0.0)
     notes = Column(Text)
+    row_version = row_version_column()
     vehicles = relationship("Vehicle", back_populates="driver")
     documents = relationship("DriverDocument", back_populates="driver")
     costs = relationship("Cost", back_populates="driver")
@@ -73,6 +109,9 @@ class Driver(Base):
 
 class DriverDocument(Base):
     __tablename__ = "driver_documents"
+    __table_args__ = (
+        Index("ix_driver_documents_row_version", "row_version", "doc_id"),
+    )
     doc_id = Column(Integer, primary_key=True, index=True)
     driver_id = Column(Integer, ForeignKey("drivers.id"))
     doc_type = Column(String, nullable=False)
@@ -81,11 +120,15 @@ class DriverDocument(Base):
     expiry_date = Column(Date)
     status = Column(String)
     file_path = Column(String)
+    row_version = row_version_column()
     driver = relationship("Driver", back_populates="documents")
 
 
 class VehicleDocument(Base):
     __tablename__ = "vehicle_documents"
+    __table_args__ = (
+        Index("ix_vehicle_documents_row_version", "row_version", "doc_id"),
+    )
     doc_id = Column(Integer, primary_key=True, index=True)
     vehicle_id = Column(Integer, ForeignKey("vehicles.id"))
     doc_type = Column(String, nullable=False)
@@ -94,13 +137,15 @@ class VehicleDocument(Base):
     expiry_date = Column(Date)
     status = Column(String)
     file_path = Column(String)
+    row_version = row_version_column()
     vehicle = relationship("Vehicle", back_populates="documents")
 
 
 class Cost(Base):
     __tablename__ = "costs"
+    __table_args__ = (Index("ix_costs_row_version", "row_version", "cost_id"),)
     cost_id = Column(Integer, primary_key=True, index=True)
-    date = Column(Date, nullable=False)
+    date = Column(Date, nullable=False, index=True)
     category = Column(String, nullable=False)
     amount = Column(Float, nullable=False)
     description = Column(Text)
@@ -109,18 +154,246 @@ class Cost(Base):
     receipt_path = Column(String)
     status = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    row_version = row_version_column()
     vehicle = relationship("Vehicle", back_populates="costs")
     driver = relationship("Driver", back_populates="costs")
 
 
 class MaintenanceRecord(Base):
     __tablename__ = "maintenance_records"
+    __table_args__ = (
+        Index("ix_maintenance_records_row_version", "row_version", "record_id"),
+    )
     record_id = Column(Integer, primary_key=True, index=True)
     vehicle_id = Column(Integer, ForeignKey("vehicles.id"))
     maintenance_type = Column(String, nullable=False)
-    date = Column(Date, nullable=False)
+    date = Column(Date, nullable=False, index=True)
     cost = Column(Float)
     notes = Column(Text)
     next_maintenance_date = Column(Date)
     status = Column(String)
+    row_version = row_version_column()
     vehicle = relationship("Vehicle", back_populates="maintenance_records")
+
+
+# Append-only position history, partitioned by day on recorded_at (partitions.py)
+class VehicleTelemetry(Base):
+    __tablename__ = "vehicle_telemetry"
+    __table_args__ = {"postgresql_partition_by": "RANGE (recorded_at)"}
+    vehicle_id = Column(Integer, primary_key=True)
+    recorded_at = Column(DateTime, primary_key=True)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    speed = Column(Float)
+    fuel_level = Column(Float)
+
+
+class VehicleTelemetryRollup(Base):
+    __tablename__ = "vehicle_telemetry_rollups"
+    __table_args__ = (
+        Index("ix_telemetry_rollups_resolution_bucket", "resolution", "bucket_start"),
+    )
+    vehicle_id = Column(Integer, primary_key=True)
+    resolution = Column(String, primary_key=True)  # 1m, 1h
+    bucket_start = Column(DateTime, primary_key=True)
+    samples = Column(Integer, nullable=False, default=0)
+    # Points that had a position, speed or fuel reading; the averages divide by
+    # these rather than by samples
+    position_samples = Column(Integer, nullable=False, default=0)
+    speed_samples = Column(Integer, nullable=False, default=0)
+    fuel_samples = Column(Integer, nullable=False, default=0)
+    sum_latitude = Column(Float, default=0)
+    sum_longitude = Column(Float, default=0)
+    sum_speed = Column(Float, default=0)
+    sum_fuel_level = Column(Float, default=0)
+    max_speed = Column(Float)
+    min_fuel_level = Column(Float)
+    max_fuel_level = Column(Float)
+
+
+class Trip(Base):
+    __tablename__ = "trips"
+    __table_args__ = (Index("ix_trips_vehicle_started", "vehicle_id", "started_at"),)
+    trip_id = Column(Integer, primary_key=True, index=True)
+    vehicle_id = Column(Integer, nullable=False)
+    started_at = Column(DateTime, nullable=False, index=True)
+    ended_at = Column(DateTime, nullable=False)
+    start_latitude = Column(Float)
+    start_longitude = Column(Float)
+    end_latitude = Column(Float)
+    end_longitude = Column(Float)
+    distance_km = Column(Float, default=0)
+    duration_seconds = Column(Float, default=0)
+    idle_seconds = Column(Float, default=0)
+    avg_speed = Column(Float, default=0)
+
+
+class Geofence(Base):
+    __tablename__ = "geofences"
+    geofence_id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False)
+    polygon = Column(Text, nullable=False)  # JSON list of [latitude, longitude]
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class GeofenceEvent(Base):
+    __tablename__ = "geofence_events"
+    __table_args__ = (
+        Index("ix_geofence_events_vehicle_occurred", "vehicle_id", "occurred_at"),
+    )
+    event_id = Column(Integer, primary_key=True, index=True)
+    geofence_id = Column(
+        Integer, ForeignKey("geofences.geofence_id", ondelete="CASCADE")
+    )
+    vehicle_id = Column(Integer, nullable=False)
+    event_type = Column(String, nullable=False)  # enter, exit
+    occurred_at = Column(DateTime, nullable=False)
+    latitude = Column(Float)
+    longitude = Column(Float)
+
+
+class FuelAlert(Base):
+    __tablename__ = "fuel_alerts"
+    __table_args__ = (
+        Index("ix_fuel_alerts_vehicle_occurred", "vehicle_id", "occurred_at"),
+    )
+    alert_id = Column(Integer, primary_key=True, index=True)
+    vehicle_id = Column(Integer, nullable=False)
+    # fuel_drop, unmatched_refuel, consumption_outlier
+    alert_type = Column(String, nullable=False)
+    occurred_at = Column(DateTime, nullable=False)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    fuel_before = Column(Float)
+    fuel_after = Column(Float)
+    details = Column(Text)
+    resolved = Column(Boolean, default=False)
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (Index("ix_jobs_status_priority", "status", "priority"),)
+    job_id = Column(Integer, primary_key=True, index=True)
+    job_type = Column(String, nullable=False)
+    tenant = Column(String)
+    payload = Column(Text)  # JSON
+    result = Column(Text)  # JSON
+    error = Column(Text)
+    # queued, running, succeeded, failed, cancelled
+    status = Column(String, nullable=False, default="queued")
+    priority = Column(Integer, nullable=False, default=0)  # higher runs first
+    heavy = Column(Boolean, default=False)
+    progress = Column(Float, default=0)
+    message = Column(String)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    cancel_requested = Column(Boolean, default=False)
+    worker = Column(String)
+    created_by = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    run_after = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    # Submitting a job with the key of a queued or running one returns that job
+    dedupe_key = Column(String, index=True)
+
+
+# Change counters per table and month, bumped once per statement by triggers
+# (migrations 0003 and 0009)
+class DataVersion(Base):
+    __tablename__ = "data_versions"
+    table_name = Column(String, primary_key=True)
+    period = Column(Date, primary_key=True)  # 1970-01-01 for whole-table counters
+    version = Column(BigInteger, nullable=False)
+
+
+# Deleted rows of the tables served by /sync, written by trigger
+class Tombstone(Base):
+    __tablename__ = "tombstones"
+    __table_args__ = (
+        Index("ix_tombstones_table_version", "table_name", "row_version"),
+    )
+    table_name = Column(String, primary_key=True)
+    row_id = Column(BigInteger, primary_key=True)
+    row_version = Column(BigInteger, nullable=False)
+    deleted_at = Column(DateTime, nullable=False)
+
+
+# Fitted cost model per vehicle and cost category (forecasting.py). The vehicle's
+# cost signature when it was fitted tells the refit job which vehicles changed.
+class CostForecast(Base):
+    __tablename__ = "cost_forecasts"
+    vehicle_id = Column(
+        Integer, ForeignKey("vehicles.id", ondelete="CASCADE"), primary_key=True
+    )
+    category = Column(String, primary_key=True)
+    method = Column(String, nullable=False)
+    params = Column(Text, nullable=False)  # JSON
+    last_period = Column(Date, nullable=False)  # last month of the fitted series
+    observations = Column(Integer, nullable=False)
+    source_version = Column(String, nullable=False)
+    fitted_at = Column(DateTime, nullable=False)
+
+
+# Workshops and the vehicles each can take in per day (maintenance_schedule.py)
+class Workshop(Base):
+    __tablename__ = "workshops"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    daily_capacity = Column(Integer, nullable=False, default=1)
+
+
+# Days, end date included, a vehicle cannot go to a workshop
+class VehicleUnavailability(Base):
+    __tablename__ = "vehicle_unavailability"
+    __table_args__ = (
+        Index("ix_vehicle_unavailability_vehicle", "vehicle_id", "end_date"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    vehicle_id = Column(
+        Integer, ForeignKey("vehicles.id", ondelete="CASCADE"), nullable=False
+    )
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=False)
+    reason = Column(String)
+
+
+# Planned workshop visit per vehicle due within the planning horizon; no
+# workshop and date when no capacity was left for it
+class MaintenanceSlot(Base):
+    __tablename__ = "maintenance_schedule"
+    __table_args__ = (
+        Index("ix_maintenance_schedule_workshop_date", "workshop_id", "scheduled_date"),
+    )
+    vehicle_id = Column(
+        Integer, ForeignKey("vehicles.id", ondelete="CASCADE"), primary_key=True
+    )
+    workshop_id = Column(Integer, ForeignKey("workshops.id", ondelete="CASCADE"))
+    scheduled_date = Column(Date)
+    due_date = Column(Date, nullable=False)
+    overdue_days = Column(Integer)
+    travel_hours = Column(Float)  # round trip
+    planned_at = Column(DateTime, nullable=False)
+
+
+# Append-only log of driver duty status changes ("driving", "on_duty",
+# "off_duty"); each event lasts until the driver's next one
+class DutyEvent(Base):
+    __tablename__ = "duty_events"
+    __table_args__ = (
+        Index("ix_duty_events_driver_started", "driver_id", "started_at"),
+        Index("ix_duty_events_row_version", "row_version", "event_id"),
+    )
+    event_id = Column(BigInteger, primary_key=True)
+    driver_id = Column(
+        Integer, ForeignKey("drivers.id", ondelete="CASCADE"), nullable=False
+    )
+    duty_status = Column(String, nullable=False)
+    started_at = Column(DateTime, nullable=False, index=True)
+    vehicle_id = Column(Integer, ForeignKey("vehicles.id", ondelete="SET NULL"))
+    source = Column(String, nullable=False)  # "api" or "driver_status"
+    recorded_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    row_version = row_version_column()
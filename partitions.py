@@ -0,0 +1,79 @@
+from datetime import date, datetime, timedelta
+import logging
+import re
+
+from sqlalchemy import text
+
+# Helpers for Postgres range partitioned tables (one partition per day or per month)
+PARTITION_FORMATS = {"day": "%Y%m%d", "month": "%Y%m"}
+# Names partition_name() gives, for either step
+PARTITION_NAME = re.compile(r".+_p(\d{6}|\d{8})")
+
+
+def partition_start(value, step: str) -> date:
+    if isinstance(value, datetime):
+        value = value.date()
+    if step == "month":
+        return value.replace(day=1)
+    return value
+
+
+def next_partition_start(start: date, step: str) -> date:
+    if step == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def partition_name(table: str, start: date, step: str) -> str:
+    return f"{table}_p{start.strftime(PARTITION_FORMATS[step])}"
+
+
+def is_partition_name(name: str) -> bool:
+    return PARTITION_NAME.fullmatch(name) is not None
+
+
+def list_partitions(conn, table: str, step: str):
+    rows = conn.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(:table)"
+        ),
+        {"table": table},
+    ).fetchall()
+    partitions = {}
+    prefix = f"{table}_p"
+    for (name,) in rows:
+        if not name.startswith(prefix):
+            continue
+        try:
+            start = datetime.strptime(name[len(prefix):], PARTITION_FORMATS[step])
+        except ValueError:
+            continue
+        partitions[start.date()] = name
+    return partitions
+
+
+def ensure_partition(conn, table: str, start: date, step: str) -> str:
+    start = partition_start(start, step)
+    name = partition_name(table, start, step)
+    end = next_partition_start(start, step)
+    conn.execute(
+        text(
+            f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{table}" '
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+    )
+    return name
+
+
+def drop_partitions_before(conn, table: str, cutoff: date, step: str):
+    dropped = []
+    for start, name in sorted(list_partitions(conn, table, step).items()):
+        # Only drop partitions whose whole range lies before the cutoff
+        if next_partition_start(start, step) <= cutoff:
+            conn.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+            dropped.append(name)
+    if dropped:
+        logging.info(f"Dropped partitions of {table}: {', '.join(dropped)}")
+    return dropped
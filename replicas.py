@@ -0,0 +1,183 @@
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from database import connect_args, engine
+from tenancy import tenant_router
+
+# Comma separated SQLAlchemy URLs of streaming replicas of the primary database
+READ_REPLICA_URLS = [
+    url.strip()
+    for url in os.getenv("READ_REPLICA_URLS", "").split(",")
+    if url.strip()
+]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_LAG_CHECK_SECONDS = float(os.getenv("REPLICA_LAG_CHECK_SECONDS", "2"))
+# Clients carry the primary's WAL position after their last write for this
+# long, and read from replicas that have replayed past it
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))
+READ_AFTER_COOKIE = "read_after"
+READ_AFTER_HEADER = "X-Read-After"
+
+LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) "
+    "END, CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() "
+    "ELSE pg_current_wal_insert_lsn() END::text"
+)
+# The insert position is past every commit record, even when commits are not
+# flushed synchronously
+WRITE_POSITION_QUERY = text("SELECT pg_current_wal_insert_lsn()::text")
+
+
+# "16/B374D848" -> comparable integer
+def parse_lsn(value: str) -> int:
+    high, low = value.split("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = url
+        self.engine = create_engine(
+            url, pool_recycle=1800, connect_args=connect_args(url)
+        )
+        self.sessionmaker = sessionmaker(
+            autocommit=False, autoflush=False, bind=self.engine
+        )
+        self.lag = math.inf
+        # Replayed WAL position as of the last check; the replica is at least
+        # this far by the time a read is routed to it
+        self.lsn = 0
+        self.checked_at = None
+
+    def check_lag(self):
+        try:
+            with self.engine.connect() as conn:
+                lag, lsn = conn.execute(LAG_QUERY).one()
+            self.lag = float(lag or 0)
+            self.lsn = parse_lsn(lsn) if lsn else 0
+        except Exception as e:
+            self.lag = math.inf
+            logging.error(f"Replica lag check failed for {self.engine.url!r}: {e}")
+        self.checked_at = time.time()
+
+
+# Read-your-writes holds across workers because the window travels with the
+# client: after a write it is handed the primary's WAL position, and its reads
+# only go to replicas that had replayed past that position at their last check.
+class ReplicaRouter:
+    def __init__(
+        self,
+        urls=READ_REPLICA_URLS,
+        max_lag: float = REPLICA_MAX_LAG_SECONDS,
+        check_seconds: float = REPLICA_LAG_CHECK_SECONDS,
+        primary=engine,
+    ):
+        self.replicas = [Replica(url) for url in urls]
+        self.max_lag = max_lag
+        self.check_seconds = check_seconds
+        self.primary = primary
+        self._next = itertools.count()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.replica_reads = 0
+        self.primary_reads = 0
+        # Reads kept on the primary because no replica had replayed their write
+        self.read_after_waits = 0
+
+    @property
+    def enabled(self) -> bool:
+        # Per-tenant databases have no configured replicas
+        return bool(self.replicas) and tenant_router.mode != "database"
+
+    # The position a client sends back with its reads after a write
+    def write_position(self):
+        if not self.enabled:
+            return None
+        try:
+            with self.primary.connect() as conn:
+                return conn.execute(WRITE_POSITION_QUERY).scalar()
+        except Exception as e:
+            logging.error(f"Reading the primary's WAL position failed: {e}")
+            return None
+
+    def choose(self, read_after: str = None):
+        if not self.enabled:
+            self.primary_reads += 1
+            return None
+        healthy = [r for r in self.replicas if r.lag <= self.max_lag]
+        if healthy and read_after:
+            try:
+                lsn = parse_lsn(read_after)
+            except ValueError:
+                lsn = math.inf
+            healthy = [r for r in healthy if r.lsn >= lsn]
+            if not healthy:
+                self.read_after_waits += 1
+        if not healthy:
+            self.primary_reads += 1
+            return None
+        self.replica_reads += 1
+        return healthy[next(self._next) % len(healthy)]
+
+    def open_read_session(self, tenant: str = None, read_after: str = None):
+        replica = self.choose(read_after)
+        if replica is None:
+            return None
+        db = replica.sessionmaker()
+        if tenant is not None and tenant_router.mode == "schema":
+            # Reset at the end of the transaction, so pooled connections stay clean
+            schema = tenant_router.schema_for(tenant)
+            db.execute(text(f'SET LOCAL search_path TO "{schema}"'))
+        return db
+
+    def start(self):
+        if not self.replicas or self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="replica-lag-monitor", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        # Replicas count as lagging until their first check, which happens here
+        # rather than in start() so an unreachable replica never delays startup
+        while True:
+            for replica in self.replicas:
+                replica.check_lag()
+            if self._stopping.wait(self.check_seconds):
+                break
+
+    def stats(self):
+        return {
+            "replicas": [
+                {
+                    "url": repr(r.engine.url),
+                    "lag_seconds": r.lag if math.isfinite(r.lag) else None,
+                    "lsn": r.lsn,
+                }
+                for r in self.replicas
+            ],
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+            "read_after_waits": self.read_after_waits,
+        }
+
+
+replica_router = ReplicaRouter()
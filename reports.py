@@ -0,0 +1,402 @@
+from datetime import date, datetime, timedelta
+import csv
+import hashlib
+import json
+import os
+import re
+import time
+
+from sqlalchemy import text
+
+from jobs import JobContext, job_queue
+from tenancy import open_session
+
+REPORT_DIR = os.getenv("REPORT_DIR", "reports")
+REPORT_RETENTION_DAYS = int(os.getenv("REPORT_RETENTION_DAYS", "30"))
+REPORT_MAX_DAYS = int(os.getenv("REPORT_MAX_DAYS", "366"))
+REPORT_FORMATS = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+REPORT_FILE_NAME = re.compile(r"^[a-z_]+_\d{8}_\d{8}(_v\d+)?_[0-9a-f]{16}\.(csv|xlsx)$")
+
+# data_versions row holding changes to tables reports use without a date filter
+WHOLE_TABLE_PERIOD = date(1970, 1, 1)
+
+VEHICLE_FILTER = "(CAST(:vehicle_id AS integer) IS NULL OR {column} = :vehicle_id)"
+
+
+class ReportError(ValueError):
+    pass
+
+
+class ReportDefinition:
+    __slots__ = ("title", "tables", "columns", "totals", "sql")
+
+    def __init__(self, title, tables, columns, totals, sql):
+        self.title = title
+        self.tables = tables  # tables whose changes invalidate cached output
+        self.columns = columns  # (key, header, kind)
+        self.totals = totals  # keys summed in a totals row
+        self.sql = text(sql)
+
+
+REPORTS = {
+    "fleet_costs": ReportDefinition(
+        "Fleet costs",
+        ("costs", "vehicles"),
+        [
+            ("vehicle_id", "Vehicle ID", "int"),
+            ("registration_number", "Registration", "text"),
+            ("category", "Category", "text"),
+            ("entries", "Entries", "int"),
+            ("total_amount", "Total amount", "money"),
+            ("average_amount", "Average amount", "money"),
+            ("first_date", "First date", "date"),
+            ("last_date", "Last date", "date"),
+        ],
+        ("entries", "total_amount"),
+        f"""
+        SELECT c.vehicle_id, v.registration_number, c.category,
+               count(*) AS entries,
+               sum(c.amount) AS total_amount,
+               avg(c.amount) AS average_amount,
+               min(c.date) AS first_date,
+               max(c.date) AS last_date
+        FROM costs c
+        LEFT JOIN vehicles v ON v.id = c.vehicle_id
+        WHERE c.date >= :start AND c.date < :end
+          AND {VEHICLE_FILTER.format(column="c.vehicle_id")}
+        GROUP BY c.vehicle_id, v.registration_number, c.category
+        ORDER BY v.registration_number NULLS LAST, c.category
+        """,
+    ),
+    "utilization": ReportDefinition(
+        "Fleet utilization",
+        ("trips", "costs", "vehicles"),
+        [
+            ("vehicle_id", "Vehicle ID", "int"),
+            ("registration_number", "Registration", "text"),
+            ("vehicle_type", "Type", "text"),
+            ("trips", "Trips", "int"),
+            ("active_days", "Active days", "int"),
+            ("distance_km", "Distance (km)", "number"),
+            ("driving_hours", "Driving hours", "number"),
+            ("idle_hours", "Idle hours", "number"),
+            ("utilization_pct", "Utilization %", "pct"),
+            ("total_cost", "Total cost", "money"),
+            ("cost_per_km", "Cost per km", "money"),
+        ],
+        ("trips", "distance_km", "driving_hours", "idle_hours", "total_cost"),
+        f"""
+        WITH t AS (
+            SELECT vehicle_id,
+                   count(*) AS trips,
+                   count(DISTINCT CAST(started_at AS date)) AS active_days,
+                   sum(distance_km) AS distance_km,
+                   sum(duration_seconds - idle_seconds) AS driving_seconds,
+                   sum(idle_seconds) AS idle_seconds
+            FROM trips
+            WHERE started_at >= :start AND started_at < :end
+            GROUP BY vehicle_id
+        ), c AS (
+            SELECT vehicle_id, sum(amount) AS total_cost
+            FROM costs
+            WHERE date >= :start AND date < :end
+            GROUP BY vehicle_id
+        )
+        SELECT v.id AS vehicle_id, v.registration_number, v.vehicle_type,
+               COALESCE(t.trips, 0) AS trips,
+               COALESCE(t.active_days, 0) AS active_days,
+               COALESCE(t.distance_km, 0) AS distance_km,
+               COALESCE(t.driving_seconds, 0) / 3600.0 AS driving_hours,
+               COALESCE(t.idle_seconds, 0) / 3600.0 AS idle_hours,
+               100.0 * COALESCE(t.driving_seconds, 0) / :window_seconds
+                   AS utilization_pct,
+               COALESCE(c.total_cost, 0) AS total_cost,
+               c.total_cost / NULLIF(t.distance_km, 0) AS cost_per_km
+        FROM vehicles v
+        LEFT JOIN t ON t.vehicle_id = v.id
+        LEFT JOIN c ON c.vehicle_id = v.id
+        WHERE {VEHICLE_FILTER.format(column="v.id")}
+        ORDER BY v.registration_number
+        """,
+    ),
+    "maintenance": ReportDefinition(
+        "Maintenance",
+        ("maintenance_records", "vehicles"),
+        [
+            ("vehicle_id", "Vehicle ID", "int"),
+            ("registration_number", "Registration", "text"),
+            ("maintenance_type", "Maintenance type", "text"),
+            ("records", "Records", "int"),
+            ("completed", "Completed", "int"),
+            ("total_cost", "Total cost", "money"),
+            ("last_date", "Last date", "date"),
+            ("next_due", "Next due", "date"),
+        ],
+        ("records", "completed", "total_cost"),
+        f"""
+        SELECT m.vehicle_id, v.registration_number, m.maintenance_type,
+               count(*) AS records,
+               count(*) FILTER (WHERE m.status = 'Completed') AS completed,
+               COALESCE(sum(m.cost), 0) AS total_cost,
+               max(m.date) AS last_date,
+               max(m.next_maintenance_date) AS next_due
+        FROM maintenance_records m
+        LEFT JOIN vehicles v ON v.id = m.vehicle_id
+        WHERE m.date >= :start AND m.date < :end
+          AND {VEHICLE_FILTER.format(column="m.vehicle_id")}
+        GROUP BY m.vehicle_id, v.registration_number, m.maintenance_type
+        ORDER BY v.registration_number NULLS LAST, m.maintenance_type
+        """,
+    ),
+}
+
+
+# A fully resolved report request; end is exclusive
+class ReportRequest:
+    __slots__ = ("report_type", "start", "end", "fmt", "vehicle_id")
+
+    def __init__(self, report_type, start, end, fmt, vehicle_id=None):
+        self.report_type = report_type
+        self.start = start
+        self.end = end
+        self.fmt = fmt
+        self.vehicle_id = vehicle_id
+
+    @classmethod
+    def parse(
+        cls, report_type, month=None, start=None, end=None, fmt="xlsx", vehicle_id=None
+    ):
+        if report_type not in REPORTS:
+            raise ReportError(f"Unknown report: {report_type}")
+        if fmt not in REPORT_FORMATS:
+            raise ReportError(f"Unsupported format: {fmt}")
+        if month:
+            try:
+                start = datetime.strptime(month, "%Y-%m").date()
+            except ValueError:
+                raise ReportError("month must look like YYYY-MM")
+            end = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+        elif start and end:
+            end = end + timedelta(days=1)  # the given end date is inclusive
+        else:
+            raise ReportError("Give either month or both start and end")
+        if start >= end:
+            raise ReportError("start must not be after end")
+        if (end - start).days > REPORT_MAX_DAYS:
+            raise ReportError(f"Reports cover at most {REPORT_MAX_DAYS} days")
+        return cls(report_type, start, end, fmt, vehicle_id)
+
+    @classmethod
+    def from_payload(cls, payload):
+        return cls(
+            payload["report_type"],
+            date.fromisoformat(payload["start"]),
+            date.fromisoformat(payload["end"]),
+            payload["format"],
+            payload.get("vehicle_id"),
+        )
+
+    def payload(self):
+        return {
+            "report_type": self.report_type,
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "format": self.fmt,
+            "vehicle_id": self.vehicle_id,
+        }
+
+    @property
+    def definition(self) -> ReportDefinition:
+        return REPORTS[self.report_type]
+
+    def params(self):
+        return {
+            "start": self.start,
+            "end": self.end,
+            "vehicle_id": self.vehicle_id,
+            "window_seconds": (self.end - self.start).total_seconds(),
+        }
+
+
+def data_version(db, request: ReportRequest) -> int:
+    # Counters only grow, so their sum changes whenever any counted row does
+    first_period = request.start.replace(day=1)
+    return int(
+        db.execute(
+            text(
+                "SELECT COALESCE(sum(version), 0) FROM data_versions "
+                "WHERE table_name = ANY(:tables) "
+                "AND (period = :whole OR (period >= :first AND period < :end))"
+            ),
+            {
+                "tables": list(request.definition.tables),
+                "whole": WHOLE_TABLE_PERIOD,
+                "first": first_period,
+                "end": request.end,
+            },
+        ).scalar()
+    )
+
+
+def cache_key(tenant, request: ReportRequest, version: int) -> str:
+    key = json.dumps(
+        {"tenant": tenant, "version": version, **request.payload()}, sort_keys=True
+    )
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def report_dir(tenant) -> str:
+    return os.path.join(REPORT_DIR, tenant or "default")
+
+
+def artifact_name(request: ReportRequest, key: str) -> str:
+    last_day = request.end - timedelta(days=1)
+    vehicle = f"_v{request.vehicle_id}" if request.vehicle_id is not None else ""
+    return (
+        f"{request.report_type}_{request.start:%Y%m%d}_{last_day:%Y%m%d}"
+        f"{vehicle}_{key}.{request.fmt}"
+    )
+
+
+def artifact_path(tenant, filename: str) -> str:
+    if not REPORT_FILE_NAME.match(filename):
+        raise ReportError("Invalid report file name")
+    return os.path.join(report_dir(tenant), filename)
+
+
+def cached_artifact(db, tenant, request: ReportRequest):
+    # Returns (version, filename, exists); cheap enough to run per request
+    version = data_version(db, request)
+    filename = artifact_name(request, cache_key(tenant, request, version))
+    exists = os.path.exists(os.path.join(report_dir(tenant), filename))
+    return version, filename, exists
+
+
+def write_csv(path, request: ReportRequest, rows):
+    columns = request.definition.columns
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow([header for _, header, _ in columns])
+        for row in rows:
+            writer.writerow(
+                [_csv_value(row[key], kind) for key, _, kind in columns]
+            )
+
+
+def _csv_value(value, kind):
+    if value is None:
+        return ""
+    if kind in ("money", "number", "pct"):
+        return f"{float(value):.2f}"
+    if kind == "date":
+        return value.isoformat()
+    return value
+
+
+def write_xlsx(path, request: ReportRequest, rows):
+    import xlsxwriter
+    from xlsxwriter.utility import xl_col_to_name
+
+    definition = request.definition
+    columns = definition.columns
+    # constant_memory streams rows to disk, so large reports need little RAM
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    try:
+        sheet = workbook.add_worksheet(definition.title[:31])
+        bold = workbook.add_format({"bold": True})
+        title = workbook.add_format({"bold": True, "font_size": 14})
+        header = workbook.add_format(
+            {"bold": True, "bottom": 1, "bg_color": "#DDEBF7"}
+        )
+        formats = {
+            "int": workbook.add_format({"num_format": "0"}),
+            "number": workbook.add_format({"num_format": "#,##0.0"}),
+            "money": workbook.add_format({"num_format": "#,##0.00"}),
+            "pct": workbook.add_format({"num_format": '0.0"%"'}),
+            "date": workbook.add_format({"num_format": "yyyy-mm-dd"}),
+            "text": None,
+        }
+        for col, (_, label, kind) in enumerate(columns):
+            sheet.set_column(col, col, max(12, len(label) + 2), formats[kind])
+        last_day = request.end - timedelta(days=1)
+        sheet.write(0, 0, f"{definition.title}: {request.start} to {last_day}", title)
+        sheet.write_row(2, 0, [label for _, label, _ in columns], header)
+        first_row = row_number = 3
+        for row in rows:
+            for col, (key, _, kind) in enumerate(columns):
+                value = row[key]
+                if value is None:
+                    continue
+                if kind in ("money", "number", "pct"):
+                    value = float(value)
+                sheet.write(row_number, col, value, formats[kind])
+            row_number += 1
+        if row_number > first_row and definition.totals:
+            sheet.write(row_number, 0, "Total", bold)
+            for col, (key, _, kind) in enumerate(columns):
+                if key not in definition.totals:
+                    continue
+                letter = xl_col_to_name(col)
+                sheet.write_formula(
+                    row_number,
+                    col,
+                    f"=SUM({letter}{first_row + 1}:{letter}{row_number})",
+                    formats[kind],
+                )
+        sheet.freeze_panes(3, 0)
+        sheet.autofilter(2, 0, max(row_number - 1, 2), len(columns) - 1)
+    finally:
+        workbook.close()
+
+
+WRITERS = {"csv": write_csv, "xlsx": write_xlsx}
+
+
+def generate_report(db, tenant, request: ReportRequest):
+    version = data_version(db, request)
+    filename = artifact_name(request, cache_key(tenant, request, version))
+    directory = report_dir(tenant)
+    path = os.path.join(directory, filename)
+    if os.path.exists(path):
+        return version, filename, None
+    os.makedirs(directory, exist_ok=True)
+    rows = db.execute(request.definition.sql, request.params()).mappings().all()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        WRITERS[request.fmt](tmp_path, request, rows)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return version, filename, len(rows)
+
+
+def prune_reports(tenant, retention_days: int = REPORT_RETENTION_DAYS):
+    directory = report_dir(tenant)
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - retention_days * 86400
+    removed = 0
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
+
+@job_queue.register("report")
+def run_report(ctx: JobContext):
+    request = ReportRequest.from_payload(ctx.payload)
+    ctx.progress(0.0, f"Building {request.definition.title} report")
+    with open_session(ctx.tenant) as db:
+        version, filename, rows = generate_report(db, ctx.tenant, request)
+    prune_reports(ctx.tenant)
+    return {
+        "file": filename,
+        "rows": rows,
+        "data_version": version,
+        "download_url": f"/reports/files/{filename}",
+    }
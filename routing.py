@@ -0,0 +1,574 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, time as dt_time, timedelta
+import bisect
+import math
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+from sqlalchemy import and_, exists, or_
+
+from jobs import JobContext, job_queue
+from models import Driver, MaintenanceSlot, Vehicle, VehicleUnavailability
+from tenancy import open_session
+from trips import EARTH_RADIUS_KM
+
+ROUTING_WORKERS = int(os.getenv("ROUTING_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Below this many orders the sectors are solved in the job's thread
+ROUTING_PARALLEL_MIN_ORDERS = int(os.getenv("ROUTING_PARALLEL_MIN_ORDERS", "2000"))
+# Orders per sweep sector. Sectors are solved independently, so their number
+# does not depend on the worker count and neither does the solution.
+ROUTING_SECTOR_ORDERS = int(os.getenv("ROUTING_SECTOR_ORDERS", "1000"))
+ROUTING_TIME_BUDGET_SECONDS = float(os.getenv("ROUTING_TIME_BUDGET_SECONDS", "30"))
+ROUTING_MAX_TIME_BUDGET_SECONDS = 300
+ROUTING_MAX_ORDERS = 20000
+ROUTING_SPEED_KMH = float(os.getenv("ROUTING_SPEED_KMH", "40"))
+# Nearest orders considered for savings and local search moves
+NEIGHBORS = 20
+# Orders per block of the distance matrix used to find neighbors
+NEIGHBOR_BLOCK = 1024
+EPSILON = 1e-7
+
+
+# Local search over one sector's routes. Index 0 is the depot, orders are
+# 1..n; positions are km east and north of the depot and times are minutes
+# since midnight. Each route belongs to one vehicle.
+class SectorSearch:
+    def __init__(self, sector):
+        self.x = [0.0, *sector["x"]]
+        self.y = [0.0, *sector["y"]]
+        self.demand = [0.0, *sector["demand"]]
+        self.service = [0.0, *sector["service"]]
+        self.start, self.end = sector["shift"]
+        self.early = [self.start, *sector["early"]]
+        self.late = [self.end, *sector["late"]]
+        self.speed = sector["speed_kmh"] / 60
+        self.n = len(self.x) - 1
+        self.vehicles = sector["vehicles"]
+        self.cap = [capacity for _, capacity in self.vehicles]
+        self.routes = [[] for _ in self.vehicles]
+        self.load = [0.0] * len(self.vehicles)
+        self.route_of = [-1] * (self.n + 1)
+        self.pos = [-1] * (self.n + 1)
+        self.unassigned = []
+        self.neighbors = self._neighbors()
+        self.moves = 0
+
+    def _neighbors(self):
+        xy = np.column_stack([self.x, self.y])[1:]
+        k = min(NEIGHBORS, self.n - 1)
+        neighbors = [[]]
+        for start in range(0, self.n, NEIGHBOR_BLOCK):
+            block = xy[start:start + NEIGHBOR_BLOCK]
+            d = np.hypot(
+                block[:, None, 0] - xy[None, :, 0], block[:, None, 1] - xy[None, :, 1]
+            )
+            d[np.arange(len(block)), np.arange(start, start + len(block))] = np.inf
+            if k <= 0:
+                neighbors.extend([] for _ in block)
+                continue
+            nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+            rows = np.arange(len(block))[:, None]
+            nearest = np.take_along_axis(
+                nearest, np.argsort(d[rows, nearest], axis=1), axis=1
+            )
+            neighbors.extend((nearest + 1).tolist())
+        return neighbors
+
+    def dist(self, i: int, j: int) -> float:
+        return math.hypot(self.x[i] - self.x[j], self.y[i] - self.y[j])
+
+    # Arrival minute at each stop, None when a time window or the shift end
+    # is missed
+    def schedule(self, route):
+        x, y, speed = self.x, self.y, self.speed
+        t = self.start
+        prev = 0
+        arrivals = []
+        for o in route:
+            t += math.hypot(x[prev] - x[o], y[prev] - y[o]) / speed
+            if t > self.late[o]:
+                return None
+            if t < self.early[o]:
+                t = self.early[o]
+            arrivals.append(t)
+            t += self.service[o]
+            prev = o
+        if t + math.hypot(x[prev], y[prev]) / speed > self.end:
+            return None
+        return arrivals
+
+    def feasible(self, route) -> bool:
+        return self.schedule(route) is not None
+
+    def route_km(self, route) -> float:
+        stops = [0, *route, 0]
+        return sum(self.dist(a, b) for a, b in zip(stops, stops[1:]))
+
+    def total_km(self) -> float:
+        return sum(self.route_km(route) for route in self.routes)
+
+    def _set_route(self, r: int, route):
+        self.routes[r] = route
+        self.load[r] = sum(self.demand[o] for o in route)
+        for p, o in enumerate(route):
+            self.route_of[o] = r
+            self.pos[o] = p
+
+    # Parallel Clarke-Wright savings over neighbor pairs, with routes capped at
+    # the largest vehicle; routes are then matched to vehicles by best fit and
+    # the orders of routes left without a vehicle are inserted where they fit
+    def construct(self):
+        max_cap = max(self.cap, default=0)
+        route_of = list(range(self.n + 1))
+        routes = {}
+        load = {}
+        for i in range(1, self.n + 1):
+            if self.demand[i] <= max_cap and self.feasible([i]):
+                routes[i] = [i]
+                load[i] = self.demand[i]
+            else:
+                self.unassigned.append(i)
+        d0 = [self.dist(0, i) for i in range(self.n + 1)]
+        savings = []
+        for i in routes:
+            for j in self.neighbors[i]:
+                if j in routes:
+                    saving = d0[i] + d0[j] - self.dist(i, j)
+                    if saving > 0:
+                        savings.append((saving, i, j))
+        savings.sort(reverse=True)
+        for _, i, j in savings:
+            ri, rj = route_of[i], route_of[j]
+            if ri == rj or load[ri] + load[rj] > max_cap:
+                continue
+            a, b = routes[ri], routes[rj]
+            if a[-1] == i and b[0] == j:
+                merged = a + b
+            elif b[-1] == j and a[0] == i:
+                merged = b + a
+            else:
+                continue
+            if not self.feasible(merged):
+                continue
+            routes[ri] = merged
+            load[ri] += load.pop(rj)
+            del routes[rj]
+            for o in b:
+                route_of[o] = ri
+        capacities = sorted((c, r) for r, c in enumerate(self.cap))
+        leftover = []
+        for key in sorted(routes, key=lambda key: load[key], reverse=True):
+            k = bisect.bisect_left(capacities, (load[key], -1))
+            if k == len(capacities):
+                leftover.extend(routes[key])
+                continue
+            _, r = capacities.pop(k)
+            self._set_route(r, routes[key])
+        for o in leftover:
+            if not self.insert(o):
+                self.unassigned.append(o)
+
+    # Cheapest feasible insertion of an order into any route
+    def insert(self, o: int) -> bool:
+        best = None
+        for r, route in enumerate(self.routes):
+            if self.load[r] + self.demand[o] > self.cap[r]:
+                continue
+            stops = [0, *route, 0]
+            for p in range(len(stops) - 1):
+                u, v = stops[p], stops[p + 1]
+                delta = self.dist(u, o) + self.dist(o, v) - self.dist(u, v)
+                if best is not None and delta >= best[0]:
+                    continue
+                candidate = route[:p] + [o] + route[p:]
+                if self.feasible(candidate):
+                    best = (delta, r, candidate)
+        if best is None:
+            return False
+        self._set_route(best[1], best[2])
+        return True
+
+    def _pred(self, route, p: int) -> int:
+        return route[p - 1] if p > 0 else 0
+
+    def _succ(self, route, p: int) -> int:
+        return route[p + 1] if p + 1 < len(route) else 0
+
+    # Moves order i next to one of its neighbors, in any route
+    def relocate(self, i: int) -> bool:
+        d = self.dist
+        r, p = self.route_of[i], self.pos[i]
+        a = self.routes[r]
+        gain = d(self._pred(a, p), i) + d(i, self._succ(a, p))
+        gain -= d(self._pred(a, p), self._succ(a, p))
+        best_delta, best = -EPSILON, None
+        for j in self.neighbors[i]:
+            s = self.route_of[j]
+            if s < 0 or (s != r and self.load[s] + self.demand[i] > self.cap[s]):
+                continue
+            b, q = self.routes[s], self.pos[j]
+            for u, v, at in ((j, self._succ(b, q), q + 1), (self._pred(b, q), j, q)):
+                if u == i or v == i:
+                    continue
+                delta = d(u, i) + d(i, v) - d(u, v) - gain
+                if delta >= best_delta:
+                    continue
+                if s == r:
+                    rest = a[:p] + a[p + 1:]
+                    at = at if at <= p else at - 1
+                    candidate = rest[:at] + [i] + rest[at:]
+                else:
+                    candidate = b[:at] + [i] + b[at:]
+                if self.feasible(candidate):
+                    best_delta, best = delta, (s, candidate)
+        if best is None:
+            return False
+        s, candidate = best
+        if s != r:
+            self._set_route(r, a[:p] + a[p + 1:])
+        self._set_route(s, candidate)
+        return True
+
+    # Exchanges order i with a neighbor in another route
+    def swap(self, i: int) -> bool:
+        d = self.dist
+        r, p = self.route_of[i], self.pos[i]
+        a = self.routes[r]
+        ap, an = self._pred(a, p), self._succ(a, p)
+        best_delta, best = -EPSILON, None
+        for j in self.neighbors[i]:
+            s = self.route_of[j]
+            if s < 0 or s == r:
+                continue
+            change = self.demand[j] - self.demand[i]
+            if self.load[r] + change > self.cap[r]:
+                continue
+            if self.load[s] - change > self.cap[s]:
+                continue
+            b, q = self.routes[s], self.pos[j]
+            bp, bn = self._pred(b, q), self._succ(b, q)
+            delta = (
+                d(ap, j) + d(j, an) - d(ap, i) - d(i, an)
+                + d(bp, i) + d(i, bn) - d(bp, j) - d(j, bn)
+            )
+            if delta >= best_delta:
+                continue
+            new_a = a[:p] + [j] + a[p + 1:]
+            new_b = b[:q] + [i] + b[q + 1:]
+            if self.feasible(new_a) and self.feasible(new_b):
+                best_delta, best = delta, (s, new_a, new_b)
+        if best is None:
+            return False
+        s, new_a, new_b = best
+        self._set_route(r, new_a)
+        self._set_route(s, new_b)
+        return True
+
+    # 2-opt*: exchanges route tails so that i is directly followed, or
+    # preceded, by a neighbor from another route
+    def two_opt_star(self, i: int) -> bool:
+        d = self.dist
+        r, p = self.route_of[i], self.pos[i]
+        a = self.routes[r]
+        best_delta, best = -EPSILON, None
+        for j in self.neighbors[i]:
+            s = self.route_of[j]
+            if s < 0 or s == r:
+                continue
+            b, q = self.routes[s], self.pos[j]
+            an, bp = self._succ(a, p), self._pred(b, q)
+            options = (
+                # ... i, j ... and ... bp, an ...
+                (d(i, j) + d(bp, an) - d(i, an) - d(bp, j), p + 1, q),
+                # ... j, i ... and ... ap, bn ...
+                (
+                    d(j, i)
+                    + d(self._pred(a, p), self._succ(b, q))
+                    - d(self._pred(a, p), i)
+                    - d(j, self._succ(b, q)),
+                    p,
+                    q + 1,
+                ),
+            )
+            for delta, cut_a, cut_b in options:
+                if delta >= best_delta:
+                    continue
+                new_a = a[:cut_a] + b[cut_b:]
+                new_b = b[:cut_b] + a[cut_a:]
+                if sum(self.demand[o] for o in new_a) > self.cap[r]:
+                    continue
+                if sum(self.demand[o] for o in new_b) > self.cap[s]:
+                    continue
+                if self.feasible(new_a) and self.feasible(new_b):
+                    best_delta, best = delta, (s, new_a, new_b)
+        if best is None:
+            return False
+        s, new_a, new_b = best
+        self._set_route(r, new_a)
+        self._set_route(s, new_b)
+        return True
+
+    # First improvement passes over the orders in random order until a pass
+    # finds nothing or the deadline passes; unassigned orders are retried
+    # after every pass
+    def improve(self, deadline: float, seed: int = 0):
+        orders = [o for o in range(1, self.n + 1) if self.route_of[o] >= 0]
+        random.Random(seed).shuffle(orders)
+        while time.time() < deadline:
+            improved = 0
+            for k, i in enumerate(orders):
+                if k % 64 == 0 and time.time() >= deadline:
+                    break
+                if self.route_of[i] < 0:
+                    continue
+                if self.relocate(i) or self.swap(i) or self.two_opt_star(i):
+                    improved += 1
+            still = []
+            for o in self.unassigned:
+                if self.insert(o):
+                    orders.append(o)
+                    improved += 1
+                else:
+                    still.append(o)
+            self.unassigned = still
+            self.moves += improved
+            if not improved:
+                break
+
+
+def solve_sector(sector):
+    started = time.time()
+    search = SectorSearch(sector)
+    search.construct()
+    construction_km = search.total_km()
+    search.improve(started + sector["seconds"], sector["seed"])
+    orders = sector["orders"]
+    routes = []
+    for (vehicle_id, _), route in zip(search.vehicles, search.routes):
+        if not route:
+            continue
+        arrivals = search.schedule(route)
+        last = route[-1]
+        back = arrivals[-1] + search.service[last]
+        back += search.dist(last, 0) / search.speed
+        routes.append(
+            {
+                "vehicle_id": vehicle_id,
+                "orders": [orders[o - 1] for o in route],
+                "arrivals": arrivals,
+                "km": search.route_km(route),
+                "load": search.load[search.route_of[route[0]]],
+                "return": back,
+            }
+        )
+    return {
+        "routes": routes,
+        "unassigned": [orders[o - 1] for o in search.unassigned],
+        "construction_km": construction_km,
+        "km": search.total_km(),
+        "moves": search.moves,
+    }
+
+
+def _minutes(value, default: float) -> float:
+    if value is None:
+        return default
+    if isinstance(value, str):
+        value = dt_time.fromisoformat(value)
+    return value.hour * 60 + value.minute + value.second / 60
+
+
+def _at(midnight: datetime, minutes: float) -> datetime:
+    return midnight + timedelta(seconds=round(minutes * 60))
+
+
+# Splits the orders into sweep sectors of similar size by bearing from the
+# depot and hands out the vehicles, largest first, to the sector whose demand
+# is least covered
+def make_sectors(x, y, demand, vehicles, sector_orders=ROUTING_SECTOR_ORDERS):
+    n = len(x)
+    count = max(1, min(math.ceil(n / sector_orders), len(vehicles)))
+    order = np.argsort(np.arctan2(y, x), kind="stable")
+    sectors = np.array_split(order, count)
+    demands = [float(demand[s].sum()) for s in sectors]
+    covered = [0.0] * count
+    assigned = [[] for _ in range(count)]
+    for vehicle in sorted(vehicles, key=lambda v: v[1], reverse=True):
+        k = max(
+            range(count), key=lambda k: (demands[k] - covered[k], -len(assigned[k]))
+        )
+        assigned[k].append(vehicle)
+        covered[k] += vehicle[1]
+    return [(s, v) for s, v in zip(sectors, assigned)]
+
+
+# Routes for one day's orders. Orders are dicts with order_id, latitude,
+# longitude, demand, service_minutes and optional window_start/window_end;
+# vehicles are (vehicle_id, capacity) pairs. Every route starts and ends at
+# the depot within the shift.
+def plan_routes(
+    orders,
+    vehicles,
+    depot,
+    day: date,
+    shift=(dt_time(8), dt_time(18)),
+    time_budget: float = ROUTING_TIME_BUDGET_SECONDS,
+    workers: int = ROUTING_WORKERS,
+    progress=None,
+):
+    started = time.time()
+    shift_start, shift_end = _minutes(shift[0], 0), _minutes(shift[1], 24 * 60)
+    result = {"routes": [], "unassigned": [o["order_id"] for o in orders]}
+    if not orders or not vehicles:
+        return {**result, "vehicles_used": 0, "km": 0.0, "seconds": 0.0}
+    lat0, lon0 = math.radians(depot[0]), math.radians(depot[1])
+    lat = np.radians([o["latitude"] for o in orders])
+    lon = np.radians([o["longitude"] for o in orders])
+    # Equirectangular projection around the depot, in km
+    x = EARTH_RADIUS_KM * (lon - lon0) * math.cos(lat0)
+    y = EARTH_RADIUS_KM * (lat - lat0)
+    demand = np.array([o.get("demand") or 0.0 for o in orders])
+    service = [o.get("service_minutes") or 0.0 for o in orders]
+    early = [_minutes(o.get("window_start"), shift_start) for o in orders]
+    late = [_minutes(o.get("window_end"), shift_end) for o in orders]
+    vehicles = [
+        (vehicle_id, math.inf if capacity is None else float(capacity))
+        for vehicle_id, capacity in vehicles
+    ]
+    sectors = make_sectors(x, y, demand, vehicles)
+    parallel = workers > 1 and len(orders) >= ROUTING_PARALLEL_MIN_ORDERS
+    # Sectors run in waves of `workers`; each gets an equal share of the budget
+    waves = math.ceil(len(sectors) / (workers if parallel else 1))
+    tasks = [
+        {
+            "orders": members.tolist(),
+            "x": x[members].tolist(),
+            "y": y[members].tolist(),
+            "demand": demand[members].tolist(),
+            "service": [service[i] for i in members],
+            "early": [early[i] for i in members],
+            "late": [late[i] for i in members],
+            "vehicles": sector_vehicles,
+            "shift": (shift_start, shift_end),
+            "speed_kmh": ROUTING_SPEED_KMH,
+            "seconds": time_budget / waves,
+            "seed": k,
+        }
+        for k, (members, sector_vehicles) in enumerate(sectors)
+        if len(members)
+    ]
+    solved = []
+    if not parallel:
+        for task in tasks:
+            solved.append(solve_sector(task))
+            if progress:
+                progress(len(solved) / len(tasks))
+    else:
+        # Spawned, not forked: the API process runs threads and holds connections
+        executor = ProcessPoolExecutor(
+            min(workers, len(tasks)), mp_context=multiprocessing.get_context("spawn")
+        )
+        try:
+            futures = [executor.submit(solve_sector, task) for task in tasks]
+            for future in as_completed(futures):
+                solved.append(future.result())
+                if progress:
+                    progress(len(solved) / len(tasks))
+        finally:
+            executor.shutdown(cancel_futures=True)
+    midnight = datetime.combine(day, dt_time())
+    routes = []
+    for sector in solved:
+        for route in sector["routes"]:
+            routes.append(
+                {
+                    "vehicle_id": route["vehicle_id"],
+                    "stops": [
+                        {
+                            "order_id": orders[i]["order_id"],
+                            "arrival": _at(midnight, arrival),
+                        }
+                        for i, arrival in zip(route["orders"], route["arrivals"])
+                    ],
+                    "load": route["load"],
+                    "distance_km": round(route["km"], 3),
+                    "returns_at": _at(midnight, route["return"]),
+                }
+            )
+    routes.sort(key=lambda route: route["vehicle_id"])
+    return {
+        "routes": routes,
+        "unassigned": [
+            orders[i]["order_id"] for sector in solved for i in sector["unassigned"]
+        ],
+        "vehicles_used": len(routes),
+        "sectors": len(tasks),
+        "construction_km": round(sum(s["construction_km"] for s in solved), 3),
+        "km": round(sum(s["km"] for s in solved), 3),
+        "search_moves": sum(s["moves"] for s in solved),
+        "seconds": round(time.time() - started, 3),
+    }
+
+
+# Vehicles that can be routed on `day`: not in or booked into a workshop, not
+# marked unavailable, with a driver who is not off duty and holds a valid
+# licence; a driver assigned to several vehicles drives the largest. Returns
+# (vehicle_id, capacity, driver_id) tuples.
+def available_vehicles(db, day: date, vehicle_ids=None):
+    query = (
+        db.query(Vehicle.id, Vehicle.capacity, Vehicle.driver_id)
+        .join(Driver, Driver.id == Vehicle.driver_id)
+        .filter(
+            or_(Vehicle.status.is_(None), Vehicle.status != "Maintenance"),
+            or_(Driver.status.is_(None), Driver.status != "Off Duty"),
+            or_(Driver.license_expiry.is_(None), Driver.license_expiry >= day),
+            ~exists().where(
+                and_(
+                    VehicleUnavailability.vehicle_id == Vehicle.id,
+                    VehicleUnavailability.start_date <= day,
+                    VehicleUnavailability.end_date >= day,
+                )
+            ),
+            ~exists().where(
+                and_(
+                    MaintenanceSlot.vehicle_id == Vehicle.id,
+                    MaintenanceSlot.scheduled_date == day,
+                )
+            ),
+        )
+    )
+    if vehicle_ids is not None:
+        query = query.filter(Vehicle.id.in_(vehicle_ids))
+    by_driver = {}
+    for vehicle_id, capacity, driver_id in query.order_by(Vehicle.id):
+        current = by_driver.get(driver_id)
+        size = math.inf if capacity is None else capacity
+        if current is None or size > current[3]:
+            by_driver[driver_id] = (vehicle_id, capacity, driver_id, size)
+    return sorted(vehicle[:3] for vehicle in by_driver.values())
+
+
+@job_queue.register("route_plan", heavy=True)
+def run_route_plan(ctx: JobContext):
+    payload = ctx.payload
+    day = date.fromisoformat(payload["day"]) if payload.get("day") else date.today()
+    with open_session(ctx.tenant) as db:
+        vehicles = available_vehicles(db, day, payload.get("vehicle_ids"))
+    orders = payload["orders"]
+    ctx.progress(0.0, f"Routing {len(orders)} orders with {len(vehicles)} vehicles")
+    result = plan_routes(
+        orders,
+        [(vehicle_id, capacity) for vehicle_id, capacity, _ in vehicles],
+        (payload["depot_latitude"], payload["depot_longitude"]),
+        day,
+        (payload["shift_start"], payload["shift_end"]),
+        payload.get("time_budget_seconds") or ROUTING_TIME_BUDGET_SECONDS,
+        progress=lambda fraction: ctx.progress(0.95 * fraction, "Solving sectors"),
+    )
+    drivers = {vehicle_id: driver_id for vehicle_id, _, driver_id in vehicles}
+    for route in result["routes"]:
+        route["driver_id"] = drivers[route["vehicle_id"]]
+    return result
@@ -0,0 +1,40 @@
+from functools import lru_cache
+import os
+
+# Alembic is imported lazily: the API process only needs it for readiness
+# checks and opt-in migrations, not to start serving.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ALEMBIC_INI = os.path.join(BASE_DIR, "alembic.ini")
+RUN_MIGRATIONS_ON_STARTUP = os.getenv("RUN_MIGRATIONS_ON_STARTUP", "false").lower()
+RUN_MIGRATIONS_ON_STARTUP = RUN_MIGRATIONS_ON_STARTUP in ("1", "true", "yes")
+
+
+def alembic_config(tenant: str = None):
+    from alembic.config import Config
+
+    config = Config(ALEMBIC_INI)
+    config.set_main_option("script_location", os.path.join(BASE_DIR, "migrations"))
+    config.attributes["configure_logger"] = False
+    if tenant:
+        config.attributes["tenant"] = tenant
+    return config
+
+
+def upgrade_database(tenant: str = None, revision: str = "head"):
+    from alembic import command
+
+    command.upgrade(alembic_config(tenant), revision)
+
+
+@lru_cache(maxsize=None)
+def head_revision():
+    from alembic.script import ScriptDirectory
+
+    return ScriptDirectory.from_config(alembic_config()).get_current_head()
+
+
+def current_revision(conn, schema: str = None):
+    from alembic.runtime.migration import MigrationContext
+
+    context = MigrationContext.configure(conn, opts={"version_table_schema": schema})
+    return context.get_current_revision()
@@ -1,6 +1,6 @@
-from pydantic import BaseModel
-from typing import Optional, List
-from datetime import date, datetime
+from pydantic import BaseModel, Field
+from typing import Any, Dict, Optional, List, Union
+from datetime import date, datetime, time
 
 class UserBase(BaseModel):
     username: str
@@ -23,7 +23,7 @@ class UserOut(UserBase):
 
 class UserActivityOut(BaseModel):
     activity_id: int
-    user_id: int
+    user_id: Optional[int]  # None once the user is deleted
     action_type: str
     action_details: Optional[str]
     timestamp: datetime
@@ -148,4 +148,342 @@ class RouteOptimizationOut(BaseModel):
     vehicle_id: int
     fuel_saved_percent: float
     time_saved_percent: float
-    carbon_reduction: Optional[float] = None
\ No newline at end of file
+    carbon_reduction: Optional[float] = None
+
+class TelemetryPointOut(BaseModel):
+    vehicle_id: int
+    recorded_at: datetime
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    speed: Optional[float] = None
+    fuel_level: Optional[float] = None
+    samples: int = 1
+    max_speed: Optional[float] = None
+    min_fuel_level: Optional[float] = None
+    max_fuel_level: Optional[float] = None
+
+class TelemetryHistoryOut(BaseModel):
+    vehicle_id: Optional[int] = None
+    resolution: str
+    start: datetime
+    end: datetime
+    points: List[TelemetryPointOut]
+
+
+class TripOut(BaseModel):
+    trip_id: Optional[int] = None
+    vehicle_id: int
+    started_at: datetime
+    ended_at: Optional[datetime] = None
+    start_latitude: Optional[float] = None
+    start_longitude: Optional[float] = None
+    end_latitude: Optional[float] = None
+    end_longitude: Optional[float] = None
+    distance_km: float
+    duration_seconds: float
+    idle_seconds: float
+    avg_speed: float
+    class Config:
+        from_attributes = True
+
+class GeofenceCreate(BaseModel):
+    name: str
+    polygon: List[List[float]]
+
+class GeofenceOut(GeofenceCreate):
+    geofence_id: int
+    created_at: datetime
+
+class GeofenceEventOut(BaseModel):
+    event_id: int
+    geofence_id: int
+    vehicle_id: int
+    event_type: str
+    occurred_at: datetime
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    class Config:
+        from_attributes = True
+
+
+class FuelAlertOut(BaseModel):
+    alert_id: int
+    vehicle_id: int
+    alert_type: str
+    occurred_at: datetime
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    fuel_before: Optional[float] = None
+    fuel_after: Optional[float] = None
+    details: Optional[str] = None
+    resolved: bool = False
+    class Config:
+        from_attributes = True
+
+
+class JobOut(BaseModel):
+    job_id: int
+    job_type: str
+    status: str
+    priority: int
+    progress: Optional[float] = None
+    message: Optional[str] = None
+    attempts: int
+    max_attempts: int
+    cancel_requested: Optional[bool] = None
+    error: Optional[str] = None
+    result: Optional[Any] = None
+    created_by: Optional[int] = None
+    created_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+
+class ReportOut(BaseModel):
+    report_type: str
+    format: str
+    start: date
+    end: date
+    vehicle_id: Optional[int] = None
+    data_version: int
+    status: str  # ready, pending
+    download_url: Optional[str] = None
+    job: Optional[JobOut] = None
+
+
+class MaintenanceStatusSummary(BaseModel):
+    needs_service: int
+    schedule_soon: int
+    good: int
+
+
+class VehicleSummary(BaseModel):
+    total: int
+    active: int
+    in_maintenance: int
+    avg_fuel_level: float
+    avg_speed: float
+    carbon_kg: float
+    maintenance_status: MaintenanceStatusSummary
+    drivers_assigned_active: int
+
+
+class DriverSummary(BaseModel):
+    total: int
+    active: int
+    on_trip: int
+
+
+class CategoryTotal(BaseModel):
+    category: str
+    entries: int
+    total: float
+
+
+class CostSummary(BaseModel):
+    month: str
+    total: float
+    entries: int
+    by_category: List[CategoryTotal]
+
+
+class AlertSummary(BaseModel):
+    maintenance_due: int
+    open_fuel_alerts: int
+
+
+class DashboardSummaryOut(BaseModel):
+    generated_at: datetime
+    vehicles: VehicleSummary
+    vehicles_on_trip: int
+    drivers: DriverSummary
+    costs_this_month: CostSummary
+    alerts: AlertSummary
+
+
+class MapClusterOut(BaseModel):
+    latitude: float  # centroid of the vehicles in the cell
+    longitude: float
+    count: int
+    statuses: Dict[str, int]
+    vehicle_id: Optional[int] = None  # set when the cell holds one vehicle
+
+
+class MapClustersOut(BaseModel):
+    zoom: int
+    version: int  # row version of the fleet state the clusters come from
+    vehicles: int
+    clusters: List[MapClusterOut]
+
+
+class SearchResultOut(BaseModel):
+    kind: str
+    id: int
+    label: str
+    field: str
+    value: str
+    score: float
+
+
+class BatchOperation(BaseModel):
+    op: str
+    entity: str
+    id: Optional[int] = None
+    data: Optional[dict] = None
+
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+
+
+class BatchResultOut(BaseModel):
+    index: int
+    op: str
+    entity: str
+    id: Optional[int] = None
+    status: str
+    error: Optional[str] = None
+
+
+class BatchOut(BaseModel):
+    committed: bool
+    results: List[BatchResultOut]
+
+
+class SyncOut(BaseModel):
+    token: str
+    more: bool
+    vehicles: List[VehicleOut] = []
+    drivers: List[DriverOut] = []
+    costs: List[CostOut] = []
+    maintenance_records: List[MaintenanceRecordOut] = []
+    deleted: Dict[str, List[int]] = {}
+
+
+class ForecastPoint(BaseModel):
+    period: date  # first day of the month
+    amount: float
+    lower: float  # 95% interval
+    upper: float
+
+
+class CategoryForecast(BaseModel):
+    category: str
+    method: Optional[str] = None  # per vehicle only
+    series: int
+    points: List[ForecastPoint]
+
+
+class CostForecastOut(BaseModel):
+    vehicle_id: Optional[int] = None
+    fitted_at: Optional[datetime] = None
+    categories: List[CategoryForecast]
+    total: List[ForecastPoint]
+
+
+class WorkshopBase(BaseModel):
+    name: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    daily_capacity: int = Field(1, ge=0)
+
+
+class WorkshopCreate(WorkshopBase):
+    pass
+
+
+class WorkshopOut(WorkshopBase):
+    id: int
+
+    class Config:
+        from_attributes = True
+
+
+class VehicleUnavailabilityCreate(BaseModel):
+    start_date: date
+    end_date: date  # included
+    reason: Optional[str] = None
+
+
+class VehicleUnavailabilityOut(VehicleUnavailabilityCreate):
+    id: int
+    vehicle_id: int
+
+    class Config:
+        from_attributes = True
+
+
+class MaintenanceSlotOut(BaseModel):
+    vehicle_id: int
+    workshop_id: Optional[int] = None  # None: no capacity left in the horizon
+    scheduled_date: Optional[date] = None
+    due_date: date
+    overdue_days: Optional[int] = None
+    travel_hours: Optional[float] = None
+    planned_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class RouteOrderIn(BaseModel):
+    order_id: Union[int, str]
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+    demand: float = Field(0, ge=0)  # in the unit of Vehicle.capacity
+    service_minutes: float = Field(5, ge=0)
+    window_start: Optional[time] = None
+    window_end: Optional[time] = None
+
+
+class RoutePlanRequest(BaseModel):
+    day: Optional[date] = None  # today by default
+    depot_latitude: float = Field(..., ge=-90, le=90)
+    depot_longitude: float = Field(..., ge=-180, le=180)
+    shift_start: time = time(8, 0)
+    shift_end: time = time(18, 0)
+    vehicle_ids: Optional[List[int]] = None  # every available vehicle by default
+    time_budget_seconds: Optional[float] = Field(None, gt=0)
+    orders: List[RouteOrderIn]
+
+
+class DutyEventCreate(BaseModel):
+    duty_status: str  # driving, on_duty or off_duty
+    started_at: Optional[datetime] = None  # now by default
+    vehicle_id: Optional[int] = None
+
+
+class DutyEventOut(BaseModel):
+    event_id: int
+    driver_id: int
+    duty_status: str
+    started_at: datetime
+    vehicle_id: Optional[int] = None
+    source: str
+    recorded_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class HoursOfServiceOut(BaseModel):
+    driver_id: int
+    duty_status: str
+    duty_since: datetime
+    vehicle_id: Optional[int] = None
+    driving_hours_24h: float
+    driving_hours_7d: float
+    rest_hours_24h: float
+    rest_hours_7d: float
+    continuous_driving_hours: float  # since the last break
+    duty_period_hours: float  # since the last daily rest
+    duty_period_driving_hours: float
+    hours_since_weekly_rest: float
+    remaining_driving_hours: float  # before a break or rest is due
+    violations: List[str]
+    predicted: List[str]  # limits reached within the warning time
+
+
+class HosComplianceOut(BaseModel):
+    checked_at: datetime
+    drivers: List[HoursOfServiceOut]
@@ -0,0 +1,567 @@
+from array import array
+from functools import partial
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from sqlalchemy import func, or_
+
+from models import Driver, DriverDocument, Tombstone, Vehicle, VehicleDocument
+from sync import snapshot_xmin
+
+SEARCH_MIN_SIMILARITY = float(os.getenv("SEARCH_MIN_SIMILARITY", "0.2"))
+# Share of query trigrams a result must contain; lower is more typo tolerant
+SEARCH_MIN_OVERLAP = float(os.getenv("SEARCH_MIN_OVERLAP", "0.5"))
+# Trigrams present in more than this share of entries are too common to help
+SEARCH_COMMON_TRIGRAM_SHARE = 0.2
+# Rebuild the postings once this share of entries has been deleted or replaced
+SEARCH_COMPACT_SHARE = 0.25
+# How often loaded indexes replay the rows other processes wrote
+SEARCH_REFRESH_SECONDS = float(os.getenv("SEARCH_REFRESH_SECONDS", "5"))
+
+KINDS = ("vehicle", "driver", "driver_document", "vehicle_document")
+FIELDS = ("registration_number", "name", "license_number", "phone", "doc_number")
+# Identifiers are matched without spaces and punctuation ("KBZ 123Y" = "kbz123y")
+WORD_FIELDS = {"name"}
+
+# Tables whose tombstones remove entries of each kind
+KIND_TABLES = {
+    "vehicles": "vehicle",
+    "drivers": "driver",
+    "driver_documents": "driver_document",
+    "vehicle_documents": "vehicle_document",
+}
+DOCUMENT_MODELS = (
+    (DriverDocument, DriverDocument.driver_id, "driver_document"),
+    (VehicleDocument, VehicleDocument.vehicle_id, "vehicle_document"),
+)
+
+NON_ALNUM = re.compile(r"[^0-9a-z]+")
+NON_WORD = re.compile(r"[^0-9a-z ]+")
+
+
+def normalize(value: str, words: bool = False) -> str:
+    value = (value or "").lower()
+    if words:
+        return " ".join(NON_WORD.sub("", value).split())
+    return NON_ALNUM.sub("", value)
+
+
+def trigrams(text: str):
+    # Each word padded like pg_trgm, so prefixes weigh more than inner matches
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+def query_trigrams(query: str):
+    words = normalize(query, words=True)
+    compact = normalize(query)
+    return trigrams(words) | trigrams(compact), compact
+
+
+# In-process trigram index. Every indexed field value is an entry with a slot
+# number; postings map a trigram to the slots containing it. Updates append a
+# new slot and mark the old one dead, so writes never rewrite postings until
+# enough dead slots pile up to compact.
+class SearchIndex:
+    def __init__(self, version: int = 0):
+        self._lock = threading.Lock()
+        # Rows written from this row version on may be missing from the index
+        self.version = version
+        self.replays = 0
+        self.replayed_rows = 0
+        self._reset()
+
+    def _reset(self):
+        self.postings = {}
+        self.slot_kind = array("B")
+        self.slot_field = array("B")
+        self.slot_entity = array("l")
+        self.slot_size = array("H")
+        self.alive = bytearray()
+        self.texts = []
+        self.values = []
+        self.entities = {}  # (kind, id) -> (label, [slots])
+        self.dead = 0
+
+    def _add_slot(self, kind, entity_id, field, value):
+        text = normalize(value, words=field in WORD_FIELDS)
+        grams = trigrams(text)
+        if not grams:
+            return None
+        slot = len(self.alive)
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array("i")
+            posting.append(slot)
+        self.slot_kind.append(KINDS.index(kind))
+        self.slot_field.append(FIELDS.index(field))
+        self.slot_entity.append(entity_id)
+        self.slot_size.append(min(len(grams), 65535))
+        self.alive.append(1)
+        self.texts.append(text)
+        self.values.append(value)
+        return slot
+
+    def _remove(self, key):
+        entry = self.entities.pop(key, None)
+        if entry is None:
+            return
+        for slot in entry[1]:
+            self.alive[slot] = 0
+            self.texts[slot] = None
+            self.values[slot] = None
+            self.dead += 1
+
+    def upsert(self, kind: str, entity_id: int, label: str, fields: dict):
+        key = (kind, entity_id)
+        with self._lock:
+            self._remove(key)
+            slots = []
+            for field, value in fields.items():
+                if value:
+                    slot = self._add_slot(kind, entity_id, field, str(value))
+                    if slot is not None:
+                        slots.append(slot)
+            self.entities[key] = (label, slots)
+            if self.dead > SEARCH_COMPACT_SHARE * max(len(self.alive), 1000):
+                self._compact()
+
+    def remove(self, kind: str, entity_id: int):
+        with self._lock:
+            self._remove((kind, entity_id))
+
+    def _compact(self):
+        live = [
+            (
+                KINDS[self.slot_kind[slot]],
+                self.slot_entity[slot],
+                FIELDS[self.slot_field[slot]],
+                self.values[slot],
+            )
+            for slot in range(len(self.alive))
+            if self.alive[slot]
+        ]
+        entities = {key: (label, []) for key, (label, _) in self.entities.items()}
+        self._reset()
+        for kind, entity_id, field, value in live:
+            slot = self._add_slot(kind, entity_id, field, value)
+            entities[(kind, entity_id)][1].append(slot)
+        self.entities = entities
+
+    def search(self, query: str, limit: int = 20, kinds=None):
+        grams, compact = query_trigrams(query)
+        if not grams:
+            return []
+        with self._lock:
+            slot_count = len(self.alive)
+            if not slot_count:
+                return []
+            lists = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+            common = SEARCH_COMMON_TRIGRAM_SHARE * slot_count
+            # In a small index every trigram is common; all of them are used then
+            useful = [p for p in lists if 0 < len(p) <= common] or [
+                p for p in lists if len(p)
+            ]
+            if not useful:
+                return []
+            need = max(1, math.ceil(len(useful) * SEARCH_MIN_OVERLAP))
+            # An entry holding `need` of the trigrams holds at least one of the
+            # len(useful) - need + 1 rarest ones, so only those are scanned in
+            # full; the common ones are looked up for a shortlist only.
+            split = len(useful) - need + 1
+            # Postings are sorted, since slots are only ever appended. Views
+            # into the arrays must be gone before the lock is released, or a
+            # writer appending to them would fail with BufferError.
+            hits = np.concatenate(
+                [np.frombuffer(p, dtype=np.int32) for p in useful[:split]]
+            )
+            hits.sort()
+            starts = np.flatnonzero(np.diff(hits, prepend=-1))
+            candidates = hits[starts]
+            counts = np.diff(starts, append=len(hits))
+            alive = np.frombuffer(self.alive, dtype=np.uint8)
+            keep = alive[candidates] == 1
+            del alive
+            if kinds:
+                slot_kinds = np.frombuffer(self.slot_kind, dtype=np.uint8)
+                codes = [KINDS.index(kind) for kind in kinds]
+                keep &= np.isin(slot_kinds[candidates], codes)
+                del slot_kinds
+            candidates, counts = candidates[keep], counts[keep]
+            shortlist = max(limit * 50, 1000)
+            if len(candidates) > shortlist:
+                best = np.argpartition(-counts, shortlist - 1)[:shortlist]
+                candidates, counts = candidates[best], counts[best]
+            for posting in useful[split:]:
+                slots = np.frombuffer(posting, dtype=np.int32)
+                positions = np.minimum(
+                    np.searchsorted(slots, candidates), len(slots) - 1
+                )
+                counts = counts + (slots[positions] == candidates)
+                del slots
+            keep = counts >= need
+            candidates, counts = candidates[keep], counts[keep]
+            sizes = np.frombuffer(self.slot_size, dtype=np.uint16)[candidates]
+            shared = counts.astype(np.float64)
+            # Jaccard similarity of trigram sets, as pg_trgm's similarity()
+            scores = shared / (len(grams) + sizes - shared)
+            keep = scores >= SEARCH_MIN_SIMILARITY
+            candidates, scores = candidates[keep], scores[keep]
+            top = min(len(candidates), limit * 5)
+            if top < len(candidates):
+                best = np.argpartition(-scores, top - 1)[:top]
+                candidates, scores = candidates[best], scores[best]
+            rows = [
+                (
+                    int(slot),
+                    float(score),
+                    KINDS[self.slot_kind[slot]],
+                    self.slot_entity[slot],
+                    FIELDS[self.slot_field[slot]],
+                    self.texts[slot],
+                    self.values[slot],
+                )
+                for slot, score in zip(candidates.tolist(), scores.tolist())
+            ]
+            labels = {
+                (kind, entity_id): self.entities[(kind, entity_id)][0]
+                for _, _, kind, entity_id, _, _, _ in rows
+            }
+        results = {}
+        for slot, score, kind, entity_id, field, text, value in rows:
+            flat = text.replace(" ", "")
+            if flat == compact:
+                score += 0.5
+            elif flat.startswith(compact):
+                score += 0.3
+            elif compact in flat:
+                score += 0.15
+            key = (kind, entity_id)
+            if key not in results or results[key]["score"] < score:
+                results[key] = {
+                    "kind": kind,
+                    "id": entity_id,
+                    "label": labels[key],
+                    "field": field,
+                    "value": value,
+                    "score": round(score, 4),
+                }
+        return sorted(results.values(), key=lambda r: -r["score"])[:limit]
+
+    # Applies the rows written and deleted since the index's version, like
+    # FleetState.replay. Documents without a number or an owner (left behind by
+    # deleting their driver or vehicle) are removed.
+    def replay(self, db) -> int:
+        version = snapshot_xmin(db)
+        deleted = db.query(Tombstone.table_name, Tombstone.row_id).filter(
+            Tombstone.table_name.in_(list(KIND_TABLES)),
+            Tombstone.row_version >= self.version,
+        ).all()
+        vehicles = (
+            db.query(Vehicle.id, Vehicle.registration_number)
+            .filter(Vehicle.row_version >= self.version)
+            .all()
+        )
+        drivers = (
+            db.query(Driver.id, Driver.name, Driver.license_number, Driver.phone)
+            .filter(Driver.row_version >= self.version)
+            .all()
+        )
+        documents = [
+            (
+                kind,
+                db.query(model.doc_id, model.doc_type, model.doc_number, owner)
+                .filter(model.row_version >= self.version)
+                .all(),
+            )
+            for model, owner, kind in DOCUMENT_MODELS
+        ]
+        for table_name, row_id in deleted:
+            self.remove(KIND_TABLES[table_name], row_id)
+        for row in vehicles:
+            self.upsert(*vehicle_entry(row))
+        for row in drivers:
+            self.upsert(*driver_entry(row))
+        changed = len(vehicles) + len(drivers)
+        for kind, rows in documents:
+            changed += len(rows)
+            for row in rows:
+                if row.doc_number and row[3] is not None:
+                    self.upsert(*document_entry(kind, row))
+                else:
+                    self.remove(kind, row.doc_id)
+        with self._lock:
+            self.version = version
+            self.replays += 1
+            self.replayed_rows += changed
+        return changed + len(deleted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "version": self.version,
+                "replays": self.replays,
+                "replayed_rows": self.replayed_rows,
+                "entities": len(self.entities),
+                "entries": len(self.alive) - self.dead,
+                "dead_entries": self.dead,
+                "trigrams": len(self.postings),
+                "posting_bytes": sum(
+                    p.itemsize * len(p) for p in self.postings.values()
+                ),
+            }
+
+
+# Entries are captured as plain values at write time, since ORM objects are
+# expired by the commit that follows
+def vehicle_entry(vehicle):
+    return (
+        "vehicle",
+        vehicle.id,
+        vehicle.registration_number,
+        {"registration_number": vehicle.registration_number},
+    )
+
+
+def driver_entry(driver):
+    return (
+        "driver",
+        driver.id,
+        driver.name,
+        {
+            "name": driver.name,
+            "license_number": driver.license_number,
+            "phone": driver.phone,
+        },
+    )
+
+
+def document_entry(kind: str, document):
+    return (
+        kind,
+        document.doc_id,
+        f"{document.doc_type} {document.doc_number or ''}".strip(),
+        {"doc_number": document.doc_number},
+    )
+
+
+def build_index(db) -> SearchIndex:
+    index = SearchIndex(snapshot_xmin(db))
+    for row in db.query(Vehicle.id, Vehicle.registration_number).yield_per(10000):
+        index.upsert(*vehicle_entry(row))
+    for row in db.query(
+        Driver.id, Driver.name, Driver.license_number, Driver.phone
+    ).yield_per(10000):
+        index.upsert(*driver_entry(row))
+    for model, owner, kind in DOCUMENT_MODELS:
+        for row in (
+            db.query(model.doc_id, model.doc_type, model.doc_number)
+            .filter(model.doc_number.isnot(None), owner.isnot(None))
+            .yield_per(10000)
+        ):
+            index.upsert(*document_entry(kind, row))
+    return index
+
+
+# Substring search straight from the database, for requests that arrive while
+# the tenant's index is still being built. Only exact substrings of the
+# normalized values match; scores follow the index's bonuses.
+def database_search(db, query: str, limit: int = 20, kinds=None):
+    compact = normalize(query)
+    if len(compact) < 2:
+        return []
+    sources = {
+        "vehicle": (
+            vehicle_entry,
+            db.query(Vehicle.id, Vehicle.registration_number),
+            (Vehicle.registration_number,),
+        ),
+        "driver": (
+            driver_entry,
+            db.query(Driver.id, Driver.name, Driver.license_number, Driver.phone),
+            (Driver.name, Driver.license_number, Driver.phone),
+        ),
+    }
+    for model, owner, kind in DOCUMENT_MODELS:
+        sources[kind] = (
+            partial(document_entry, kind),
+            db.query(model.doc_id, model.doc_type, model.doc_number).filter(
+                owner.isnot(None)
+            ),
+            (model.doc_number,),
+        )
+    results = []
+    for kind, (entry, rows, columns) in sources.items():
+        if kinds and kind not in kinds:
+            continue
+        matches = [
+            func.regexp_replace(func.lower(column), "[^0-9a-z]", "", "g").like(
+                f"%{compact}%"
+            )
+            for column in columns
+        ]
+        for row in rows.filter(or_(*matches)).limit(limit):
+            _, entity_id, label, fields = entry(row)
+            best = None
+            for field, value in fields.items():
+                flat = normalize(value)
+                if not value or compact not in flat:
+                    continue
+                score = len(compact) / len(flat)
+                if flat == compact:
+                    score += 0.5
+                elif flat.startswith(compact):
+                    score += 0.3
+                else:
+                    score += 0.15
+                if best is None or best["score"] < score:
+                    best = {
+                        "kind": kind,
+                        "id": entity_id,
+                        "label": label,
+                        "field": field,
+                        "value": value,
+                        "score": round(score, 4),
+                    }
+            if best is not None:
+                results.append(best)
+    return sorted(results, key=lambda r: -r["score"])[:limit]
+
+
+# One index per tenant, built from the database on first use. Changes made
+# while an index is being built are queued and replayed once it is ready; a
+# single thread then replays what every process wrote, so an index trails the
+# database by at most SEARCH_REFRESH_SECONDS.
+class SearchRegistry:
+    def __init__(
+        self, session_factory_for, refresh_seconds: float = SEARCH_REFRESH_SECONDS
+    ):
+        self.session_factory_for = session_factory_for
+        self.refresh_seconds = refresh_seconds
+        self.indexes = {}
+        self._building = {}  # tenant -> (done event, queued changes)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def get(self, tenant: str = None) -> SearchIndex:
+        index = self.indexes.get(tenant)
+        if index is not None:
+            return index
+        with self._lock:
+            index = self.indexes.get(tenant)
+            if index is not None:
+                return index
+            building = self._building.get(tenant)
+            owner = building is None
+            if owner:
+                building = self._building[tenant] = (threading.Event(), [])
+        done, queued = building
+        if not owner:
+            done.wait()
+            return self.get(tenant)
+        try:
+            started = time.monotonic()
+            db = self.session_factory_for(tenant)()
+            try:
+                index = build_index(db)
+            finally:
+                db.close()
+            with self._lock:
+                for change in queued:
+                    change(index)
+                self.indexes[tenant] = index
+            logging.info(
+                f"Built search index for tenant {tenant}: {len(index.entities)} "
+                f"entities in {time.monotonic() - started:.1f}s"
+            )
+            return index
+        finally:
+            with self._lock:
+                self._building.pop(tenant, None)
+            done.set()
+
+    # The tenant's index, or None while it is built in the background
+    def ready(self, tenant: str = None):
+        index = self.indexes.get(tenant)
+        if index is None:
+            with self._lock:
+                building = tenant in self._building
+            if not building:
+                threading.Thread(
+                    target=self._warm,
+                    args=(tenant,),
+                    name="search-index-build",
+                    daemon=True,
+                ).start()
+        return index
+
+    def _warm(self, tenant):
+        try:
+            self.get(tenant)
+        except Exception as e:
+            logging.error(f"Search index build failed for {tenant}: {e}")
+
+    def _apply(self, tenant, change):
+        with self._lock:
+            index = self.indexes.get(tenant)
+            if index is None:
+                if tenant in self._building:
+                    self._building[tenant][1].append(change)
+                # An index that was never built has nothing to update
+                return
+        change(index)
+
+    def upsert(self, tenant, entry):
+        self._apply(tenant, lambda index: index.upsert(*entry))
+
+    def remove(self, tenant, kind: str, entity_id: int):
+        self._apply(tenant, lambda index: index.remove(kind, entity_id))
+
+    def invalidate(self, tenant: str = None):
+        with self._lock:
+            self.indexes.pop(tenant, None)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="search-refresh", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping.wait(self.refresh_seconds):
+            self.refresh_all()
+
+    def refresh_all(self):
+        for tenant, index in list(self.indexes.items()):
+            try:
+                db = self.session_factory_for(tenant)()
+                try:
+                    index.replay(db)
+                finally:
+                    db.close()
+            except Exception as e:
+                logging.error(f"Search index refresh failed for {tenant}: {e}")
+
+    def stats(self):
+        return {str(t): index.stats() for t, index in list(self.indexes.items())}
@@ -0,0 +1,146 @@
+import base64
+from datetime import datetime, timedelta
+import json
+import os
+import time
+
+from sqlalchemy import text, tuple_
+
+from models import Cost, Driver, MaintenanceRecord, Tombstone, Vehicle
+
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", "1000"))
+SYNC_TOMBSTONE_DAYS = int(os.getenv("SYNC_TOMBSTONE_DAYS", "30"))
+# Tokens must be younger than the tombstones kept, with room for transactions
+# that were still open when the token was issued
+SYNC_TOKEN_MAX_AGE = timedelta(days=SYNC_TOMBSTONE_DAYS) - timedelta(days=1)
+
+# Table -> (model, primary key column)
+SYNC_TABLES = {
+    "vehicles": (Vehicle, Vehicle.id),
+    "drivers": (Driver, Driver.id),
+    "costs": (Cost, Cost.cost_id),
+    "maintenance_records": (MaintenanceRecord, MaintenanceRecord.record_id),
+}
+
+
+class SyncError(ValueError):
+    pass
+
+
+class SyncTokenExpired(SyncError):
+    pass
+
+
+# Row versions are transaction ids (migration 0004). A sync cycle returns the
+# rows whose version is at least `since`; when it is done, the next cycle starts
+# at the oldest transaction that was still open when this one began, so a
+# write that commits late is never skipped (at worst it is sent twice).
+# Pages within a cycle resume after the last (version, key) sent per table.
+class SyncToken:
+    def __init__(self, since=0, since_at=None, upto=None, upto_at=None, cursors=None):
+        self.since = since
+        self.since_at = since_at if since_at is not None else time.time()
+        self.upto = upto
+        self.upto_at = upto_at
+        self.cursors = cursors or {}
+
+    @classmethod
+    def parse(cls, token: str):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(token.encode() + b"=="))
+            parsed = cls(
+                int(data["s"]),
+                float(data["sa"]),
+                data.get("u"),
+                data.get("ua"),
+                {key: tuple(value) for key, value in data.get("c", {}).items()},
+            )
+        except (ValueError, KeyError, TypeError):
+            raise SyncError("Invalid sync token")
+        if time.time() - parsed.since_at > SYNC_TOKEN_MAX_AGE.total_seconds():
+            raise SyncTokenExpired("Sync token expired, start a full sync")
+        return parsed
+
+    def encode(self) -> str:
+        data = {"s": self.since, "sa": round(self.since_at, 3)}
+        if self.upto is not None:
+            data.update(u=self.upto, ua=self.upto_at, c=self.cursors)
+        raw = json.dumps(data, separators=(",", ":")).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def snapshot_xmin(db) -> int:
+    return db.execute(
+        text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+    ).scalar()
+
+
+def _page(query, version, key, since, cursor, limit):
+    query = query.filter(version >= since)
+    if cursor is not None:
+        query = query.filter(tuple_(version, *key) > tuple_(*cursor))
+    return query.order_by(version, *key).limit(limit + 1).all()
+
+
+def sync_changes(db, token: str = None, tables=None, limit: int = SYNC_PAGE_SIZE):
+    state = SyncToken.parse(token) if token else SyncToken()
+    tables = list(tables or SYNC_TABLES)
+    if state.upto is None:
+        # First page of a cycle: fix where the next cycle starts
+        state.upto = snapshot_xmin(db)
+        state.upto_at = time.time()
+    result = {"deleted": {}}
+    more = False
+    for table in tables:
+        model, pk = SYNC_TABLES[table]
+        rows = _page(
+            db.query(model),
+            model.row_version,
+            (pk,),
+            state.since,
+            state.cursors.get(table),
+            limit,
+        )
+        if len(rows) > limit:
+            more = True
+            rows = rows[:limit]
+        if rows:
+            state.cursors[table] = (rows[-1].row_version, getattr(rows[-1], pk.key))
+        result[table] = rows
+    # Deletes come with the table so clients can apply them before the changes,
+    # which also handles a row deleted and recreated with the same key. A first
+    # sync has nothing to delete.
+    tombstones = []
+    if state.since > 0:
+        query = db.query(
+            Tombstone.table_name, Tombstone.row_id, Tombstone.row_version
+        ).filter(Tombstone.table_name.in_(tables))
+        tombstones = _page(
+            query,
+            Tombstone.row_version,
+            (Tombstone.table_name, Tombstone.row_id),
+            state.since,
+            state.cursors.get("tombstones"),
+            limit,
+        )
+    if len(tombstones) > limit:
+        more = True
+        tombstones = tombstones[:limit]
+    for table_name, row_id, _ in tombstones:
+        result["deleted"].setdefault(table_name, []).append(row_id)
+    if tombstones:
+        last = tombstones[-1]
+        state.cursors["tombstones"] = (last.row_version, last.table_name, last.row_id)
+    if not more:
+        state = SyncToken(state.upto, state.upto_at)
+    result["token"] = state.encode()
+    result["more"] = more
+    return result
+
+
+def prune_tombstones(db, now: datetime = None):
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=SYNC_TOMBSTONE_DAYS)
+    db.query(Tombstone).filter(Tombstone.deleted_at < cutoff).delete(
+        synchronize_session=False
+    )
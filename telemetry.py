@@ -0,0 +1,437 @@
+from datetime import datetime, timedelta, timezone
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from models import VehicleTelemetry, VehicleTelemetryRollup
+from partitions import ensure_partition, drop_partitions_before
+from sync import prune_tombstones
+
+TELEMETRY_FLUSH_SIZE = int(os.getenv("TELEMETRY_FLUSH_SIZE", "500"))
+TELEMETRY_FLUSH_SECONDS = float(os.getenv("TELEMETRY_FLUSH_SECONDS", "1.0"))
+TELEMETRY_MAX_BUFFERED = int(os.getenv("TELEMETRY_MAX_BUFFERED", "100000"))
+# Consecutive failed flushes after which the buffered points are dropped
+TELEMETRY_FLUSH_RETRIES = int(os.getenv("TELEMETRY_FLUSH_RETRIES", "3"))
+# Most points one history request returns
+TELEMETRY_MAX_POINTS = int(os.getenv("TELEMETRY_MAX_POINTS", "10000"))
+# Rows per INSERT of raw points
+TELEMETRY_INSERT_CHUNK = 1000
+RAW_RETENTION_DAYS = int(os.getenv("TELEMETRY_RAW_RETENTION_DAYS", "7"))
+ROLLUP_RETENTION_DAYS = {
+    "1m": int(os.getenv("TELEMETRY_1M_RETENTION_DAYS", "30")),
+    "1h": int(os.getenv("TELEMETRY_1H_RETENTION_DAYS", "365")),
+}
+RETENTION_CHECK_SECONDS = 3600
+# Points stamped further ahead than this (a tracker with a wrong clock) are
+# rejected, like points older than raw retention: each would otherwise create
+# a daily partition of its own
+TELEMETRY_MAX_FUTURE_SECONDS = float(os.getenv("TELEMETRY_MAX_FUTURE_SECONDS", "86400"))
+
+# Longest window served from each resolution when resolution="auto"
+RESOLUTION_WINDOWS = [
+    ("raw", timedelta(hours=2)),
+    ("1m", timedelta(days=2)),
+    ("1h", None),
+]
+
+RAW_TABLE = VehicleTelemetry.__tablename__
+
+
+def parse_timestamp(value) -> datetime:
+    # Trackers send either epoch seconds or an ISO-8601 string; default to arrival time
+    if value is None:
+        return datetime.utcnow()
+    if isinstance(value, (int, float)):
+        return datetime.utcfromtimestamp(value)
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def in_time_window(recorded_at: datetime, now: datetime = None) -> bool:
+    now = now or datetime.utcnow()
+    oldest = (now - timedelta(days=RAW_RETENTION_DAYS)).date()
+    newest = now + timedelta(seconds=TELEMETRY_MAX_FUTURE_SECONDS)
+    return recorded_at.date() >= oldest and recorded_at <= newest
+
+
+def bucket_start(value: datetime, resolution: str) -> datetime:
+    if resolution == "1h":
+        return value.replace(minute=0, second=0, microsecond=0)
+    return value.replace(second=0, microsecond=0)
+
+
+def choose_resolution(start: datetime, end: datetime, now: datetime = None) -> str:
+    now = now or datetime.utcnow()
+    span = end - start
+    for resolution, window in RESOLUTION_WINDOWS:
+        if window is not None and span > window:
+            continue
+        # Use a coarser resolution once retention has removed the finer data
+        retention = (
+            RAW_RETENTION_DAYS
+            if resolution == "raw"
+            else ROLLUP_RETENTION_DAYS[resolution]
+        )
+        if start < now - timedelta(days=retention) and resolution != "1h":
+            continue
+        return resolution
+    return "1h"
+
+
+def rollup_rows(points):
+    buckets = {}
+    for point in points:
+        for resolution in ROLLUP_RETENTION_DAYS:
+            key = (
+                point["vehicle_id"],
+                resolution,
+                bucket_start(point["recorded_at"], resolution),
+            )
+            row = buckets.get(key)
+            if row is None:
+                row = buckets[key] = {
+                    "vehicle_id": key[0],
+                    "resolution": key[1],
+                    "bucket_start": key[2],
+                    "samples": 0,
+                    "position_samples": 0,
+                    "speed_samples": 0,
+                    "fuel_samples": 0,
+                    "sum_latitude": 0.0,
+                    "sum_longitude": 0.0,
+                    "sum_speed": 0.0,
+                    "sum_fuel_level": 0.0,
+                    "max_speed": None,
+                    "min_fuel_level": None,
+                    "max_fuel_level": None,
+                }
+            row["samples"] += 1
+            if point["latitude"] is not None and point["longitude"] is not None:
+                row["position_samples"] += 1
+                row["sum_latitude"] += point["latitude"]
+                row["sum_longitude"] += point["longitude"]
+            speed = point["speed"]
+            if speed is not None:
+                row["speed_samples"] += 1
+                row["sum_speed"] += speed
+                if row["max_speed"] is None or speed > row["max_speed"]:
+                    row["max_speed"] = speed
+            fuel = point["fuel_level"]
+            if fuel is not None:
+                row["fuel_samples"] += 1
+                row["sum_fuel_level"] += fuel
+                if row["min_fuel_level"] is None or fuel < row["min_fuel_level"]:
+                    row["min_fuel_level"] = fuel
+                if row["max_fuel_level"] is None or fuel > row["max_fuel_level"]:
+                    row["max_fuel_level"] = fuel
+    return list(buckets.values())
+
+
+def upsert_rollups(db, rows):
+    if not rows:
+        return
+    table = VehicleTelemetryRollup.__table__
+    stmt = insert(table)
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["vehicle_id", "resolution", "bucket_start"],
+        set_={
+            "samples": table.c.samples + excluded.samples,
+            "position_samples": table.c.position_samples + excluded.position_samples,
+            "speed_samples": table.c.speed_samples + excluded.speed_samples,
+            "fuel_samples": table.c.fuel_samples + excluded.fuel_samples,
+            "sum_latitude": table.c.sum_latitude + excluded.sum_latitude,
+            "sum_longitude": table.c.sum_longitude + excluded.sum_longitude,
+            "sum_speed": table.c.sum_speed + excluded.sum_speed,
+            "sum_fuel_level": table.c.sum_fuel_level + excluded.sum_fuel_level,
+            "max_speed": func.greatest(table.c.max_speed, excluded.max_speed),
+            "min_fuel_level": func.least(
+                table.c.min_fuel_level, excluded.min_fuel_level
+            ),
+            "max_fuel_level": func.greatest(
+                table.c.max_fuel_level, excluded.max_fuel_level
+            ),
+        },
+    )
+    db.execute(stmt, rows)
+
+
+# Inserts the points and returns the ones that were new; points already stored
+# (a tracker resending, or a retried flush) must not be counted in the rollups
+# again
+def insert_points(db, points):
+    table = VehicleTelemetry.__table__
+    inserted = []
+    for start in range(0, len(points), TELEMETRY_INSERT_CHUNK):
+        stmt = (
+            insert(table)
+            .values(points[start:start + TELEMETRY_INSERT_CHUNK])
+            .on_conflict_do_nothing()
+            .returning(*table.c)
+        )
+        inserted += [dict(row._mapping) for row in db.execute(stmt)]
+    return inserted
+
+
+def apply_retention(db, now: datetime = None):
+    now = now or datetime.utcnow()
+    conn = db.connection()
+    drop_partitions_before(
+        conn, RAW_TABLE, (now - timedelta(days=RAW_RETENTION_DAYS)).date(), "day"
+    )
+    for resolution, days in ROLLUP_RETENTION_DAYS.items():
+        db.query(VehicleTelemetryRollup).filter(
+            VehicleTelemetryRollup.resolution == resolution,
+            VehicleTelemetryRollup.bucket_start < now - timedelta(days=days),
+        ).delete(synchronize_session=False)
+
+
+# Collects position updates from the ingestion path; a background writer
+# (ingestion.PipelineRegistry) flushes them in batches, so a telemetry
+# message never waits on an INSERT.
+class TelemetryBuffer:
+    def __init__(
+        self,
+        session_factory,
+        flush_size: int = TELEMETRY_FLUSH_SIZE,
+        max_buffered: int = TELEMETRY_MAX_BUFFERED,
+        wakeup: threading.Event = None,
+    ):
+        self.session_factory = session_factory
+        self.flush_size = flush_size
+        self.max_buffered = max_buffered
+        # Objects with has_pending() and flush(db) whose writes join each flush
+        # transaction (trips, geofence events, fuel alerts, ...)
+        self.flushers = []
+        self._points = []
+        self._lock = threading.Lock()
+        # May be shared by several buffers drained by one writer thread
+        self._wakeup = wakeup or threading.Event()
+        self._known_partitions = set()
+        self._last_retention = 0.0
+        self._failures = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.written = 0
+        self.duplicates = 0
+        self.failed_flushes = 0
+
+    # Checked before a point goes anywhere, so a bad timestamp neither creates
+    # a partition nor moves a vehicle's trip state ahead
+    def accepts(self, recorded_at: datetime, now: datetime = None) -> bool:
+        if in_time_window(recorded_at, now):
+            return True
+        with self._lock:
+            self.rejected += 1
+        return False
+
+    def add(
+        self,
+        vehicle_id: int,
+        recorded_at: datetime,
+        latitude,
+        longitude,
+        speed,
+        fuel_level,
+    ):
+        point = {
+            "vehicle_id": vehicle_id,
+            "recorded_at": recorded_at,
+            "latitude": latitude,
+            "longitude": longitude,
+            "speed": speed,
+            "fuel_level": fuel_level,
+        }
+        with self._lock:
+            if len(self._points) >= self.max_buffered:
+                self.dropped += 1
+                return
+            self._points.append(point)
+            if len(self._points) >= self.flush_size:
+                self._wakeup.set()
+
+    def flush(self):
+        with self._lock:
+            pending, self._points = self._points, []
+        now = datetime.utcnow()
+        oldest = (now - timedelta(days=RAW_RETENTION_DAYS)).date()
+        # Drop points outside the time window (the oldest ones may have aged out
+        # while buffered) and duplicates of the same (vehicle, instant)
+        unique = {}
+        rejected = 0
+        for p in pending:
+            if in_time_window(p["recorded_at"], now):
+                unique[(p["vehicle_id"], p["recorded_at"])] = p
+            else:
+                rejected += 1
+        if rejected:
+            with self._lock:
+                self.rejected += rejected
+        points = list(unique.values())
+        elapsed = time.monotonic() - self._last_retention
+        run_retention = elapsed >= RETENTION_CHECK_SECONDS
+        flushers = [f for f in self.flushers if f.has_pending()]
+        if not points and not flushers and not run_retention:
+            return
+        try:
+            inserted = self._write(points, flushers, run_retention, now)
+        except Exception:
+            self._requeue(points)
+            raise
+        self._failures = 0
+        if points:
+            self._known_partitions |= {p["recorded_at"].date() for p in points}
+            self.written += len(inserted)
+            self.duplicates += len(points) - len(inserted)
+        if run_retention:
+            self._known_partitions = {
+                d for d in self._known_partitions if d >= oldest
+            }
+            self._last_retention = time.monotonic()
+
+    # One transaction for the points, their rollups and the derived writes;
+    # returns the points that were new
+    def _write(self, points, flushers, run_retention, now):
+        inserted = []
+        db = self.session_factory()
+        try:
+            if points:
+                days = {p["recorded_at"].date() for p in points}
+                days -= self._known_partitions
+                conn = db.connection()
+                for day in days:
+                    ensure_partition(conn, RAW_TABLE, day, "day")
+                inserted = insert_points(db, points)
+                upsert_rollups(db, rollup_rows(inserted))
+            for flusher in flushers:
+                # A derived write that fails (say, an event for a row deleted
+                # meanwhile) loses its own batch, not the raw points
+                try:
+                    with db.begin_nested():
+                        flusher.flush(db)
+                except Exception as e:
+                    logging.error(
+                        f"Telemetry flush of {type(flusher).__name__} failed: {e}"
+                    )
+            if run_retention:
+                apply_retention(db, now)
+                prune_tombstones(db, now)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        return inserted
+
+    # Puts the points of a failed flush back in front of the newer ones, so the
+    # next flush retries them; after TELEMETRY_FLUSH_RETRIES failures in a row
+    # they are dropped rather than retried forever
+    def _requeue(self, points):
+        self.failed_flushes += 1
+        self._failures += 1
+        if self._failures > TELEMETRY_FLUSH_RETRIES:
+            self.dropped += len(points)
+            logging.error(
+                f"Dropped {len(points)} telemetry points after "
+                f"{self._failures - 1} failed retries"
+            )
+            self._failures = 0
+            return
+        with self._lock:
+            room = max(self.max_buffered - len(self._points), 0)
+            self.dropped += max(len(points) - room, 0)
+            self._points[:0] = points[:room]
+
+    def stats(self):
+        with self._lock:
+            buffered = len(self._points)
+        return {
+            "buffered": buffered,
+            "written": self.written,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+def _average(total, samples):
+    return total / samples if samples else None
+
+
+def query_history(
+    db,
+    start: datetime,
+    end: datetime,
+    vehicle_id: int = None,
+    resolution: str = "auto",
+    limit: int = TELEMETRY_MAX_POINTS,
+):
+    if resolution == "auto":
+        resolution = choose_resolution(start, end)
+    if resolution == "raw":
+        query = db.query(VehicleTelemetry).filter(
+            VehicleTelemetry.recorded_at >= start, VehicleTelemetry.recorded_at < end
+        )
+        if vehicle_id is not None:
+            query = query.filter(VehicleTelemetry.vehicle_id == vehicle_id)
+        rows = (
+            query.order_by(VehicleTelemetry.vehicle_id, VehicleTelemetry.recorded_at)
+            .limit(limit)
+            .all()
+        )
+        points = [
+            {
+                "vehicle_id": r.vehicle_id,
+                "recorded_at": r.recorded_at,
+                "latitude": r.latitude,
+                "longitude": r.longitude,
+                "speed": r.speed,
+                "fuel_level": r.fuel_level,
+                "samples": 1,
+                "max_speed": r.speed,
+                "min_fuel_level": r.fuel_level,
+                "max_fuel_level": r.fuel_level,
+            }
+            for r in rows
+        ]
+        return resolution, points
+
+    query = db.query(VehicleTelemetryRollup).filter(
+        VehicleTelemetryRollup.resolution == resolution,
+        VehicleTelemetryRollup.bucket_start >= bucket_start(start, resolution),
+        VehicleTelemetryRollup.bucket_start < end,
+    )
+    if vehicle_id is not None:
+        query = query.filter(VehicleTelemetryRollup.vehicle_id == vehicle_id)
+    rows = (
+        query.order_by(
+            VehicleTelemetryRollup.vehicle_id, VehicleTelemetryRollup.bucket_start
+        )
+        .limit(limit)
+        .all()
+    )
+    points = []
+    for r in rows:
+        points.append(
+            {
+                "vehicle_id": r.vehicle_id,
+                "recorded_at": r.bucket_start,
+                "latitude": _average(r.sum_latitude, r.position_samples),
+                "longitude": _average(r.sum_longitude, r.position_samples),
+                "speed": _average(r.sum_speed, r.speed_samples),
+                "fuel_level": _average(r.sum_fuel_level, r.fuel_samples),
+                "samples": r.samples,
+                "max_speed": r.max_speed,
+                "min_fuel_level": r.min_fuel_level,
+                "max_fuel_level": r.max_fuel_level,
+            }
+        )
+    return resolution, points
@@ -0,0 +1,259 @@
+from collections import OrderedDict
+import argparse
+import logging
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from database import SQLALCHEMY_DATABASE_URL, SessionLocal, connect_args
+
+# off: single shared database; schema: one Postgres schema per tenant in the
+# main database; database: one database per tenant built from a URL template
+TENANT_MODE = os.getenv("TENANT_MODE", "off")
+TENANT_DATABASE_URL_TEMPLATE = os.getenv(
+    "TENANT_DATABASE_URL_TEMPLATE",
+    "postgresql://postgres@localhost/logistics_{tenant}",
+)
+TENANT_SCHEMA_PREFIX = os.getenv("TENANT_SCHEMA_PREFIX", "tenant_")
+DEFAULT_TENANT = os.getenv("DEFAULT_TENANT", "default")
+TENANT_POOL_SIZE = int(os.getenv("TENANT_POOL_SIZE", "2"))
+TENANT_MAX_OVERFLOW = int(os.getenv("TENANT_MAX_OVERFLOW", "3"))
+TENANT_MAX_POOLS = int(os.getenv("TENANT_MAX_POOLS", "200"))
+TENANT_POOL_IDLE_SECONDS = float(os.getenv("TENANT_POOL_IDLE_SECONDS", "300"))
+IDLE_SWEEP_SECONDS = 30
+
+TENANT_NAME = re.compile(r"^[a-z0-9][a-z0-9_]{0,47}$")
+
+
+class InvalidTenant(ValueError):
+    pass
+
+
+def validate_tenant(tenant: str) -> str:
+    tenant = (tenant or "").lower()
+    if not TENANT_NAME.match(tenant):
+        raise InvalidTenant(f"Invalid tenant name: {tenant!r}")
+    return tenant
+
+
+# A session that hands its pool's lease back when closed
+class _LeasedSession(Session):
+    def __init__(self, *args, release=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._release = release
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release()
+
+
+class _TenantPool:
+    __slots__ = ("engine", "sessionmaker", "last_used", "sessions")
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.sessionmaker = sessionmaker(
+            class_=_LeasedSession, autocommit=False, autoflush=False, bind=engine
+        )
+        self.last_used = time.monotonic()
+        # Open sessions; they check out connections lazily, so a pool with none
+        # checked out may still be about to use one
+        self.sessions = 0
+
+
+# Lazily creates one small connection pool per tenant and keeps at most
+# max_pools of them, evicting the least recently used idle pool first. Sessions
+# are counted under the same lock eviction takes, so a pool is only disposed
+# when no session can still check out a connection from it.
+class TenantRouter:
+    def __init__(
+        self,
+        mode: str = TENANT_MODE,
+        base_url: str = SQLALCHEMY_DATABASE_URL,
+        url_template: str = TENANT_DATABASE_URL_TEMPLATE,
+        pool_size: int = TENANT_POOL_SIZE,
+        max_overflow: int = TENANT_MAX_OVERFLOW,
+        max_pools: int = TENANT_MAX_POOLS,
+        idle_seconds: float = TENANT_POOL_IDLE_SECONDS,
+    ):
+        self.mode = mode
+        self.base_url = base_url
+        self.url_template = url_template
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.max_pools = max_pools
+        self.idle_seconds = idle_seconds
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.created = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("schema", "database")
+
+    def schema_for(self, tenant: str) -> str:
+        return f"{TENANT_SCHEMA_PREFIX}{tenant}"
+
+    # (url, schema) of a tenant's data: its own database, or its schema in the
+    # main database
+    def location(self, tenant: str):
+        if self.mode == "database":
+            return self.url_template.format(tenant=tenant), None
+        return self.base_url, self.schema_for(tenant)
+
+    def _create_engine(self, tenant: str):
+        kwargs = {
+            "poolclass": QueuePool,
+            "pool_size": self.pool_size,
+            "max_overflow": self.max_overflow,
+            "pool_recycle": 1800,
+        }
+        if self.mode == "schema":
+            # search_path is fixed when the connection is opened, so requests
+            # pay nothing per checkout and raw SQL resolves to the tenant schema
+            args = connect_args(self.base_url)
+            args["options"] = f"-csearch_path={self.schema_for(tenant)}"
+            return create_engine(self.base_url, connect_args=args, **kwargs)
+        url = self.url_template.format(tenant=tenant)
+        return create_engine(url, connect_args=connect_args(url), **kwargs)
+
+    def _pool(self, tenant: str, lease: bool = False) -> _TenantPool:
+        if time.monotonic() - self._last_sweep >= IDLE_SWEEP_SECONDS:
+            self.evict_idle()
+        evicted = []
+        with self._lock:
+            pool = self._pools.get(tenant)
+            if pool is not None:
+                self._pools.move_to_end(tenant)
+            else:
+                pool = self._pools[tenant] = _TenantPool(self._create_engine(tenant))
+                self.created += 1
+            pool.last_used = time.monotonic()
+            if lease:
+                pool.sessions += 1
+            if len(self._pools) > self.max_pools:
+                evicted = self._evict_over_capacity()
+        for engine in evicted:
+            engine.dispose()
+        return pool
+
+    # A session closing is a use: the pool moves to the end so the pools stay
+    # ordered by last use, which the idle sweep relies on to stop early
+    def _release(self, tenant: str, pool: _TenantPool):
+        with self._lock:
+            pool.sessions -= 1
+            pool.last_used = time.monotonic()
+            if self._pools.get(tenant) is pool:
+                self._pools.move_to_end(tenant)
+
+    @staticmethod
+    def _in_use(pool: _TenantPool) -> bool:
+        return pool.sessions > 0 or pool.engine.pool.checkedout() > 0
+
+    def _evict_over_capacity(self):
+        evicted = []
+        for tenant in list(self._pools):
+            if len(self._pools) <= self.max_pools:
+                break
+            pool = self._pools[tenant]
+            # Never close a pool that a session may still use
+            if self._in_use(pool):
+                continue
+            del self._pools[tenant]
+            evicted.append(pool.engine)
+            self.evicted += 1
+        return evicted
+
+    def evict_idle(self):
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            self._last_sweep = now
+            for tenant in list(self._pools):
+                pool = self._pools[tenant]
+                if now - pool.last_used < self.idle_seconds:
+                    break
+                if self._in_use(pool):
+                    continue
+                del self._pools[tenant]
+                evicted.append(pool.engine)
+                self.evicted += 1
+        for engine in evicted:
+            engine.dispose()
+        return len(evicted)
+
+    # Tenants with an open pool; None alone when tenancy is off
+    def active_tenants(self):
+        if not self.enabled:
+            return [None]
+        with self._lock:
+            return list(self._pools)
+
+    def engine_for(self, tenant: str):
+        return self._pool(tenant).engine
+
+    def session_for(self, tenant: str):
+        pool = self._pool(tenant, lease=True)
+        return pool.sessionmaker(release=lambda: self._release(tenant, pool))
+
+    def provision(self, tenant: str):
+        # Creates the tenant schema if needed and runs all migrations in it
+        from schema_migrations import upgrade_database
+
+        tenant = validate_tenant(tenant)
+        upgrade_database(tenant)
+        logging.info(f"Provisioned tenant {tenant}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "pools": len(self._pools),
+                "max_pools": self.max_pools,
+                "created": self.created,
+                "evicted": self.evicted,
+                "sessions": sum(p.sessions for p in self._pools.values()),
+                "checked_out": sum(
+                    p.engine.pool.checkedout() for p in self._pools.values()
+                ),
+            }
+
+
+tenant_router = TenantRouter()
+
+
+def open_session(tenant: str = None):
+    if tenant is None or not tenant_router.enabled:
+        return SessionLocal()
+    return tenant_router.session_for(tenant)
+
+
+def database_location(tenant: str = None):
+    if tenant is None or not tenant_router.enabled:
+        return SQLALCHEMY_DATABASE_URL, None
+    return tenant_router.location(tenant)
+
+
+def session_factory_for(tenant: str = None):
+    return lambda: open_session(tenant)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tenant administration")
+    parser.add_argument("command", choices=["provision"])
+    parser.add_argument("tenant")
+    args = parser.parse_args()
+    if not tenant_router.enabled:
+        parser.error("Set TENANT_MODE to 'schema' or 'database' first")
+    tenant_router.provision(args.tenant)
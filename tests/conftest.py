@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# A session on DB_URI for the tests that need Postgres; they are skipped when
+# the database cannot be reached
+@pytest.fixture
+def db():
+    from sqlalchemy.exc import OperationalError
+
+    from database import SessionLocal
+
+    session = SessionLocal()
+    try:
+        session.connection()
+    except OperationalError as e:
+        session.close()
+        pytest.skip(f"Postgres is not reachable: {e.orig}")
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
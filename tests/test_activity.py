@@ -0,0 +1,44 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import text
+
+from activity import ActivityArchive
+
+PARTITION = "test_user_activity_p202001"
+MONTH = date(2020, 1, 1)
+
+
+def fill_partition(db, activity_ids):
+    db.execute(text(f'DROP TABLE IF EXISTS "{PARTITION}"'))
+    db.execute(
+        text(
+            f'CREATE TABLE "{PARTITION}" (activity_id bigint, user_id bigint, '
+            "action_type text, action_details text, timestamp timestamp)"
+        )
+    )
+    for activity_id in activity_ids:
+        db.execute(
+            text(f'INSERT INTO "{PARTITION}" VALUES (:id, 1, \'login\', NULL, :at)'),
+            {"id": activity_id, "at": datetime(2020, 1, activity_id)},
+        )
+
+
+def test_archiving_a_month_again_keeps_each_row_once(db, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    archive = ActivityArchive(str(tmp_path))
+    try:
+        fill_partition(db, [1, 2])
+        assert archive.archive_partition(db, "acme", MONTH, PARTITION) == 2
+        # The drop did not commit: the same rows, and one that arrived late
+        db.rollback()
+        fill_partition(db, [1, 2, 3])
+        assert archive.archive_partition(db, "acme", MONTH, PARTITION) == 1
+        db.commit()
+        ids = pq.read_table(archive.path("acme", MONTH)).column("activity_id")
+        assert sorted(ids.to_pylist()) == [1, 2, 3]
+        assert archive.archived_rows == 3
+    finally:
+        db.rollback()
+        db.execute(text(f'DROP TABLE IF EXISTS "{PARTITION}"'))
+        db.commit()
@@ -0,0 +1,56 @@
+from datetime import date, timedelta
+
+import pytest
+
+from dashboard import (
+    driver_summary,
+    fleet_driver_summary,
+    fleet_vehicle_summary,
+    vehicle_summary,
+)
+
+
+def test_fleet_state_summaries_match_the_database(db):
+    from fleet_state import FleetState
+    from models import Driver, Vehicle
+
+    tag = f"{id(db):x}"
+    today = date.today()
+    # One vehicle in each maintenance state, plus nulls the aggregates skip
+    vehicles = [
+        Vehicle(
+            registration_number=f"DSH-{tag}-{i}",
+            vehicle_type="Van",
+            status=status,
+            maintenance_score=score,
+            last_maintenance=last,
+            fuel_level=fuel,
+        )
+        for i, (status, score, last, fuel) in enumerate(
+            [
+                ("Active", 90.0, today - timedelta(days=10), 50.0),
+                ("Active", 40.0, today - timedelta(days=10), None),
+                ("Maintenance", 90.0, today - timedelta(days=150), 20.0),
+                ("Active", None, None, 75.0),
+            ]
+        )
+    ]
+    driver = Driver(name=f"Dash {tag}", license_number=f"DSH-{tag}", status="On Trip")
+    db.add_all([*vehicles, driver])
+    db.flush()
+    vehicles[0].driver_id = vehicles[1].driver_id = driver.id
+    db.commit()
+    try:
+        state = FleetState.load(db)
+        expected = vehicle_summary(db, today)
+        actual = fleet_vehicle_summary(state, today)
+        for key in ("avg_fuel_level", "avg_speed", "carbon_kg"):
+            assert actual.pop(key) == pytest.approx(expected.pop(key), abs=0.1)
+        assert actual == expected
+        assert fleet_driver_summary(state) == driver_summary(db)
+    finally:
+        db.rollback()
+        for vehicle in vehicles:
+            db.delete(vehicle)
+        db.delete(driver)
+        db.commit()
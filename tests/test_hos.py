@@ -0,0 +1,195 @@
+from datetime import datetime, timedelta
+import math
+
+import pytest
+
+from hos import (
+    DAY,
+    DRIVING,
+    HOS_BREAK_MINUTES,
+    HOS_CONTINUOUS_DRIVING_HOURS,
+    HOS_DAILY_REST_HOURS,
+    HOS_WARNING_MINUTES,
+    HOS_WEEKLY_REST_HOURS,
+    OFF_DUTY,
+    ON_DUTY,
+    DriverClock,
+    HosEngine,
+    RollingTotal,
+    record_duty_event,
+)
+
+H = 3600.0
+BREAK = HOS_BREAK_MINUTES * 60
+WARNING = HOS_WARNING_MINUTES * 60
+
+
+# A clock fed with (status, hours) periods back to back from time 0
+def clock_after(*periods):
+    status, hours = periods[0]
+    clock = DriverClock(status, 0.0, (0.0, 1))
+    at = hours * H
+    for event_id, (status, hours) in enumerate(periods[1:], 2):
+        clock.apply(status, at, (at, event_id))
+        at += hours * H
+    return clock, at
+
+
+def test_rolling_total_drops_periods_leaving_the_window():
+    total = RollingTotal(DAY)
+    total.add(0.0, 2 * H)
+    total.add(5 * H, 6 * H)
+    assert total.value(6 * H) == 3 * H
+    # Half of the first period is still inside the window
+    assert total.value(DAY + H) == pytest.approx(2 * H)
+    assert total.value(DAY + 2 * H) == pytest.approx(H)
+    assert total.value(DAY + 7 * H) == 0.0
+    assert not total.periods
+
+
+def test_driving_leaves_the_24h_window():
+    clock, now = clock_after((DRIVING, 3), (OFF_DUTY, 12))
+    assert clock.evaluate(now)["driving_hours_24h"] == pytest.approx(3)
+    assert clock.evaluate(now + 11 * H)["driving_hours_24h"] == pytest.approx(1)
+    assert clock.evaluate(now + 13 * H)["driving_hours_24h"] == 0.0
+    assert clock.evaluate(now + 13 * H)["driving_hours_7d"] == pytest.approx(3)
+
+
+def test_break_resets_continuous_driving():
+    clock, now = clock_after((DRIVING, 4), (ON_DUTY, BREAK / H), (DRIVING, 1))
+    state = clock.evaluate(now)
+    assert state["continuous_driving_hours"] == pytest.approx(1)
+    assert "continuous_driving" not in state["violations"]
+
+
+def test_short_break_does_not_reset_continuous_driving():
+    clock, now = clock_after((DRIVING, 4), (ON_DUTY, 0.25), (DRIVING, 1))
+    state = clock.evaluate(now)
+    assert state["continuous_driving_hours"] == pytest.approx(5)
+    assert "continuous_driving" in state["violations"]
+
+
+def test_break_in_progress_resets_continuous_driving():
+    clock, now = clock_after((DRIVING, 4), (OFF_DUTY, 0))
+    assert clock.evaluate(now + 10 * 60)["continuous_driving_hours"] == 4
+    assert clock.evaluate(now + BREAK)["continuous_driving_hours"] == 0
+
+
+def test_daily_rest_starts_a_new_duty_period():
+    rest = HOS_DAILY_REST_HOURS
+    clock, now = clock_after(
+        (DRIVING, 4), (ON_DUTY, 1), (DRIVING, 4), (OFF_DUTY, rest), (DRIVING, 2)
+    )
+    state = clock.evaluate(now)
+    assert state["duty_period_driving_hours"] == pytest.approx(2)
+    assert state["duty_period_hours"] == pytest.approx(2)
+    assert not state["violations"]
+
+
+def test_short_rest_keeps_the_duty_period_going():
+    clock, now = clock_after(
+        (DRIVING, 4), (ON_DUTY, 1), (DRIVING, 4), (OFF_DUTY, 8), (DRIVING, 2)
+    )
+    state = clock.evaluate(now)
+    assert state["duty_period_driving_hours"] == pytest.approx(10)
+    assert "daily_driving" in state["violations"]
+    # The duty period started at time 0 and has run past the rest deadline
+    assert "daily_rest" in state["violations"]
+
+
+def test_weekly_rest_resets_hours_since_weekly_rest():
+    weekly_rest = (OFF_DUTY, HOS_WEEKLY_REST_HOURS)
+    clock, now = clock_after((ON_DUTY, 10), weekly_rest, (ON_DUTY, 5))
+    assert clock.evaluate(now)["hours_since_weekly_rest"] == pytest.approx(5)
+    clock, now = clock_after((ON_DUTY, 10), (OFF_DUTY, 40), (ON_DUTY, 5))
+    assert clock.evaluate(now)["hours_since_weekly_rest"] == pytest.approx(55)
+
+
+def test_limits_within_the_warning_are_predicted_then_violated():
+    limit = HOS_CONTINUOUS_DRIVING_HOURS * H
+    clock = DriverClock(DRIVING, 0.0, (0.0, 1))
+    early = clock.evaluate(limit - WARNING - 60)
+    assert not early["violations"] and not early["predicted"]
+    near = clock.evaluate(limit - WARNING / 2)
+    assert near["predicted"] == ["continuous_driving"]
+    assert not near["violations"]
+    assert near["next_review"] == limit - WARNING / 2
+    late = clock.evaluate(limit + 60)
+    assert late["violations"] == ["continuous_driving"]
+    assert late["remaining_driving_hours"] == 0
+
+
+def test_next_review_is_when_the_first_limit_comes_within_the_warning():
+    clock = DriverClock(DRIVING, 0.0, (0.0, 1))
+    state = clock.evaluate(H)
+    assert state["next_review"] == pytest.approx(
+        HOS_CONTINUOUS_DRIVING_HOURS * H - WARNING
+    )
+    # Nothing runs out while resting
+    clock.apply(OFF_DUTY, H, (H, 2))
+    assert clock.evaluate(2 * H)["next_review"] == math.inf
+
+
+def test_listing_skips_clocks_until_their_review_is_due():
+    engine = HosEngine()
+    engine.apply(1, DRIVING, 0.0, 1)
+    engine.apply(2, OFF_DUTY, 0.0, 2)
+    assert engine.non_compliant(H) == []
+    assert engine.evaluated == 2
+    assert engine.non_compliant(2 * H) == []
+    assert engine.evaluated == 2
+
+    due = HOS_CONTINUOUS_DRIVING_HOURS * H - WARNING
+    listed = engine.non_compliant(due + 60)
+    assert [(s["driver_id"], s["predicted"]) for s in listed] == [
+        (1, ["continuous_driving"])
+    ]
+    assert engine.evaluated == 3
+
+    # A new event makes the clock due again
+    engine.apply(2, DRIVING, due, 3)
+    engine.non_compliant(due + 120)
+    assert engine.evaluated == 5
+
+
+def test_events_applied_twice_or_out_of_order_are_ignored():
+    engine = HosEngine()
+    assert engine.apply(1, DRIVING, 0.0, 1)
+    assert engine.apply(1, ON_DUTY, 2 * H, 2)
+    assert not engine.apply(1, ON_DUTY, 2 * H, 2)
+    assert not engine.apply(1, OFF_DUTY, H, 3)
+    assert engine.events == 2
+    state = engine.state(1, now=3 * H)
+    assert state["duty_status"] == ON_DUTY
+    assert state["driving_hours_24h"] == pytest.approx(2)
+
+
+def test_replay_applies_each_new_event_once(db):
+    from models import Driver
+
+    driver = Driver(name="HOS test", license_number=f"HOS-TEST-{id(db)}")
+    db.add(driver)
+    db.flush()
+    start = datetime.utcnow() - timedelta(hours=3)
+    record_duty_event(db, driver, DRIVING, start)
+    db.commit()
+    try:
+        engine = HosEngine.load(db)
+        db.commit()
+        assert engine.state(driver.id)["duty_status"] == DRIVING
+
+        record_duty_event(db, driver, OFF_DUTY, start + timedelta(hours=2))
+        db.commit()
+        # Rows written since the engine's version are read again by the next
+        # replay; only the new one counts
+        assert engine.replay(db) == 1
+        db.commit()
+        assert engine.replay(db) == 0
+        db.commit()
+        state = engine.state(driver.id)
+        assert state["duty_status"] == OFF_DUTY
+        assert state["driving_hours_24h"] == pytest.approx(2)
+    finally:
+        db.rollback()
+        db.delete(db.get(Driver, driver.id))
+        db.commit()
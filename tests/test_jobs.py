@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+from jobs import JOB_STALE_SECONDS, JobQueue
+
+
+def test_stale_jobs_out_of_attempts_fail_instead_of_running_again(db):
+    from database import SessionLocal
+    from models import Job
+
+    heartbeat = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS + 60)
+    jobs = {
+        name: Job(
+            job_type="test_stale",
+            status="running",
+            attempts=attempts,
+            max_attempts=3,
+            cancel_requested=cancel,
+            heartbeat_at=at,
+        )
+        for name, attempts, cancel, at in (
+            ("retry", 1, False, heartbeat),
+            ("last attempt", 3, False, heartbeat),
+            ("cancelling", 1, True, heartbeat),
+            ("alive", 3, False, datetime.utcnow()),
+        )
+    }
+    db.add_all(jobs.values())
+    db.commit()
+    ids = {name: job.job_id for name, job in jobs.items()}
+    try:
+        queue = JobQueue(SessionLocal)
+        queue._maintain()
+        db.expire_all()
+        status = {name: db.get(Job, job_id).status for name, job_id in ids.items()}
+        assert status == {
+            "retry": "queued",
+            "last attempt": "failed",
+            "cancelling": "cancelled",
+            "alive": "running",
+        }
+        assert db.get(Job, ids["last attempt"]).finished_at is not None
+        assert queue.failed == 1
+    finally:
+        db.rollback()
+        db.query(Job).filter(Job.job_id.in_(ids.values())).delete(
+            synchronize_session=False
+        )
+        db.commit()
+
+
+def test_running_jobs_stay_alive_without_reporting_progress(db):
+    import time
+
+    from database import SessionLocal
+    from models import Job
+
+    queue = JobQueue(SessionLocal, workers=0, heartbeat_seconds=0.05)
+    heartbeats = []
+
+    @queue.register("test_heartbeat")
+    def silent(ctx):
+        check = SessionLocal()
+        try:
+            for _ in range(2):
+                time.sleep(0.3)
+                heartbeats.append(
+                    check.query(Job.heartbeat_at)
+                    .filter(Job.job_id == ctx.job_id)
+                    .scalar()
+                )
+                check.rollback()
+        finally:
+            check.close()
+
+    queue.submit(db, "test_heartbeat")
+    db.commit()
+    job = queue._claim()
+    try:
+        claimed_at = job.heartbeat_at
+        queue._execute(job)
+        assert claimed_at < heartbeats[0] < heartbeats[1]
+        db.expire_all()
+        assert db.get(Job, job.job_id).status == "succeeded"
+    finally:
+        db.rollback()
+        db.query(Job).filter(Job.job_type == "test_heartbeat").delete(
+            synchronize_session=False
+        )
+        db.commit()
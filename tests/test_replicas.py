@@ -0,0 +1,61 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+from replicas import ReplicaRouter, parse_lsn
+
+REPLICA_DATABASE = "logistics_saas_replica_test"
+
+
+def test_lsns_compare_as_wal_positions():
+    assert parse_lsn("0/16B3748") < parse_lsn("0/A0000000") < parse_lsn("1/0")
+    with pytest.raises(ValueError):
+        parse_lsn("not a position")
+
+
+# A second database on the local server stands in for the replica: it reports
+# the cluster's WAL position, like a replica that is fully caught up
+@pytest.fixture
+def replica_url(db):
+    url = make_url(str(db.get_bind().url))
+    admin = create_engine(url, isolation_level="AUTOCOMMIT")
+    try:
+        with admin.connect() as conn:
+            conn.execute(text(f"DROP DATABASE IF EXISTS {REPLICA_DATABASE}"))
+            conn.execute(text(f"CREATE DATABASE {REPLICA_DATABASE}"))
+        yield str(url.set(database=REPLICA_DATABASE))
+    finally:
+        with admin.connect() as conn:
+            conn.execute(
+                text(f"DROP DATABASE IF EXISTS {REPLICA_DATABASE} WITH (FORCE)")
+            )
+        admin.dispose()
+
+
+def test_reads_after_a_write_wait_for_the_replica_in_every_worker(db, replica_url):
+    # Two workers, sharing nothing but the position the client carries
+    writer = ReplicaRouter([replica_url], check_seconds=60, primary=db.get_bind())
+    reader = ReplicaRouter([replica_url], check_seconds=60, primary=db.get_bind())
+    replica = reader.replicas[0]
+    try:
+        replica.check_lag()
+        assert replica.lag == 0 and replica.lsn > 0
+        assert reader.choose() is replica
+
+        db.execute(text("SELECT pg_current_xact_id()"))
+        db.commit()
+        position = writer.write_position()
+        assert parse_lsn(position) > replica.lsn
+        # The replica was last seen before the write
+        assert reader.choose(position) is None
+        assert reader.read_after_waits == 1
+        assert reader.choose() is replica
+
+        replica.check_lag()
+        assert reader.choose(position) is replica
+        # A position that cannot be read keeps the reads on the primary
+        assert reader.choose("garbage") is None
+    finally:
+        for router in (writer, reader):
+            for r in router.replicas:
+                r.engine.dispose()
@@ -0,0 +1,56 @@
+import pytest
+
+# Round trips (statements, BEGIN and COMMIT) per request of
+# benchmarks/bench_request_round_trips.py. Before requests ran in one unit of
+# work they took 356 in all; the comments give the old count where it differed.
+ROUND_TRIP_BUDGET = {
+    "login": 5,  # 8
+    "register": 4,  # 11
+    "create user": 5,  # 13
+    "update user": 6,  # 14
+    "delete user": 7,  # 10
+    "create vehicle": 5,  # 13
+    "update vehicle": 6,  # 14
+    "delete vehicle": 9,  # 12
+    "create driver": 5,  # 13
+    "update driver": 6,  # 14
+    "delete driver": 9,  # 12
+    "driver document": 6,  # 13
+    "vehicle document": 6,  # 13
+    "maintenance record": 20,  # 30
+    "workshop": 5,  # 12
+    "unavailability": 13,  # 17
+    "batch": 10,  # 14
+    "create geofence": 5,  # 12
+    "delete geofence": 7,  # 10
+    "resolve fuel alert": 6,  # 13
+    "optimize route": 5,
+    "report": 6,  # 11
+    "cancel job": 5,  # 10
+    "plan maintenance": 5,  # 10
+    "refit forecasts": 5,  # 10
+    "backfill trips": 4,  # 9
+    "plan routes": 4,  # 9
+    "backup": 4,  # 9
+    "restore": 4,  # 9
+    "seed data": 4,  # 6
+}
+
+
+def test_write_endpoints_stay_within_their_round_trip_budget(db):
+    from models import User
+
+    if db.query(User.id).filter(User.username == "admin").first() is None:
+        pytest.skip("the benchmark signs in as the seeded admin")
+    db.rollback()
+    from benchmarks.bench_request_round_trips import measure
+
+    counts = measure()
+    assert set(counts) == set(ROUND_TRIP_BUDGET)
+    assert all(count["status"] < 400 for count in counts.values())
+    over = {
+        name: count["total"]
+        for name, count in counts.items()
+        if count["total"] > ROUND_TRIP_BUDGET[name]
+    }
+    assert not over
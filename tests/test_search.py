@@ -0,0 +1,91 @@
+from search import SearchIndex, build_index, database_search
+
+
+def test_upserts_replace_and_removals_drop_entries():
+    index = SearchIndex()
+    index.upsert("vehicle", 1, "KBZ 123Y", {"registration_number": "KBZ 123Y"})
+    assert [r["id"] for r in index.search("kbz123y")] == [1]
+    index.upsert("vehicle", 1, "KCA 456Z", {"registration_number": "KCA 456Z"})
+    assert index.search("kbz123y") == []
+    assert index.search("KCA 456Z")[0]["value"] == "KCA 456Z"
+    index.remove("vehicle", 1)
+    assert index.search("KCA 456Z") == []
+
+
+def test_small_indexes_find_exact_matches():
+    # Every trigram of a two-entry index is in more than the common share
+    index = SearchIndex()
+    index.upsert("vehicle", 1, "KAA 123A", {"registration_number": "KAA 123A"})
+    index.upsert(
+        "vehicle_document", 7, "Insurance DOC-abc", {"doc_number": "DOC-abc"}
+    )
+    assert [(r["kind"], r["id"]) for r in index.search("DOC-abc")] == [
+        ("vehicle_document", 7)
+    ]
+    assert [r["id"] for r in index.search("KAA 123A")] == [1]
+    assert [r["id"] for r in index.search("kaa")] == [1]
+
+
+def test_replay_applies_changes_and_deletes_from_other_processes(db):
+    from models import Driver, DriverDocument
+
+    tag = f"{id(db):x}"
+    driver = Driver(name=f"Searchable {tag}", license_number=f"SRCH-{tag}")
+    db.add(driver)
+    db.flush()
+    document = DriverDocument(
+        driver_id=driver.id, doc_type="Licence", doc_number=f"DOC-{tag}"
+    )
+    db.add(document)
+    db.commit()
+    driver_id, doc_id = driver.id, document.doc_id
+    try:
+        index = build_index(db)
+        db.commit()
+        assert index.search(f"DOC-{tag}")[0]["id"] == doc_id
+        # Written through another session, as another worker would
+        renamed = f"Renamed {tag}"
+        db.query(Driver).filter(Driver.id == driver_id).update({"name": renamed})
+        db.commit()
+        assert index.replay(db) >= 1
+        db.commit()
+        assert index.search(renamed, kinds=["driver"])[0]["id"] == driver_id
+
+        # Deleting the driver unlinks its document, which must leave the index
+        db.delete(db.get(Driver, driver_id))
+        db.commit()
+        index.replay(db)
+        db.commit()
+        assert index.search(renamed, kinds=["driver"]) == []
+        assert index.search(f"DOC-{tag}") == []
+
+        db.delete(db.get(DriverDocument, doc_id))
+        db.commit()
+        index.replay(db)
+        db.commit()
+        assert ("driver_document", doc_id) not in index.entities
+    finally:
+        db.rollback()
+        db.query(DriverDocument).filter(DriverDocument.doc_id == doc_id).delete()
+        db.query(Driver).filter(Driver.id == driver_id).delete()
+        db.commit()
+
+
+def test_database_search_matches_normalized_substrings(db):
+    from models import Vehicle
+
+    tag = f"{id(db) % 100000:05d}"
+    vehicle = Vehicle(
+        registration_number=f"QX {tag}", vehicle_type="Truck", status="Active"
+    )
+    db.add(vehicle)
+    db.commit()
+    try:
+        results = database_search(db, f"qx{tag}", kinds=["vehicle"])
+        assert results[0]["id"] == vehicle.id
+        assert results[0]["value"] == f"QX {tag}"
+        assert database_search(db, f"qx{tag}", kinds=["driver"]) == []
+    finally:
+        db.rollback()
+        db.delete(vehicle)
+        db.commit()
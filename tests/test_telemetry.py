@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from ingestion import TelemetryPipeline
+from telemetry import (
+    RAW_RETENTION_DAYS,
+    TELEMETRY_FLUSH_RETRIES,
+    TelemetryBuffer,
+    query_history,
+    rollup_rows,
+)
+
+VEHICLE_ID = 987654321
+
+
+def point(at, latitude=1.0, longitude=2.0, speed=10.0, fuel=50.0):
+    return {
+        "vehicle_id": VEHICLE_ID,
+        "recorded_at": at,
+        "latitude": latitude,
+        "longitude": longitude,
+        "speed": speed,
+        "fuel_level": fuel,
+    }
+
+
+def test_rollups_count_only_the_readings_points_have():
+    at = datetime(2026, 10, 19, 12, 0, 5)
+    rows = rollup_rows(
+        [
+            point(at, latitude=4.0, longitude=6.0, fuel=None),
+            point(at + timedelta(seconds=10), latitude=None, longitude=None),
+            point(at + timedelta(seconds=20), speed=None, fuel=40.0),
+        ]
+    )
+    minute = next(row for row in rows if row["resolution"] == "1m")
+    assert minute["samples"] == 3
+    assert minute["position_samples"] == 2
+    assert minute["sum_latitude"] == 5.0
+    assert minute["speed_samples"] == 2
+    assert minute["fuel_samples"] == 2
+    assert minute["sum_fuel_level"] == 90.0
+
+
+class FailingSessions:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        raise RuntimeError("database is down")
+
+
+def test_failed_flushes_keep_the_points_for_a_few_retries():
+    buffer = TelemetryBuffer(FailingSessions())
+    at = datetime.utcnow()
+    buffer.add(VEHICLE_ID, at, 1.0, 2.0, 10.0, 50.0)
+    for _ in range(TELEMETRY_FLUSH_RETRIES):
+        with pytest.raises(RuntimeError):
+            buffer.flush()
+        assert buffer.stats()["buffered"] == 1
+    buffer.add(VEHICLE_ID, at + timedelta(seconds=1), 1.0, 2.0, 10.0, 50.0)
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+    stats = buffer.stats()
+    assert stats["buffered"] == 0
+    assert stats["dropped"] == 2
+    assert stats["failed_flushes"] == TELEMETRY_FLUSH_RETRIES + 1
+
+
+def test_points_outside_the_time_window_are_rejected():
+    pipeline = TelemetryPipeline(FailingSessions())
+    now = datetime.utcnow()
+    reading = (1.0, 2.0, 10.0, 50.0)
+    # A tracker clock years ahead, and a point older than raw retention
+    assert not pipeline.record(VEHICLE_ID, now + timedelta(days=3650), *reading)
+    assert not pipeline.record(
+        VEHICLE_ID, now - timedelta(days=RAW_RETENTION_DAYS + 1), *reading
+    )
+    assert pipeline.record(VEHICLE_ID, now + timedelta(hours=1), *reading)
+    assert pipeline.record(VEHICLE_ID, now + timedelta(hours=2), *reading)
+    # The trip engine kept following the vehicle
+    assert pipeline.trips.vehicles[VEHICLE_ID].last_at == now + timedelta(hours=2)
+    stats = pipeline.buffer.stats()
+    assert stats["rejected"] == 2
+    assert stats["buffered"] == 2
+
+    # Points that reach the buffer directly are checked again when flushed
+    buffer = TelemetryBuffer(FailingSessions())
+    buffer.add(VEHICLE_ID, now + timedelta(days=3650), *reading)
+    # The first flush also runs retention, hence the failing session
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+    stats = buffer.stats()
+    assert stats["rejected"] == 1
+    assert stats["buffered"] == 0
+
+
+def test_points_written_twice_are_rolled_up_once(db):
+    from database import SessionLocal
+    from models import VehicleTelemetry, VehicleTelemetryRollup
+
+    def cleanup():
+        for model in (VehicleTelemetry, VehicleTelemetryRollup):
+            db.query(model).filter(model.vehicle_id == VEHICLE_ID).delete()
+        db.commit()
+
+    minute = datetime.utcnow().replace(second=0, microsecond=0)
+    readings = [
+        (minute + timedelta(seconds=1), 4.0, 6.0, 10.0, None),
+        (minute + timedelta(seconds=2), None, None, 20.0, 40.0),
+    ]
+    cleanup()
+    try:
+        buffer = TelemetryBuffer(SessionLocal)
+        for reading in readings:
+            buffer.add(VEHICLE_ID, *reading)
+        buffer.flush()
+        # A tracker resending the same positions
+        for reading in readings:
+            buffer.add(VEHICLE_ID, *reading)
+        buffer.flush()
+        assert buffer.stats()["written"] == 2
+        assert buffer.stats()["duplicates"] == 2
+
+        resolution, points = query_history(
+            db, minute, minute + timedelta(minutes=1), VEHICLE_ID, "1m"
+        )
+        assert resolution == "1m"
+        assert len(points) == 1
+        assert points[0]["samples"] == 2
+        assert points[0]["latitude"] == 4.0
+        assert points[0]["longitude"] == 6.0
+        assert points[0]["speed"] == 15.0
+        assert points[0]["fuel_level"] == 40.0
+    finally:
+        db.rollback()
+        cleanup()
@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+import pytest
+from sqlalchemy import text
+from starlette.requests import Request
+
+from ingestion import PipelineRegistry
+from tenancy import TenantRouter
+
+
+def sqlite_router(tmp_path, **kwargs):
+    return TenantRouter(
+        mode="database", url_template=f"sqlite:///{tmp_path}/{{tenant}}.db", **kwargs
+    )
+
+
+def test_pools_with_open_sessions_are_not_evicted(tmp_path):
+    router = sqlite_router(tmp_path, max_pools=1)
+    # Not connected yet: nothing is checked out, but the session will be
+    session = router.session_for("a")
+    router.session_for("b").close()
+    assert router.active_tenants() == ["a", "b"]
+
+    assert session.execute(text("SELECT 1")).scalar() == 1
+    session.close()
+    router.session_for("c").close()
+    assert router.active_tenants() == ["c"]
+    assert router.evicted == 2
+    assert router.stats()["sessions"] == 0
+
+
+def test_idle_pools_are_evicted_once_their_sessions_close(tmp_path):
+    router = sqlite_router(tmp_path, idle_seconds=0)
+    session = router.session_for("a")
+    assert router.evict_idle() == 0
+    session.close()
+    # Closing twice hands the lease back once
+    session.close()
+    assert router.stats()["sessions"] == 0
+    assert router.evict_idle() == 1
+    assert router.active_tenants() == []
+
+
+def test_a_long_session_keeps_its_pool_out_of_the_idle_sweep(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("tenancy.time.monotonic", lambda: clock[0])
+    router = sqlite_router(tmp_path, idle_seconds=60)
+    # "a" is opened first but its session is closed last
+    session = router.session_for("a")
+    router.session_for("b").close()
+    clock[0] += 50
+    session.close()
+    clock[0] += 20
+    assert router.active_tenants() == ["b", "a"]
+    assert router.evict_idle() == 1
+    assert router.active_tenants() == ["a"]
+    clock[0] += 50
+    assert router.evict_idle() == 1
+
+
+def request(path, headers=(), query=b""):
+    return Request(
+        {
+            "type": "http",
+            "method": "POST",
+            "path": path,
+            "query_string": query,
+            "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+        }
+    )
+
+
+def test_only_sign_in_and_registration_name_their_tenant(monkeypatch):
+    from main import get_tenant, tenant_router
+    from utils import ALGORITHM, SECRET_KEY
+    from jose import jwt
+
+    monkeypatch.setattr(tenant_router, "mode", "schema")
+    header = [("X-Tenant-ID", "acme")]
+    assert get_tenant(request("/login", header)) == "acme"
+    assert get_tenant(request("/register", query=b"tenant=acme")) == "acme"
+    with pytest.raises(HTTPException) as refused:
+        get_tenant(request("/seed-data", header))
+    assert refused.value.status_code == 401
+
+    claims = {"sub": "device:7", "device": 7, "tenant": "globex"}
+    token = jwt.encode(claims, SECRET_KEY, algorithm=ALGORITHM)
+    signed = [("Authorization", f"Bearer {token}"), *header]
+    assert get_tenant(request("/seed-data", signed)) == "globex"
+
+
+def test_idle_pipelines_are_evicted_after_their_trips_close(db):
+    from database import SessionLocal
+
+    registry = PipelineRegistry(lambda tenant: SessionLocal, idle_seconds=3600)
+    pipeline = registry.get("acme")
+    start = datetime.utcnow() - timedelta(minutes=5)
+    for minute in range(3):
+        pipeline.trips.process(
+            1, start + timedelta(minutes=minute), -1.29 + minute / 100, 36.8, 40.0
+        )
+    assert pipeline.trips.open_trip_vehicle_ids() == [1]
+    registry.get(None)
+
+    pipeline.last_used -= 7200
+    # Still on a trip
+    assert registry.evict_idle() == 0
+    assert registry.get("acme") is pipeline
+
+    # The trip timed out; the lookup above counted as use
+    pipeline.trips.vehicles.clear()
+    assert registry.evict_idle() == 0
+    pipeline.last_used -= 7200
+    registry.pipelines[None].last_used -= 7200
+    # The tenant-less pipeline stays
+    assert registry.evict_idle() == 1
+    assert list(registry.pipelines) == [None]
+    assert registry.get("acme") is not pipeline
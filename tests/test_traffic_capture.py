@@ -0,0 +1,33 @@
+import gzip
+import json
+
+from traffic_capture import TrafficRecorder, process_path
+
+
+def test_trace_paths_are_per_process():
+    assert process_path("traces/trace-{pid}.jsonl.gz", 42) == "traces/trace-42.jsonl.gz"
+    assert process_path("traces/trace.jsonl.gz", 42) == "traces/trace.42.jsonl.gz"
+    assert process_path("trace", 42) == "trace.42"
+
+
+def test_recorders_of_different_processes_write_separate_files(tmp_path, monkeypatch):
+    path = str(tmp_path / "trace.jsonl.gz")
+    recorders = []
+    for pid in (101, 102):
+        monkeypatch.setattr("os.getpid", lambda pid=pid: pid)
+        recorder = TrafficRecorder(path)
+        recorder.start()
+        recorder.record({"kind": "http", "pid": pid})
+        recorders.append(recorder)
+    for recorder in recorders:
+        recorder.stop()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "trace.101.jsonl.gz",
+        "trace.102.jsonl.gz",
+    ]
+    for pid in (101, 102):
+        with gzip.open(tmp_path / f"trace.{pid}.jsonl.gz", "rt") as f:
+            header, entry = [json.loads(line) for line in f]
+        assert header["pid"] == pid
+        assert entry == {"kind": "http", "pid": pid}
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from trips import TRIP_IDLE_TIMEOUT, GeofenceIndex, TripEngine, haversine_km
+
+LAT = -1.3
+LON = 36.8
+STEP = 0.01  # degrees of longitude per minute, about 67 km/h
+DEPOT = 42
+T0 = datetime(2026, 10, 19, 6, 0)
+
+
+def depot_polygon(half=0.005):
+    return [
+        (LAT - half, LON - half),
+        (LAT - half, LON + half),
+        (LAT + half, LON + half),
+        (LAT + half, LON - half),
+    ]
+
+
+# One sample a minute: (longitude, speed) per minute from T0
+def feed(engine, samples, vehicle_id=1):
+    for minute, (lon, speed) in enumerate(samples):
+        engine.process(vehicle_id, T0 + timedelta(minutes=minute), LAT, lon, speed)
+
+
+def drive(lon, steps, direction=1):
+    return [(lon + direction * STEP * i, 60.0) for i in range(1, steps + 1)]
+
+
+def stop(lon, minutes):
+    return [(lon, 0.0)] * minutes
+
+
+def test_stop_go_track_yields_trips_idle_time_and_depot_events():
+    engine = TripEngine()
+    engine.add_geofence(DEPOT, depot_polygon())
+    stopped = int(TRIP_IDLE_TIMEOUT // 60) + 1
+    out = LON + 15 * STEP
+
+    samples = stop(LON, 2)  # parked in the depot
+    samples += drive(LON, 10)  # leaves at minute 2
+    samples += stop(LON + 10 * STEP, 3)  # traffic light: idle inside the trip
+    samples += drive(LON + 10 * STEP, 5)
+    samples += stop(out, stopped)  # long enough to end the trip
+    back = len(samples)
+    samples += drive(out, 15, direction=-1)  # back into the depot
+    samples += stop(LON, stopped)
+    feed(engine, samples)
+
+    trips, events = engine.drain()
+    assert len(trips) == 2
+    leg = 15 * haversine_km(LAT, LON, LAT, LON + STEP)
+    outbound, inbound = trips
+    # A trip starts at the sample before the first move and ends at the last move
+    assert outbound["started_at"] == T0 + timedelta(minutes=1)
+    assert outbound["ended_at"] == T0 + timedelta(minutes=19)
+    assert outbound["distance_km"] == pytest.approx(leg)
+    assert outbound["idle_seconds"] == 180
+    assert outbound["duration_seconds"] == 18 * 60
+    assert outbound["end_longitude"] == pytest.approx(out)
+
+    assert inbound["started_at"] == T0 + timedelta(minutes=back - 1)
+    assert inbound["ended_at"] == T0 + timedelta(minutes=back + 14)
+    assert inbound["distance_km"] == pytest.approx(leg)
+    assert inbound["idle_seconds"] == 0
+    assert inbound["end_longitude"] == pytest.approx(LON)
+
+    assert [(e["event_type"], e["occurred_at"]) for e in events] == [
+        ("exit", T0 + timedelta(minutes=2)),
+        ("enter", T0 + timedelta(minutes=back + 14)),
+    ]
+    assert {e["geofence_id"] for e in events} == {DEPOT}
+    assert engine.open_trip(1) is None
+
+
+def test_short_moves_and_gaps_do_not_make_trips():
+    engine = TripEngine()
+    # Creeping across the yard stays under the minimum trip distance
+    feed(engine, stop(LON, 1) + [(LON + 0.001, 10.0)] + stop(LON + 0.001, 11))
+    assert engine.drain() == ([], [])
+
+    # A vehicle that goes silent mid-trip gets the trip closed when it is stale
+    feed(engine, stop(LON, 1) + drive(LON, 5), vehicle_id=2)
+    assert engine.open_trip(2)["distance_km"] == pytest.approx(
+        5 * haversine_km(LAT, LON, LAT, LON + STEP)
+    )
+    engine.close_stale(T0 + timedelta(hours=1))
+    trips, _ = engine.drain()
+    assert [t["vehicle_id"] for t in trips] == [2]
+    assert engine.open_trip(2) is None
+
+
+def test_geofence_index_finds_only_the_containing_fences():
+    index = GeofenceIndex(cell_degrees=0.01)
+    index.add(1, depot_polygon(0.02))
+    index.add(2, depot_polygon(0.005))
+    assert index.containing(LAT, LON) == {1, 2}
+    assert index.containing(LAT + 0.01, LON) == {1}
+    assert index.containing(LAT + 0.05, LON) == frozenset()
+    index.remove(1)
+    assert index.containing(LAT + 0.01, LON) == frozenset()
+    assert index.containing(LAT, LON) == {2}
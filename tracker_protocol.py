@@ -0,0 +1,244 @@
+from datetime import datetime
+import os
+import struct
+import time
+
+import numpy as np
+from psycopg2.extras import execute_values
+from sqlalchemy import text
+
+# Binary telemetry framing for /ws/updates, for trackers on metered links.
+#
+# A frame is an 8 byte header followed by `count` packed 20 byte records, all
+# little endian:
+#
+#   header  u8 version (1) | u8 kind (1) | u16 count | u32 sequence
+#   record  u32 vehicle_id | u32 timestamp (epoch seconds, 0: arrival time)
+#           i32 latitude, i32 longitude (1e-7 degrees)
+#           u16 speed (0.01 km/h) | u16 fuel_level (0.01 %)
+#
+# A coordinate of -2^31 or a speed or fuel level of 0xFFFF means "not
+# reported": the vehicle keeps its previous value, like a missing JSON key.
+#
+# The server acknowledges cumulatively with a 16 byte ack:
+#
+#   u8 version (1) | u8 kind (2) | u16 0 | u32 sequence
+#   u32 records accepted | u32 records rejected (since the previous ack)
+#
+# meaning every frame up to `sequence` has been processed. Trackers resend
+# what was not acknowledged when they reconnect; a repeated point is stored
+# once.
+PROTOCOL_VERSION = 1
+KIND_TELEMETRY = 1
+KIND_ACK = 2
+HEADER = struct.Struct("<BBHI")
+ACK = struct.Struct("<BBHIII")
+RECORD_DTYPE = np.dtype(
+    [
+        ("vehicle_id", "<u4"),
+        ("timestamp", "<u4"),
+        ("latitude", "<i4"),
+        ("longitude", "<i4"),
+        ("speed", "<u2"),
+        ("fuel_level", "<u2"),
+    ]
+)
+MAX_RECORDS = 0xFFFF
+# Fixed point units per degree and per km/h or percent
+COORDINATE_UNITS = 10**7
+GAUGE_UNITS = 100
+MISSING_COORDINATE = np.iinfo(np.int32).min
+MISSING_GAUGE = 0xFFFF
+POSITION_FIELDS = ("latitude", "longitude", "speed", "fuel_level")
+
+# An ack is sent after this many frames, or this long after the oldest
+# unacknowledged frame
+BINARY_ACK_FRAMES = int(os.getenv("TELEMETRY_BINARY_ACK_FRAMES", "8"))
+BINARY_ACK_SECONDS = float(os.getenv("TELEMETRY_BINARY_ACK_SECONDS", "0.5"))
+
+
+class FrameError(ValueError):
+    pass
+
+
+# Returns the sequence number and a read-only structured array over the
+# frame's own bytes; nothing is copied
+def decode_frame(data) -> tuple:
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise FrameError("Frame shorter than its header")
+    version, kind, count, sequence = HEADER.unpack_from(view)
+    if version != PROTOCOL_VERSION or kind != KIND_TELEMETRY:
+        raise FrameError(f"Unsupported frame version {version} kind {kind}")
+    if len(view) != HEADER.size + count * RECORD_DTYPE.itemsize:
+        raise FrameError(f"Frame length does not match {count} records")
+    records = np.frombuffer(view, dtype=RECORD_DTYPE, count=count, offset=HEADER.size)
+    return sequence, records
+
+
+def encode_frame(sequence: int, records: np.ndarray) -> bytes:
+    if len(records) > MAX_RECORDS:
+        raise FrameError(f"At most {MAX_RECORDS} records per frame")
+    header = HEADER.pack(PROTOCOL_VERSION, KIND_TELEMETRY, len(records), sequence)
+    return header + records.astype(RECORD_DTYPE, copy=False).tobytes()
+
+
+# Records from (vehicle_id, epoch seconds, latitude, longitude, speed,
+# fuel_level) tuples; None for a value that is not reported
+def pack_records(points) -> np.ndarray:
+    records = np.zeros(len(points), dtype=RECORD_DTYPE)
+    for i, (vehicle_id, timestamp, lat, lon, speed, fuel) in enumerate(points):
+        records[i] = (
+            vehicle_id,
+            int(timestamp or 0),
+            MISSING_COORDINATE if lat is None else round(lat * COORDINATE_UNITS),
+            MISSING_COORDINATE if lon is None else round(lon * COORDINATE_UNITS),
+            MISSING_GAUGE if speed is None else round(speed * GAUGE_UNITS),
+            MISSING_GAUGE if fuel is None else round(fuel * GAUGE_UNITS),
+        )
+    return records
+
+
+def encode_ack(sequence: int, accepted: int, rejected: int) -> bytes:
+    return ACK.pack(PROTOCOL_VERSION, KIND_ACK, 0, sequence, accepted, rejected)
+
+
+def decode_ack(data) -> tuple:
+    version, kind, _, sequence, accepted, rejected = ACK.unpack(data)
+    if version != PROTOCOL_VERSION or kind != KIND_ACK:
+        raise FrameError(f"Unsupported ack version {version} kind {kind}")
+    return sequence, accepted, rejected
+
+
+# Scaled float columns, NaN where a value was not reported
+def record_values(records: np.ndarray) -> dict:
+    values = {}
+    for field in ("latitude", "longitude"):
+        raw = records[field]
+        values[field] = np.where(
+            raw == MISSING_COORDINATE, np.nan, raw / COORDINATE_UNITS
+        )
+    for field in ("speed", "fuel_level"):
+        raw = records[field]
+        values[field] = np.where(raw == MISSING_GAUGE, np.nan, raw / GAUGE_UNITS)
+    return values
+
+
+def _valid(records: np.ndarray, values: dict) -> np.ndarray:
+    lat, lon = values["latitude"], values["longitude"]
+    return (
+        (records["vehicle_id"] > 0)
+        & (np.isnan(lat) | (np.abs(lat) <= 90))
+        & (np.isnan(lon) | (np.abs(lon) <= 180))
+    )
+
+
+def _current_positions(db, vehicle_ids):
+    rows = db.execute(
+        text(
+            "SELECT id, latitude, longitude, speed, fuel_level FROM vehicles "
+            "WHERE id = ANY(:ids)"
+        ),
+        {"ids": vehicle_ids},
+    )
+    return {row[0]: list(row[1:]) for row in rows}
+
+
+# Frames processed on one connection since its last ack
+class AckWindow:
+    def __init__(self):
+        self.frames = 0
+        self.sequence = None
+        self.accepted = 0
+        self.rejected = 0
+        self.opened_at = None
+
+    def add(self, sequence: int, accepted: int, rejected: int):
+        if self.frames == 0:
+            self.opened_at = time.monotonic()
+        self.frames += 1
+        self.sequence = sequence
+        self.accepted += accepted
+        self.rejected += rejected
+
+    # Seconds until an ack is due, None while there is nothing to acknowledge
+    def timeout(self):
+        if self.frames == 0:
+            return None
+        if self.frames >= BINARY_ACK_FRAMES:
+            return 0.0
+        return max(0.0, self.opened_at + BINARY_ACK_SECONDS - time.monotonic())
+
+    def take_ack(self) -> bytes:
+        ack = encode_ack(self.sequence, self.accepted, self.rejected)
+        self.frames = self.accepted = self.rejected = 0
+        return ack
+
+
+# Frames, records and bytes taken in over the binary protocol, per process
+class BinaryTelemetry:
+    def __init__(self):
+        self.frames = 0
+        self.records = 0
+        self.rejected = 0
+        self.bytes = 0
+
+    # Updates the vehicles' current positions with one statement and feeds
+    # every point to the pipeline in frame order. Returns (accepted, rejected).
+    def apply(self, db, pipeline, frame_bytes: int, records: np.ndarray):
+        values = record_values(records)
+        valid = _valid(records, values)
+        vehicle_ids = records["vehicle_id"]
+        current = _current_positions(db, np.unique(vehicle_ids[valid]).tolist())
+        now = datetime.utcnow()
+        accepted = 0
+        columns = [values[field].tolist() for field in POSITION_FIELDS]
+        valid = valid.tolist()
+        for i, (vehicle_id, timestamp) in enumerate(
+            zip(vehicle_ids.tolist(), records["timestamp"].tolist())
+        ):
+            state = current.get(vehicle_id)
+            if state is None or not valid[i]:
+                continue
+            for k, column in enumerate(columns):
+                value = column[i]
+                if value == value:  # not NaN
+                    state[k] = value
+            accepted += pipeline.record(
+                vehicle_id,
+                datetime.utcfromtimestamp(timestamp) if timestamp else now,
+                *state,
+            )
+        if current:
+            cursor = db.connection().connection.cursor()
+            try:
+                execute_values(
+                    cursor,
+                    "UPDATE vehicles AS t SET latitude = v.latitude, "
+                    "longitude = v.longitude, speed = v.speed, "
+                    "fuel_level = v.fuel_level "
+                    "FROM (VALUES %s) AS v(id, latitude, longitude, speed, fuel_level) "
+                    "WHERE t.id = v.id",
+                    [(vehicle_id, *state) for vehicle_id, state in current.items()],
+                    template="(%s, %s::float8, %s::float8, %s::float8, %s::float8)",
+                )
+            finally:
+                cursor.close()
+        db.commit()
+        rejected = len(records) - accepted
+        self.frames += 1
+        self.records += accepted
+        self.rejected += rejected
+        self.bytes += frame_bytes
+        return accepted, rejected
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "records": self.records,
+            "rejected": self.rejected,
+            "bytes": self.bytes,
+        }
+
+
+binary_telemetry = BinaryTelemetry()
@@ -0,0 +1,377 @@
+import gzip
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from urllib.parse import parse_qsl
+
+# Opt-in capture of the shape and timing of every request and WebSocket
+# connection, for replaying production load against a local instance with
+# benchmarks/replay_traffic.py. Off unless TRAFFIC_CAPTURE_PATH is set. Each
+# process writes its own file, since workers appending to one file would
+# interleave their gzip streams: "{pid}" in the path is replaced by the process
+# id, and paths without it get the id before their extensions
+# (traces/trace.jsonl.gz becomes traces/trace.<pid>.jsonl.gz).
+#
+# A trace is gzipped JSON lines: one header line per capture run, then one line
+# per request or connection, e.g.
+#
+#   {"t": 1792300000.123, "kind": "http", "method": "GET",
+#    "route": "/vehicles/{vehicle_id}", "params": {"vehicle_id": "12"},
+#    "query": [["limit", "50"]], "auth": true, "request_bytes": 0,
+#    "status": 200, "response_bytes": 412, "duration": 0.0042}
+#
+# Headers are never recorded and neither are bodies unless
+# TRAFFIC_CAPTURE_BODIES is on (JSON and form bodies only). Values of the
+# TRAFFIC_REDACT_FIELDS keys in query strings, path parameters and bodies are
+# replaced by REDACTED.
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH", "")
+# Fraction of requests and connections captured
+TRAFFIC_CAPTURE_SAMPLE = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE", "1.0"))
+TRAFFIC_CAPTURE_BODIES = os.getenv("TRAFFIC_CAPTURE_BODIES", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+TRAFFIC_CAPTURE_MAX_BODY = int(os.getenv("TRAFFIC_CAPTURE_MAX_BODY", "65536"))
+# Capture stops once the compressed trace reaches this size
+TRAFFIC_CAPTURE_MAX_MB = float(os.getenv("TRAFFIC_CAPTURE_MAX_MB", "512"))
+TRAFFIC_CAPTURE_QUEUE_SIZE = int(os.getenv("TRAFFIC_CAPTURE_QUEUE_SIZE", "10000"))
+TRAFFIC_REDACT_FIELDS = os.getenv(
+    "TRAFFIC_REDACT_FIELDS",
+    "password,token,access_token,refresh_token,secret,authorization,api_key,"
+    "license_number,phone,email",
+)
+TRACE_FORMAT = 1
+REDACTED = "***"
+FLUSH_SECONDS = 1.0
+
+
+def parse_fields(spec: str):
+    return frozenset(f.strip().lower() for f in spec.split(",") if f.strip())
+
+
+REDACT_FIELDS = parse_fields(TRAFFIC_REDACT_FIELDS)
+
+
+def redact(value, fields=REDACT_FIELDS):
+    if isinstance(value, dict):
+        return {
+            k: REDACTED if str(k).lower() in fields else redact(v, fields)
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(v, fields) for v in value]
+    return value
+
+
+def redact_pairs(pairs, fields=REDACT_FIELDS):
+    return [[k, REDACTED if k.lower() in fields else v] for k, v in pairs]
+
+
+# The decoded, redacted body, or None for bodies that are not JSON or form data
+def capture_body(content_type: str, body: bytes, fields=REDACT_FIELDS):
+    content_type = content_type.split(";")[0].strip().lower()
+    try:
+        if content_type == "application/json":
+            return {"json": redact(json.loads(body), fields)}
+        if content_type == "application/x-www-form-urlencoded":
+            pairs = parse_qsl(body.decode("latin-1"), keep_blank_values=True)
+            return {"form": redact_pairs(pairs, fields)}
+    except ValueError:
+        pass
+    return None
+
+
+def _header(scope, name: bytes) -> str:
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return ""
+
+
+# Route template and path parameters of a served request. FastAPI puts the
+# matched route in the scope; requests no route matched keep their raw path.
+def _route(scope, fields):
+    route = scope.get("route")
+    if route is None:
+        return {"route": None, "path": scope.get("path")}
+    params = {
+        k: REDACTED if k.lower() in fields else str(v)
+        for k, v in scope.get("path_params", {}).items()
+    }
+    return {"route": route.path, "params": params}
+
+
+def _shape(scope, fields):
+    query = parse_qsl(
+        scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True
+    )
+    return {
+        **_route(scope, fields),
+        "query": redact_pairs(query, fields),
+        "auth": bool(
+            _header(scope, b"authorization")
+            or any(k == "token" for k, _ in query)
+        ),
+    }
+
+
+def process_path(path: str, pid: int) -> str:
+    if "{pid}" in path:
+        return path.replace("{pid}", str(pid))
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition(".")
+    return os.path.join(directory, f"{stem}.{pid}{dot}{extensions}")
+
+
+# Appends captured entries to the trace from a writer thread; request handling
+# only queues them and never blocks, dropping entries when the writer falls
+# behind
+class TrafficRecorder:
+    def __init__(
+        self,
+        path: str = TRAFFIC_CAPTURE_PATH,
+        sample: float = TRAFFIC_CAPTURE_SAMPLE,
+        bodies: bool = TRAFFIC_CAPTURE_BODIES,
+        max_body: int = TRAFFIC_CAPTURE_MAX_BODY,
+        max_bytes: int = int(TRAFFIC_CAPTURE_MAX_MB * 1024 * 1024),
+        fields=REDACT_FIELDS,
+    ):
+        self.path = process_path(path, os.getpid()) if path else ""
+        self.sample = sample
+        self.bodies = bodies
+        self.max_body = max_body
+        self.max_bytes = max_bytes
+        self.fields = fields
+        self.queue = queue.Queue(TRAFFIC_CAPTURE_QUEUE_SIZE)
+        self.captured = 0
+        self.written = 0
+        self.dropped = 0
+        self.full = False
+        self._raw = None
+        self._file = None
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def sampled(self) -> bool:
+        if not self.enabled or self.full:
+            return False
+        return self.sample >= 1.0 or random.random() < self.sample
+
+    def record(self, entry: dict):
+        try:
+            self.queue.put_nowait(entry)
+            self.captured += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Each run appends its own gzip member; readers see one stream
+        self._raw = open(self.path, "ab")
+        self._file = gzip.GzipFile(fileobj=self._raw, mode="wb")
+        self._write(
+            {
+                "trace": TRACE_FORMAT,
+                "started_at": time.time(),
+                "pid": os.getpid(),
+                "sample": self.sample,
+                "bodies": self.bodies,
+                "redacted": sorted(self.fields),
+            }
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="traffic-capture", daemon=True
+        )
+        self._thread.start()
+        logging.info(f"Capturing traffic to {self.path}")
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        self._raw.close()
+        self._file = self._raw = None
+
+    def _run(self):
+        flushed = time.monotonic()
+        while True:
+            try:
+                entry = self.queue.get(timeout=FLUSH_SECONDS)
+            except queue.Empty:
+                entry = False
+            if entry is None:
+                break
+            try:
+                if entry:
+                    self._write(entry)
+                    self.written += 1
+                if time.monotonic() - flushed >= FLUSH_SECONDS:
+                    # Readable up to here while the capture is still running
+                    self._file.flush()
+                    flushed = time.monotonic()
+                    if self._raw.tell() >= self.max_bytes and not self.full:
+                        self.full = True
+                        logging.warning(
+                            f"Traffic capture stopped: {self.path} reached "
+                            f"{self.max_bytes // (1024 * 1024)} MB"
+                        )
+            except Exception as e:
+                logging.error(f"Traffic capture write failed: {e}")
+
+    def _write(self, entry: dict):
+        line = json.dumps(entry, separators=(",", ":"), default=str) + "\n"
+        self._file.write(line.encode("utf-8"))
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "path": self.path or None,
+            "captured": self.captured,
+            "written": self.written,
+            "dropped": self.dropped,
+            "queued": self.queue.qsize(),
+            "full": self.full,
+            "trace_bytes": self._raw.tell() if self._raw is not None else 0,
+        }
+
+
+traffic_recorder = TrafficRecorder()
+
+
+# Pure ASGI middleware, so it sees WebSocket connections too and adds no task
+# per request. Added outermost, so shed requests and the time spent in the
+# other middleware count.
+class TrafficCapture:
+    def __init__(self, app, recorder: TrafficRecorder = traffic_recorder):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and self.recorder.sampled():
+            await self._http(scope, receive, send)
+        elif scope["type"] == "websocket" and self.recorder.sampled():
+            await self._websocket(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+    async def _http(self, scope, receive, send):
+        recorder = self.recorder
+        started = time.time()
+        clock = time.perf_counter()
+        content_type = _header(scope, b"content-type")
+        body = bytearray() if recorder.bodies else None
+        request_bytes = 0
+        response = {"status": None, "bytes": 0}
+
+        async def capture_receive():
+            nonlocal body, request_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                request_bytes += len(chunk)
+                if body is not None:
+                    if len(body) + len(chunk) > recorder.max_body:
+                        body = None
+                    else:
+                        body += chunk
+            return message
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            entry = {
+                "t": round(started, 6),
+                "kind": "http",
+                "method": scope["method"],
+                **_shape(scope, recorder.fields),
+                "content_type": content_type.split(";")[0] or None,
+                # Endpoints that never read their body still declare its size
+                "request_bytes": request_bytes
+                or int(_header(scope, b"content-length") or 0),
+                "status": response["status"] or 500,
+                "response_bytes": response["bytes"],
+                "duration": round(time.perf_counter() - clock, 6),
+            }
+            if body:
+                captured = capture_body(content_type, bytes(body), recorder.fields)
+                if captured is not None:
+                    entry["body"] = captured
+            recorder.record(entry)
+
+    # Message counts, sizes and the span between the first and last message
+    # each way; the replay spreads the messages evenly over that span
+    async def _websocket(self, scope, receive, send):
+        started = time.time()
+        clock = time.perf_counter()
+        received = {"text": 0, "binary": 0, "bytes": 0, "first": None, "last": None}
+        sent = {"text": 0, "binary": 0, "bytes": 0, "first": None, "last": None}
+        state = {"accepted": False, "close_code": None}
+
+        def count(counts, message):
+            at = round(time.perf_counter() - clock, 6)
+            if message.get("bytes") is not None:
+                counts["binary"] += 1
+                counts["bytes"] += len(message["bytes"])
+            else:
+                counts["text"] += 1
+                counts["bytes"] += len((message.get("text") or "").encode("utf-8"))
+            if counts["first"] is None:
+                counts["first"] = at
+            counts["last"] = at
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "websocket.receive":
+                count(received, message)
+            elif message["type"] == "websocket.disconnect":
+                if state["close_code"] is None:
+                    state["close_code"] = message.get("code", 1000)
+            return message
+
+        async def capture_send(message):
+            if message["type"] == "websocket.accept":
+                state["accepted"] = True
+            elif message["type"] == "websocket.send":
+                count(sent, message)
+            elif message["type"] == "websocket.close":
+                if state["close_code"] is None:
+                    state["close_code"] = message.get("code", 1000)
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            self.recorder.record(
+                {
+                    "t": round(started, 6),
+                    "kind": "websocket",
+                    **_shape(scope, self.recorder.fields),
+                    "accepted": state["accepted"],
+                    "close_code": state["close_code"],
+                    "received": received,
+                    "sent": sent,
+                    "duration": round(time.perf_counter() - clock, 6),
+                }
+            )
@@ -0,0 +1,386 @@
+from datetime import datetime
+import json
+import logging
+import math
+import os
+import threading
+
+from models import Geofence, GeofenceEvent, Trip, VehicleTelemetry
+
+TRIP_MOVING_SPEED = float(os.getenv("TRIP_MOVING_SPEED", "5"))  # km/h
+TRIP_IDLE_TIMEOUT = float(os.getenv("TRIP_IDLE_TIMEOUT", "600"))  # seconds
+TRIP_MAX_GAP = float(os.getenv("TRIP_MAX_GAP", "1800"))  # seconds without data
+TRIP_MIN_DISTANCE = float(os.getenv("TRIP_MIN_DISTANCE", "0.2"))  # km
+GEOFENCE_CELL_DEGREES = float(os.getenv("GEOFENCE_CELL_DEGREES", "0.05"))
+STALE_CHECK_SECONDS = 60
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = (
+        math.sin(dphi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def point_in_polygon(lat, lon, polygon):
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lon_i = polygon[i]
+        lat_j, lon_j = polygon[j]
+        if (lon_i > lon) != (lon_j > lon):
+            cross = (lat_j - lat_i) * (lon - lon_i) / (lon_j - lon_i) + lat_i
+            if lat < cross:
+                inside = not inside
+        j = i
+    return inside
+
+
+# Uniform grid over polygon bounding boxes: a lookup touches one cell and only
+# runs the point-in-polygon test for the few fences registered there.
+class GeofenceIndex:
+    def __init__(self, cell_degrees: float = GEOFENCE_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.fences = {}
+        self.cells = {}
+
+    def _cell(self, lat, lon):
+        return (
+            int(math.floor(lat / self.cell_degrees)),
+            int(math.floor(lon / self.cell_degrees)),
+        )
+
+    def _cells_for(self, bbox):
+        min_lat, min_lon, max_lat, max_lon = bbox
+        low = self._cell(min_lat, min_lon)
+        high = self._cell(max_lat, max_lon)
+        for i in range(low[0], high[0] + 1):
+            for j in range(low[1], high[1] + 1):
+                yield (i, j)
+
+    def add(self, geofence_id: int, polygon):
+        self.remove(geofence_id)
+        polygon = [(float(lat), float(lon)) for lat, lon in polygon]
+        lats = [p[0] for p in polygon]
+        lons = [p[1] for p in polygon]
+        bbox = (min(lats), min(lons), max(lats), max(lons))
+        self.fences[geofence_id] = (bbox, polygon)
+        for cell in self._cells_for(bbox):
+            self.cells.setdefault(cell, []).append(geofence_id)
+
+    def remove(self, geofence_id: int):
+        fence = self.fences.pop(geofence_id, None)
+        if fence is None:
+            return
+        for cell in self._cells_for(fence[0]):
+            ids = self.cells.get(cell)
+            if ids and geofence_id in ids:
+                ids.remove(geofence_id)
+                if not ids:
+                    del self.cells[cell]
+
+    def containing(self, lat, lon):
+        ids = self.cells.get(self._cell(lat, lon))
+        if not ids:
+            return frozenset()
+        found = []
+        for geofence_id in ids:
+            fence = self.fences.get(geofence_id)
+            if fence is None:
+                # Removed by another thread (a backfill shares the live index)
+                continue
+            (min_lat, min_lon, max_lat, max_lon), polygon = fence
+            if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                if point_in_polygon(lat, lon, polygon):
+                    found.append(geofence_id)
+        return frozenset(found)
+
+
+class _VehicleState:
+    __slots__ = (
+        "last_at",
+        "last_lat",
+        "last_lon",
+        "in_trip",
+        "started_at",
+        "start_lat",
+        "start_lon",
+        "moving_at",
+        "moving_lat",
+        "moving_lon",
+        "distance",
+        "moving_distance",
+        "idle",
+        "pending_idle",
+        "geofences",
+    )
+
+    def __init__(self, at, lat, lon, geofences):
+        self.last_at = at
+        self.last_lat = lat
+        self.last_lon = lon
+        self.in_trip = False
+        self.geofences = geofences
+
+
+# Segments position updates into trips and geofence enter/exit events.
+# State is kept per vehicle so each update is O(1) plus one grid cell lookup.
+class TripEngine:
+    def __init__(self, geofences: GeofenceIndex = None):
+        self.geofences = geofences or GeofenceIndex()
+        self.vehicles = {}
+        self.completed = []
+        self.events = []
+        self._lock = threading.Lock()
+        self._last_stale_check = datetime.utcnow()
+
+    def process(self, vehicle_id: int, at: datetime, lat, lon, speed):
+        if lat is None or lon is None:
+            return
+        with self._lock:
+            self._process(vehicle_id, at, lat, lon, speed)
+
+    def process_many(self, points):
+        with self._lock:
+            for vehicle_id, at, lat, lon, speed in points:
+                if lat is not None and lon is not None:
+                    self._process(vehicle_id, at, lat, lon, speed)
+
+    def _process(self, vehicle_id, at, lat, lon, speed):
+        fences = frozenset()
+        if self.geofences.fences:
+            fences = self.geofences.containing(lat, lon)
+        state = self.vehicles.get(vehicle_id)
+        if state is None:
+            # First sighting: no events, we do not know where the vehicle came from
+            self.vehicles[vehicle_id] = _VehicleState(at, lat, lon, fences)
+            return
+        dt = (at - state.last_at).total_seconds()
+        if dt <= 0:
+            return
+
+        if fences != state.geofences:
+            for geofence_id in fences - state.geofences:
+                self.events.append(
+                    {
+                        "geofence_id": geofence_id,
+                        "vehicle_id": vehicle_id,
+                        "event_type": "enter",
+                        "occurred_at": at,
+                        "latitude": lat,
+                        "longitude": lon,
+                    }
+                )
+            for geofence_id in state.geofences - fences:
+                self.events.append(
+                    {
+                        "geofence_id": geofence_id,
+                        "vehicle_id": vehicle_id,
+                        "event_type": "exit",
+                        "occurred_at": at,
+                        "latitude": lat,
+                        "longitude": lon,
+                    }
+                )
+            state.geofences = fences
+
+        if state.in_trip and dt > TRIP_MAX_GAP:
+            self._end_trip(vehicle_id, state)
+        step = haversine_km(state.last_lat, state.last_lon, lat, lon)
+        if speed is None:
+            speed = step / (dt / 3600.0)
+        moving = speed >= TRIP_MOVING_SPEED
+
+        if state.in_trip:
+            state.distance += step
+            if moving:
+                state.idle += state.pending_idle
+                state.pending_idle = 0.0
+                state.moving_at = at
+                state.moving_lat = lat
+                state.moving_lon = lon
+                state.moving_distance = state.distance
+            else:
+                state.pending_idle += dt
+                if (at - state.moving_at).total_seconds() >= TRIP_IDLE_TIMEOUT:
+                    self._end_trip(vehicle_id, state)
+        elif moving:
+            state.in_trip = True
+            if dt <= TRIP_MAX_GAP:
+                state.started_at = state.last_at
+                state.start_lat = state.last_lat
+                state.start_lon = state.last_lon
+                state.distance = step
+            else:
+                state.started_at = at
+                state.start_lat = lat
+                state.start_lon = lon
+                state.distance = 0.0
+            state.moving_at = at
+            state.moving_lat = lat
+            state.moving_lon = lon
+            state.moving_distance = state.distance
+            state.idle = 0.0
+            state.pending_idle = 0.0
+
+        state.last_at = at
+        state.last_lat = lat
+        state.last_lon = lon
+
+    def _end_trip(self, vehicle_id, state):
+        # The trip ends at the last moving sample; trailing idle time is not part of it
+        state.in_trip = False
+        duration = (state.moving_at - state.started_at).total_seconds()
+        distance = state.moving_distance
+        if distance < TRIP_MIN_DISTANCE or duration <= 0:
+            return
+        self.completed.append(
+            {
+                "vehicle_id": vehicle_id,
+                "started_at": state.started_at,
+                "ended_at": state.moving_at,
+                "start_latitude": state.start_lat,
+                "start_longitude": state.start_lon,
+                "end_latitude": state.moving_lat,
+                "end_longitude": state.moving_lon,
+                "distance_km": distance,
+                "duration_seconds": duration,
+                "idle_seconds": state.idle,
+                "avg_speed": distance / (duration / 3600.0),
+            }
+        )
+
+    def close_stale(self, now: datetime):
+        # Vehicles that stopped reporting mid-trip still get their trip closed
+        with self._lock:
+            for vehicle_id, state in self.vehicles.items():
+                if not state.in_trip:
+                    continue
+                silent = (now - state.last_at).total_seconds()
+                idle = (now - state.moving_at).total_seconds()
+                if silent > TRIP_MAX_GAP or idle >= TRIP_IDLE_TIMEOUT:
+                    self._end_trip(vehicle_id, state)
+
+    # Fence changes go through the engine so a lookup never sees a fence half
+    # removed, and a deleted fence leaves no exit event behind for its row
+    def add_geofence(self, geofence_id: int, polygon):
+        with self._lock:
+            self.geofences.add(geofence_id, polygon)
+
+    def remove_geofence(self, geofence_id: int):
+        with self._lock:
+            self.geofences.remove(geofence_id)
+            for state in self.vehicles.values():
+                if geofence_id in state.geofences:
+                    state.geofences = state.geofences - {geofence_id}
+            self.events = [e for e in self.events if e["geofence_id"] != geofence_id]
+
+    def open_trip(self, vehicle_id: int):
+        with self._lock:
+            state = self.vehicles.get(vehicle_id)
+            if state is None or not state.in_trip:
+                return None
+            duration = (state.last_at - state.started_at).total_seconds()
+            return {
+                "vehicle_id": vehicle_id,
+                "started_at": state.started_at,
+                "ended_at": None,
+                "start_latitude": state.start_lat,
+                "start_longitude": state.start_lon,
+                "end_latitude": state.last_lat,
+                "end_longitude": state.last_lon,
+                "distance_km": state.distance,
+                "duration_seconds": duration,
+                "idle_seconds": state.idle + state.pending_idle,
+                "avg_speed": state.distance / (duration / 3600.0) if duration else 0.0,
+            }
+
+    def open_trip_vehicle_ids(self):
+        with self._lock:
+            return [v for v, state in self.vehicles.items() if state.in_trip]
+
+    def drain(self):
+        with self._lock:
+            trips, self.completed = self.completed, []
+            events, self.events = self.events, []
+        return trips, events
+
+    def has_pending(self) -> bool:
+        now = datetime.utcnow()
+        if (now - self._last_stale_check).total_seconds() >= STALE_CHECK_SECONDS:
+            self.close_stale(now)
+            self._last_stale_check = now
+        return bool(self.completed or self.events)
+
+    def flush(self, db):
+        trips, events = self.drain()
+        if trips:
+            db.bulk_insert_mappings(Trip, trips)
+        if events:
+            db.bulk_insert_mappings(GeofenceEvent, events)
+
+
+def load_geofences(db, index: GeofenceIndex):
+    for geofence in db.query(Geofence).all():
+        index.add(geofence.geofence_id, json.loads(geofence.polygon))
+    return index
+
+
+def backfill(
+    db,
+    geofences: GeofenceIndex,
+    start: datetime,
+    end: datetime,
+    vehicle_id: int = None,
+    batch_size: int = 5000,
+):
+    # Replays raw history through a fresh engine and replaces the trips and
+    # geofence events previously stored for the window.
+    engine = TripEngine(geofences)
+    query = db.query(
+        VehicleTelemetry.vehicle_id,
+        VehicleTelemetry.recorded_at,
+        VehicleTelemetry.latitude,
+        VehicleTelemetry.longitude,
+        VehicleTelemetry.speed,
+    ).filter(
+        VehicleTelemetry.recorded_at >= start, VehicleTelemetry.recorded_at < end
+    )
+    if vehicle_id is not None:
+        query = query.filter(VehicleTelemetry.vehicle_id == vehicle_id)
+    query = query.order_by(VehicleTelemetry.vehicle_id, VehicleTelemetry.recorded_at)
+    processed = 0
+    for row in query.yield_per(batch_size):
+        engine.process(
+            row.vehicle_id, row.recorded_at, row.latitude, row.longitude, row.speed
+        )
+        processed += 1
+    # Trips still open at the end of the window are left to the live engine
+    engine.close_stale(end)
+
+    trips_query = db.query(Trip).filter(
+        Trip.started_at >= start, Trip.started_at < end
+    )
+    events_query = db.query(GeofenceEvent).filter(
+        GeofenceEvent.occurred_at >= start, GeofenceEvent.occurred_at < end
+    )
+    if vehicle_id is not None:
+        trips_query = trips_query.filter(Trip.vehicle_id == vehicle_id)
+        events_query = events_query.filter(GeofenceEvent.vehicle_id == vehicle_id)
+    trips_query.delete(synchronize_session=False)
+    events_query.delete(synchronize_session=False)
+    trips, events = engine.drain()
+    db.bulk_insert_mappings(Trip, trips)
+    db.bulk_insert_mappings(GeofenceEvent, events)
+    logging.info(
+        f"Trip backfill {start} - {end}: {processed} points, "
+        f"{len(trips)} trips, {len(events)} geofence events"
+    )
+    return {"points": processed, "trips": len(trips), "geofence_events": len(events)}
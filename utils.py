@@ -1,16 +1,30 @@
+from functools import lru_cache
+import os
+
 from jose import jwt
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
 
 SECRET_KEY = "123456789"  # Replace with a secure key
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Trackers are configured once, so their tokens live much longer than a login
+DEVICE_TOKEN_EXPIRE_DAYS = int(os.getenv("DEVICE_TOKEN_EXPIRE_DAYS", "365"))
+
+
+# Built on first use so importing the app does not pay for passlib/bcrypt setup
+@lru_cache(maxsize=None)
+def get_pwd_context():
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def hash_password(password):
+    return get_pwd_context().hash(password)
 
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):